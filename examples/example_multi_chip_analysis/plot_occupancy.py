@@ -10,10 +10,11 @@ def draw_hit_map_from_raw_data(raw_data_file, front_ends):
     with PdfPages(raw_data_file[:-3] + '.pdf') as output_pdf:
         with tb.open_file(raw_data_file, 'r') as in_file_h5:
             raw_data = in_file_h5.root.raw_data[:]
+            channel_raw_data = readout_utils.demultiplex_data(raw_data, channels=[4 - front_end for front_end in range(front_ends)])  # split data only once
             for front_end in range(front_ends):
                 print 'Create occupancy hist of front end %d' % front_end
-                occupancy_array, _, _ = np.histogram2d(*readout_utils.convert_data_array(raw_data,
-                                                                                         filter_func=readout_utils.logical_and(readout_utils.is_data_record, readout_utils.is_data_from_channel(4 - front_end)),
+                occupancy_array, _, _ = np.histogram2d(*readout_utils.convert_data_array(channel_raw_data[4 - front_end],
+                                                                                         filter_func=readout_utils.logical_and(readout_utils.is_fe_word, readout_utils.is_data_record),
                                                                                          converter_func=readout_utils.get_col_row_array_from_data_record_array), bins=(80, 336), range=[[1, 80], [1, 336]])
                 plotting.plot_three_way(hist=occupancy_array.T, title="Occupancy of chip %d" % front_end, x_axis_title="Occupancy", filename=output_pdf)
 
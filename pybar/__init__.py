@@ -1,4 +1,8 @@
-from pybar.run_manager import RunManager, run_status
-from pybar.scans import *
+import sys
 
-__all__ = ["RunManager", "run_status", "HitOrCalibration", "create_hitor_calibration",  "PlsrDacTransientCalibration", "PlsrDacTransientCalibrationAdvanced", "PlsrDacCalibration", "plot_pulser_dac", "PulserDacCorrectionCalibration", "ThresholdCalibration", "create_threshold_calibration", "TotCalibration", "AnalogScan", "CrosstalkScan", "DigitalScan", "ExtTriggerGdacScan", "StopModeExtTriggerScan", "ExtTriggerScan", "FEI4SelfTriggerScan", "HitDelayScan", "IleakScan", "InitScan", "IVScan", "FastThresholdScan", "ThresholdScan", "RegisterTest", "TdcTest", "FdacTuning", "FeedbackTuning", "Fei4Tuning", "GdacTuning", "HotPixelTuning", "MergedPixelsTuning", "NoiseOccupancyScan", "StuckPixelScan", "TdacTuning", "ThresholdBaselineTuning", "TluTuning"]
+from pybar.run_manager import RunManager, MultiRunManager, run_status
+from pybar.scans import ScanRegistryModule
+
+__all__ = ["RunManager", "MultiRunManager", "run_status", "HitOrCalibration", "create_hitor_calibration",  "PlsrDacTransientCalibration", "PlsrDacTransientCalibrationAdvanced", "PlsrDacCalibration", "plot_pulser_dac", "PulserDacCorrectionCalibration", "ThresholdCalibration", "create_threshold_calibration", "TotCalibration", "AnalogScan", "CrosstalkScan", "DigitalScan", "ExtTriggerGdacScan", "StopModeExtTriggerScan", "ExtTriggerScan", "FEI4SelfTriggerScan", "HitDelayScan", "IleakScan", "InitScan", "IVScan", "FastThresholdScan", "ThresholdScan", "RegisterTest", "TdcTest", "FdacTuning", "FeedbackTuning", "Fei4Tuning", "GdacTuning", "HotPixelTuning", "MergedPixelsTuning", "NoiseOccupancyScan", "StuckPixelScan", "TdacTuning", "ThresholdBaselineTuning", "TluTuning"]
+
+sys.modules[__name__] = ScanRegistryModule(sys.modules[__name__])  # scans are imported on first use
@@ -538,5 +538,82 @@ def analyze_hits_per_scan_parameter(analyze_data, scan_parameters=None, chunk_si
     if opened_file:
         in_hit_file_h5.close()
 
+
+def merge_m26_telescope_hits(input_file_hits, input_file_m26_hits, output_file_hits, trigger_number_range=None, chunk_size=1000000):
+    ''' Merges the FE-I4 hits and the Mimosa26 hits of a telescope run (see M26TelescopeScan) at the trigger number and stores the merged events into a new hit table.
+    The hit tables are read in chunks and merged with a sorted merge-join, only the hits with a trigger number larger than the last trigger number of both chunks
+    are kept for the next chunk. Only triggers with hits in both tables are taken.
+
+    Parameters
+    ----------
+    input_file_hits: str
+        the input file name with the FE-I4 hits (Hits table)
+    input_file_m26_hits: str
+        the input file name with the Mimosa26 hits (Hits table with the fields trigger_number, plane, column and row)
+    output_file_hits: str
+        the output file name for the merged hits (see analysis_utils.telescope_hit_dtype)
+    trigger_number_range: int
+        range of the trigger counter (e.g. 2**15 for the TLU trigger number), if given, the trigger numbers are unwrapped. If None, the trigger numbers have to be increasing.
+    chunk_size: int
+        number of hits of each table read at once
+
+    Returns
+    -------
+    Number of merged events.
+    '''
+    logging.info('Merge FE-I4 hits from ' + str(input_file_hits) + ' and Mimosa26 hits from ' + str(input_file_m26_hits) + ' into ' + str(output_file_hits))
+    with tb.open_file(input_file_hits, mode="r") as in_hit_file_h5:
+        with tb.open_file(input_file_m26_hits, mode="r") as in_m26_hit_file_h5:
+            with tb.open_file(output_file_hits, mode="w") as out_hit_file_h5:
+                hit_table_out = out_hit_file_h5.create_table(out_hit_file_h5.root, name='Hits', description=analysis_utils.telescope_hit_dtype, title='Telescope hits', filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                streams = []
+                for hit_table in (in_hit_file_h5.root.Hits, in_m26_hit_file_h5.root.Hits):
+                    streams.append({'table': hit_table, 'index': 0, 'offset': 0, 'last_trigger_number': None, 'hits': hit_table.read(0, 0), 'trigger_number': np.zeros(shape=(0,), dtype=np.int64)})
+
+                def read_chunk(stream):
+                    hits = stream['table'].read(stream['index'], stream['index'] + chunk_size)
+                    stream['index'] += hits.shape[0]
+                    if trigger_number_range:
+                        trigger_number, stream['offset'], stream['last_trigger_number'] = analysis_utils.unwrap_trigger_number(hits['trigger_number'], trigger_number_range, stream['offset'], stream['last_trigger_number'])
+                    else:
+                        trigger_number = hits['trigger_number'].astype(np.int64)
+                    if np.any(np.diff(np.concatenate([stream['trigger_number'][-1:], trigger_number])) < 0):
+                        raise analysis_utils.InvalidInputError('Trigger numbers of %s are not increasing, set trigger_number_range to unwrap the trigger numbers' % stream['table']._v_file.filename)
+                    stream['hits'] = np.concatenate([stream['hits'], hits])
+                    stream['trigger_number'] = np.concatenate([stream['trigger_number'], trigger_number])
+
+                def exhausted(stream):
+                    return stream['index'] >= stream['table'].shape[0]
+
+                n_events = 0
+                progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', analysis_utils.ETA()], maxval=streams[0]['table'].shape[0], term_width=80)
+                progress_bar.start()
+                limiting_streams = streams
+                while True:
+                    for stream in limiting_streams:  # only read the streams which limit the merging, so that the buffer of the other stream is not growing
+                        if not exhausted(stream):
+                            read_chunk(stream)
+                    if any(exhausted(stream) and stream['trigger_number'].shape[0] == 0 for stream in streams):
+                        break  # no more matching triggers
+                    # the hits with a trigger number below the last trigger number of each chunk are complete
+                    last_trigger_numbers = [np.inf if exhausted(stream) else stream['trigger_number'][-1] for stream in streams]
+                    stop_trigger_number = min(last_trigger_numbers)
+                    stop_index = [np.searchsorted(stream['trigger_number'], stop_trigger_number, side='left') if np.isfinite(stop_trigger_number) else stream['trigger_number'].shape[0] for stream in streams]
+                    merged_hits, n_merged_events = analysis_utils.merge_hits_at_trigger_number(streams[0]['hits'][:stop_index[0]], streams[1]['hits'][:stop_index[1]], fe_trigger_number=streams[0]['trigger_number'][:stop_index[0]], m26_trigger_number=streams[1]['trigger_number'][:stop_index[1]], event_number_offset=n_events)
+                    hit_table_out.append(merged_hits)
+                    n_events += n_merged_events
+                    for index, stream in enumerate(streams):
+                        stream['hits'] = stream['hits'][stop_index[index]:]
+                        stream['trigger_number'] = stream['trigger_number'][stop_index[index]:]
+                    if not np.isfinite(stop_trigger_number):
+                        break  # all hits merged
+                    limiting_streams = [stream for stream, last_trigger_number in zip(streams, last_trigger_numbers) if last_trigger_number == stop_trigger_number]
+                    progress_bar.update(streams[0]['index'])
+                progress_bar.finish()
+                hit_table_out.flush()
+    logging.info('Merged %d events', n_events)
+    return n_events
+
+
 if __name__ == "__main__":
     print 'run analysis as main'
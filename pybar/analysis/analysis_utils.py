@@ -14,16 +14,16 @@ import numpy as np
 import tables as tb
 from tables import dtype_from_descr
 import numexpr as ne
-from scipy.interpolate import interp1d
-from scipy.interpolate import splrep, splev
 
 import progressbar
 
 from pybar_fei4_interpreter import analysis_utils
 from pybar.daq.fei4_record import FEI4Record
-from pybar.analysis.plotting import plotting
+from pybar.utils.utils import LazyModule
 from pybar.daq.readout_utils import is_fe_word, is_data_header, is_trigger_word, logical_and
 
+plotting = LazyModule('pybar.analysis.plotting.plotting')  # importing Matplotlib on first use
+
 
 class AnalysisError(Exception):
 
@@ -640,6 +640,7 @@ def smooth_differentiation(x, y, weigths=None, order=5, smoothness=3, derivation
     '''
     if (len(x) != len(y)):
         raise ValueError("x, y must have the same length")
+    from scipy.interpolate import splrep, splev
     f = splrep(x, y, w=weigths, k=order, s=smoothness)  # spline function
     return splev(x, f, der=derivation)
 
@@ -1322,6 +1323,87 @@ def data_aligned_at_events(table, start_event_number=None, stop_event_number=Non
             current_start_index = current_start_index + nrows + chunk_start_index  # events fully read, increase start index and continue reading
 
 
+telescope_hit_dtype = np.dtype([('event_number', '<i8'), ('trigger_number', '<i8'), ('plane', 'u1'), ('column', '<u2'), ('row', '<u2'), ('tot', 'u1')])  # plane 0: FE-I4, planes 1 to 6: Mimosa26, tot is 0 for Mimosa26 hits
+
+
+def unwrap_trigger_number(trigger_number, trigger_number_range, offset=0, last_trigger_number=None):
+    '''Unwrapping the trigger numbers of a trigger counter with limited range (e.g. 15-bit TLU trigger number), so that the trigger numbers are increasing.
+
+    A decrease of the trigger number by more than half of the range is taken as counter overflow, an increase by more than half of the range
+    as a trigger number from before the overflow (e.g. out of order). The function can be used in chunks by passing the returned offset
+    and last trigger number to the next call.
+
+    Parameters
+    ----------
+    trigger_number : array
+        Trigger numbers.
+    trigger_number_range : int
+        Range of the trigger counter (maximum trigger number + 1).
+    offset : int
+        Offset from the previous chunk.
+    last_trigger_number : int
+        Last trigger number of the previous chunk.
+
+    Returns
+    -------
+    Tuple of unwrapped trigger numbers, offset and last trigger number for the next chunk.
+    '''
+    trigger_number = np.asarray(trigger_number).astype(np.int64)
+    if trigger_number.shape[0] == 0:
+        return trigger_number, offset, last_trigger_number
+    previous_trigger_number = np.empty_like(trigger_number)
+    previous_trigger_number[0] = trigger_number[0] if last_trigger_number is None else last_trigger_number
+    previous_trigger_number[1:] = trigger_number[:-1]
+    difference = trigger_number - previous_trigger_number
+    overflows = np.cumsum((difference < -(trigger_number_range // 2)).astype(np.int64) - (difference > trigger_number_range // 2)) * trigger_number_range
+    return trigger_number + offset + overflows, offset + overflows[-1], trigger_number[-1]
+
+
+def merge_hits_at_trigger_number(fe_hits, m26_hits, fe_trigger_number=None, m26_trigger_number=None, event_number_offset=0):
+    '''Merging FE-I4 hits and Mimosa26 hits with the same trigger number (sorted merge-join).
+
+    Only triggers with hits in both arrays are taken. The hits of each trigger are merged into one event, the FE-I4 hits first.
+
+    Parameters
+    ----------
+    fe_hits : structured array
+        FE-I4 hits (fields trigger_number, column, row and tot), sorted by trigger number.
+    m26_hits : structured array
+        Mimosa26 hits (fields trigger_number, plane, column and row), sorted by trigger number.
+    fe_trigger_number, m26_trigger_number : array
+        Trigger numbers of the hits (e.g. unwrapped trigger numbers). If None, the trigger_number field is used.
+    event_number_offset : int
+        Event number of the first merged event.
+
+    Returns
+    -------
+    Tuple of merged hits (see telescope_hit_dtype) and number of merged events.
+    '''
+    fe_trigger_number = (fe_hits['trigger_number'] if fe_trigger_number is None else fe_trigger_number).astype(np.int64)
+    m26_trigger_number = (m26_hits['trigger_number'] if m26_trigger_number is None else m26_trigger_number).astype(np.int64)
+    trigger_numbers = np.intersect1d(fe_trigger_number, m26_trigger_number)
+    if trigger_numbers.shape[0] == 0:
+        return np.zeros(shape=(0,), dtype=telescope_hit_dtype), 0
+    fe_selection = in1d_sorted(fe_trigger_number, trigger_numbers)
+    fe_hits, fe_trigger_number = fe_hits[fe_selection], fe_trigger_number[fe_selection]
+    m26_selection = in1d_sorted(m26_trigger_number, trigger_numbers)
+    m26_hits, m26_trigger_number = m26_hits[m26_selection], m26_trigger_number[m26_selection]
+    # positions of both sorted arrays in the merged array
+    fe_index = np.searchsorted(m26_trigger_number, fe_trigger_number, side='left') + np.arange(fe_trigger_number.shape[0])
+    m26_index = np.searchsorted(fe_trigger_number, m26_trigger_number, side='right') + np.arange(m26_trigger_number.shape[0])
+    merged_hits = np.zeros(shape=(fe_trigger_number.shape[0] + m26_trigger_number.shape[0],), dtype=telescope_hit_dtype)
+    merged_hits['trigger_number'][fe_index] = fe_trigger_number
+    merged_hits['column'][fe_index] = fe_hits['column']
+    merged_hits['row'][fe_index] = fe_hits['row']
+    merged_hits['tot'][fe_index] = fe_hits['tot']
+    merged_hits['trigger_number'][m26_index] = m26_trigger_number
+    merged_hits['plane'][m26_index] = m26_hits['plane']
+    merged_hits['column'][m26_index] = m26_hits['column']
+    merged_hits['row'][m26_index] = m26_hits['row']
+    merged_hits['event_number'] = event_number_offset + np.searchsorted(trigger_numbers, merged_hits['trigger_number'])
+    return merged_hits, trigger_numbers.shape[0]
+
+
 def select_good_pixel_region(hits, col_span, row_span, min_cut_threshold=0.2, max_cut_threshold=2.0):
     '''Takes the hit array and masks all pixels with a certain occupancy.
 
@@ -1383,6 +1465,7 @@ def get_hit_rate_correction(gdacs, calibration_gdacs, cluster_size_histogram):
     calibration_gdacs_sorted = np.array(calibration_gdacs)
     correction_factor_sorted = correction_factor[np.argsort(calibration_gdacs_sorted)]
     calibration_gdacs_sorted = np.sort(calibration_gdacs_sorted)
+    from scipy.interpolate import interp1d
     interpolation = interp1d(calibration_gdacs_sorted.tolist(), correction_factor_sorted.tolist(), kind='cubic', bounds_error=True)
     return interpolation(gdacs)
 
@@ -1403,6 +1486,7 @@ def get_mean_threshold_from_calibration(gdac, mean_threshold_calibration):
     numpy.array, shape=(len(gdac), )
         The mean threshold values at each value in gdacs.
     '''
+    from scipy.interpolate import interp1d
     interpolation = interp1d(mean_threshold_calibration['parameter_value'], mean_threshold_calibration['mean_threshold'], kind='slinear', bounds_error=True)
     return interpolation(gdac)
 
@@ -1426,6 +1510,7 @@ def get_pixel_thresholds_from_calibration_array(gdacs, calibration_gdacs, thresh
     '''
     if len(calibration_gdacs) != threshold_calibration_array.shape[2]:
         raise ValueError('Length of the provided pixel GDACs does not match the third dimension of the calibration array')
+    from scipy.interpolate import interp1d
     interpolation = interp1d(x=calibration_gdacs, y=threshold_calibration_array, kind='slinear', bounds_error=bounds_error)
     return interpolation(gdacs)
 
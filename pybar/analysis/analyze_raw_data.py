@@ -10,30 +10,29 @@ from functools import partial
 import tables as tb
 from tables import dtype_from_descr, Col
 import numpy as np
-from scipy.optimize import curve_fit, OptimizeWarning
-from scipy.special import erf
-from matplotlib.backends.backend_pdf import PdfPages
 
 import progressbar
 
-from pixel_clusterizer.clusterizer import HitClusterizer
-
 from pybar_fei4_interpreter.data_interpreter import PyDataInterpreter
 from pybar_fei4_interpreter.data_histograming import PyDataHistograming
 from pybar_fei4_interpreter import data_struct
 from pybar_fei4_interpreter import analysis_utils as fast_analysis_utils
 
 from pybar.analysis import analysis_utils
-from pybar.analysis.plotting import plotting
+from pybar.utils.utils import LazyModule
 from pybar.analysis.analysis_utils import check_bad_data, fix_raw_data, consecutive
 from pybar.daq.readout_utils import is_fe_word, is_data_header, is_trigger_word, logical_and
 
+plotting = LazyModule('pybar.analysis.plotting.plotting')  # importing Matplotlib on first use
+special = LazyModule('scipy.special')  # importing SciPy on first use
+optimize = LazyModule('scipy.optimize')
+
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - [%(levelname)-8s] (%(threadName)-10s) %(message)s")
 
 
 def scurve(x, A, mu, sigma):
-    return 0.5 * A * erf((x - mu) / (np.sqrt(2) * sigma)) + 0.5 * A
+    return 0.5 * A * special.erf((x - mu) / (np.sqrt(2) * sigma)) + 0.5 * A
 
 
 def fit_scurve(scurve_data, PlsrDAC):  # data of some pixels to fit, has to be global for the multiprocessing module
@@ -44,7 +43,7 @@ def fit_scurve(scurve_data, PlsrDAC):  # data of some pixels to fit, has to be g
         popt = [0, 0, 0]
     else:
         try:
-            popt, _ = curve_fit(scurve, PlsrDAC, scurve_data, p0=[max_occ, threshold, 2.5], check_finite=False)
+            popt, _ = optimize.curve_fit(scurve, PlsrDAC, scurve_data, p0=[max_occ, threshold, 2.5], check_finite=False)
         except RuntimeError:  # fit failed
             popt = [0, 0, 0]
     if popt[1] < 0:  # threshold < 0 rarely happens if fit does not work
@@ -130,6 +129,7 @@ class AnalyzeRawData(object):
             else:
                 output_pdf_filename = os.path.splitext(raw_data_file)[0] + ".pdf"
             logging.info('Opening output PDF file: %s', output_pdf_filename)
+            from matplotlib.backends.backend_pdf import PdfPages
             self.output_pdf = PdfPages(output_pdf_filename)
         else:
             self.output_pdf = None
@@ -143,9 +143,11 @@ class AnalyzeRawData(object):
         del self.interpreter
         del self.histogram
         del self.clusterizer
-        if self.output_pdf is not None and isinstance(self.output_pdf, PdfPages):
-            logging.info('Closing output PDF file: %s', str(self.output_pdf._file.fh.name))
-            self.output_pdf.close()
+        if self.output_pdf is not None:
+            from matplotlib.backends.backend_pdf import PdfPages
+            if isinstance(self.output_pdf, PdfPages):
+                logging.info('Closing output PDF file: %s', str(self.output_pdf._file.fh.name))
+                self.output_pdf.close()
         if self.is_open(self.out_file_h5):
             self.out_file_h5.close()
 
@@ -202,6 +204,7 @@ class AnalyzeRawData(object):
                                   ('event_status', '<u2')])
 
         # Initialize clusterizer with custom hit/cluster fields
+        from pixel_clusterizer.clusterizer import HitClusterizer
         self.clusterizer = HitClusterizer(
             hit_fields=hit_fields,
             hit_dtype=hit_dtype,
@@ -236,8 +239,9 @@ class AnalyzeRawData(object):
         self.c_low, self.c_mid, self.c_high = None, None, None
         self.c_low_mask, self.c_high_mask = None, None
         self._filter_table = tb.Filters(complib='blosc', complevel=5, fletcher32=False)
-        warnings.simplefilter("ignore", OptimizeWarning)
+        warnings.simplefilter("ignore", optimize.OptimizeWarning)
         self.meta_event_index = None
+        self.occupancy_fill_mask = None  # boolean array (row, column, scan parameter), occupancy is set to n_injections (pixels which were not injected, see AdaptiveInjectionMask)
         self.fei4b = False
         self.create_hit_table = False
         self.create_empty_event_hits = False
@@ -951,6 +955,11 @@ class AnalyzeRawData(object):
                     rel_bcid_hist_table[:] = self.rel_bcid_hist
         if self._create_occupancy_hist:
             self.occupancy_array = np.swapaxes(self.histogram.get_occupancy(), 0, 1)  # swap axis col,row, parameter --> row, col, parameter
+            if self.occupancy_fill_mask is not None:
+                if self.occupancy_fill_mask.shape == self.occupancy_array.shape:
+                    self.occupancy_array = np.where(self.occupancy_fill_mask, self._n_injection, self.occupancy_array).astype(self.occupancy_array.dtype)
+                else:
+                    logging.warning('Occupancy fill mask shape %s does not match occupancy histogram shape %s', str(self.occupancy_fill_mask.shape), str(self.occupancy_array.shape))
             if self._analyzed_data_file is not None and safe_to_file:
                 occupancy_array_table = self.out_file_h5.create_carray(self.out_file_h5.root, name='HistOcc', title='Occupancy Histogram', atom=tb.Atom.from_dtype(self.occupancy_array.dtype), shape=self.occupancy_array.shape, filters=self._filter_table)
                 occupancy_array_table[0:336, 0:80, 0:self.histogram.get_n_parameters()] = self.occupancy_array
@@ -1163,6 +1172,7 @@ class AnalyzeRawData(object):
             else:
                 output_pdf_filename = pdf_filename
             logging.info('Opening output PDF file: %s', output_pdf_filename)
+            from matplotlib.backends.backend_pdf import PdfPages
             output_pdf = PdfPages(output_pdf_filename)
         else:
             output_pdf = self.output_pdf
@@ -5,11 +5,17 @@ import os.path
 from os import remove
 from operator import itemgetter
 
+import numpy as np
 import tables as tb
 import zmq
+try:
+    import blosc
+except ImportError:
+    blosc = None
 
 from pybar_fei4_interpreter.data_struct import MetaTableV2 as MetaTable, generate_scan_parameter_description
-from pybar.daq.readout_utils import save_configuration_dict
+from pybar.daq.readout_utils import save_configuration_dict, demultiplex_data
+from pybar.daq.raw_data_replay import read_raw_data_file
 
 
 def send_meta_data(socket, conf, name):
@@ -25,8 +31,13 @@ def send_meta_data(socket, conf, name):
         pass
 
 
-def send_data(socket, data, scan_parameters={}, name='ReadoutData'):
+def send_data(socket, data, scan_parameters={}, name='ReadoutData', sequence=None, compression=None, channel=None, channels=None):
     '''Sends the data of every read out (raw data and meta data) via ZeroMQ to a specified socket
+
+    The sequence number (if given) allows the subscribers to detect lost messages (see SequenceCounter).
+    If compression is 'blosc', the raw data is compressed with blosc (see get_data_from_message()).
+    If channel is given, the raw data contains only the data of this channel (see demultiplex_data()).
+    If channels is given, the data of these channels is also sent in separate messages (see is_message_for_channel()).
     '''
     if not scan_parameters:
         scan_parameters = {}
@@ -39,14 +50,135 @@ def send_data(socket, data, scan_parameters={}, name='ReadoutData'):
         readout_error=data[3],  # int
         scan_parameters=scan_parameters  # dict
     )
+    if sequence is not None:
+        data_meta_data['sequence'] = sequence
+    if channel is not None:
+        data_meta_data['channel'] = channel
+    if channels:
+        data_meta_data['channels'] = channels
+    if compression == 'blosc':
+        raw_data = np.ascontiguousarray(data[0])
+        payload = blosc.compress_ptr(raw_data.__array_interface__['data'][0], raw_data.size, typesize=raw_data.dtype.itemsize, clevel=5, shuffle=blosc.SHUFFLE, cname='lz4')
+        data_meta_data['compression'] = 'blosc'
+    else:
+        payload = data[0]
     try:
         socket.send_json(data_meta_data, flags=zmq.SNDMORE | zmq.NOBLOCK)
-        socket.send(data[0], flags=zmq.NOBLOCK)  # PyZMQ supports sending numpy arrays without copying any data
+        socket.send(payload, flags=zmq.NOBLOCK, copy=False)  # PyZMQ supports sending numpy arrays without copying any data
     except zmq.Again:
         pass
 
 
-def open_raw_data_file(filename, mode="w", title="", register=None, conf=None, run_conf=None, scan_parameters=None, context=None, socket_address=None):
+def get_data_from_message(meta_data, data):
+    '''Returns the raw data array from the meta data and data received from send_data().
+    '''
+    if meta_data.get('compression') == 'blosc':
+        data = blosc.decompress(bytes(data))
+    return np.frombuffer(buffer(data), dtype=meta_data['dtype']).reshape(meta_data['shape'])
+
+
+def is_message_for_channel(meta_data, channel=None):
+    '''Returns whether a raw data message is used by a subscriber of the given channel (None: all channels).
+
+    If the publisher sends the data of each channel separately, it also sends the complete raw data (see DataPublisher). The trigger and TDC words are
+    contained in each message, so a subscriber must take either the complete raw data or the messages of a single channel to not count them twice.
+    A subscriber of a channel takes the message of its channel if available and the complete raw data otherwise (the raw data has to be filtered, see is_data_from_channel()).
+    '''
+    if 'channel' in meta_data:
+        return channel is not None and meta_data['channel'] == channel
+    return channel is None or channel not in meta_data.get('channels', ())
+
+
+class SequenceCounter(object):
+    '''Counting lost messages from the sequence numbers of the received messages (see send_data()). The sequence numbers of each channel are counted separately.
+    '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.sequences = {}
+        self.n_received = 0
+        self.n_lost = 0
+
+    def update(self, meta_data):
+        '''Updating counters with the meta data of a received message.
+
+        Returns:
+        Number of messages lost since the previous message.
+        '''
+        self.n_received += 1
+        sequence = meta_data.get('sequence')
+        if sequence is None:
+            return 0
+        channel = meta_data.get('channel')
+        last_sequence = self.sequences.get(channel)
+        if last_sequence is None or sequence <= last_sequence:  # first message or publisher restarted
+            n_lost = 0
+        else:
+            n_lost = sequence - last_sequence - 1
+        self.sequences[channel] = sequence
+        self.n_lost += n_lost
+        return n_lost
+
+
+class DataPublisher(object):
+    '''Publishing raw data and meta data via ZeroMQ.
+
+    Each raw data message is numbered, so that the subscribers can count lost messages (see SequenceCounter). When the high water mark of a subscriber
+    is reached, the PUB socket drops the message for this subscriber without blocking the data taking.
+
+    Parameters:
+    socket_address : string
+        Address of the PUB socket (bind).
+    context : zmq.Context
+        ZeroMQ context. If None, a new context is created.
+    hwm : int
+        Send high water mark (max. number of queued messages per subscriber). If None, the ZeroMQ default is used.
+    compression : string
+        Compression of the raw data. Either None or 'blosc' (needs python-blosc).
+    channels : iterable
+        If given, the raw data is demultiplexed and the data of each channel is sent in a separate message (see demultiplex_data()) in addition to the complete raw data.
+        Subscribers can select the messages of their channel without filtering the raw data (see is_message_for_channel()).
+    '''
+    def __init__(self, socket_address, context=None, hwm=None, compression=None, channels=None):
+        if compression not in (None, 'blosc'):
+            raise ValueError('Unknown compression: %s' % compression)
+        if compression == 'blosc' and blosc is None:
+            logging.warning('python-blosc not available, sending uncompressed data')
+            compression = None
+        if not context:
+            logging.info('Creating ZMQ context')
+            context = zmq.Context()
+        logging.info('Creating socket connection to server %s', socket_address)
+        self.socket = context.socket(zmq.PUB)  # publisher socket
+        if hwm is not None:
+            self.socket.setsockopt(zmq.SNDHWM, hwm)
+        self.socket.bind(socket_address)
+        self.compression = compression
+        self.channels = list(channels) if channels else None
+        self.sequences = {}
+
+    def send_meta_data(self, conf, name):
+        send_meta_data(self.socket, conf, name)
+
+    def send_data(self, data, scan_parameters=None):
+        if self.channels:
+            channel_data = demultiplex_data(data[0], self.channels)
+            for channel in self.channels:
+                self.send_channel_data((channel_data[channel],) + tuple(data[1:]), scan_parameters, channel=channel)
+        self.send_channel_data(data, scan_parameters, channels=self.channels)  # complete raw data
+
+    def send_channel_data(self, data, scan_parameters=None, channel=None, channels=None):
+        sequence = self.sequences.get(channel, 0)
+        send_data(self.socket, data, scan_parameters, sequence=sequence, compression=self.compression, channel=channel, channels=channels)
+        self.sequences[channel] = sequence + 1
+
+    def close(self):
+        logging.info('Closing socket connection')
+        self.socket.close()  # close here, do not wait for garbage collector
+
+
+def open_raw_data_file(filename, mode="w", title="", register=None, conf=None, run_conf=None, scan_parameters=None, context=None, socket_address=None, socket_hwm=None, socket_compression=None, socket_channels=None):
     '''Mimics pytables.open_file() and stores the configuration and run configuration
 
     Returns:
@@ -57,7 +189,7 @@ def open_raw_data_file(filename, mode="w", title="", register=None, conf=None, r
         # do something here
         raw_data_file.append(self.readout.data, scan_parameters={scan_parameter:scan_parameter_value})
     '''
-    return RawDataFile(filename=filename, mode=mode, title=title, register=register, conf=conf, run_conf=run_conf, scan_parameters=scan_parameters, context=context, socket_address=socket_address)
+    return RawDataFile(filename=filename, mode=mode, title=title, register=register, conf=conf, run_conf=run_conf, scan_parameters=scan_parameters, context=context, socket_address=socket_address, socket_hwm=socket_hwm, socket_compression=socket_compression, socket_channels=socket_channels)
 
 
 class RawDataFile(object):
@@ -67,7 +199,7 @@ class RawDataFile(object):
     '''Raw data file object. Saving data queue to HDF5 file.
     '''
 
-    def __init__(self, filename, mode="w", title='', register=None, conf=None, run_conf=None, scan_parameters=None, context=None, socket_address=None):  # mode="r+" to append data, raw_data_file_h5 must exist, "w" to overwrite raw_data_file_h5, "a" to append data, if raw_data_file_h5 does not exist it is created):
+    def __init__(self, filename, mode="w", title='', register=None, conf=None, run_conf=None, scan_parameters=None, context=None, socket_address=None, socket_hwm=None, socket_compression=None, socket_channels=None):  # mode="r+" to append data, raw_data_file_h5 must exist, "w" to overwrite raw_data_file_h5, "a" to append data, if raw_data_file_h5 does not exist it is created):
         self.lock = RLock()
         if os.path.splitext(filename)[1].strip().lower() != '.h5':
             self.base_filename = filename
@@ -84,17 +216,11 @@ class RawDataFile(object):
         self.scan_param_table = None
         self.h5_file = None
 
-        if socket_address and not context:
-            logging.info('Creating ZMQ context')
-            context = zmq.Context()
-
-        if socket_address and context:
-            logging.info('Creating socket connection to server %s', socket_address)
-            self.socket = context.socket(zmq.PUB)  # publisher socket
-            self.socket.bind(socket_address)
-            send_meta_data(self.socket, None, name='Reset')  # send reset to indicate a new scan
+        if socket_address:
+            self.publisher = DataPublisher(socket_address=socket_address, context=context, hwm=socket_hwm, compression=socket_compression, channels=socket_channels)
+            self.publisher.send_meta_data(None, name='Reset')  # send reset to indicate a new scan
         else:
-            self.socket = None
+            self.publisher = None
 
         if mode and mode[0] == 'w':
             h5_files = glob.glob(os.path.splitext(filename)[0] + '*.h5')
@@ -109,17 +235,17 @@ class RawDataFile(object):
 
         if register is not None:
             register.save_configuration(self.h5_file)
-            if self.socket:
+            if self.publisher:
                 global_register_config = {}
                 for global_reg in sorted(register.get_global_register_objects(readonly=False), key=itemgetter('name')):
                     global_register_config[global_reg['name']] = global_reg['value']
-                send_meta_data(self.socket, global_register_config, name='GlobalRegisterConf')  # send run info
+                self.publisher.send_meta_data(global_register_config, name='GlobalRegisterConf')  # send run info
         if conf is not None:
             save_configuration_dict(self.h5_file, 'conf', conf)
         if run_conf is not None:
             save_configuration_dict(self.h5_file, 'run_conf', run_conf)
-            if self.socket:
-                send_meta_data(self.socket, run_conf, name='RunConf')
+            if self.publisher:
+                self.publisher.send_meta_data(run_conf, name='RunConf')
 
     def __enter__(self):
         return self
@@ -135,8 +261,8 @@ class RawDataFile(object):
             logging.info('Opening existing raw data file: %s', filename)
         else:
             logging.info('Opening new raw data file: %s', filename)
-        if self.socket:
-            send_meta_data(self.socket, os.path.basename(filename), name='Filename')
+        if self.publisher:
+            self.publisher.send_meta_data(os.path.basename(filename), name='Filename')
 
         filter_raw_data = tb.Filters(complib='blosc', complevel=5, fletcher32=False)
         filter_tables = tb.Filters(complib='zlib', complevel=5, fletcher32=False)
@@ -162,10 +288,9 @@ class RawDataFile(object):
             logging.info('Closing raw data file: %s', self.h5_file.filename)
             self.h5_file.close()
             self.h5_file = None
-        if self.socket and close_socket:
-            logging.info('Closing socket connection')
-            self.socket.close()  # close here, do not wait for garbage collector
-            self.socket = None
+        if self.publisher and close_socket:
+            self.publisher.close()
+            self.publisher = None
 
     def append_item(self, data_tuple, scan_parameters=None, new_file=False, flush=True):
         with self.lock:
@@ -222,8 +347,8 @@ class RawDataFile(object):
                 self.scan_param_table.row.append()
             if flush:
                 self.flush()
-            if self.socket:
-                send_data(self.socket, data_tuple, self.scan_parameters)
+            if self.publisher:
+                self.publisher.send_data(data_tuple, self.scan_parameters)
 
     def append(self, data_iterable, scan_parameters=None, flush=True):
         with self.lock:
@@ -240,6 +365,56 @@ class RawDataFile(object):
                 self.scan_param_table.flush()
 
 
+def demultiplex_raw_data_file(filename, channels, registers=None, conf=None, run_conf=None, chunk_size=10000):
+    '''Splitting a raw data file into a raw data file for each channel (e.g. for the analysis of each FE of a quad module).
+
+    The data of each readout is demultiplexed (see demultiplex_data()), the timestamps, readout errors and scan parameters are kept.
+    The channel is added to the filename (e.g. 1_module_test_analog_scan_ch4.h5).
+
+    Parameters
+    ----------
+    filename : string
+        Filename of the raw data file.
+    channels : iterable
+        Channel numbers.
+    registers : iterable
+        FE register of each channel, stored in the raw data file of each channel.
+    conf, run_conf : dict
+        Configuration and run configuration, stored in the raw data file of each channel.
+    chunk_size : int
+        Number of readouts which are read at once (see read_raw_data_file()).
+
+    Returns
+    -------
+    Dictionary with channel number as key and filename as value.
+    '''
+    if os.path.splitext(filename)[1].strip().lower() != '.h5':
+        base_filename = filename
+    else:
+        base_filename = os.path.splitext(filename)[0]
+    channels = list(channels)
+    registers = [None] * len(channels) if registers is None else list(registers)
+    with tb.open_file(base_filename + '.h5', mode="r") as in_file_h5:
+        try:
+            scan_parameters = list(in_file_h5.root.scan_parameters.dtype.names)
+        except tb.NoSuchNodeError:
+            scan_parameters = None
+    filenames = dict((channel, base_filename + '_ch%d' % channel) for channel in channels)
+    logging.info('Demultiplexing raw data file %s into channel(s) %s', base_filename + '.h5', ', '.join([str(channel) for channel in channels]))
+    raw_data_files = {}
+    try:
+        for channel, register in zip(channels, registers):
+            raw_data_files[channel] = open_raw_data_file(filename=filenames[channel], mode='w', title=os.path.basename(filenames[channel]), register=register, conf=conf, run_conf=run_conf, scan_parameters=scan_parameters)
+        for data_tuple, scan_parameter_values in read_raw_data_file(base_filename + '.h5', chunk_size=chunk_size):
+            channel_data = demultiplex_data(data_tuple[0], channels)
+            for channel in channels:
+                raw_data_files[channel].append_item((channel_data[channel],) + tuple(data_tuple[1:]), scan_parameters=scan_parameter_values, flush=False)
+    finally:
+        for raw_data_file in raw_data_files.itervalues():
+            raw_data_file.close()
+    return filenames
+
+
 def save_raw_data_from_data_queue(data_queue, filename, mode='a', title='', scan_parameters=None):  # mode="r+" to append data, raw_data_file_h5 must exist, "w" to overwrite raw_data_file_h5, "a" to append data, if raw_data_file_h5 does not exist it is created
     '''Writing raw data file from data queue
 
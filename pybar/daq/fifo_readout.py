@@ -1,6 +1,6 @@
 import logging
 from time import sleep, time
-from threading import Thread, Event
+from threading import Thread, Event, Lock
 from collections import deque
 from Queue import Queue, Empty
 import sys
@@ -8,7 +8,7 @@ import sys
 import numpy as np
 
 from pybar.utils.utils import get_float_time
-from pybar.daq.readout_utils import is_fe_word, is_data_record, is_data_header, logical_or, logical_and
+from pybar.daq.readout_utils import is_fe_word, is_data_record, is_data_header, logical_or, logical_and, demultiplex_data, convert_data_array, get_col_row_array_from_data_record_array
 
 
 data_iterable = ("data", "timestamp_start", "timestamp_stop", "error")
@@ -34,6 +34,140 @@ class StopTimeout(Exception):
     pass
 
 
+class ChannelDemultiplexer(object):
+    '''Demultiplexing the readout data of multiple FEs (e.g. quad modules) into the data of each channel.
+
+    Can be used as callback of the FIFO readout. Each readout is split only once (see demultiplex_data()), the callback is called for each channel
+    with the channel data. Trigger and TDC words are added to the data of each channel.
+
+    Parameters
+    ----------
+    channels : iterable
+        Channel numbers.
+    callback : function
+        Function called with channel number and data tuple (data, timestamp_start, timestamp_stop, error) for each channel.
+    fill_buffer : bool
+        If True, the data of each channel is stored in a buffer (see data).
+    '''
+    def __init__(self, channels, callback=None, fill_buffer=False):
+        self.channels = list(channels)
+        self.callback = callback
+        self.fill_buffer = fill_buffer
+        self.data = dict((channel, deque()) for channel in self.channels)
+
+    def __call__(self, data_tuple):
+        channel_data = demultiplex_data(data_tuple[0], self.channels)
+        for channel in self.channels:
+            channel_data_tuple = (channel_data[channel],) + tuple(data_tuple[1:])
+            if self.fill_buffer:
+                self.data[channel].append(channel_data_tuple)
+            if self.callback:
+                self.callback(channel, channel_data_tuple)
+
+    def clear_buffer(self):
+        for channel in self.channels:
+            self.data[channel].clear()
+
+
+class OccupancyHistogram(object):
+    '''Online histogramming of the pixel occupancy for each scan parameter value.
+
+    Can be used as callback of the FIFO readout. The data records are histogrammed while the data is arriving,
+    the occupancy of each scan parameter value (e.g. the S-curves of a threshold scan) is available right after the readout is stopped.
+
+    Parameters
+    ----------
+    callback : function
+        Function called with data tuple (data, timestamp_start, timestamp_stop, error) for each readout (e.g. handle_data()).
+    shape : tuple
+        Shape of the occupancy histogram (columns, rows).
+    '''
+    def __init__(self, callback=None, shape=(80, 336)):
+        self.callback = callback
+        self.shape = shape
+        self.scan_parameter_value = None  # data is histogrammed for this scan parameter value
+        self.occupancy = {}
+        self.lock = Lock()
+
+    def __call__(self, data_tuple):
+        if self.callback:
+            self.callback(data_tuple)
+        self.fill(data_tuple[0], self.scan_parameter_value)
+
+    def fill(self, data, scan_parameter_value=None):
+        '''Adding data records of raw data array to the occupancy histogram.
+
+        Parameters
+        ----------
+        data : numpy.array
+            Raw data array.
+        scan_parameter_value : int
+            Scan parameter value.
+        '''
+        col, row = convert_data_array(data, filter_func=logical_and(is_fe_word, is_data_record), converter_func=get_col_row_array_from_data_record_array)
+        select = np.logical_and(np.logical_and(col > 0, col <= self.shape[0]), np.logical_and(row > 0, row <= self.shape[1]))  # filter bad data records (e.g. random data)
+        hist = np.bincount((col[select] - 1) * self.shape[1] + (row[select] - 1), minlength=self.shape[0] * self.shape[1]).reshape(self.shape).astype(np.uint32)
+        with self.lock:
+            if scan_parameter_value in self.occupancy:
+                self.occupancy[scan_parameter_value] += hist
+            else:
+                self.occupancy[scan_parameter_value] = hist
+
+    def set_scan_parameter_value(self, scan_parameter_value, clear=True):
+        '''Setting scan parameter value of the following data.
+
+        Parameters
+        ----------
+        scan_parameter_value : int
+            Scan parameter value.
+        clear : bool
+            If True, the occupancy of this scan parameter value is cleared (e.g. scan parameter value is scanned again).
+        '''
+        self.scan_parameter_value = scan_parameter_value
+        if clear:
+            self.clear(scan_parameter_value)
+
+    def clear(self, scan_parameter_value):
+        with self.lock:
+            self.occupancy.pop(scan_parameter_value, None)
+
+    def reset(self):
+        with self.lock:
+            self.occupancy.clear()
+        self.scan_parameter_value = None
+
+    def get_occupancy(self, scan_parameter_value=None):
+        '''Returns the occupancy histogram (columns, rows) of the given scan parameter value.
+        '''
+        with self.lock:
+            if scan_parameter_value in self.occupancy:
+                return self.occupancy[scan_parameter_value].copy()
+        return np.zeros(shape=self.shape, dtype=np.uint32)
+
+    def get_scan_parameter_values(self):
+        with self.lock:
+            return sorted(self.occupancy.iterkeys())
+
+    def get_scurves(self, scan_parameter_values=None):
+        '''Returns the occupancy histograms of all scan parameter values (e.g. S-curves of a threshold scan).
+
+        Parameters
+        ----------
+        scan_parameter_values : iterable
+            Scan parameter values. If None, all scan parameter values in ascending order.
+
+        Returns
+        -------
+        Tuple of scan parameter values and array with the shape (columns, rows, scan parameter values).
+        '''
+        if scan_parameter_values is None:
+            scan_parameter_values = self.get_scan_parameter_values()
+        scurves = np.zeros(shape=self.shape + (len(scan_parameter_values),), dtype=np.uint32)
+        for index, scan_parameter_value in enumerate(scan_parameter_values):
+            scurves[:, :, index] = self.get_occupancy(scan_parameter_value)
+        return list(scan_parameter_values), scurves
+
+
 class FifoReadout(object):
     def __init__(self, dut):
         self.dut = dut
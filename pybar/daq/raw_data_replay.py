@@ -0,0 +1,113 @@
+''' Replaying raw data files.
+
+The readouts are read chunk-wise from the raw data file (using the index_start and index_stop of the meta data), so that files of any size
+can be replayed. The readouts are sent with the original timing (speed=1.0), faster or slower (scaled timing), or as fast as possible (speed=None).
+The achieved throughput is returned, so that the replay can be used as load generator for the online monitor and other subscribers.
+
+Usage
+-----
+publisher = DataPublisher(socket_address='tcp://127.0.0.1:5678')
+throughput = replay_raw_data_file('scan.h5', publisher, speed=2.0)
+print_throughput(throughput)
+publisher.close()
+'''
+import logging
+from time import time, sleep
+
+import numpy as np
+import tables as tb
+import progressbar
+
+
+def read_raw_data_file(filename, chunk_size=10000):
+    '''Reading readouts chunk-wise from raw data file.
+
+    Parameters
+    ----------
+    filename : string
+        Filename of the raw data file.
+    chunk_size : int
+        Number of readouts (meta data rows) which are read at once.
+
+    Returns
+    -------
+    Generator of tuples with data tuple (raw data, timestamp_start, timestamp_stop, error) and scan parameter dictionary (None if no scan parameters).
+    '''
+    with tb.open_file(filename, mode="r") as in_file_h5:
+        meta_data_table = in_file_h5.root.meta_data
+        try:
+            scan_parameter_table = in_file_h5.root.scan_parameters
+        except tb.NoSuchNodeError:
+            scan_parameter_table = None
+        for meta_data_index in range(0, meta_data_table.shape[0], chunk_size):
+            meta_data = meta_data_table[meta_data_index:meta_data_index + chunk_size]
+            if meta_data.shape[0] == 0:
+                break
+            scan_parameters = scan_parameter_table[meta_data_index:meta_data_index + meta_data.shape[0]] if scan_parameter_table is not None else None
+            # read raw data of all readouts in this chunk at once
+            chunk_index_start = meta_data['index_start'][0]
+            raw_data = in_file_h5.root.raw_data[chunk_index_start:meta_data['index_stop'][-1]]
+            for index, readout_meta_data in enumerate(meta_data):
+                data = (raw_data[readout_meta_data['index_start'] - chunk_index_start:readout_meta_data['index_stop'] - chunk_index_start], float(readout_meta_data['timestamp_start']), float(readout_meta_data['timestamp_stop']), int(readout_meta_data['error']))
+                if scan_parameters is not None:
+                    yield data, dict((name, int(scan_parameters[index][name])) for name in scan_parameters.dtype.names)
+                else:
+                    yield data, None
+
+
+def replay_raw_data_file(filename, publisher, speed=1.0, chunk_size=10000, progress_bar=True):
+    '''Replaying raw data file.
+
+    Parameters
+    ----------
+    filename : string
+        Filename of the raw data file.
+    publisher : DataPublisher
+        Publisher (see fei4_raw_data.DataPublisher).
+    speed : float
+        Replay speed relative to the data taking (1.0: original timing). If None or 0, the readouts are sent as fast as possible.
+    chunk_size : int
+        Number of readouts which are read at once.
+    progress_bar : bool
+        Showing a progress bar.
+
+    Returns
+    -------
+    Dictionary with number of readouts, number of data words, replay duration (in seconds) and readout, word and byte rate (per second).
+    '''
+    with tb.open_file(filename, mode="r") as in_file_h5:
+        n_readouts = in_file_h5.root.meta_data.shape[0]
+    if progress_bar:
+        progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=n_readouts, term_width=80)
+        progress_bar.start()
+    n_words = 0
+    n_bytes = 0
+    start_time = time()
+    first_timestamp = None
+    for index, (data, scan_parameters) in enumerate(read_raw_data_file(filename, chunk_size=chunk_size)):
+        if speed:
+            # send readout at the (scaled) time it was read out during data taking
+            if first_timestamp is None:
+                first_timestamp = data[2]
+            wait_time = start_time + (data[2] - first_timestamp) / speed - time()
+            if wait_time > 0:
+                sleep(wait_time)
+        publisher.send_data(data, scan_parameters)
+        n_words += data[0].shape[0]
+        n_bytes += data[0].nbytes
+        if progress_bar:
+            progress_bar.update(index + 1)
+    duration = time() - start_time
+    if progress_bar:
+        progress_bar.finish()
+    return {
+        'n_readouts': n_readouts,
+        'n_words': n_words,
+        'duration': duration,
+        'readout_rate': n_readouts / duration if duration else np.inf,
+        'word_rate': n_words / duration if duration else np.inf,
+        'byte_rate': n_bytes / duration if duration else np.inf}
+
+
+def print_throughput(throughput):
+    logging.info('Replayed %d readout(s) with %d word(s) in %.3fs: %.1f readouts/s, %.3f MWords/s, %.3f MB/s', throughput['n_readouts'], throughput['n_words'], throughput['duration'], throughput['readout_rate'], throughput['word_rate'] / 1e6, throughput['byte_rate'] / 1e6)
@@ -155,6 +155,29 @@ def is_data_from_channel(channel=4):  # function factory
         raise ValueError('Invalid channel number')
 
 
+def demultiplex_data(array, channels):
+    '''Splitting raw data into the data of each channel.
+
+    The channel of each word is determined only once. FE words are assigned to their channel, all other words (e.g. trigger words, TDC words)
+    are assigned to each channel, so that each channel data can be interpreted like the data of a single FE. The order of the words is kept.
+
+    Parameters
+    ----------
+    array : numpy.array
+        Raw data array.
+    channels : iterable
+        Channel numbers.
+
+    Returns
+    -------
+    Dictionary with channel number as key and raw data array as value.
+    '''
+    word_channels = np.right_shift(np.bitwise_and(array, 0xFF000000), 24).astype(np.uint8)
+    word_channels[~is_fe_word(array)] = 0xFF  # words from all channels
+    all_channels = (word_channels == 0xFF)
+    return dict((channel, array[np.logical_or(word_channels == channel, all_channels)]) for channel in channels)
+
+
 def logical_and(f1, f2):  # function factory
     '''Logical and from functions.
 
@@ -367,11 +390,89 @@ def get_tot_iterator_from_data_records(array):  # generator
 
 
 def build_events_from_raw_data(array):
-    idx = np.where(is_trigger_word(array))[-1]
-    if idx.shape[0] == 0:
-        return [array]
-    else:
-        return np.split(array, idx)
+    '''Splitting raw data into events. Each event starts with a trigger word, the first event contains the data before the first trigger word
+    (empty array, if the data starts with a trigger word).
+
+    Each event is a new array. For large data, use build_event_index_from_raw_data() instead.
+
+    Returns
+    -------
+    List of raw data arrays.
+    '''
+    return np.split(array, np.flatnonzero(is_trigger_word(array)))
+
+
+def build_event_index_from_raw_data(array):
+    '''Event index of the raw data (CSR-style offsets).
+
+    Each event starts with a trigger word, the first event contains the data before the first trigger word (if any).
+    The raw data is not copied, the words of event i are array[offsets[i]:offsets[i + 1]].
+
+    Parameters
+    ----------
+    array : numpy.array
+        Raw data array.
+
+    Returns
+    -------
+    offsets : numpy.array
+        Offsets of the events (number of events + 1). For empty raw data, the offsets contain only 0 (no event).
+    '''
+    trigger_word_index = np.flatnonzero(is_trigger_word(array))
+    offsets = np.empty(shape=(trigger_word_index.shape[0] + 2,), dtype=np.int64)
+    offsets[0] = 0
+    offsets[1:-1] = trigger_word_index
+    offsets[-1] = array.shape[0]
+    if array.shape[0] == 0 or (trigger_word_index.shape[0] and trigger_word_index[0] == 0):
+        offsets = offsets[1:]  # no data before the first trigger word
+    return offsets
+
+
+def get_event_sizes(offsets):
+    '''Number of words of each event from the event index.
+    '''
+    return np.diff(offsets)
+
+
+def get_event_numbers(offsets):
+    '''Event number (index of the event) of each word from the event index.
+    '''
+    sizes = get_event_sizes(offsets)
+    return np.repeat(np.arange(sizes.shape[0], dtype=np.int64), sizes)
+
+
+def reduce_events(values, offsets, ufunc=np.add, empty_value=0):
+    '''Reduction of the values of each event (e.g. sum, maximum) without splitting the data.
+
+    Parameters
+    ----------
+    values : numpy.array
+        Values of each word (e.g. raw data, ToT, boolean array of a filter function).
+    offsets : numpy.array
+        Event index (see build_event_index_from_raw_data()).
+    ufunc : numpy.ufunc
+        Reduction function (e.g. numpy.add, numpy.maximum, numpy.logical_or).
+    empty_value : scalar
+        Value for events without words.
+
+    Returns
+    -------
+    Array with the reduced value of each event.
+
+    Examples
+    --------
+    offsets = build_event_index_from_raw_data(raw_data)
+    n_data_records = reduce_events(is_data_record(raw_data), offsets, np.add)  # number of data records of each event
+    '''
+    values = np.asarray(values)[offsets[0]:offsets[-1]]
+    sizes = get_event_sizes(offsets)
+    non_empty = sizes > 0
+    if not np.any(non_empty):
+        return np.full(shape=sizes.shape, fill_value=empty_value, dtype=values.dtype)
+    reduced_values = ufunc.reduceat(values, offsets[:-1][non_empty] - offsets[0])  # empty events have no words, the reduction of each non-empty event ends at the next non-empty event
+    result = np.full(shape=sizes.shape, fill_value=empty_value, dtype=reduced_values.dtype)
+    result[non_empty] = reduced_values
+    return result
 
 
 def interpret_pixel_data(data, dc, pixel_array, invert=True):
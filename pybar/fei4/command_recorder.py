@@ -0,0 +1,225 @@
+''' Recording of the FE-I4 command stream and estimation of the scan duration.
+
+The DryRunCmd replaces the CMD interface (cmd_seq) of the DUT. Instead of sending the commands to the FE-I4, each started command is recorded by the CommandRecorder
+together with the number of command clock cycles which are needed to execute the command. From the recorded commands, the time spent in hardware (command execution)
+and on the host (command generation, Python overhead) is estimated for each section of the scan (e.g. each mask step of the scan loop).
+
+The estimate does not include the time needed for transferring the command data to the readout board (e.g. USB transfers), only the number of uploaded bytes is recorded.
+A dry run covers functions which only need the register, the register utils and the stop_run event of the run object (e.g. scan_loop()). Complete scans and tunings
+(Fei4RunBase) need the readout hardware and the recorded data and cannot be executed in a dry run; their duration can be estimated by executing their scan_loop() calls
+with a DryRun object (see usage).
+
+Usage
+-----
+dry_run = DryRun(register=FEI4Register(fe_type='fei4a'))
+cal_lvl1_command = dry_run.register.get_commands("CAL")[0] + dry_run.register.get_commands("zeros", length=40)[0] + dry_run.register.get_commands("LV1")[0]
+for plsr_dac in range(0, 101, 2):
+    dry_run.register.set_global_register_value('PlsrDAC', plsr_dac)
+    scan_loop(dry_run, cal_lvl1_command, repeat_command=100, mask_steps=3, same_mask_for_all_dc=True)
+dry_run.recorder.save('threshold_scan_commands.h5')
+dry_run.recorder.print_summary()
+'''
+import logging
+from time import time
+from threading import Event, Lock
+from collections import OrderedDict
+
+import numpy as np
+import tables as tb
+
+from pybar.fei4.register_utils import FEI4RegisterUtils
+
+
+clock_period = 25e-9  # command clock (40 MHz)
+
+
+class CommandRecord(tb.IsDescription):
+    index = tb.UInt32Col(pos=0)
+    section = tb.StringCol(64, pos=1)
+    timestamp = tb.Float64Col(pos=2)  # host time of the command start
+    cmd_size = tb.UInt32Col(pos=3)  # command length in bits
+    cmd_repeat = tb.UInt32Col(pos=4)
+    start_sequence_length = tb.UInt32Col(pos=5)
+    stop_sequence_length = tb.UInt32Col(pos=6)
+    wait_cycles = tb.UInt64Col(pos=7)  # command clock cycles needed to execute the command
+    data_bytes = tb.UInt32Col(pos=8)  # bytes written into the command memory before the command start
+    host_time = tb.Float64Col(pos=9)  # host time spent before the command start
+    hardware_time = tb.Float64Col(pos=10)  # execution time of the command
+
+
+class CommandRecorder(object):
+    '''Recording started commands.
+
+    The host time of a command is the time since the previous command was started (or since the recorder was reset). In a dry run, no time is spent for executing the commands,
+    so the host time equals the time needed to generate the command. The time needed for the data transfer to the readout board is not included (see data_bytes).
+    '''
+    def __init__(self):
+        self.lock = Lock()
+        self.section = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.records = []
+            self.command_data = []
+            self._last_timestamp = time()
+
+    def record(self, command_data, cmd_size, cmd_repeat, start_sequence_length=0, stop_sequence_length=0, data_bytes=0):
+        '''Recording a started command.
+
+        Parameters
+        ----------
+        command_data : array-like
+            Content of the command memory (bytes).
+        cmd_size : int
+            Command length in bits (including start and stop sequence).
+        cmd_repeat : int
+            Repetitions of the command (without start and stop sequence).
+        start_sequence_length, stop_sequence_length : int
+            Length of the start and stop sequence in bits.
+        data_bytes : int
+            Bytes written into the command memory since the last command.
+
+        Returns
+        -------
+        Number of command clock cycles needed to execute the command.
+        '''
+        wait_cycles = get_wait_cycles(cmd_size, cmd_repeat, start_sequence_length, stop_sequence_length)
+        timestamp = time()
+        with self.lock:
+            self.records.append((len(self.records), str(self.section) if self.section is not None else '', timestamp, cmd_size, cmd_repeat, start_sequence_length, stop_sequence_length, wait_cycles, data_bytes, timestamp - self._last_timestamp, wait_cycles * clock_period))
+            self.command_data.append(np.array(command_data, dtype=np.uint8))
+            self._last_timestamp = timestamp
+        return wait_cycles
+
+    def get_records(self):
+        '''Returns the recorded commands as structured array.
+        '''
+        with self.lock:
+            return np.array(self.records, dtype=tb.description.dtype_from_descr(CommandRecord))
+
+    def save(self, filename):
+        '''Saving the recorded commands to HDF5 file.
+
+        The table "commands" holds the command settings and the estimated times, the array "command_data" holds the content of the command memory for each command.
+        '''
+        records = self.get_records()
+        filter_tables = tb.Filters(complib='zlib', complevel=5, fletcher32=False)
+        with tb.open_file(filename, mode='w', title='Command stream') as h5_file:
+            commands_table = h5_file.create_table(h5_file.root, name='commands', description=CommandRecord, title='commands', filters=filter_tables)
+            commands_table.append(records)
+            command_data_array = h5_file.create_vlarray(h5_file.root, name='command_data', atom=tb.UInt8Atom(), title='command_data', filters=filter_tables)
+            with self.lock:
+                for command_data in self.command_data:
+                    command_data_array.append(command_data)
+        logging.info('Saved %d command(s) to %s', records.shape[0], filename)
+
+    def get_summary(self):
+        '''Returns the estimated time for each section.
+
+        Returns
+        -------
+        Ordered dictionary with section as key and dictionary with n_commands, data_bytes, hardware_time and host_time as value.
+        '''
+        return get_summary(self.get_records())
+
+    def print_summary(self):
+        print_summary(self.get_summary())
+
+
+class DryRunCmd(object):
+    '''CMD interface (cmd_seq) that records the started commands instead of sending them.
+    '''
+    def __init__(self, recorder, command_memory_byte_size=2048 - 16, name='CMD'):
+        self.recorder = recorder
+        self.name = name
+        self._memory = np.zeros(shape=command_memory_byte_size, dtype=np.uint8)
+        self._data_bytes = 0
+        self._registers = {'CMD_SIZE': 0, 'CMD_REPEAT': 1, 'START_SEQUENCE_LENGTH': 0, 'STOP_SEQUENCE_LENGTH': 0}
+
+    def __getitem__(self, name):
+        if name == 'START':
+            self.start()
+        elif name == 'READY':
+            return True
+        else:
+            return self._registers.get(name, 0)
+
+    def __setitem__(self, name, value):
+        self._registers[name] = value
+
+    def set_data(self, data, addr=0):
+        if isinstance(data, basestring):
+            data = np.frombuffer(data, dtype=np.uint8)
+        else:
+            data = np.asarray(data, dtype=np.uint8)
+        self._memory[addr:addr + data.shape[0]] = data
+        self._data_bytes += data.shape[0]
+
+    def get_data(self, size=None, addr=0):
+        return self._memory[addr:addr + (self._memory.shape[0] if size is None else size)].copy()
+
+    def start(self):
+        cmd_size = self._registers['CMD_SIZE']
+        self.recorder.record(command_data=self._memory[:(cmd_size + 7) // 8], cmd_size=cmd_size, cmd_repeat=self._registers['CMD_REPEAT'], start_sequence_length=self._registers['START_SEQUENCE_LENGTH'], stop_sequence_length=self._registers['STOP_SEQUENCE_LENGTH'], data_bytes=self._data_bytes)
+        self._data_bytes = 0
+
+    def wait_for_ready(self, timeout=None, times=None, delay=None, abort=None):
+        return True  # command is finished immediately
+
+
+class DryRun(object):
+    '''Minimal run object for executing the scan loop (and other functions using the register utils) without hardware.
+
+    Only the CMD interface is provided, functions which need the readout (FIFO, TDC, trigger) or recorded data cannot be executed.
+
+    Parameters
+    ----------
+    register : FEI4Register
+        FE-I4 register.
+    recorder : CommandRecorder
+        Command recorder. If None, a new recorder will be created.
+    '''
+    def __init__(self, register, recorder=None):
+        self.register = register
+        self.recorder = recorder if recorder is not None else CommandRecorder()
+        self.dut = {'CMD': DryRunCmd(self.recorder)}
+        self.register_utils = FEI4RegisterUtils(self.dut, self.register, abort=Event())
+        self.register_utils.command_recorder = self.recorder
+        self.stop_run = Event()
+        self.run_number = 0
+        self.run_id = 'dry_run'
+
+
+def get_wait_cycles(cmd_size, cmd_repeat, start_sequence_length=0, stop_sequence_length=0):
+    '''Returns the number of command clock cycles needed to execute a command. The start and stop sequence is sent only once.
+    '''
+    return start_sequence_length + (cmd_size - start_sequence_length - stop_sequence_length) * max(cmd_repeat, 1) + stop_sequence_length
+
+
+def get_summary(records):
+    '''Returns the estimated time for each section from the recorded commands (see CommandRecorder.get_records()).
+    '''
+    summary = OrderedDict()
+    for record in records:
+        section_summary = summary.setdefault(str(record['section']), {'n_commands': 0, 'data_bytes': 0, 'hardware_time': 0.0, 'host_time': 0.0})
+        section_summary['n_commands'] += 1
+        section_summary['data_bytes'] += int(record['data_bytes'])
+        section_summary['hardware_time'] += float(record['hardware_time'])
+        section_summary['host_time'] += float(record['host_time'])
+    return summary
+
+
+def print_summary(summary):
+    total_hardware_time = sum([section_summary['hardware_time'] for section_summary in summary.values()])
+    total_host_time = sum([section_summary['host_time'] for section_summary in summary.values()])
+    for section, section_summary in summary.items():
+        logging.info('%s: %d command(s), %d byte(s), hardware time %.3fs, host time %.3fs', section if section else 'no section', section_summary['n_commands'], section_summary['data_bytes'], section_summary['hardware_time'], section_summary['host_time'])
+    logging.info('Total: hardware time %.3fs, host time %.3fs, estimated duration %.3fs (without data transfer)', total_hardware_time, total_host_time, total_hardware_time + total_host_time)
+
+
+def load_summary(filename):
+    '''Returns the estimated time for each section from a HDF5 file (see CommandRecorder.save()).
+    '''
+    with tb.open_file(filename, mode='r') as h5_file:
+        return get_summary(h5_file.root.commands[:])
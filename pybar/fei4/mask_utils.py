@@ -0,0 +1,517 @@
+''' Pixel mask algebra for the FEI4 pixel matrix (80 columns x 336 rows).
+
+All masks are generated with numpy array operations. Masks used inside the scan loop are memoized
+(see get_pixel_mask()), so that scans calling the scan loop for each scan parameter value (e.g. PlsrDAC, GDAC)
+do not re-generate identical masks.
+'''
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+
+
+shape = (80, 336)  # FEI4 pixel matrix (columns, rows)
+
+_mask_cache = OrderedDict()
+_mask_cache_lock = Lock()
+mask_cache_size = 512  # max. number of cached masks, each mask has 80 * 336 bytes
+
+
+def invert_pixel_mask(mask):
+    '''Invert pixel mask (0->1, 1(and greater)->0).
+
+    Parameters
+    ----------
+    mask : array-like
+        Mask.
+
+    Returns
+    -------
+    inverted_mask : array-like
+        Inverted Mask.
+    '''
+    inverted_mask = np.ones(shape=shape, dtype=np.dtype('>u1'))
+    inverted_mask[mask >= 1] = 0
+    return inverted_mask
+
+
+def make_pixel_mask(steps, shift, default=0, value=1, enable_columns=None, mask=None):
+    '''Generate pixel mask.
+
+    Parameters
+    ----------
+    steps : int
+        Number of mask steps, e.g. steps=3 (every third pixel is enabled), steps=336 (one pixel per column), steps=672 (one pixel per double column).
+    shift : int
+        Shift mask by given value to the bottom (towards higher row numbers). From 0 to (steps - 1).
+    default : int
+        Value of pixels that are not selected by the mask.
+    value : int
+        Value of pixels that are selected by the mask.
+    enable_columns : list
+        List of columns where the shift mask will be applied. List elements can range from 1 to 80.
+    mask : array_like
+        Additional mask. Must be convertible to an array of booleans with the same shape as mask array. True indicates a masked (i.e. invalid) data. Masked pixels will be set to default value.
+
+    Returns
+    -------
+    mask_array : numpy.ndarray
+        Mask array.
+
+    Usage
+    -----
+    shift_mask = 'enable'
+    steps = 3 # three step mask
+    for mask_step in range(steps):
+        commands = []
+        commands.extend(self.register.get_commands("ConfMode"))
+        mask_array = make_pixel_mask(steps=steps, step=mask_step)
+        self.register.set_pixel_register_value(shift_mask, mask_array)
+        commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=True, name=shift_mask))
+        self.register_utils.send_commands(commands)
+        # do something here
+    '''
+    mask_array = np.full(shape, default, dtype=np.uint8)
+    # FE columns and rows are starting from 1
+    if enable_columns:
+        odd_columns = [odd - 1 for odd in enable_columns if odd % 2 != 0]
+        even_columns = [even - 1 for even in enable_columns if even % 2 == 0]
+    else:
+        odd_columns = range(0, 80, 2)
+        even_columns = range(1, 80, 2)
+    odd_rows = np.arange(shift % steps, 336, steps)
+    even_row_offset = ((steps // 2) + shift) % steps  # // integer devision
+    even_rows = np.arange(even_row_offset, 336, steps)
+    if odd_columns:
+        mask_array[np.ix_(odd_columns, odd_rows)] = value  # any combination of column and row, no for loop needed
+    if even_columns:
+        mask_array[np.ix_(even_columns, even_rows)] = value
+    if mask is not None:
+        mask_array[np.asarray(mask, dtype=bool)] = default
+    return mask_array
+
+
+def get_pixel_mask(steps, shift, default=0, value=1, enable_columns=None, mask=None):
+    '''Memoized version of make_pixel_mask().
+
+    The masks are cached and keyed by the arguments of make_pixel_mask() (the additional mask is keyed by its content).
+    The returned array is read-only and shared between calls. Make a copy before modifying it.
+
+    Parameters
+    ----------
+    See make_pixel_mask().
+
+    Returns
+    -------
+    mask_array : numpy.ndarray
+        Read-only mask array.
+    '''
+    key = (steps, shift % steps, default, value, tuple(enable_columns) if enable_columns else None, None if mask is None else np.packbits(np.asarray(mask, dtype=bool)).tobytes())
+    with _mask_cache_lock:
+        try:
+            mask_array = _mask_cache.pop(key)
+        except KeyError:
+            mask_array = make_pixel_mask(steps=steps, shift=shift, default=default, value=value, enable_columns=enable_columns, mask=mask)
+            mask_array.flags.writeable = False
+            if len(_mask_cache) >= mask_cache_size:
+                _mask_cache.popitem(last=False)  # remove least recently used mask
+        _mask_cache[key] = mask_array
+    return mask_array
+
+
+def clear_mask_cache():
+    '''Deleting all cached masks.
+    '''
+    with _mask_cache_lock:
+        _mask_cache.clear()
+
+
+def get_injected_columns(double_column, digital_injection=False):
+    '''Returns the columns which are injected when the given double column is selected in the scan loop (see scan_loop()).
+
+    Parameters
+    ----------
+    double_column : int
+        Double column (from 0 to 39).
+    digital_injection : bool
+        If True, digital injection, else analog injection.
+
+    Returns
+    -------
+    List of columns (from 1 to 80).
+    '''
+    if digital_injection:
+        return [double_column * 2 + 1, double_column * 2 + 2]
+    else:  # analog injection
+        if double_column == 0:
+            return [1]
+        elif double_column == 39:
+            return [78, 79, 80]
+        else:
+            return [double_column * 2, double_column * 2 + 1]
+
+
+def get_mask_steps(steps):
+    '''Returns the mask step of each pixel, i.e. the shift of make_pixel_mask() which selects the pixel.
+
+    Parameters
+    ----------
+    steps : int
+        Number of mask steps (see make_pixel_mask()).
+
+    Returns
+    -------
+    mask_steps : numpy.ndarray
+        Array with the mask step of each pixel.
+    '''
+    rows = np.arange(shape[1])
+    mask_steps = np.empty(shape, dtype=np.uint16)
+    mask_steps[0::2, :] = rows % steps  # odd columns (columns start from 1)
+    mask_steps[1::2, :] = (rows - (steps // 2)) % steps  # even columns
+    return mask_steps
+
+
+def get_injected_pixels(mask_steps, enable_mask_steps=None, enable_double_columns=None, digital_injection=False, mask=None):
+    '''Returns the pixels which are injected by the scan loop (see scan_loop()).
+
+    Parameters
+    ----------
+    mask_steps : int
+        Number of mask steps.
+    enable_mask_steps : list, tuple
+        Mask steps of the scan loop. A value equal None or empty list will select all mask steps.
+    enable_double_columns : list, tuple
+        Double columns of the scan loop. A value equal None or empty list will select all double columns.
+    digital_injection : bool
+        If True, digital injection, else analog injection.
+    mask : array-like
+        Mask (see scan_loop()). True indicates a masked pixel. If None, no pixel is masked.
+
+    Returns
+    -------
+    Boolean array of the injected pixels.
+    '''
+    if not enable_mask_steps:
+        enable_mask_steps = range(mask_steps)
+    if not enable_double_columns:
+        enable_double_columns = range(40)
+    injected = np.zeros(shape, dtype=bool)
+    for double_column in enable_double_columns:
+        injected[np.array(get_injected_columns(double_column, digital_injection=digital_injection)) - 1, :] = True
+    injected &= np.in1d(get_mask_steps(mask_steps), enable_mask_steps).reshape(shape)
+    if mask is not None:
+        injected &= np.logical_not(np.asarray(mask, dtype=bool))
+    return injected
+
+
+def get_scan_loop_selection(mask, mask_steps, enable_mask_steps=None, enable_double_columns=None, digital_injection=False):
+    '''Returns the mask steps and double columns of the scan loop which inject at least one unmasked pixel.
+
+    Parameters
+    ----------
+    mask : array-like
+        Mask (see scan_loop()). True indicates a masked pixel. If None, no pixel is masked.
+    mask_steps : int
+        Number of mask steps.
+    enable_mask_steps : list, tuple
+        Mask steps to select from. A value equal None or empty list will select all mask steps.
+    enable_double_columns : list, tuple
+        Double columns to select from. A value equal None or empty list will select all double columns.
+    digital_injection : bool
+        If True, digital injection, else analog injection.
+
+    Returns
+    -------
+    Tuple of lists of mask steps and double columns (enable_mask_steps and enable_double_columns of scan_loop()).
+    The lists are empty, if all pixels are masked.
+    '''
+    if not enable_mask_steps:
+        enable_mask_steps = range(mask_steps)
+    if not enable_double_columns:
+        enable_double_columns = range(40)
+    injected = get_injected_pixels(mask_steps, enable_mask_steps=enable_mask_steps, enable_double_columns=enable_double_columns, digital_injection=digital_injection, mask=mask)
+    selected_mask_steps = set(get_mask_steps(mask_steps)[injected])
+    return [mask_step for mask_step in enable_mask_steps if mask_step in selected_mask_steps], [double_column for double_column in enable_double_columns if np.any(injected[np.array(get_injected_columns(double_column, digital_injection=digital_injection)) - 1, :])]
+
+
+def get_newly_masked_pixels(mask, selected, min_pixels=1):
+    '''Returns the selected pixels which are not yet masked, if at least min_pixels of them or all unmasked pixels are selected.
+
+    Every change of the mask of the scan loop (see mask parameter of scan_loop()) is written pixel by pixel and compiles
+    a new scan loop program, therefore the pixels are collected until they can be masked at once.
+
+    Parameters
+    ----------
+    mask : array-like
+        Mask. True indicates a masked pixel.
+    selected : array-like
+        Pixels which can be masked (e.g. saturated pixels, pixels with a settled decision).
+    min_pixels : int
+        Minimum number of newly masked pixels.
+
+    Returns
+    -------
+    Boolean array of the newly masked pixels. No pixel is selected, if less than min_pixels pixels are newly masked.
+    '''
+    unmasked = np.logical_not(np.asarray(mask, dtype=bool))
+    newly_masked = np.logical_and(unmasked, np.asarray(selected, dtype=bool))
+    n_masked = np.count_nonzero(newly_masked)
+    if n_masked < min_pixels and n_masked < np.count_nonzero(unmasked):
+        newly_masked[:] = False
+    return newly_masked
+
+
+class AdaptiveInjectionMask(object):
+    '''Adaptive injection mask for threshold scans.
+
+    Pixels which see all injections for a given number of consecutive scan parameter values (e.g. PlsrDAC) are above
+    their S-curve transition and are masked (not injected anymore) for the following scan parameter values (see mask parameter of scan_loop()).
+    The scan parameter values must be increasing. The occupancy of the masked pixels is assumed to be n_injections (see fill_occupancy()).
+    Saturated pixels are masked in batches of at least min_masked_pixels pixels (see get_newly_masked_pixels()).
+    Pixels which do not reach a new maximum occupancy for stalled_steps consecutive scan parameter values (e.g. inefficient or dead pixels)
+    are stalled. They may never saturate, therefore the mask is complete when only a few stalled pixels remain (see is_complete()).
+
+    Parameters
+    ----------
+    n_injections : int
+        Number of injections.
+    saturated_steps : int
+        Number of consecutive scan parameter values with full occupancy before a pixel is masked.
+    min_masked_pixels : int
+        Minimum number of newly masked pixels for changing the mask. The remaining pixels are always masked.
+    max_stalled_pixels : int
+        Maximum number of remaining stalled pixels for a complete mask.
+    stalled_steps : int
+        Number of consecutive scan parameter values without a new maximum occupancy before a pixel is stalled.
+    mask : array-like
+        Initial mask (e.g. disabled pixels). True indicates a masked pixel.
+    '''
+    def __init__(self, n_injections, saturated_steps=3, min_masked_pixels=1, max_stalled_pixels=0, stalled_steps=10, mask=None):
+        self.n_injections = n_injections
+        self.saturated_steps = saturated_steps
+        self.min_masked_pixels = min_masked_pixels
+        self.max_stalled_pixels = max_stalled_pixels
+        self.stalled_steps = stalled_steps
+        self.initial_mask = np.zeros(shape=shape, dtype=bool) if mask is None else np.asarray(mask, dtype=bool)
+        self.reset()
+
+    def reset(self):
+        self.adaptive_mask = np.zeros(shape=shape, dtype=bool)  # masked pixels
+        self.masked_after = np.full(shape, fill_value=np.inf)  # scan parameter value after which the pixel is masked
+        self.saturated = np.zeros(shape=shape, dtype=np.uint32)  # number of consecutive scan parameter values with full occupancy
+        self.max_occupancy = np.zeros(shape=shape, dtype=np.uint32)  # maximum occupancy of the scan parameter values
+        self.stalled = np.zeros(shape=shape, dtype=np.uint32)  # number of consecutive scan parameter values without a new maximum occupancy
+
+    @property
+    def mask(self):
+        '''Mask for the scan loop. True indicates a masked pixel.
+        '''
+        return np.logical_or(self.initial_mask, self.adaptive_mask)
+
+    def get_stalled_pixels(self):
+        '''Returns the unmasked pixels which are stalled.
+        '''
+        return np.logical_and(np.logical_not(self.mask), self.stalled >= self.stalled_steps)
+
+    def is_complete(self):
+        '''Returns True if all pixels are masked, or if the unmasked pixels are stalled and their number does not exceed max_stalled_pixels.
+        '''
+        n_unmasked = np.count_nonzero(np.logical_not(self.mask))
+        return n_unmasked == 0 or (n_unmasked <= self.max_stalled_pixels and np.count_nonzero(self.get_stalled_pixels()) == n_unmasked)
+
+    def update(self, occupancy, scan_parameter_value):
+        '''Updating the mask with the occupancy of the given scan parameter value.
+
+        Parameters
+        ----------
+        occupancy : array-like
+            Occupancy histogram (columns, rows).
+        scan_parameter_value : int
+            Scan parameter value.
+
+        Returns
+        -------
+        Number of newly masked pixels.
+        '''
+        unmasked = np.logical_not(self.mask)
+        occupancy = np.asarray(occupancy)[unmasked]
+        self.saturated[unmasked] = np.where(occupancy >= self.n_injections, self.saturated[unmasked] + 1, 0)
+        self.stalled[unmasked] = np.where(np.logical_or(occupancy > self.max_occupancy[unmasked], occupancy >= self.n_injections), 0, self.stalled[unmasked] + 1)
+        self.max_occupancy[unmasked] = np.maximum(self.max_occupancy[unmasked], occupancy)
+        masked = get_newly_masked_pixels(self.mask, self.saturated >= self.saturated_steps, min_pixels=self.min_masked_pixels)
+        self.masked_after[masked] = scan_parameter_value
+        self.adaptive_mask[masked] = True
+        return np.count_nonzero(masked)
+
+    def get_fill_mask(self, scan_parameter_values):
+        '''Returns the pixels which were not injected for each of the given scan parameter values.
+
+        Parameters
+        ----------
+        scan_parameter_values : iterable
+            Scan parameter values.
+
+        Returns
+        -------
+        Boolean array (columns, rows, scan parameter values).
+        '''
+        return np.greater.outer(np.asarray(scan_parameter_values), self.masked_after).transpose(1, 2, 0)
+
+    def fill_occupancy(self, occupancy, scan_parameter_values):
+        '''Setting the occupancy of the pixels which were not injected to n_injections.
+
+        Parameters
+        ----------
+        occupancy : array-like
+            Occupancy histogram (columns, rows, scan parameter values) or (columns, rows) for a single scan parameter value.
+        scan_parameter_values : iterable, int
+            Scan parameter values.
+
+        Returns
+        -------
+        Occupancy histogram.
+        '''
+        occupancy = np.array(occupancy)
+        if np.ndim(scan_parameter_values) == 0:
+            occupancy[self.masked_after < scan_parameter_values] = self.n_injections
+        else:
+            occupancy[self.get_fill_mask(scan_parameter_values)] = self.n_injections
+        return occupancy
+
+
+def make_pixel_mask_from_col_row(column, row, default=0, value=1):
+    '''Generate mask from column and row lists
+
+    Parameters
+    ----------
+    column : iterable, int
+        List of colums values.
+    row : iterable, int
+        List of row values.
+    default : int
+        Value of pixels that are not selected by the mask.
+    value : int
+        Value of pixels that are selected by the mask.
+
+    Returns
+    -------
+    mask : numpy.ndarray
+    '''
+    # FE columns and rows start from 1
+    col_array = np.array(column) - 1
+    row_array = np.array(row) - 1
+    if np.any(col_array >= 80) or np.any(col_array < 0) or np.any(row_array >= 336) or np.any(row_array < 0):
+        raise ValueError('Column and/or row out of range')
+    mask = np.full(shape, default, dtype=np.uint8)
+    mask[col_array, row_array] = value  # advanced indexing
+    return mask
+
+
+def make_box_pixel_mask_from_col_row(column, row, default=0, value=1):
+    '''Generate box shaped mask from column and row lists. Takes the minimum and maximum value from each list.
+
+    Parameters
+    ----------
+    column : iterable, int
+        List of colums values.
+    row : iterable, int
+        List of row values.
+    default : int
+        Value of pixels that are not selected by the mask.
+    value : int
+        Value of pixels that are selected by the mask.
+
+    Returns
+    -------
+    numpy.ndarray
+    '''
+    # FE columns and rows start from 1
+    col_array = np.array(column) - 1
+    row_array = np.array(row) - 1
+    if np.any(col_array >= 80) or np.any(col_array < 0) or np.any(row_array >= 336) or np.any(row_array < 0):
+        raise ValueError('Column and/or row out of range')
+    mask = np.full(shape, default, dtype=np.uint8)
+    if column and row:
+        mask[col_array.min():col_array.max() + 1, row_array.min():row_array.max() + 1] = value  # advanced indexing
+    return mask
+
+
+def make_xtalk_mask(mask):
+    """
+    Generate xtalk mask (row - 1, row + 1) from pixel mask.
+
+    Parameters
+    ----------
+    mask : ndarray
+        Pixel mask.
+
+    Returns
+    -------
+    ndarray
+        Xtalk mask.
+
+    Example
+    -------
+    Input:
+    [[1 0 0 0 0 0 1 0 0 0 ... 0 0 0 0 1 0 0 0 0 0]
+     [0 0 0 1 0 0 0 0 0 1 ... 0 1 0 0 0 0 0 1 0 0]
+     ...
+     [1 0 0 0 0 0 1 0 0 0 ... 0 0 0 0 1 0 0 0 0 0]
+     [0 0 0 1 0 0 0 0 0 1 ... 0 1 0 0 0 0 0 1 0 0]]
+
+    Output:
+    [[0 1 0 0 0 1 0 1 0 0 ... 0 0 0 1 0 1 0 0 0 1]
+     [0 0 1 0 1 0 0 0 1 0 ... 1 0 1 0 0 0 1 0 1 0]
+     ...
+     [0 1 0 0 0 1 0 1 0 0 ... 0 0 0 1 0 1 0 0 0 1]
+     [0 0 1 0 1 0 0 0 1 0 ... 1 0 1 0 0 0 1 0 1 0]]
+    """
+    selected = np.asarray(mask) != 0
+    xtalk_mask = np.zeros(shape, dtype=np.uint8)
+    xtalk_mask[:, 1:][selected[:, :-1]] = 1  # row + 1
+    xtalk_mask[np.roll(selected, -1, axis=1)] = 1  # row - 1, row 1 wraps around to row 336 (see example)
+    return xtalk_mask
+
+
+def make_checkerboard_mask(column_distance, row_distance, column_offset=0, row_offset=0, default=0, value=1):
+    """
+    Generate chessboard/checkerboard mask.
+
+    Parameters
+    ----------
+    column_distance : int
+        Column distance of the enabled pixels.
+    row_distance : int
+        Row distance of the enabled pixels.
+    column_offset : int
+        Additional column offset which shifts the columns by the given amount.
+    column_offset : int
+        Additional row offset which shifts the rows by the given amount.
+
+    Returns
+    -------
+    ndarray
+        Chessboard mask.
+
+    Example
+    -------
+    Input:
+    column_distance : 6
+    row_distance : 2
+
+    Output:
+    [[1 0 0 0 0 0 1 0 0 0 ... 0 0 0 0 1 0 0 0 0 0]
+     [0 0 0 0 0 0 0 0 0 0 ... 0 0 0 0 0 0 0 0 0 0]
+     [0 0 0 1 0 0 0 0 0 1 ... 0 1 0 0 0 0 0 1 0 0]
+     ...
+     [0 0 0 0 0 0 0 0 0 0 ... 0 0 0 0 0 0 0 0 0 0]
+     [0 0 0 1 0 0 0 0 0 1 ... 0 1 0 0 0 0 0 1 0 0]
+     [0 0 0 0 0 0 0 0 0 0 ... 0 0 0 0 0 0 0 0 0 0]]
+    """
+    col_shape = (336,)
+    col = np.full(col_shape, fill_value=default, dtype=np.uint8)
+    col[::row_distance] = value
+    chessboard_mask = np.full(shape, fill_value=default, dtype=np.uint8)
+    chessboard_mask[column_offset::column_distance * 2] = np.roll(col, row_offset)
+    chessboard_mask[column_distance + column_offset::column_distance * 2] = np.roll(col, row_distance / 2 + row_offset)
+    return chessboard_mask
@@ -6,6 +6,8 @@ from ast import literal_eval
 from collections import OrderedDict
 import copy
 import datetime
+import hashlib
+from threading import Lock
 from contextlib import contextmanager
 from importlib import import_module
 from operator import itemgetter
@@ -19,6 +21,13 @@ from pybar.utils.utils import string_is_binary, flatten_iterable, iterable
 
 flavors = ('fei4a', 'fei4b')
 
+_fe_type_cache = {}  # register definitions for each FE type, see FEI4Register.init_fe_type()
+_configuration_cache = OrderedDict()  # compiled text configurations, see load_configuration_from_text_file()
+_configuration_cache_lock = Lock()
+configuration_cache_size = 16  # max. number of compiled text configurations kept in memory
+configuration_cache_dir = None  # compiled text configurations on disk (e.g. ~/.pybar/configuration_cache), None disables the disk cache, see set_configuration_cache_dir()
+configuration_cache_dir_size = 64  # max. number of compiled text configurations kept on disk
+
 
 class FEI4Register(object):
 
@@ -61,53 +70,27 @@ class FEI4Register(object):
 
     def init_fe_type(self, fe_type):
         self.flavor = None
-        self.global_registers = {}
-        self.pixel_registers = {}
+        self.global_registers = OrderedDict()
+        self.pixel_registers = OrderedDict()
         self.calibration_parameters = OrderedDict()
         self.miscellaneous = OrderedDict()
-        self.commands = {}
-        fei4_defines = import_module('pybar.fei4.fei4_defines')
-        fe_type = getattr(fei4_defines, fe_type)
-        if 'flavor' not in fe_type:
-            raise ValueError('FEI4 flavor not defined')
-        elif fe_type['flavor'] not in flavors:
-            raise ValueError('Unknown FEI4 flavor: %s' % fe_type['flavor'])
-        else:
-            self.flavor = fe_type['flavor']
-            logging.info('Initializing FEI4 registers (flavor: %s)', self.flavor)
-        for name, reg in fe_type['global_registers'].iteritems():
-            address = reg.get('address')
-            offset = reg.get('offset', 0)
-            bitlength = reg.get('bitlength')
-            addresses = range(address, address + (offset + bitlength + 16 - 1) / 16)
-            littleendian = reg.get('littleendian', False)
-            register_littleendian = reg.get('register_littleendian', False)
-            value = reg.get('value', 0)
-            if not 0 <= value < 2 ** bitlength:
-                raise ValueError("Global register %s: value exceeds limits" % (name,))
-            readonly = reg.get('readonly', False)
-            description = reg.get('description', '')
-            self.global_registers[name] = dict(name=name, address=address, offset=offset, bitlength=bitlength, addresses=addresses, littleendian=littleendian, register_littleendian=register_littleendian, value=value, readonly=readonly, description=description)
-        for name, reg in fe_type['pixel_registers'].iteritems():
-            pxstrobe = reg.get('pxstrobe')
-            bitlength = reg.get('bitlength')
-            if bitlength > 8:
-                raise Exception('Pixel register %s: up to 8 bits supported' % (name,))  # numpy array dtype is uint8
-            littleendian = reg.get('littleendian', False)
-            if not 0 <= reg.get('value', 0) < 2 ** bitlength:
-                raise ValueError("Global register %s: value exceeds limits" % (name,))
-            value = np.full((80, 336), reg.get('value', 0), dtype=np.uint8)
-            description = reg.get('description', '')
-            self.pixel_registers[name] = dict(name=name, pxstrobe=pxstrobe, bitlength=bitlength, littleendian=littleendian, value=value, description=description)
-        for name, command in fe_type['commands'].iteritems():
-            bitlength = command.get('bitlength')
-            description = command.get('description', '')
-            if 'bitstream' in command:
-                bitstream = command.get('bitstream')
-                self.commands[name] = dict(name=name, bitstream=bitstream, bitlength=bitlength, description=description)
-            else:
-                self.commands[name] = dict(name=name, bitlength=bitlength, description=description)
-        self.calibration_parameters = fe_type['calibration_parameters'].copy()
+        self.commands = OrderedDict()
+        # the register definitions are built only once for each FE type and copied afterwards
+        try:
+            flavor, global_registers, pixel_registers, commands, calibration_parameters = _fe_type_cache[fe_type]
+        except KeyError:
+            flavor, global_registers, pixel_registers, commands, calibration_parameters = build_fe_type(fe_type)
+            _fe_type_cache[fe_type] = (flavor, global_registers, pixel_registers, commands, calibration_parameters)
+        self.flavor = flavor
+        logging.info('Initializing FEI4 registers (flavor: %s)', self.flavor)
+        for name, reg in global_registers.iteritems():
+            self.global_registers[name] = reg.copy()
+        for name, reg in pixel_registers.iteritems():
+            self.pixel_registers[name] = reg.copy()
+            self.pixel_registers[name]['value'] = reg['value'].copy()
+        for name, command in commands.iteritems():
+            self.commands[name] = command.copy()
+        self.calibration_parameters = calibration_parameters.copy()
 
     def is_chip_flavor(self, chip_flavor):
         if chip_flavor in flavors:
@@ -695,7 +678,15 @@ def load_configuration_from_text_file(register, configuration_file):
     logging.info("Loading configuration: %s" % configuration_file)
     register.configuration_file = configuration_file
 
-    config_dict = parse_global_config(register.configuration_file)
+    # the parsed configuration and the pixel registers are taken from the configuration cache, if the configuration files have not changed
+    compiled_configuration = get_compiled_configuration(register.configuration_file)
+    if compiled_configuration is None:
+        config_dict = parse_global_config(register.configuration_file)
+        compiled_config_dict = copy.deepcopy(config_dict)
+        compiled_pixel_registers = {}
+    else:
+        config_dict, compiled_pixel_registers = compiled_configuration
+        compiled_config_dict = None
 
     if 'Flavor' in config_dict:
         flavor = config_dict.pop('Flavor').lower()
@@ -734,7 +725,12 @@ def load_configuration_from_text_file(register, configuration_file):
             register.set_global_register_value(key, value)
             global_registers_configured.append(key)
         elif key in register.pixel_registers:
-            register.set_pixel_register_value(key, value)
+            if key in compiled_pixel_registers:
+                register.set_pixel_register_value(key, compiled_pixel_registers[key])
+            else:
+                register.set_pixel_register_value(key, value)
+                if compiled_config_dict is not None and isinstance(value, basestring):
+                    compiled_pixel_registers[key] = register.get_pixel_register_value(key)
             pixel_registers_configured.append(key)
         elif key in register.calibration_parameters:
             register.calibration_parameters[key] = value
@@ -752,6 +748,9 @@ def load_configuration_from_text_file(register, configuration_file):
     if register.miscellaneous:
         logging.warning("Found following unknown parameter(s): {}".format(', '.join('\'' + parameter + '\'' for parameter in register.miscellaneous.iterkeys())))
 
+    if compiled_config_dict is not None:
+        set_compiled_configuration(register.configuration_file, compiled_config_dict, compiled_pixel_registers)
+
 
 def load_configuration_from_hdf5(register, configuration_file, node=''):
     '''Loading configuration from HDF5 file to register object
@@ -992,7 +991,240 @@ def save_configuration_to_hdf5(register, configuration_file, name=''):
             save_conf()
 
 
+def get_pixel_config_filename(configuration_file, value):
+    '''Returns the filename of a pixel register configuration file (see FEI4Register.set_pixel_register_value()).
+    '''
+    if value[0] == "~" or value[0] == "!":
+        value = value[1:]
+    return os.path.join(os.path.dirname(configuration_file), os.path.normpath(value.replace('\\', '/')))
+
+
+def get_file_hash(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def get_file_stat(filename):
+    '''Returns modification time and size of a file.
+    '''
+    stat = os.stat(filename)
+    return stat.st_mtime, stat.st_size
+
+
+def is_file_modified(filename, file_hash, file_stat=None):
+    '''Returns True if the file has changed. The file is hashed only if modification time or size of the file has changed.
+    '''
+    if file_stat and get_file_stat(filename) == tuple(file_stat):
+        return False
+    return get_file_hash(filename) != file_hash
+
+
+def get_configuration_cache_key(configuration_file):
+    '''Returns the key of a text configuration, which is the hash of the configuration file and its location (pixel configuration files are relative to the configuration file).
+    '''
+    sha1 = hashlib.sha1(os.path.dirname(os.path.abspath(configuration_file)))
+    with open(configuration_file, 'rb') as f:
+        sha1.update(f.read())
+    return sha1.hexdigest()
+
+
+def get_compiled_configuration(configuration_file):
+    '''Returns the parsed text configuration and the pixel register arrays from the configuration cache.
+
+    The compiled configuration is taken from memory or from the configuration cache directory. The compiled configuration is valid only if the hash of all pixel configuration files has not changed.
+    The pixel configuration files are hashed only if their modification time or size has changed.
+
+    Returns
+    -------
+    Tuple of configuration dictionary and dictionary with pixel register arrays, None if the configuration is not cached.
+    '''
+    key = get_configuration_cache_key(configuration_file)
+    with _configuration_cache_lock:
+        compiled_configuration = _configuration_cache.pop(key, None)
+        if compiled_configuration is not None:
+            _configuration_cache[key] = compiled_configuration
+    if compiled_configuration is None and configuration_cache_dir:
+        cache_file = os.path.join(configuration_cache_dir, key + '.npz')
+        if os.path.isfile(cache_file):
+            try:
+                with np.load(cache_file) as compiled_configuration_file:
+                    config_dict = literal_eval(str(compiled_configuration_file['config_dict']))
+                    dependencies = [(dependency[0], dependency[1], dependency[2] if len(dependency) > 2 else None) for dependency in literal_eval(str(compiled_configuration_file['dependencies']))]  # no file stat in older cache files
+                    pixel_registers = dict((name[len('pixel_register_'):], compiled_configuration_file[name]) for name in compiled_configuration_file.files if name.startswith('pixel_register_'))
+            except Exception as e:
+                logging.warning('Cannot load compiled configuration %s: %s', cache_file, e)
+            else:
+                compiled_configuration = (config_dict, pixel_registers, dependencies)
+                with _configuration_cache_lock:
+                    add_compiled_configuration(key, compiled_configuration)
+                try:
+                    os.utime(cache_file, None)  # least recently used files are removed first
+                except OSError:
+                    pass
+    if compiled_configuration is None:
+        return None
+    config_dict, pixel_registers, dependencies = compiled_configuration
+    try:
+        if any(is_file_modified(filename, file_hash, file_stat) for filename, file_hash, file_stat in dependencies):
+            return None
+    except (IOError, OSError):  # missing pixel configuration files
+        return None
+    logging.debug('Using compiled configuration %s', key)
+    return copy.deepcopy(config_dict), pixel_registers
+
+
+def set_compiled_configuration(configuration_file, config_dict, pixel_registers):
+    '''Adding the parsed text configuration and the pixel register arrays to the configuration cache.
+
+    Parameters
+    ----------
+    configuration_file : string
+        Filename of the text configuration.
+    config_dict : dict
+        Parsed configuration file (see parse_global_config()).
+    pixel_registers : dict
+        Pixel register arrays of pixel registers configured by pixel configuration files.
+    '''
+    key = get_configuration_cache_key(configuration_file)
+    dependencies = []
+    for name, value in config_dict.iteritems():
+        if name in pixel_registers:
+            filename = get_pixel_config_filename(configuration_file, value)
+            file_stat = get_file_stat(filename)  # before hashing, changes during hashing will be detected
+            dependencies.append((filename, get_file_hash(filename), file_stat))
+    pixel_registers = dict((name, value.copy()) for name, value in pixel_registers.iteritems())
+    with _configuration_cache_lock:
+        add_compiled_configuration(key, (config_dict, pixel_registers, dependencies))
+    if configuration_cache_dir:
+        cache_file = os.path.join(configuration_cache_dir, key + '.npz')
+        try:
+            if not os.path.exists(configuration_cache_dir):
+                os.makedirs(configuration_cache_dir)
+            arrays = dict(('pixel_register_' + name, value) for name, value in pixel_registers.iteritems())
+            tmp_cache_file = cache_file + '.%d.tmp' % os.getpid()
+            with open(tmp_cache_file, 'wb') as f:
+                np.savez(f, config_dict=repr(config_dict), dependencies=repr(dependencies), **arrays)
+            if os.path.exists(cache_file):
+                os.remove(cache_file)
+            os.rename(tmp_cache_file, cache_file)
+            prune_configuration_cache_dir()
+        except (IOError, OSError) as e:
+            logging.warning('Cannot write compiled configuration %s: %s', cache_file, e)
+
+
+def add_compiled_configuration(key, compiled_configuration):
+    _configuration_cache.pop(key, None)
+    if len(_configuration_cache) >= configuration_cache_size:
+        _configuration_cache.popitem(last=False)  # remove least recently used configuration
+    _configuration_cache[key] = compiled_configuration
+
+
+def set_configuration_cache_dir(cache_dir, size=None):
+    '''Setting the directory for compiled text configurations (see configuration_cache_dir in configuration.yaml).
+
+    Parameters
+    ----------
+    cache_dir : string
+        Path of the configuration cache directory. If None, the disk cache is disabled.
+    size : int
+        Max. number of compiled configurations kept in the directory. If None, the size is not changed.
+    '''
+    global configuration_cache_dir, configuration_cache_dir_size
+    configuration_cache_dir = os.path.abspath(os.path.expanduser(cache_dir)) if cache_dir else None
+    if size is not None:
+        if size < 1:
+            raise ValueError('Configuration cache size must be at least 1')
+        configuration_cache_dir_size = size
+    if configuration_cache_dir:
+        prune_configuration_cache_dir()
+
+
+def prune_configuration_cache_dir():
+    '''Deleting the least recently used compiled configurations from the configuration cache directory exceeding configuration_cache_dir_size.
+    '''
+    if not configuration_cache_dir or not os.path.isdir(configuration_cache_dir):
+        return
+    cache_files = []
+    for filename in os.listdir(configuration_cache_dir):
+        if filename.endswith('.npz'):
+            cache_file = os.path.join(configuration_cache_dir, filename)
+            try:
+                cache_files.append((os.path.getmtime(cache_file), cache_file))
+            except OSError:  # removed in the meantime
+                pass
+    cache_files.sort()
+    for _, cache_file in cache_files[:max(0, len(cache_files) - configuration_cache_dir_size)]:
+        try:
+            os.remove(cache_file)
+        except OSError as e:
+            logging.warning('Cannot remove compiled configuration %s: %s', cache_file, e)
+
+
+def clear_configuration_cache(clear_cache_dir=False):
+    '''Deleting all compiled configurations from memory and optionally from the configuration cache directory.
+    '''
+    with _configuration_cache_lock:
+        _configuration_cache.clear()
+    if clear_cache_dir and configuration_cache_dir and os.path.isdir(configuration_cache_dir):
+        for filename in os.listdir(configuration_cache_dir):
+            if filename.endswith('.npz'):
+                os.remove(os.path.join(configuration_cache_dir, filename))
+
+
 # Helper functions
+def build_fe_type(fe_type):
+    '''Building the register definitions from fei4_defines.
+
+    Returns
+    -------
+    Tuple of flavor, global registers, pixel registers, commands and calibration parameters.
+    '''
+    global_registers = OrderedDict()
+    pixel_registers = OrderedDict()
+    commands = OrderedDict()
+    fei4_defines = import_module('pybar.fei4.fei4_defines')
+    fe_type = getattr(fei4_defines, fe_type)
+    if 'flavor' not in fe_type:
+        raise ValueError('FEI4 flavor not defined')
+    elif fe_type['flavor'] not in flavors:
+        raise ValueError('Unknown FEI4 flavor: %s' % fe_type['flavor'])
+    else:
+        flavor = fe_type['flavor']
+    for name, reg in fe_type['global_registers'].iteritems():
+        address = reg.get('address')
+        offset = reg.get('offset', 0)
+        bitlength = reg.get('bitlength')
+        addresses = range(address, address + (offset + bitlength + 16 - 1) / 16)
+        littleendian = reg.get('littleendian', False)
+        register_littleendian = reg.get('register_littleendian', False)
+        value = reg.get('value', 0)
+        if not 0 <= value < 2 ** bitlength:
+            raise ValueError("Global register %s: value exceeds limits" % (name,))
+        readonly = reg.get('readonly', False)
+        description = reg.get('description', '')
+        global_registers[name] = dict(name=name, address=address, offset=offset, bitlength=bitlength, addresses=addresses, littleendian=littleendian, register_littleendian=register_littleendian, value=value, readonly=readonly, description=description)
+    for name, reg in fe_type['pixel_registers'].iteritems():
+        pxstrobe = reg.get('pxstrobe')
+        bitlength = reg.get('bitlength')
+        if bitlength > 8:
+            raise Exception('Pixel register %s: up to 8 bits supported' % (name,))  # numpy array dtype is uint8
+        littleendian = reg.get('littleendian', False)
+        if not 0 <= reg.get('value', 0) < 2 ** bitlength:
+            raise ValueError("Global register %s: value exceeds limits" % (name,))
+        value = np.full((80, 336), reg.get('value', 0), dtype=np.uint8)
+        description = reg.get('description', '')
+        pixel_registers[name] = dict(name=name, pxstrobe=pxstrobe, bitlength=bitlength, littleendian=littleendian, value=value, description=description)
+    for name, command in fe_type['commands'].iteritems():
+        bitlength = command.get('bitlength')
+        description = command.get('description', '')
+        if 'bitstream' in command:
+            bitstream = command.get('bitstream')
+            commands[name] = dict(name=name, bitstream=bitstream, bitlength=bitlength, description=description)
+        else:
+            commands[name] = dict(name=name, bitlength=bitlength, description=description)
+    return flavor, global_registers, pixel_registers, commands, fe_type['calibration_parameters'].copy()
+
+
 def parse_global_config(filename):  # parses the global config text file
     with open(filename, 'r') as f:
         f.seek(0)
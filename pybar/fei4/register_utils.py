@@ -3,9 +3,12 @@ import time
 import re
 import struct
 import os
+import sys
+from threading import Thread, Event
+from Queue import Queue
 from ast import literal_eval
 from operator import itemgetter
-import itertools
+from collections import OrderedDict
 
 from bitarray import bitarray
 import numpy as np
@@ -15,6 +18,8 @@ from basil.utils.BitLogic import BitLogic
 from pybar.utils.utils import bitarray_to_array
 from pybar.daq.readout_utils import interpret_pixel_data
 from pybar.daq.fei4_record import FEI4Record
+from pybar.fei4.mask_utils import invert_pixel_mask, make_pixel_mask, get_pixel_mask, make_pixel_mask_from_col_row, make_box_pixel_mask_from_col_row, make_xtalk_mask, make_checkerboard_mask  # for backward compatibility
+from pybar.fei4.mask_utils import get_injected_columns
 
 
 class CmdTimeoutError(Exception):
@@ -32,6 +37,26 @@ class FEI4RegisterUtils(object):
         self.zero_cmd_padded = self.zero_cmd.copy()
         self.zero_cmd_padded.fill()
         self.abort = abort
+        self.scan_loop_programs = OrderedDict()
+        self.max_scan_loop_programs = 8
+        self.command_recorder = None  # see command_recorder.CommandRecorder
+
+    def command_queue(self, size=2):
+        '''Returns an asynchronous command queue (see CommandQueue).
+        '''
+        return CommandQueue(self, size=size)
+
+    def get_scan_loop_program(self, key):
+        '''Returns the compiled scan loop commands for the given key (see ScanLoopProgram.get_key()).
+        '''
+        try:
+            program = self.scan_loop_programs.pop(key)
+        except KeyError:
+            program = ScanLoopProgram(self.register, self)
+            if len(self.scan_loop_programs) >= self.max_scan_loop_programs:
+                self.scan_loop_programs.popitem(last=False)  # remove least recently used program
+        self.scan_loop_programs[key] = program
+        return program
 
     def add_commands(self, x, y):
         return x + self.zero_cmd + y  # FE needs a zero bits between commands
@@ -252,6 +277,309 @@ class FEI4RegisterUtils(object):
             return value
 
 
+class ScanLoopProgram(object):
+    '''Compiled scan loop commands.
+
+    The commands of the scan loop (mask step and double column commands) are generated once and are replayed each time the scan loop is executed with the same settings (e.g. for each PlsrDAC or GDAC step).
+    Global registers that are not modified by the scan loop, but share an address with a register written during the scan loop (e.g. PlsrDAC), are patched into the replayed commands.
+    '''
+    def __init__(self, register, register_utils):
+        self.register = register
+        self.register_utils = register_utils
+        self.blocks = {}
+        self.address_slice = self.get_command_part_slice("WrRegister", "Address")
+        self.data_slice = self.get_command_part_slice("WrRegister", "GlobalData")
+        self.wr_register_length = self.register.commands["WrRegister"]["bitlength"]
+        self.wr_register_header = self.register.build_command("WrRegister", ChipID=self.register.chip_id_bitarray, Address=0, GlobalData=self.register.get_commands("zeros", length=self.data_slice.stop - self.data_slice.start)[0])[:self.address_slice.start]
+        self.addresses = {}
+        self.patchable_registers = {}
+        self.register_fields = {}
+
+    @staticmethod
+    def get_managed_registers(register):
+        '''Returns the global registers which are temporarily modified when generating the WrFrontEnd command.
+        '''
+        managed_registers = ["S0", "S1", "SR_Clr", "CalEn", "DIGHITIN_SEL", "GateHitOr", "ReadErrorReq", "StopClkPulse", "SR_Clock", "Efuse_Sense", "HITLD_IN", "Colpr_Mode", "Colpr_Addr", "Pixel_Strobes", "Latch_En"]
+        if register.fei4a:
+            managed_registers.append("ReadSkipped")
+        elif register.fei4b:
+            managed_registers.append("SR_Read")
+        return managed_registers
+
+    @staticmethod
+    def get_key(register, **kwargs):
+        '''Returns the program key from the scan loop settings and the state of the managed registers.
+        '''
+        key = []
+        for name, value in sorted(kwargs.iteritems()):
+            if isinstance(value, np.ndarray):
+                value = (value.shape, value.tobytes())
+            elif isinstance(value, list):
+                value = tuple(value)
+            key.append((name, value))
+        key.append(('chip_id', register.chip_id))
+        key.extend([(name, register.get_global_register_value(name)) for name in ScanLoopProgram.get_managed_registers(register)])
+        return tuple(key)
+
+    def get_command_part_slice(self, command_name, part_name):
+        '''Returns the position of a command part inside the command.
+        '''
+        start = 0
+        for part in re.split(r'\s*[+]\s*', self.register.commands[command_name]['bitstream']):
+            if part in self.register.commands:
+                length = self.register.commands[part]['bitlength']
+            else:
+                length = len(part)
+            if part == part_name:
+                return slice(start, start + length)
+            start += length
+        raise ValueError('Command %s has no part %s' % (command_name, part_name))
+
+    def get_commands(self, key, generate, byte_padding=False):
+        '''Returns the compiled commands.
+
+        Parameters
+        ----------
+        key : hashable
+            Key of the commands inside the program (e.g. mask step and double column).
+        generate : function
+            Function returning the list of commands. Only called when compiling the commands.
+        byte_padding : bool
+            Byte padding between the commands.
+
+        Returns
+        -------
+        List of concatenated commands (bitarray), each fits into the command memory.
+        '''
+        try:
+            commands, wr_registers = self.blocks[key]
+        except KeyError:
+            commands, wr_registers = self.compile_commands(generate(), byte_padding=byte_padding)
+            self.blocks[key] = (commands, wr_registers)
+        else:
+            self.patch_commands(commands, wr_registers)
+        return commands
+
+    def send_commands(self, key, generate, byte_padding=False):
+        '''Sending the compiled commands (see get_commands()).
+        '''
+        for command in self.get_commands(key=key, generate=generate, byte_padding=byte_padding):
+            self.register_utils.send_command(command=command)
+
+    def compile_commands(self, commands, byte_padding=False):
+        '''Concatenating commands in the same way FEI4RegisterUtils.send_commands() does.
+
+        Returns
+        -------
+        List of concatenated commands and list of the WrRegister commands (command index, bit offset of the data, address, values of the patchable registers).
+        '''
+        max_length = self.register_utils.command_memory_byte_size * 8
+        separator_length = (self.register_utils.zero_cmd_padded if byte_padding else self.register_utils.zero_cmd).length()
+
+        def get_length(command):
+            return (command.length() + 7) // 8 * 8 if byte_padding else command.length()
+
+        groups = []
+        for command in commands:
+            if groups:
+                length = (get_length(groups[-1][0]) if len(groups[-1]) == 1 else length) + separator_length + get_length(command)
+                if length <= max_length:
+                    groups[-1].append(command)
+                    continue
+            groups.append([command])
+        concatenated_commands = []
+        wr_registers = []
+        for index, group in enumerate(groups):
+            concatenated_command = bitarray(endian='little')
+            for command in group:
+                if len(concatenated_command):
+                    concatenated_command += self.register_utils.zero_cmd_padded if byte_padding else self.register_utils.zero_cmd
+                address = self.get_address(command)
+                if address is not None and self.get_patchable_registers(address):
+                    wr_registers.append((index, concatenated_command.length() + self.data_slice.start, address, dict((name, self.register.global_registers[name]['value']) for name in self.get_patchable_registers(address))))
+                concatenated_command += command
+                if byte_padding and len(group) > 1:
+                    concatenated_command.fill()
+            concatenated_commands.append(concatenated_command)
+        return concatenated_commands, wr_registers
+
+    def patch_commands(self, commands, wr_registers):
+        '''Writing the current value of the patchable registers into the WrRegister commands.
+        '''
+        for index, offset, address, values in wr_registers:
+            for name, value in values.iteritems():
+                curr_value = self.register.global_registers[name]['value']
+                if curr_value != value:
+                    mask, data = self.get_register_field(name, address, curr_value)
+                    commands[index][offset:offset + mask.length()] = (commands[index][offset:offset + mask.length()] & ~mask) | data
+                    values[name] = curr_value
+
+    def get_address(self, command):
+        '''Returns the address of a WrRegister command, None for any other command.
+        '''
+        if command.length() != self.wr_register_length or command[:self.address_slice.start] != self.wr_register_header:
+            return None
+        address_bits = command[self.address_slice].to01()
+        try:
+            return self.addresses[address_bits]
+        except KeyError:
+            address = int(address_bits, 2)
+            self.addresses[address_bits] = address
+            return address
+
+    def get_patchable_registers(self, address):
+        '''Returns the global registers at the given address which are not modified by the scan loop.
+        '''
+        try:
+            return self.patchable_registers[address]
+        except KeyError:
+            managed_registers = self.get_managed_registers(self.register)
+            patchable_registers = [register_object['name'] for register_object in self.register.get_global_register_objects(addresses=address) if not register_object['readonly'] and register_object['name'] not in managed_registers]
+            self.patchable_registers[address] = patchable_registers
+            return patchable_registers
+
+    def get_register_field(self, name, address, value):
+        '''Returns the bit mask and the data of a global register value inside the register data at the given address.
+        '''
+        try:
+            return self.register_fields[(name, address, value)]
+        except KeyError:
+            register_object = self.register.global_registers[name]
+            curr_value = register_object['value']
+            try:
+                register_object['value'] = 0
+                zero_data = self.register.get_global_register_bitsets([address])[0]
+                register_object['value'] = 2 ** register_object['bitlength'] - 1
+                mask = self.register.get_global_register_bitsets([address])[0] ^ zero_data
+                register_object['value'] = value
+                data = self.register.get_global_register_bitsets([address])[0] ^ zero_data
+            finally:
+                register_object['value'] = curr_value
+            self.register_fields[(name, address, value)] = (mask, data)
+            return mask, data
+
+
+class CommandQueue(object):
+    '''Asynchronous command queue for the CMD interface.
+
+    The commands are converted to command memory data when they are put into the queue. A worker thread uploads the next command as soon as the previous command has been finished,
+    while the calling thread is already generating the following commands. The worker thread waits for the previous command with the computed command delay (no busy polling)
+    and signals the completion of each command with an event.
+
+    Usage
+    -----
+    with self.register_utils.command_queue() as command_queue:
+        for command in commands:
+            command_queue.put(command)
+        command_queue.join()  # wait until all commands are finished
+    '''
+    def __init__(self, register_utils, size=2):
+        self.register_utils = register_utils
+        self._queue = Queue(maxsize=size)  # two commands by default (double buffering)
+        self._worker_thread = None
+        self._exc_info = None
+        self._last_finished = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop(raise_exception=exc_type is None)
+
+    @property
+    def is_running(self):
+        return self._worker_thread is not None and self._worker_thread.is_alive()
+
+    def start(self):
+        if self.is_running:
+            raise RuntimeError('Command queue already running: use stop() before start()')
+        self._exc_info = None
+        self._last_finished = None
+        self._worker_thread = Thread(target=self.worker, name='CommandQueueThread')
+        self._worker_thread.daemon = True
+        self._worker_thread.start()
+
+    def stop(self, raise_exception=True):
+        if self._worker_thread is None:
+            return
+        self._queue.put(None)
+        self._worker_thread.join()
+        self._worker_thread = None
+        if raise_exception:
+            self._raise_exception()
+
+    def put(self, command, repeat=1, set_length=True, byte_offset=0, start_sequence_length=None):
+        '''Putting command into queue. Blocks when the queue is full.
+
+        Parameters
+        ----------
+        command : bitarray
+            Command.
+        repeat : int
+            Command repetitions. If None, CMD_REPEAT will not be written.
+        set_length : bool
+            Writing CMD_SIZE. If False, only the command memory is overwritten (e.g. only the beginning of a command).
+        byte_offset : int
+            Byte offset inside the command memory.
+        start_sequence_length : int
+            Length of the start sequence. If None, START_SEQUENCE_LENGTH will not be written.
+
+        Returns
+        -------
+        Event which is set when the command is finished.
+        '''
+        self._raise_exception()
+        if not self.is_running:
+            raise RuntimeError('Command queue not running: use start() before put()')
+        finished = Event()
+        self._queue.put((bitarray_to_array(command), command.length(), repeat, set_length, byte_offset, start_sequence_length, finished))
+        self._last_finished = finished
+        return finished
+
+    def join(self):
+        '''Waiting until all commands in the queue are finished.
+        '''
+        if self._last_finished is not None:
+            while not self._last_finished.wait(0.1):
+                self._raise_exception()
+                if not self.is_running:
+                    break
+        self._raise_exception()
+
+    def worker(self):
+        '''Worker thread uploading the commands into the command memory.
+        '''
+        cmd = self.register_utils.dut['CMD']
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            data, length, repeat, set_length, byte_offset, start_sequence_length, finished = item
+            try:
+                if self._exc_info is None:  # skip all queued commands after an error
+                    if repeat is not None:
+                        cmd['CMD_REPEAT'] = repeat
+                    if set_length:
+                        cmd['CMD_SIZE'] = length
+                    if start_sequence_length is not None:
+                        cmd['START_SEQUENCE_LENGTH'] = start_sequence_length
+                    cmd.set_data(data=data, addr=byte_offset)
+                    cmd['START']
+                    # the next command can be uploaded only after the command has been finished, in the meantime the next command is prepared by the calling thread
+                    # if only a part of the command memory was overwritten or a start sequence is used, the command length is read back from the CMD interface
+                    self.register_utils.wait_for_command(length=length if (set_length and not start_sequence_length) else None, repeat=repeat)
+            except Exception:
+                self._exc_info = sys.exc_info()
+            finally:
+                finished.set()
+
+    def _raise_exception(self):
+        # the exception is kept until start(), the worker thread skips all remaining commands in the meantime
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+
 def read_chip_sn(self):
     '''Reading Chip S/N
 
@@ -632,235 +960,6 @@ def is_fe_ready(self):
         return False
 
 
-def invert_pixel_mask(mask):
-    '''Invert pixel mask (0->1, 1(and greater)->0).
-
-    Parameters
-    ----------
-    mask : array-like
-        Mask.
-
-    Returns
-    -------
-    inverted_mask : array-like
-        Inverted Mask.
-    '''
-    inverted_mask = np.ones(shape=(80, 336), dtype=np.dtype('>u1'))
-    inverted_mask[mask >= 1] = 0
-    return inverted_mask
-
-
-def make_pixel_mask(steps, shift, default=0, value=1, enable_columns=None, mask=None):
-    '''Generate pixel mask.
-
-    Parameters
-    ----------
-    steps : int
-        Number of mask steps, e.g. steps=3 (every third pixel is enabled), steps=336 (one pixel per column), steps=672 (one pixel per double column).
-    shift : int
-        Shift mask by given value to the bottom (towards higher row numbers). From 0 to (steps - 1).
-    default : int
-        Value of pixels that are not selected by the mask.
-    value : int
-        Value of pixels that are selected by the mask.
-    enable_columns : list
-        List of columns where the shift mask will be applied. List elements can range from 1 to 80.
-    mask : array_like
-        Additional mask. Must be convertible to an array of booleans with the same shape as mask array. True indicates a masked (i.e. invalid) data. Masked pixels will be set to default value.
-
-    Returns
-    -------
-    mask_array : numpy.ndarray
-        Mask array.
-
-    Usage
-    -----
-    shift_mask = 'enable'
-    steps = 3 # three step mask
-    for mask_step in range(steps):
-        commands = []
-        commands.extend(self.register.get_commands("ConfMode"))
-        mask_array = make_pixel_mask(steps=steps, step=mask_step)
-        self.register.set_pixel_register_value(shift_mask, mask_array)
-        commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=True, name=shift_mask))
-        self.register_utils.send_commands(commands)
-        # do something here
-    '''
-    shape = (80, 336)
-    # value = np.zeros(dimension, dtype = np.uint8)
-    mask_array = np.full(shape, default, dtype=np.uint8)
-    # FE columns and rows are starting from 1
-    if enable_columns:
-        odd_columns = [odd - 1 for odd in enable_columns if odd % 2 != 0]
-        even_columns = [even - 1 for even in enable_columns if even % 2 == 0]
-    else:
-        odd_columns = range(0, 80, 2)
-        even_columns = range(1, 80, 2)
-    odd_rows = np.arange(shift % steps, 336, steps)
-    even_row_offset = ((steps // 2) + shift) % steps  # // integer devision
-    even_rows = np.arange(even_row_offset, 336, steps)
-    if odd_columns:
-        odd_col_rows = itertools.product(odd_columns, odd_rows)  # get any combination of column and row, no for loop needed
-        for odd_col_row in odd_col_rows:
-            mask_array[odd_col_row[0], odd_col_row[1]] = value  # advanced indexing
-    if even_columns:
-        even_col_rows = itertools.product(even_columns, even_rows)
-        for even_col_row in even_col_rows:
-            mask_array[even_col_row[0], even_col_row[1]] = value
-    if mask is not None:
-        mask_array = np.ma.array(mask_array, mask=mask, fill_value=default)
-        mask_array = mask_array.filled()
-    return mask_array
-
-
-def make_pixel_mask_from_col_row(column, row, default=0, value=1):
-    '''Generate mask from column and row lists
-
-    Parameters
-    ----------
-    column : iterable, int
-        List of colums values.
-    row : iterable, int
-        List of row values.
-    default : int
-        Value of pixels that are not selected by the mask.
-    value : int
-        Value of pixels that are selected by the mask.
-
-    Returns
-    -------
-    mask : numpy.ndarray
-    '''
-    # FE columns and rows start from 1
-    col_array = np.array(column) - 1
-    row_array = np.array(row) - 1
-    if np.any(col_array >= 80) or np.any(col_array < 0) or np.any(row_array >= 336) or np.any(col_array < 0):
-        raise ValueError('Column and/or row out of range')
-    shape = (80, 336)
-    mask = np.full(shape, default, dtype=np.uint8)
-    mask[col_array, row_array] = value  # advanced indexing
-    return mask
-
-
-def make_box_pixel_mask_from_col_row(column, row, default=0, value=1):
-    '''Generate box shaped mask from column and row lists. Takes the minimum and maximum value from each list.
-
-    Parameters
-    ----------
-    column : iterable, int
-        List of colums values.
-    row : iterable, int
-        List of row values.
-    default : int
-        Value of pixels that are not selected by the mask.
-    value : int
-        Value of pixels that are selected by the mask.
-
-    Returns
-    -------
-    numpy.ndarray
-    '''
-    # FE columns and rows start from 1
-    col_array = np.array(column) - 1
-    row_array = np.array(row) - 1
-    if np.any(col_array >= 80) or np.any(col_array < 0) or np.any(row_array >= 336) or np.any(col_array < 0):
-        raise ValueError('Column and/or row out of range')
-    shape = (80, 336)
-    mask = np.full(shape, default, dtype=np.uint8)
-    if column and row:
-        mask[col_array.min():col_array.max() + 1, row_array.min():row_array.max() + 1] = value  # advanced indexing
-    return mask
-
-
-def make_xtalk_mask(mask):
-    """
-    Generate xtalk mask (row - 1, row + 1) from pixel mask.
-
-    Parameters
-    ----------
-    mask : ndarray
-        Pixel mask.
-
-    Returns
-    -------
-    ndarray
-        Xtalk mask.
-
-    Example
-    -------
-    Input:
-    [[1 0 0 0 0 0 1 0 0 0 ... 0 0 0 0 1 0 0 0 0 0]
-     [0 0 0 1 0 0 0 0 0 1 ... 0 1 0 0 0 0 0 1 0 0]
-     ...
-     [1 0 0 0 0 0 1 0 0 0 ... 0 0 0 0 1 0 0 0 0 0]
-     [0 0 0 1 0 0 0 0 0 1 ... 0 1 0 0 0 0 0 1 0 0]]
-
-    Output:
-    [[0 1 0 0 0 1 0 1 0 0 ... 0 0 0 1 0 1 0 0 0 1]
-     [0 0 1 0 1 0 0 0 1 0 ... 1 0 1 0 0 0 1 0 1 0]
-     ...
-     [0 1 0 0 0 1 0 1 0 0 ... 0 0 0 1 0 1 0 0 0 1]
-     [0 0 1 0 1 0 0 0 1 0 ... 1 0 1 0 0 0 1 0 1 0]]
-    """
-    col, row = mask.nonzero()
-    row_plus_one = row + 1
-    del_index = np.where(row_plus_one > 335)
-    row_plus_one = np.delete(row_plus_one, del_index)
-    col_plus_one = np.delete(col.copy(), del_index)
-    row_minus_one = row - 1
-    del_index = np.where(row_minus_one > 335)
-    row_minus_one = np.delete(row_minus_one, del_index)
-    col_minus_one = np.delete(col.copy(), del_index)
-    col = np.concatenate((col_plus_one, col_minus_one))
-    row = np.concatenate((row_plus_one, row_minus_one))
-    return make_pixel_mask_from_col_row(col + 1, row + 1)
-
-
-def make_checkerboard_mask(column_distance, row_distance, column_offset=0, row_offset=0, default=0, value=1):
-    """
-    Generate chessboard/checkerboard mask.
-
-    Parameters
-    ----------
-    column_distance : int
-        Column distance of the enabled pixels.
-    row_distance : int
-        Row distance of the enabled pixels.
-    column_offset : int
-        Additional column offset which shifts the columns by the given amount.
-    column_offset : int
-        Additional row offset which shifts the rows by the given amount.
-
-    Returns
-    -------
-    ndarray
-        Chessboard mask.
-
-    Example
-    -------
-    Input:
-    column_distance : 6
-    row_distance : 2
-
-    Output:
-    [[1 0 0 0 0 0 1 0 0 0 ... 0 0 0 0 1 0 0 0 0 0]
-     [0 0 0 0 0 0 0 0 0 0 ... 0 0 0 0 0 0 0 0 0 0]
-     [0 0 0 1 0 0 0 0 0 1 ... 0 1 0 0 0 0 0 1 0 0]
-     ...
-     [0 0 0 0 0 0 0 0 0 0 ... 0 0 0 0 0 0 0 0 0 0]
-     [0 0 0 1 0 0 0 0 0 1 ... 0 1 0 0 0 0 0 1 0 0]
-     [0 0 0 0 0 0 0 0 0 0 ... 0 0 0 0 0 0 0 0 0 0]]
-    """
-    col_shape = (336,)
-    col = np.full(col_shape, fill_value=default, dtype=np.uint8)
-    col[::row_distance] = value
-    shape = (80, 336)
-    chessboard_mask = np.full(shape, fill_value=default, dtype=np.uint8)
-    chessboard_mask[column_offset::column_distance * 2] = np.roll(col, row_offset)
-    chessboard_mask[column_distance + column_offset::column_distance * 2] = np.roll(col, row_distance / 2 + row_offset)
-    return chessboard_mask
-
-
 def parse_key_value(filename, key, deletechars=''):
     with open(filename, 'r') as f:
         return parse_key_value_from_file(f, key, deletechars)
@@ -885,9 +984,12 @@ def calculate_wait_cycles(mask_steps):
     return int(336.0 / mask_steps * 25.0 + 600)
 
 
-def scan_loop(self, command, repeat_command=100, use_delay=True, additional_delay=0, mask_steps=3, enable_mask_steps=None, enable_double_columns=None, same_mask_for_all_dc=False, fast_dc_loop=True, bol_function=None, eol_function=None, digital_injection=False, enable_shift_masks=None, disable_shift_masks=None, restore_shift_masks=True, mask=None, double_column_correction=False):
+def scan_loop(self, command, repeat_command=100, use_delay=True, additional_delay=0, mask_steps=3, enable_mask_steps=None, enable_double_columns=None, same_mask_for_all_dc=False, fast_dc_loop=True, bol_function=None, eol_function=None, digital_injection=False, enable_shift_masks=None, disable_shift_masks=None, restore_shift_masks=True, mask=None, double_column_correction=False, broadcast=True):
     '''Implementation of the scan loops (mask shifting, loop over double columns, repeatedly sending any arbitrary command).
 
+    In multi-FE runs (see Fei4RunBase.multi_fe), the commands are broadcasted to all FEs, so that all FEs are scanned at once.
+    If the FEs need different masks, the scan loop is executed for each FE, while the shift masks of the other FEs are disabled.
+
     Parameters
     ----------
     command : BitVector
@@ -924,6 +1026,8 @@ def scan_loop(self, command, repeat_command=100, use_delay=True, additional_dela
         Additional mask. Must be convertible to an array of booleans with the same shape as mask array. True indicates a masked pixel. Masked pixels will be disabled during shifting of the enable shift masks, and enabled during shifting disable shift mask.
     double_column_correction : str, bool, list, tuple
         Enables double column PlsrDAC correction. If value is a filename (string) or list/tuple, the default PlsrDAC correction will be overwritten. First line of the file must be a Python list ([0, 0, ...])
+    broadcast : bool
+        Multi-FE runs only. If True, the commands are broadcasted to all FEs. If False, or if mask is a dictionary with the mask of each RX channel, the scan loop is executed for each FE.
     '''
     if not isinstance(command, bitarray):
         raise TypeError
@@ -934,6 +1038,46 @@ def scan_loop(self, command, repeat_command=100, use_delay=True, additional_dela
     if disable_shift_masks is None:
         disable_shift_masks = []
 
+    def restore_configuration():
+        self.register_utils.configure_global()  # always restore global configuration
+        if restore_shift_masks:
+            commands = []
+            commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, name=disable_shift_masks))
+            commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, name=enable_shift_masks))
+            commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, name="EnableDigInj"))
+            self.register_utils.send_commands(commands)
+
+    def write_disabled_shift_masks():
+        # disabling shift masks of the FE (or of all FEs, if register is the broadcast register)
+        self.register.create_restore_point()
+        commands = []
+        commands.extend(self.register.get_commands("ConfMode"))
+        if disable_shift_masks:
+            map(lambda mask_name: self.register.set_pixel_register_value(mask_name, 1), disable_shift_masks)
+            commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=True, name=disable_shift_masks, joint_write=True))
+        if enable_shift_masks:
+            map(lambda mask_name: self.register.set_pixel_register_value(mask_name, 0), enable_shift_masks)
+            commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=True, name=enable_shift_masks, joint_write=True))
+        commands.extend(self.register.get_commands("RunMode"))
+        self.register_utils.send_commands(commands)
+        self.register.restore()
+
+    multi_fe = getattr(self, 'multi_fe', False) and self.selected_channel is None  # multi-FE run, register is the broadcast register
+    if multi_fe and (not broadcast or isinstance(mask, dict)):
+        # only the FE which is scanned has enabled shift masks
+        write_disabled_shift_masks()
+        for channel in self.registers:
+            if self.stop_run.is_set():
+                break
+            with self.select_fe(channel):
+                logging.info('Scan loop for FE on RX channel %d', channel)
+                scan_loop(self, command=command, repeat_command=repeat_command, use_delay=use_delay, additional_delay=additional_delay, mask_steps=mask_steps, enable_mask_steps=enable_mask_steps, enable_double_columns=enable_double_columns, same_mask_for_all_dc=same_mask_for_all_dc, fast_dc_loop=fast_dc_loop, bol_function=bol_function, eol_function=eol_function, digital_injection=digital_injection, enable_shift_masks=enable_shift_masks, disable_shift_masks=disable_shift_masks, restore_shift_masks=False, mask=mask.get(channel) if isinstance(mask, dict) else mask, double_column_correction=double_column_correction)
+                write_disabled_shift_masks()
+        for channel in self.registers:
+            with self.select_fe(channel):
+                restore_configuration()
+        return
+
     # get PlsrDAC correction
     if isinstance(double_column_correction, basestring):  # from file
         with open(double_column_correction) as fp:
@@ -963,15 +1107,7 @@ def scan_loop(self, command, repeat_command=100, use_delay=True, additional_dela
         scan_loop_command = command
 
     def enable_columns(dc):
-        if digital_injection:
-            return [dc * 2 + 1, dc * 2 + 2]
-        else:  # analog injection
-            if dc == 0:
-                return [1]
-            elif dc == 39:
-                return [78, 79, 80]
-            else:
-                return [dc * 2, dc * 2 + 1]
+        return get_injected_columns(dc, digital_injection=digital_injection)
 
     def write_double_columns(dc):
         if digital_injection:
@@ -985,15 +1121,64 @@ def scan_loop(self, command, repeat_command=100, use_delay=True, additional_dela
                 return [dc - 1, dc]
 
     def get_dc_address_command(dc):
-        commands = []
-        commands.append(conf_mode_command)
         self.register.set_global_register_value("Colpr_Addr", dc)
-        commands.append(self.register.get_commands("WrRegister", name=["Colpr_Addr"])[0])
         if double_column_correction:
             self.register.set_global_register_value("PlsrDAC", initial_plsr_dac + int(round(plsr_dac_correction[dc])))
-            commands.append(self.register.get_commands("WrRegister", name=["PlsrDAC"])[0])
-        commands.append(run_mode_command)
-        return self.register_utils.concatenate_commands(commands, byte_padding=True)
+
+        def generate():
+            commands = []
+            commands.append(conf_mode_command)
+            commands.append(self.register.get_commands("WrRegister", name=["Colpr_Addr"])[0])
+            if double_column_correction:
+                commands.append(self.register.get_commands("WrRegister", name=["PlsrDAC"])[0])
+            commands.append(run_mode_command)
+            return commands
+        return program.get_commands(key=('dc', dc), generate=generate, byte_padding=True)[0]
+
+    def get_mask_commands(mask_step, dc=None, dcs=None):
+        # set pixel registers
+        if dc is None:
+            if same_mask_for_all_dc:  # generate and write first mask step
+                if disable_shift_masks:
+                    curr_dis_mask = get_pixel_mask(steps=mask_steps, shift=mask_step, default=1, value=0, mask=mask)
+                    map(lambda mask_name: self.register.set_pixel_register_value(mask_name, curr_dis_mask), disable_shift_masks)
+                if enable_shift_masks:
+                    curr_en_mask = get_pixel_mask(steps=mask_steps, shift=mask_step, mask=mask)
+                    map(lambda mask_name: self.register.set_pixel_register_value(mask_name, curr_en_mask), enable_shift_masks)
+            else:  # set masks to default values
+                if disable_shift_masks:
+                    map(lambda mask_name: self.register.set_pixel_register_value(mask_name, 1), disable_shift_masks)
+                if enable_shift_masks:
+                    map(lambda mask_name: self.register.set_pixel_register_value(mask_name, 0), enable_shift_masks)
+        else:
+            ec = enable_columns(dc)
+            if disable_shift_masks:
+                curr_dis_mask = get_pixel_mask(steps=mask_steps, shift=mask_step, default=1, value=0, enable_columns=ec, mask=mask)
+                map(lambda mask_name: self.register.set_pixel_register_value(mask_name, curr_dis_mask), disable_shift_masks)
+            if enable_shift_masks:
+                curr_en_mask = get_pixel_mask(steps=mask_steps, shift=mask_step, enable_columns=ec, mask=mask)
+                map(lambda mask_name: self.register.set_pixel_register_value(mask_name, curr_en_mask), enable_shift_masks)
+        # DIGHITIN_SEL is written last, since after mask writing it is disabled
+        if digital_injection is True:
+            self.register.set_global_register_value("DIGHITIN_SEL", 1)
+
+        def generate():
+            commands = []
+            commands.append(conf_mode_command)
+            if dc is None:
+                if disable_shift_masks:
+                    commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False if (same_mask_for_all_dc and mask is not None) else True, name=disable_shift_masks, joint_write=True))
+                if enable_shift_masks:
+                    commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False if (same_mask_for_all_dc and mask is not None) else True, name=enable_shift_masks, joint_write=True))
+            else:
+                if disable_shift_masks:
+                    commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, dcs=dcs, name=disable_shift_masks, joint_write=True))
+                if enable_shift_masks:
+                    commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, dcs=dcs, name=enable_shift_masks, joint_write=True))
+            if digital_injection is True:
+                commands.extend(self.register.get_commands("WrRegister", name=["DIGHITIN_SEL"]))
+            return commands
+        return program.get_commands(key=('mask', mask_step, dc, None if dcs is None else tuple(dcs)), generate=generate)
 
     if not enable_mask_steps:
         enable_mask_steps = range(mask_steps)
@@ -1001,6 +1186,9 @@ def scan_loop(self, command, repeat_command=100, use_delay=True, additional_dela
     if not enable_double_columns:
         enable_double_columns = range(40)
 
+    # compiled scan loop commands, reused when the scan loop is called again with the same settings
+    program = self.register_utils.get_scan_loop_program(ScanLoopProgram.get_key(self.register, mask_steps=mask_steps, enable_mask_steps=enable_mask_steps, enable_double_columns=enable_double_columns, same_mask_for_all_dc=same_mask_for_all_dc, digital_injection=digital_injection, enable_shift_masks=enable_shift_masks, disable_shift_masks=disable_shift_masks, mask=None if mask is None else np.asarray(mask, dtype=bool), double_column_correction=bool(double_column_correction)))
+
     # preparing for scan
     commands = []
     commands.append(conf_mode_command)
@@ -1031,194 +1219,126 @@ def scan_loop(self, command, repeat_command=100, use_delay=True, additional_dela
     commands.extend(self.register.get_commands("WrRegister", name=["DIGHITIN_SEL"]))
     self.register_utils.send_commands(commands, concatenate=True)
 
-    for mask_step in enable_mask_steps:
-        if self.stop_run.is_set():
-            break
-        commands = []
-        commands.append(conf_mode_command)
-        if same_mask_for_all_dc:  # generate and write first mask step
-            if disable_shift_masks:
-                curr_dis_mask = make_pixel_mask(steps=mask_steps, shift=mask_step, default=1, value=0, mask=mask)
-                map(lambda mask_name: self.register.set_pixel_register_value(mask_name, curr_dis_mask), disable_shift_masks)
-                commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False if mask is not None else True, name=disable_shift_masks, joint_write=True))
-            if enable_shift_masks:
-                curr_en_mask = make_pixel_mask(steps=mask_steps, shift=mask_step, mask=mask)
-                map(lambda mask_name: self.register.set_pixel_register_value(mask_name, curr_en_mask), enable_shift_masks)
-                commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False if mask is not None else True, name=enable_shift_masks, joint_write=True))
-            if digital_injection is True:  # write EnableDigInj last
-                # write DIGHITIN_SEL since after mask writing it is disabled
-                self.register.set_global_register_value("DIGHITIN_SEL", 1)
-                commands.extend(self.register.get_commands("WrRegister", name=["DIGHITIN_SEL"]))
-        else:  # set masks to default values
-            if disable_shift_masks:
-                map(lambda mask_name: self.register.set_pixel_register_value(mask_name, 1), disable_shift_masks)
-                commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=True, name=disable_shift_masks, joint_write=True))
-            if enable_shift_masks:
-                map(lambda mask_name: self.register.set_pixel_register_value(mask_name, 0), enable_shift_masks)
-                commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=True, name=enable_shift_masks, joint_write=True))
-            if digital_injection is True:  # write EnableDigInj last
-                # write DIGHITIN_SEL since after mask writing it is disabled
-                self.register.set_global_register_value("DIGHITIN_SEL", 1)
-                commands.extend(self.register.get_commands("WrRegister", name=["DIGHITIN_SEL"]))
-        self.register_utils.send_commands(commands, concatenate=True)
-        logging.info('%d injection(s): mask step %d %s', repeat_command, mask_step, ('[%d - %d]' % (enable_mask_steps[0], enable_mask_steps[-1])) if len(enable_mask_steps) > 1 else ('[%d]' % enable_mask_steps[0]))
-
-        if same_mask_for_all_dc:
-            if fast_dc_loop:  # fast DC loop with optimized pixel register writing
-                # set repeat, should be 1 by default when arriving here
-                self.dut['CMD']['CMD_REPEAT'] = repeat_command
-
-                # get DC command for the first DC in the list, DC command is byte padded
-                # fill CMD memory with DC command and scan loop command, inside the loop only overwrite DC command
-                dc_address_command = get_dc_address_command(enable_double_columns[0])
-                self.dut['CMD']['START_SEQUENCE_LENGTH'] = len(dc_address_command)
-                self.register_utils.set_command(command=self.register_utils.concatenate_commands((dc_address_command, scan_loop_command), byte_padding=False))
-
-                for index, dc in enumerate(enable_double_columns):
-                    if self.stop_run.is_set():
-                        break
-                    if index != 0:  # full command is already set before loop
-                        # get DC command before wait to save some time
-                        dc_address_command = get_dc_address_command(dc)
-                        self.register_utils.wait_for_command()
-                        if eol_function:
-                            eol_function()  # do this after command has finished
-                        # only set command after FPGA is ready
-                        # overwrite only the DC command in CMD memory
-                        self.register_utils.set_command(dc_address_command, set_length=False)  # do not set length here, because it was already set up before the loop
-
-                    if bol_function:
-                        bol_function()
+    # commands are recorded for each mask step in a dry run (see command_recorder.DryRun)
+    command_recorder = self.register_utils.command_recorder
+    if command_recorder is not None:
+        command_recorder_section = command_recorder.section
+
+    try:
+        for mask_step in enable_mask_steps:
+            if self.stop_run.is_set():
+                break
+            if command_recorder is not None:
+                command_recorder.section = 'mask step %d' % mask_step
+            for mask_command in get_mask_commands(mask_step):
+                self.register_utils.send_command(mask_command)
+            logging.info('%d injection(s): mask step %d %s', repeat_command, mask_step, ('[%d - %d]' % (enable_mask_steps[0], enable_mask_steps[-1])) if len(enable_mask_steps) > 1 else ('[%d]' % enable_mask_steps[0]))
+
+            if same_mask_for_all_dc:
+                if fast_dc_loop:  # fast DC loop with optimized pixel register writing
+                    # the next DC command is uploaded by the command queue as soon as the previous command has been finished
+                    with self.register_utils.command_queue() as command_queue:
+                        for index, dc in enumerate(enable_double_columns):
+                            if self.stop_run.is_set():
+                                break
+                            # get DC command, DC command is byte padded
+                            dc_address_command = get_dc_address_command(dc)
+                            if index != 0 and (bol_function or eol_function):
+                                command_queue.join()
+                                if eol_function:
+                                    eol_function()  # do this after command has finished
+
+                            if bol_function:
+                                bol_function()
+
+                            if index == 0:
+                                # fill CMD memory with DC command and scan loop command, inside the loop only overwrite DC command
+                                command_queue.put(command=self.register_utils.concatenate_commands((dc_address_command, scan_loop_command), byte_padding=False), repeat=repeat_command, start_sequence_length=len(dc_address_command))
+                            else:
+                                # overwrite only the DC command in CMD memory
+                                command_queue.put(command=dc_address_command, repeat=None, set_length=False)  # do not set length here, because it was already set up before the loop
 
-                    self.dut['CMD']['START']
+                        # wait here before we go on because we just jumped out of the loop
+                        command_queue.join()
+                    if eol_function:
+                        eol_function()
+                    self.dut['CMD']['START_SEQUENCE_LENGTH'] = 0
 
-                # wait here before we go on because we just jumped out of the loop
-                self.register_utils.wait_for_command()
-                if eol_function:
-                    eol_function()
-                self.dut['CMD']['START_SEQUENCE_LENGTH'] = 0
+                else:  # the slow DC loop allows writing commands inside bol and eol functions
+                    for index, dc in enumerate(enable_double_columns):
+                        if self.stop_run.is_set():
+                            break
+                        dc_address_command = get_dc_address_command(dc)
+                        self.register_utils.send_command(dc_address_command)
 
-            else:  # the slow DC loop allows writing commands inside bol and eol functions
-                for index, dc in enumerate(enable_double_columns):
-                    if self.stop_run.is_set():
-                        break
-                    dc_address_command = get_dc_address_command(dc)
-                    self.register_utils.send_command(dc_address_command)
+                        if bol_function:
+                            bol_function()
 
-                    if bol_function:
-                        bol_function()
+                        self.register_utils.send_command(scan_loop_command, repeat=repeat_command)
 
-                    self.register_utils.send_command(scan_loop_command, repeat=repeat_command)
+                        if eol_function:
+                            eol_function()
 
+            else:
+                if fast_dc_loop:  # fast DC loop with optimized pixel register writing
+                    # mask commands and DC commands are uploaded by the command queue as soon as the previous command has been finished
+                    with self.register_utils.command_queue() as command_queue:
+                        for index, dc in enumerate(enable_double_columns):
+                            if self.stop_run.is_set():
+                                break
+                            dcs = write_double_columns(dc)
+                            if index != 0:
+                                dcs.extend(write_double_columns(enable_double_columns[index - 1]))
+                            # get commands before wait to save some time
+                            mask_commands = get_mask_commands(mask_step, dc=dc, dcs=dcs)
+                            dc_address_command = get_dc_address_command(dc)
+
+                            if index != 0 and eol_function:
+                                command_queue.join()
+                                eol_function()  # do this after command has finished
+                            for mask_command in mask_commands:
+                                command_queue.put(command=mask_command)
+
+                            if bol_function:
+                                command_queue.join()
+                                bol_function()
+
+                            command_queue.put(command=self.register_utils.concatenate_commands((dc_address_command, scan_loop_command), byte_padding=False), repeat=repeat_command, start_sequence_length=len(dc_address_command))
+
+                        command_queue.join()
                     if eol_function:
                         eol_function()
+                    self.dut['CMD']['START_SEQUENCE_LENGTH'] = 0
 
-        else:
-            if fast_dc_loop:  # fast DC loop with optimized pixel register writing
-                dc = enable_double_columns[0]
-                ec = enable_columns(dc)
-                dcs = write_double_columns(dc)
-                commands = []
-                commands.append(conf_mode_command)
-                if disable_shift_masks:
-                    curr_dis_mask = make_pixel_mask(steps=mask_steps, shift=mask_step, default=1, value=0, enable_columns=ec, mask=mask)
-                    map(lambda mask_name: self.register.set_pixel_register_value(mask_name, curr_dis_mask), disable_shift_masks)
-                    commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, dcs=dcs, name=disable_shift_masks, joint_write=True))
-                if enable_shift_masks:
-                    curr_en_mask = make_pixel_mask(steps=mask_steps, shift=mask_step, enable_columns=ec, mask=mask)
-                    map(lambda mask_name: self.register.set_pixel_register_value(mask_name, curr_en_mask), enable_shift_masks)
-                    commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, dcs=dcs, name=enable_shift_masks, joint_write=True))
-                if digital_injection is True:
-                    self.register.set_global_register_value("DIGHITIN_SEL", 1)
-                    commands.extend(self.register.get_commands("WrRegister", name=["DIGHITIN_SEL"]))
-                self.register_utils.send_commands(commands, concatenate=True)
-
-                dc_address_command = get_dc_address_command(dc)
-                self.dut['CMD']['START_SEQUENCE_LENGTH'] = len(dc_address_command)
-                self.dut['CMD']['CMD_REPEAT'] = repeat_command
-                self.register_utils.set_command(command=self.register_utils.concatenate_commands((dc_address_command, scan_loop_command), byte_padding=False))
-
-                for index, dc in enumerate(enable_double_columns):
-                    if self.stop_run.is_set():
-                        break
-                    if index != 0:  # full command is already set before loop
-                        ec = enable_columns(dc)
+                else:
+                    for index, dc in enumerate(enable_double_columns):
+                        if self.stop_run.is_set():
+                            break
                         dcs = write_double_columns(dc)
-                        dcs.extend(write_double_columns(enable_double_columns[index - 1]))
-                        commands = []
-                        commands.append(conf_mode_command)
-                        if disable_shift_masks:
-                            curr_dis_mask = make_pixel_mask(steps=mask_steps, shift=mask_step, default=1, value=0, enable_columns=ec, mask=mask)
-                            map(lambda mask_name: self.register.set_pixel_register_value(mask_name, curr_dis_mask), disable_shift_masks)
-                            commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, dcs=dcs, name=disable_shift_masks, joint_write=True))
-                        if enable_shift_masks:
-                            curr_en_mask = make_pixel_mask(steps=mask_steps, shift=mask_step, enable_columns=ec, mask=mask)
-                            map(lambda mask_name: self.register.set_pixel_register_value(mask_name, curr_en_mask), enable_shift_masks)
-                            commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, dcs=dcs, name=enable_shift_masks, joint_write=True))
-                        if digital_injection is True:
-                            self.register.set_global_register_value("DIGHITIN_SEL", 1)
-                            commands.extend(self.register.get_commands("WrRegister", name=["DIGHITIN_SEL"]))
-                        dc_address_command = get_dc_address_command(dc)
-
-                        self.register_utils.wait_for_command()
-                        if eol_function:
-                            eol_function()  # do this after command has finished
-                        self.register_utils.send_commands(commands, concatenate=True)
+                        if index != 0:
+                            dcs.extend(write_double_columns(enable_double_columns[index - 1]))
+                        for mask_command in get_mask_commands(mask_step, dc=dc, dcs=dcs):
+                            self.register_utils.send_command(mask_command)
 
-                        self.dut['CMD']['START_SEQUENCE_LENGTH'] = len(dc_address_command)
-                        self.dut['CMD']['CMD_REPEAT'] = repeat_command
-                        self.register_utils.set_command(command=self.register_utils.concatenate_commands((dc_address_command, scan_loop_command), byte_padding=False))
-
-                    if bol_function:
-                        bol_function()
-
-                    self.dut['CMD']['START']
+                        dc_address_command = get_dc_address_command(dc)
+                        self.register_utils.send_command(dc_address_command)
 
-                self.register_utils.wait_for_command()
-                if eol_function:
-                    eol_function()
-                self.dut['CMD']['START_SEQUENCE_LENGTH'] = 0
+                        if bol_function:
+                            bol_function()
 
-            else:
-                for index, dc in enumerate(enable_double_columns):
-                    if self.stop_run.is_set():
-                        break
-                    ec = enable_columns(dc)
-                    dcs = write_double_columns(dc)
-                    if index != 0:
-                        dcs.extend(write_double_columns(enable_double_columns[index - 1]))
-                    commands = []
-                    commands.append(conf_mode_command)
-                    if disable_shift_masks:
-                        curr_dis_mask = make_pixel_mask(steps=mask_steps, shift=mask_step, default=1, value=0, enable_columns=ec, mask=mask)
-                        map(lambda mask_name: self.register.set_pixel_register_value(mask_name, curr_dis_mask), disable_shift_masks)
-                        commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, dcs=dcs, name=disable_shift_masks, joint_write=True))
-                    if enable_shift_masks:
-                        curr_en_mask = make_pixel_mask(steps=mask_steps, shift=mask_step, enable_columns=ec, mask=mask)
-                        map(lambda mask_name: self.register.set_pixel_register_value(mask_name, curr_en_mask), enable_shift_masks)
-                        commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, dcs=dcs, name=enable_shift_masks, joint_write=True))
-                    if digital_injection is True:
-                        self.register.set_global_register_value("DIGHITIN_SEL", 1)
-                        commands.extend(self.register.get_commands("WrRegister", name=["DIGHITIN_SEL"]))
-                    self.register_utils.send_commands(commands, concatenate=True)
-
-                    dc_address_command = get_dc_address_command(dc)
-                    self.register_utils.send_command(dc_address_command)
-
-                    if bol_function:
-                        bol_function()
-
-                    self.register_utils.send_command(scan_loop_command, repeat=repeat_command)
+                        self.register_utils.send_command(scan_loop_command, repeat=repeat_command)
 
-                    if eol_function:
-                        eol_function()
+                        if eol_function:
+                            eol_function()
+    finally:
+        if command_recorder is not None:
+            command_recorder.section = command_recorder_section
 
     # restoring default values
     self.register.restore(name=restore_point_name)
-    self.register_utils.configure_global()  # always restore global configuration
-    if restore_shift_masks:
-        commands = []
-        commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, name=disable_shift_masks))
-        commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, name=enable_shift_masks))
-        commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, name="EnableDigInj"))
-        self.register_utils.send_commands(commands)
+    if multi_fe:  # commands were broadcasted, restoring the configuration of each FE
+        for channel in self.registers:
+            with self.select_fe(channel):
+                restore_configuration()
+    else:
+        restore_configuration()
@@ -0,0 +1,228 @@
+''' Sequential testing for the tunings.
+
+Instead of sending a fixed number of injections for each tuning step, the injections are sent in batches (see sequential_scan_loop()).
+After each batch, the decision of each pixel (e.g. occupancy above or below 50%, mean ToT above or below the target ToT),
+or the decision of the median/mean of all pixels, is tested. Pixels with a settled decision are masked and not injected anymore
+(see mask parameter of scan_loop()), mask steps and double columns without unsettled pixels are skipped.
+The injections stop when the decisions of (almost) all pixels are settled or the maximum number of injections is reached.
+'''
+import numpy as np
+
+from pybar.fei4.register_utils import scan_loop
+from pybar.fei4.mask_utils import get_injected_pixels, get_scan_loop_selection, get_newly_masked_pixels
+from pybar.daq.readout_utils import convert_data_array, is_data_record, is_fe_word, logical_and, data_array_from_data_iterable, get_col_row_array_from_data_record_array, get_col_row_tot_array_from_data_record_array
+
+
+def binomial_decision(hits, injections, p=0.5, z=3.0):
+    '''Decision whether the hit probability is above or below p (Wilson score interval).
+
+    Parameters
+    ----------
+    hits : array-like
+        Number of hits.
+    injections : array-like
+        Number of injections.
+    p : float
+        Probability to test against (e.g. 0.5 for threshold tuning).
+    z : float
+        Width of the confidence interval in standard deviations.
+
+    Returns
+    -------
+    Array with 1 (above p), -1 (below p) and 0 (not yet decided).
+    '''
+    hits = np.asarray(hits, dtype=np.float64)
+    injections = np.asarray(injections, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p_hat = np.clip(hits / injections, 0.0, 1.0)  # noise hits can exceed the number of injections
+        denominator = 1.0 + z ** 2 / injections
+        center = (p_hat + z ** 2 / (2.0 * injections)) / denominator
+        half_width = z * np.sqrt(p_hat * (1.0 - p_hat) / injections + z ** 2 / (4.0 * injections ** 2)) / denominator
+        decision = np.zeros(shape=np.shape(hits), dtype=np.int8)
+        decision[np.asarray(center - half_width > p)] = 1
+        decision[np.asarray(center + half_width < p)] = -1
+    return decision
+
+
+def mean_decision(sum_values, sum_squares, n, target, z=3.0, quantization=1.0):
+    '''Decision whether the mean (e.g. mean ToT) is above or below the target value.
+
+    The standard error of the mean is calculated from the sample variance and the quantization (e.g. ToT code) of the values.
+
+    Parameters
+    ----------
+    sum_values : array-like
+        Sum of the values.
+    sum_squares : array-like
+        Sum of the squared values.
+    n : array-like
+        Number of values.
+    target : float
+        Target value.
+    z : float
+        Width of the confidence interval in standard errors.
+    quantization : float
+        Step size of the values.
+
+    Returns
+    -------
+    Array with 1 (above target), -1 (below target) and 0 (not yet decided).
+    '''
+    sum_values = np.asarray(sum_values, dtype=np.float64)
+    sum_squares = np.asarray(sum_squares, dtype=np.float64)
+    n = np.asarray(n, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = sum_values / n
+        variance = np.maximum(sum_squares / n - mean ** 2, 0.0) + quantization ** 2 / 12.0
+        sem = np.sqrt(variance / n)
+        decision = np.zeros(shape=np.shape(sum_values), dtype=np.int8)
+        decision[np.asarray(mean - z * sem > target)] = 1
+        decision[np.asarray(mean + z * sem < target)] = -1
+    return decision
+
+
+def normalize(values, injections, n_injections):
+    '''Scales the values (e.g. occupancy) of each pixel to n_injections. Pixels without injections are set to 0.
+
+    Parameters
+    ----------
+    values : array-like
+        Values (array with shape (columns, rows)).
+    injections : array-like
+        Number of injections of each pixel (see sequential_scan_loop()).
+    n_injections : int
+        Number of injections to scale to.
+
+    Returns
+    -------
+    Array with shape (columns, rows).
+    '''
+    injections = np.asarray(injections)
+    return np.where(injections > 0, np.asarray(values, dtype=np.float64) * n_injections / np.maximum(injections, 1), 0.0)
+
+
+def get_occupancy(data_array):
+    '''Returns the occupancy (array with shape (columns, rows)) from the raw data.
+    '''
+    occupancy_array, _, _ = np.histogram2d(*convert_data_array(data_array, filter_func=logical_and(is_fe_word, is_data_record), converter_func=get_col_row_array_from_data_record_array), bins=(80, 336), range=[[1, 80], [1, 336]])
+    return occupancy_array
+
+
+def get_tot_sums(data_array):
+    '''Returns the number of hits, the sum of the ToT and the sum of the squared ToT (arrays with shape (columns, rows)) from the raw data.
+    '''
+    col, row, tot = convert_data_array(data_array, filter_func=logical_and(is_fe_word, is_data_record), converter_func=get_col_row_tot_array_from_data_record_array)
+    selection = (col >= 1) & (col <= 80) & (row >= 1) & (row <= 336)
+    index = (col[selection].astype(np.int64) - 1) * 336 + (row[selection].astype(np.int64) - 1)
+    tot = tot[selection].astype(np.float64)
+    n_hits = np.bincount(index, minlength=80 * 336).reshape(80, 336)
+    sum_tot = np.bincount(index, weights=tot, minlength=80 * 336).reshape(80, 336)
+    sum_tot_squares = np.bincount(index, weights=tot ** 2, minlength=80 * 336).reshape(80, 336)
+    return n_hits, sum_tot, sum_tot_squares
+
+
+def median_decision(decision, select=None):
+    '''Decision of the median from the decisions of the pixels.
+
+    The median is above (below) if more than half of the pixels are decided above (below).
+
+    Parameters
+    ----------
+    decision : array-like
+        Decision of each pixel (see binomial_decision()).
+    select : array-like
+        Selected pixels. If None, all pixels are selected.
+
+    Returns
+    -------
+    1 (above), -1 (below) or 0 (not yet decided).
+    '''
+    decision = np.asarray(decision)
+    if select is not None:
+        decision = decision[np.asarray(select, dtype=bool)]
+    if np.count_nonzero(decision > 0) > decision.size / 2.0:
+        return 1
+    elif np.count_nonzero(decision < 0) > decision.size / 2.0:
+        return -1
+    else:
+        return 0
+
+
+def sequential_scan_loop(self, command, max_injections, batch_injections=None, decide=None, min_settled_pixels=500, settled_fraction=1.0, readout_kwargs=None, **kwargs):
+    '''Scan loop with sequential testing.
+
+    The command is sent in batches until the decision function returns True, the decisions of settled_fraction of the pixels are settled,
+    or the maximum number of injections is reached. Pixels with a settled decision are masked for the following batches
+    (in batches of at least min_settled_pixels pixels, see get_newly_masked_pixels()). Only the mask steps and double columns
+    with unmasked pixels are injected. If batch_injections is None or not smaller than max_injections, this is equivalent
+    to a single call of scan_loop().
+
+    Parameters
+    ----------
+    self : Fei4RunBase
+        Run (see scan_loop()).
+    command : BitVector
+        Command (see scan_loop()).
+    max_injections : int
+        Maximum number of injections.
+    batch_injections : int
+        Number of injections per batch.
+    decide : function
+        Function called after each batch with the raw data array of all batches and the number of injections (array with shape (columns, rows)).
+        Returns True if the decision is settled (stop injecting), False, or a boolean array (columns, rows) of the pixels with a settled decision.
+    min_settled_pixels : int
+        Minimum number of newly settled pixels for changing the mask.
+    settled_fraction : float
+        Fraction of the injected pixels with a settled decision for stopping the injections.
+        Some pixels may never settle (e.g. pixels with an occupancy close to 50% in the threshold tuning).
+    readout_kwargs : dict
+        Arguments for the readout, e.g. scan parameters (see Fei4RunBase.readout()).
+    kwargs : dict
+        Arguments for scan_loop(). The mask is extended by the pixels with a settled decision.
+        The mask steps and double columns are selected from enable_mask_steps and enable_double_columns.
+
+    Returns
+    -------
+    Tuple of raw data array of all batches and number of injections (array with shape (columns, rows)).
+    The number of injections is 0 for all pixels if the run was stopped before the first batch.
+    '''
+    if not batch_injections or batch_injections > max_injections:
+        batch_injections = max_injections
+    readout_kwargs = {} if readout_kwargs is None else readout_kwargs
+    initial_mask = kwargs.pop('mask', None)
+    initial_mask = np.zeros(shape=(80, 336), dtype=bool) if initial_mask is None else np.asarray(initial_mask, dtype=bool)
+    enable_mask_steps = kwargs.pop('enable_mask_steps', None)
+    enable_double_columns = kwargs.pop('enable_double_columns', None)
+    mask_steps = kwargs.get('mask_steps', 3)
+    digital_injection = kwargs.get('digital_injection', False)
+    injected = get_injected_pixels(mask_steps, enable_mask_steps=enable_mask_steps, enable_double_columns=enable_double_columns, digital_injection=digital_injection, mask=initial_mask)
+    n_pixels = np.count_nonzero(injected)
+    settled = np.zeros(shape=(80, 336), dtype=bool)
+    injections = np.zeros(shape=(80, 336), dtype=np.uint32)
+    data = []
+    n_injections = 0
+    while n_injections < max_injections:
+        if self.stop_run.is_set():
+            break
+        repeat_command = min(batch_injections, max_injections - n_injections)
+        mask = np.logical_or(initial_mask, settled)
+        scan_loop_enable_mask_steps, scan_loop_enable_double_columns = get_scan_loop_selection(mask, mask_steps=mask_steps, enable_mask_steps=enable_mask_steps, enable_double_columns=enable_double_columns, digital_injection=digital_injection)
+        if not scan_loop_enable_mask_steps:  # all pixels are masked
+            break
+        with self.readout(reset_sram_fifo=True, fill_buffer=True, clear_buffer=True, callback=self.handle_data, **readout_kwargs):
+            scan_loop(self, command=command, repeat_command=repeat_command, enable_mask_steps=scan_loop_enable_mask_steps, enable_double_columns=scan_loop_enable_double_columns, mask=mask if np.any(mask) else None, **kwargs)
+        data.extend(self.fifo_readout.data)
+        injections[get_injected_pixels(mask_steps, enable_mask_steps=scan_loop_enable_mask_steps, enable_double_columns=scan_loop_enable_double_columns, digital_injection=digital_injection, mask=mask)] += repeat_command
+        n_injections += repeat_command
+        if decide is None or n_injections >= max_injections:
+            continue
+        result = np.asarray(decide(data_array_from_data_iterable(data), injections), dtype=bool)
+        if result.ndim == 0:  # decision of all pixels
+            if result:
+                break
+        else:
+            result = np.logical_and(result, injected)
+            if np.count_nonzero(result) >= settled_fraction * n_pixels:
+                break
+            settled = np.logical_or(settled, get_newly_masked_pixels(mask, result, min_pixels=min_settled_pixels))
+    return data_array_from_data_iterable(data) if data else np.array([], dtype=np.uint32), injections
@@ -7,10 +7,11 @@ import smtplib
 from socket import gethostname
 import zmq
 import numpy as np
+import copy
 from functools import wraps
 from threading import Event, Thread
 from Queue import Queue
-from collections import namedtuple, Mapping
+from collections import namedtuple, Mapping, OrderedDict
 from contextlib import contextmanager
 import abc
 import ast
@@ -20,10 +21,10 @@ import sys
 from basil.dut import Dut
 
 from pybar.run_manager import RunManager, RunBase, RunAborted, RunStopped
-from pybar.fei4.register import FEI4Register
+from pybar.fei4.register import FEI4Register, set_configuration_cache_dir
 from pybar.fei4.register_utils import FEI4RegisterUtils, is_fe_ready, CmdTimeoutError
 from pybar.daq.fifo_readout import FifoReadout, RxSyncError, EightbTenbError, FifoError, NoDataTimeout, StopTimeout
-from pybar.daq.fei4_raw_data import open_raw_data_file
+from pybar.daq.fei4_raw_data import open_raw_data_file, demultiplex_raw_data_file
 from pybar.analysis.analysis_utils import AnalysisError
 
 
@@ -34,6 +35,8 @@ class Fei4RunBase(RunBase):
     '''
     __metaclass__ = abc.ABCMeta
 
+    background_analysis = True  # if False, analyze() is always executed before the next run starts (e.g. analysis results are written to the FE register)
+
     def __init__(self, conf, run_conf=None):
         # default run conf parameters added for all scans
         if 'comment' not in self._default_run_conf:
@@ -50,12 +53,28 @@ class Fei4RunBase(RunBase):
             conf.update({'zmq_context': None})  # ZMQ context
         if 'send_data' not in conf:
             conf.update({'send_data': None})  # address string of PUB socket
+        if 'send_data_hwm' not in conf:
+            conf.update({'send_data_hwm': None})  # int, send high water mark of PUB socket
+        if 'send_data_compression' not in conf:
+            conf.update({'send_data_compression': None})  # None or 'blosc'
+        if 'send_data_channels' not in conf:
+            conf.update({'send_data_channels': None})  # list of channels, if given, data of each channel is sent separately in addition to the complete data
         if 'send_error_msg' not in conf:
             conf.update({'send_error_msg': None})  # bool
+        if 'rx_channels' not in conf:
+            conf.update({'rx_channels': None})  # list of RX channels, one for each FE (e.g. quad module), fe_configuration and chip_address can be lists with an entry for each FE
+        if 'configuration_cache_dir' not in conf:
+            conf.update({'configuration_cache_dir': None})  # path string, directory for compiled text configurations, if None, no compiled configurations are written to disk
+        if 'configuration_cache_size' not in conf:
+            conf.update({'configuration_cache_size': None})  # int, max. number of compiled text configurations in configuration_cache_dir
 
         self.err_queue = Queue()
         self.fifo_readout = None
         self.raw_data_file = None
+        self._register_utils = None
+        self._fe_register_utils = {}
+        self._broadcast_register = None
+        self._selected_channel = None
 
     @property
     def working_dir(self):
@@ -70,14 +89,68 @@ class Fei4RunBase(RunBase):
 
     @property
     def register(self):
-        return self._conf['fe_configuration']
+        '''FE register. In multi-FE runs, the register of the selected FE (see select_fe()) or the broadcast register, if no FE is selected.
+        '''
+        if self._selected_channel is not None:
+            return self.registers[self._selected_channel]
+        elif self.multi_fe:
+            return self._broadcast_register
+        else:
+            return self._conf['fe_configuration']
+
+    @property
+    def register_utils(self):
+        if self._selected_channel is not None:
+            return self._fe_register_utils[self._selected_channel]
+        else:
+            return self._register_utils
+
+    @property
+    def multi_fe(self):
+        '''True if more than one FE is read out (see rx_channels).
+        '''
+        return bool(self._conf['rx_channels']) and len(self._conf['rx_channels']) > 1
+
+    @property
+    def registers(self):
+        '''FE registers (dictionary with RX channel as key).
+        '''
+        if self.multi_fe:
+            return OrderedDict(zip(self._conf['rx_channels'], self._conf['fe_configuration']))
+        else:
+            return OrderedDict([(self._conf['rx_channels'][0] if self._conf['rx_channels'] else None, self._conf['fe_configuration'])])
+
+    @property
+    def selected_channel(self):
+        '''RX channel of the selected FE (see select_fe()), None if no FE is selected.
+        '''
+        return self._selected_channel
+
+    @contextmanager
+    def select_fe(self, channel):
+        '''Selecting the FE of the given RX channel in multi-FE runs.
+
+        Inside the context, register, register_utils and output_filename belong to the selected FE, e.g. for FE specific configuration and analysis.
+        If channel is None, the broadcast register is selected.
+        '''
+        if channel is not None and channel not in self.registers:
+            raise ValueError('Unknown RX channel: %s' % channel)
+        selected_channel = self._selected_channel
+        self._selected_channel = channel
+        try:
+            yield self.register
+        finally:
+            self._selected_channel = selected_channel
 
     @property
     def output_filename(self):
         if self.module_id:
-            return os.path.join(self.working_dir, str(self.run_number) + "_" + self.module_id + "_" + self.run_id)
+            filename = os.path.join(self.working_dir, str(self.run_number) + "_" + self.module_id + "_" + self.run_id)
         else:
-            return os.path.join(self.working_dir, str(self.run_number) + "_" + self.run_id)
+            filename = os.path.join(self.working_dir, str(self.run_number) + "_" + self.run_id)
+        if self._selected_channel is not None:
+            filename += "_ch%d" % self._selected_channel
+        return filename
 
     @property
     def module_id(self):
@@ -200,40 +273,43 @@ class Fei4RunBase(RunBase):
             logging.warning('Omit initialization of DUT %s', self.dut.name)
 
     def init_fe(self):
+        if self._conf['configuration_cache_dir']:
+            set_configuration_cache_dir(os.path.join(self._conf['working_dir'], os.path.expanduser(self._conf['configuration_cache_dir'])), size=self._conf['configuration_cache_size'])  # relative to working_dir
         if 'fe_configuration' in self._conf:
-            last_configuration = self._get_configuration()
-            # init config, a number <=0 will also do the initialization (run 0 does not exists)
-            if (not self._conf['fe_configuration'] and not last_configuration) or (isinstance(self._conf['fe_configuration'], (int, long)) and self._conf['fe_configuration'] <= 0):
+            if self.multi_fe:
+                n_fes = len(self._conf['rx_channels'])
+                fe_configurations = self._conf['fe_configuration'] if isinstance(self._conf['fe_configuration'], (list, tuple)) else [self._conf['fe_configuration']] * n_fes
+                chip_addresses = self._conf['chip_address'] if 'chip_address' in self._conf and isinstance(self._conf['chip_address'], (list, tuple)) else [None] * n_fes
+                if len(fe_configurations) != n_fes or len(chip_addresses) != n_fes:
+                    raise ValueError('Number of FE configurations and chip addresses must match the number of RX channels')
+                # chip address is needed to distinguish the FEs
+                self._conf['fe_configuration'] = [self._init_register(fe_configuration, chip_address=chip_address, broadcast=False, channel=channel) for fe_configuration, chip_address, channel in zip(fe_configurations, chip_addresses, self._conf['rx_channels'])]
+                # broadcast register for commands that are sent to all FEs at once
+                self._broadcast_register = copy.deepcopy(self._conf['fe_configuration'][0])
+                self._broadcast_register.clear_restore_points()
+                self._broadcast_register.broadcast = True
+                self._broadcast_register.set_chip_address(0)
+                self._fe_register_utils = dict((channel, FEI4RegisterUtils(self.dut, register)) for channel, register in self.registers.iteritems())
+            else:
                 if 'chip_address' in self._conf and self._conf['chip_address']:
                     chip_address = self._conf['chip_address']
                     broadcast = False
                 else:
                     chip_address = 0
                     broadcast = True
-                if 'fe_flavor' in self._conf and self._conf['fe_flavor']:
-                    self._conf['fe_configuration'] = FEI4Register(fe_type=self._conf['fe_flavor'], chip_address=chip_address, broadcast=broadcast)
-                else:
-                    raise ValueError('No fe_flavor given')
-            # use existing config
-            elif not self._conf['fe_configuration'] and last_configuration:
-                self._conf['fe_configuration'] = FEI4Register(configuration_file=last_configuration)
-            # path string
-            elif isinstance(self._conf['fe_configuration'], basestring):
-                if os.path.isabs(self._conf['fe_configuration']):  # absolute path
-                    self._conf['fe_configuration'] = FEI4Register(configuration_file=self._conf['fe_configuration'])
-                else:  # relative path
-                    self._conf['fe_configuration'] = FEI4Register(configuration_file=os.path.join(self._conf['working_dir'], self._conf['fe_configuration']))
-            # run number
-            elif isinstance(self._conf['fe_configuration'], (int, long)) and self._conf['fe_configuration'] > 0:
-                self._conf['fe_configuration'] = FEI4Register(configuration_file=self._get_configuration(self._conf['fe_configuration']))
-            # assume fe_configuration already initialized
-            elif not isinstance(self._conf['fe_configuration'], FEI4Register):
-                raise ValueError('No valid fe_configuration given')
+                self._conf['fe_configuration'] = self._init_register(self._conf['fe_configuration'], chip_address=chip_address, broadcast=broadcast)
             # init register utils
-            self.register_utils = FEI4RegisterUtils(self.dut, self.register)
+            self._register_utils = FEI4RegisterUtils(self.dut, self.register)
+            if not self.multi_fe:
+                self._fe_register_utils = {self.registers.keys()[0]: self._register_utils}
             # reset and configuration
             self.register_utils.global_reset()
-            self.register_utils.configure_all()
+            if self.multi_fe:
+                for channel in self.registers:
+                    with self.select_fe(channel):
+                        self.register_utils.configure_all()
+            else:
+                self.register_utils.configure_all()
             if is_fe_ready(self):
                 reset_service_records = False
             else:
@@ -246,7 +322,39 @@ class Fei4RunBase(RunBase):
         else:
             pass  # no fe_configuration
 
+    def _init_register(self, fe_configuration, chip_address, broadcast, channel=None):
+        '''Returns the FE register from the FE configuration (see fe_configuration in configuration.yaml).
+        '''
+        last_configuration = self._get_configuration(channel=channel)
+        # init config, a number <=0 will also do the initialization (run 0 does not exists)
+        if (not fe_configuration and not last_configuration) or (isinstance(fe_configuration, (int, long)) and fe_configuration <= 0):
+            if chip_address is None:
+                raise ValueError('No chip_address given for FE on RX channel %d' % channel)
+            if 'fe_flavor' in self._conf and self._conf['fe_flavor']:
+                return FEI4Register(fe_type=self._conf['fe_flavor'], chip_address=chip_address, broadcast=broadcast)
+            else:
+                raise ValueError('No fe_flavor given')
+        # use existing config
+        elif not fe_configuration and last_configuration:
+            return FEI4Register(configuration_file=last_configuration)
+        # path string
+        elif isinstance(fe_configuration, basestring):
+            if os.path.isabs(fe_configuration):  # absolute path
+                return FEI4Register(configuration_file=fe_configuration)
+            else:  # relative path
+                return FEI4Register(configuration_file=os.path.join(self._conf['working_dir'], fe_configuration))
+        # run number
+        elif isinstance(fe_configuration, (int, long)) and fe_configuration > 0:
+            return FEI4Register(configuration_file=self._get_configuration(fe_configuration, channel=channel))
+        # assume fe_configuration already initialized
+        elif not isinstance(fe_configuration, FEI4Register):
+            raise ValueError('No valid fe_configuration given')
+        return fe_configuration
+
     def pre_run(self):
+        # the broadcast register is a copy of the register of the first FE, runs writing the analysis results to the FE register (e.g. tunings) would write them to all FEs
+        if self.multi_fe and not self.background_analysis:
+            raise NotImplementedError('%s does not support multi-FE runs (rx_channels: %s), run it for each FE with a single RX channel' % (self.__class__.__name__, ', '.join([str(channel) for channel in self._conf['rx_channels']])))
         # clear error queue in case run is executed a second time
         self.err_queue.queue.clear()
         # opening ZMQ context and binding socket
@@ -346,13 +454,13 @@ class Fei4RunBase(RunBase):
         self.init_fe()
 
     def do_run(self):
-        with self.register.restored(name=self.run_number):
+        with self.restored_registers(name=self.run_number):
             # configure for scan
             self.configure()
             self.fifo_readout.reset_rx()
             self.fifo_readout.reset_sram_fifo()
             self.fifo_readout.print_readout_status()
-            with open_raw_data_file(filename=self.output_filename, mode='w', title=self.run_id, register=self.register, conf=self._conf, run_conf=self._run_conf, scan_parameters=self.scan_parameters._asdict(), context=self._conf['zmq_context'], socket_address=self._conf['send_data']) as self.raw_data_file:
+            with open_raw_data_file(filename=self.output_filename, mode='w', title=self.run_id, register=self.register, conf=self._conf, run_conf=self._run_conf, scan_parameters=self.scan_parameters._asdict(), context=self._conf['zmq_context'], socket_address=self._conf['send_data'], socket_hwm=self._conf['send_data_hwm'], socket_compression=self._conf['send_data_compression'], socket_channels=self._conf['send_data_channels']) as self.raw_data_file:
                 # scan
                 self.scan()
 
@@ -364,12 +472,21 @@ class Fei4RunBase(RunBase):
             pass
 
         # analyzing data
-        try:
-            self.analyze()
-        except Exception:  # analysis errors
-            self.handle_err(sys.exc_info())
-        else:  # analyzed data, save config
-            self.register.save_configuration(self.output_filename)
+        if self.analysis_queue is not None and self.background_analysis and self.err_queue.empty() and not self.abort_run.is_set():
+            # configuration is saved immediately for the next run, the analysis is started after the run has finished (see RunBase._start_analysis_job())
+            try:
+                self.save_configuration()
+            except Exception:
+                self.handle_err(sys.exc_info())
+            else:
+                self._analysis_job = self.analyze_in_background
+        else:
+            try:
+                self.analyze_fes()
+            except Exception:  # analysis errors
+                self.handle_err(sys.exc_info())
+            else:  # analyzed data, save config
+                self.save_configuration()
 
         if not self.err_queue.empty():
             exc = self.err_queue.get()
@@ -442,16 +559,24 @@ class Fei4RunBase(RunBase):
                 self.abort(msg=str(exc[1]))
             self.err_queue.put(exc)
 
-    def _get_configuration(self, run_number=None):
+    def _get_configuration(self, run_number=None, channel=None):
         def find_file(run_number):
+            # configuration file from run database, avoid walking the working directory
+            cfg_file = self.run_database.get_configuration_file(run_number)
+            if cfg_file and channel is not None:  # configuration file of the first FE is stored in multi-FE runs
+                cfg_file = re.sub(r'_ch\d+(\.\w+)$', r'_ch%d\1' % channel, cfg_file)
+            if cfg_file and os.path.basename(cfg_file).startswith(''.join([str(run_number), '_', self.module_id])) and os.path.isfile(cfg_file):
+                return cfg_file
             for root, _, files in os.walk(self.working_dir):
                 for cfgfile in files:
                     cfg_root, cfg_ext = os.path.splitext(cfgfile)
-                    if cfg_root.startswith(''.join([str(run_number), '_', self.module_id])) and cfg_ext.endswith(".cfg"):
-                        return os.path.join(root, cfgfile)
+                    if cfg_root.startswith(''.join([str(run_number), '_', self.module_id])) and cfg_ext.endswith(".cfg") and (channel is None or cfg_root.endswith('_ch%d' % channel)):
+                        cfg_file = os.path.join(root, cfgfile)
+                        self.run_database.set_configuration_file(run_number, cfg_file)
+                        return cfg_file
 
         if not run_number:
-            run_numbers = sorted(self._get_run_numbers(status='FINISHED').iterkeys(), reverse=True)
+            run_numbers = self.run_database.get_run_numbers(status='FINISHED')
             for run_number in run_numbers:
                 cfg_file = find_file(run_number)
                 if cfg_file:
@@ -543,6 +668,52 @@ class Fei4RunBase(RunBase):
         '''
         pass
 
+    def analyze_in_background(self):
+        '''Data analysis in background (see AnalysisQueue).
+
+        Executed in a forked process, the run database is opened with a new connection (see run_database). The configuration has already been saved by post_run().
+        '''
+        try:
+            self.analyze_fes()
+        finally:
+            self._close_run_database()
+
+    def analyze_fes(self):
+        '''Data analysis of each FE.
+
+        In multi-FE runs, the raw data is split into a raw data file for each FE (see demultiplex_raw_data_file()) and analyze() is executed for each FE (see select_fe()).
+        '''
+        if self.multi_fe:
+            demultiplex_raw_data_file(self.output_filename, channels=self.registers.keys(), registers=self.registers.values(), conf=self._conf, run_conf=self._run_conf)
+            for channel in self.registers:
+                with self.select_fe(channel):
+                    self.analyze()
+        else:
+            self.analyze()
+
+    def save_configuration(self):
+        '''Saving the configuration of each FE. In multi-FE runs, the RX channel is added to the filename.
+        '''
+        for channel in self.registers:
+            with self.select_fe(channel if self.multi_fe else None):
+                self.register.save_configuration(self.output_filename)
+        self.run_database.set_configuration_file(self.run_number, self.registers.values()[0].configuration_file)
+
+    @contextmanager
+    def restored_registers(self, name=None):
+        '''Restoring the registers of all FEs (and the broadcast register) after leaving the context (see FEI4Register.restored()).
+        '''
+        registers = self.registers.values()
+        if self.multi_fe:
+            registers.append(self._broadcast_register)
+        for register in registers:
+            register.create_restore_point(name)
+        try:
+            yield
+        finally:
+            for register in registers:
+                register.restore()
+
 
 def timed(f):
     @wraps(f)
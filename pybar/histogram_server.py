@@ -0,0 +1,428 @@
+''' Headless histogram server for the online monitor.
+
+The server subscribes to the raw data published by the scans (see fei4_raw_data.send_data()), interprets the raw data once
+and publishes rate-limited, compressed histogram snapshots. Any number of online monitors (see online_monitor.py) and scripts
+can subscribe to the histogram server without interpreting the raw data themselves.
+
+Messages
+--------
+Histograms: JSON meta data (name 'Histograms') followed by one zlib compressed frame per histogram (see send_histograms() and receive_histograms()).
+    The histograms are delta encoded, only changed bins are sent. Every few snapshots, a keyframe with the complete histograms is sent (see HistogramEncoder).
+RunConf, GlobalRegisterConf, Reset, Filename: forwarded without changes.
+
+Usage
+-----
+python histogram_server.py tcp://127.0.0.1:5678 tcp://*:5679
+python online_monitor.py tcp://127.0.0.1:5679
+'''
+import logging
+import time
+import zlib
+from threading import Event
+from optparse import OptionParser
+
+import numpy as np
+import zmq
+
+from pybar_fei4_interpreter.data_interpreter import PyDataInterpreter
+from pybar_fei4_interpreter.data_histograming import PyDataHistograming
+
+from pybar.daq.fei4_raw_data import get_data_from_message, is_message_for_channel, SequenceCounter
+
+
+# histograms shown by the online monitor (name, shape)
+histogram_shapes = (('occupancy', (80, 336, 1)), ('tot_hist', (16,)), ('tdc_counters', (4096,)), ('tdc_distance', (256,)), ('error_counters', (16,)), ('service_records_counters', (32,)), ('trigger_error_counters', (8,)), ('rel_bcid_hist', (16,)))
+
+
+def create_raw_data_analysis():
+    '''Returns interpreter and histogrammer for the online monitor and whether the TDC distance histogram is available.
+    '''
+    interpreter = PyDataInterpreter()
+    histogram = PyDataHistograming()
+    interpreter.set_warning_output(False)
+    histogram.set_no_scan_parameter()
+    histogram.create_occupancy_hist(True)
+    histogram.create_rel_bcid_hist(True)
+    histogram.create_tot_hist(True)
+    histogram.create_tdc_hist(True)
+    try:
+        histogram.create_tdc_distance_hist(True)
+        interpreter.use_tdc_trigger_time_stamp(True)
+    except AttributeError:
+        has_tdc_distance = False
+    else:
+        has_tdc_distance = True
+    return interpreter, histogram, has_tdc_distance
+
+
+def get_interpreted_data(interpreter, histogram, has_tdc_distance, copy=False):
+    '''Returns the histograms and counters of the raw data analysis.
+
+    The arrays are views into the buffers of the interpreter and histogram (changed by the next interpretation) unless copy is True.
+    '''
+    if copy:
+        return dict((name, np.array(value, copy=True)) for name, value in get_interpreted_data(interpreter, histogram, has_tdc_distance).iteritems())
+    return {
+        'occupancy': histogram.get_occupancy(),
+        'tot_hist': histogram.get_tot_hist(),
+        'tdc_counters': interpreter.get_tdc_counters(),
+        'tdc_distance': interpreter.get_tdc_distance() if has_tdc_distance else np.zeros((256,), dtype=np.uint8),
+        'error_counters': interpreter.get_error_counters(),
+        'service_records_counters': interpreter.get_service_records_counters(),
+        'trigger_error_counters': interpreter.get_trigger_error_counters(),
+        'rel_bcid_hist': histogram.get_rel_bcid_hist()}
+
+
+def integrate_readout(interpreter, histogram, has_tdc_distance, raw_data, n_readout, integrate_readouts, n_remaining_readouts):
+    '''Interpreting a readout and adding the hits to the histograms. The histograms are reset at the beginning of each integration.
+
+    Parameters
+    ----------
+    raw_data : array
+        Raw data of the readout.
+    n_readout : int
+        Number of the readout (counted from 1).
+    integrate_readouts : int
+        Number of readouts which are integrated into one histogram (0: integrate all readouts).
+    n_remaining_readouts : int
+        Number of readouts remaining in the current batch of messages.
+
+    Returns
+    -------
+    True if the histograms are to be taken at the next update (integration of all readouts), a copy of the histograms if an integration is completed
+    and it is the last completed integration in this batch, otherwise None.
+    '''
+    if integrate_readouts != 0 and n_readout % integrate_readouts == 0:
+        histogram.reset()
+    interpreter.interpret_raw_data(raw_data)
+    histogram.add_hits(interpreter.get_hits())
+    if integrate_readouts == 0:
+        return True
+    elif n_readout % integrate_readouts == integrate_readouts - 1 and n_remaining_readouts < integrate_readouts:
+        # histograms are taken only for the last completed integration in this batch
+        return get_interpreted_data(interpreter, histogram, has_tdc_distance, copy=True)
+
+
+class HistogramEncoder(object):
+    '''Delta encoding of histogram snapshots.
+
+    Only the histograms and bins which have changed since the previous snapshot are sent (sparse: bin indices and new values).
+    A histogram is sent completely if this is smaller than the sparse encoding (e.g. after a histogram reset).
+    Every keyframe_interval snapshots (and after reset()), all histograms are sent completely (keyframe), so that clients can start at any time
+    and can recover from lost messages.
+
+    Parameters
+    ----------
+    keyframe_interval : int
+        Number of snapshots between two keyframes (1: every snapshot is a keyframe).
+    '''
+    def __init__(self, keyframe_interval=10):
+        self.keyframe_interval = keyframe_interval
+        self.sequence = 0
+        self.reset()
+
+    def reset(self):
+        '''Next snapshot is a keyframe.
+        '''
+        self._histograms = {}
+        self._n_delta_frames = None
+
+    def encode(self, histograms):
+        '''Encoding histograms.
+
+        Parameters
+        ----------
+        histograms : dict
+            Histogram name and array.
+
+        Returns
+        -------
+        Tuple with snapshot meta data (sequence number, keyframe flag and meta data for each histogram) and list of frames (one for each histogram).
+        '''
+        keyframe = self._n_delta_frames is None or self._n_delta_frames + 1 >= self.keyframe_interval
+        histograms_meta_data = []
+        frames = []
+        for name in sorted(histograms.keys()):
+            array = np.ascontiguousarray(histograms[name])
+            previous_array = self._histograms.get(name)
+            encoding = 'full'
+            if not keyframe and previous_array is not None and previous_array.shape == array.shape and previous_array.dtype == array.dtype:
+                changed_bins = np.flatnonzero(array != previous_array).astype(np.uint32)
+                if changed_bins.shape[0] == 0:
+                    encoding = 'unchanged'
+                    frame = b''
+                elif changed_bins.nbytes + changed_bins.shape[0] * array.itemsize < array.nbytes:
+                    encoding = 'sparse'
+                    frame = changed_bins.tostring() + array.ravel()[changed_bins].tostring()
+            if encoding == 'full':
+                frame = array.tostring()
+            histograms_meta_data.append(dict(name=name, dtype=str(array.dtype), shape=array.shape, encoding=encoding))
+            frames.append(frame)
+            if encoding != 'unchanged':
+                self._histograms[name] = array.copy()
+        self._n_delta_frames = 0 if keyframe else self._n_delta_frames + 1
+        self.sequence += 1
+        return dict(sequence=self.sequence, keyframe=keyframe, histograms=histograms_meta_data), frames
+
+
+class HistogramDecoder(object):
+    '''Decoding of delta encoded histogram snapshots (see HistogramEncoder).
+
+    Snapshots following a lost snapshot are dropped until the next keyframe arrives.
+    '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._histograms = None
+        self._sequence = None
+
+    def decode(self, snapshot_meta_data, frames):
+        '''Decoding histograms.
+
+        Parameters
+        ----------
+        snapshot_meta_data : dict
+            Snapshot meta data (see HistogramEncoder.encode()).
+        frames : list
+            Frames (uncompressed).
+
+        Returns
+        -------
+        Dictionary with histogram name and array. None if the snapshot cannot be decoded (no keyframe received yet, lost snapshot).
+        '''
+        sequence = snapshot_meta_data['sequence']
+        if not snapshot_meta_data['keyframe'] and (self._histograms is None or sequence != self._sequence + 1):
+            self.reset()  # wait for next keyframe
+            return None
+        histograms = {} if snapshot_meta_data['keyframe'] else self._histograms
+        for histogram_meta_data, frame in zip(snapshot_meta_data['histograms'], frames):
+            name = histogram_meta_data['name']
+            dtype = np.dtype(histogram_meta_data['dtype'])
+            if histogram_meta_data['encoding'] == 'full':
+                histograms[name] = np.frombuffer(frame, dtype=dtype).reshape(histogram_meta_data['shape']).copy()
+            elif histogram_meta_data['encoding'] == 'sparse':
+                n_changed_bins = len(frame) // (4 + dtype.itemsize)
+                changed_bins = np.frombuffer(frame, dtype=np.uint32, count=n_changed_bins)
+                histograms[name].ravel()[changed_bins] = np.frombuffer(frame, dtype=dtype, offset=n_changed_bins * 4)
+        self._histograms = histograms
+        self._sequence = sequence
+        return dict((name, array.copy()) for name, array in histograms.iteritems())
+
+
+def send_histograms(socket, histograms, meta_data=None, compression_level=1, encoder=None, name='Histograms'):
+    '''Sends histograms (zlib compressed) and meta data via ZeroMQ to a specified socket.
+
+    Parameters
+    ----------
+    socket : zmq.Socket
+        Publisher socket.
+    histograms : dict
+        Histogram name and array.
+    meta_data : dict
+        Additional meta data (e.g. readout meta data, number of hits and events).
+    compression_level : int
+        zlib compression level (0: no compression, 1: fastest, 9: best compression).
+    encoder : HistogramEncoder
+        Delta encoder. If None, all histograms are sent completely.
+    '''
+    if encoder is None:
+        encoder = HistogramEncoder(keyframe_interval=1)
+    histograms_meta_data, frames = encoder.encode(histograms)
+    histograms_meta_data.update(
+        name=name,
+        compression='zlib' if compression_level else None,
+        meta_data=meta_data if meta_data else {}
+    )
+    if compression_level:
+        frames = [zlib.compress(frame, compression_level) for frame in frames]
+    try:
+        socket.send_json(histograms_meta_data, flags=zmq.SNDMORE | zmq.NOBLOCK)
+        socket.send_multipart(frames, flags=zmq.NOBLOCK)
+    except zmq.Again:
+        pass
+
+
+def receive_histograms(histograms_meta_data, frames, decoder=None):
+    '''Returns the histograms from the meta data and frames received from the histogram server (see send_histograms()).
+
+    Parameters
+    ----------
+    histograms_meta_data : dict
+        Meta data (JSON) of the histograms message.
+    frames : list
+        Frames following the meta data.
+    decoder : HistogramDecoder
+        Delta decoder, keeping the histograms of the previous snapshots. If None, only keyframes can be decoded.
+
+    Returns
+    -------
+    Dictionary with histogram name and array. None if the histograms cannot be decoded.
+    '''
+    if decoder is None:
+        decoder = HistogramDecoder()
+    if histograms_meta_data['compression'] == 'zlib':
+        frames = [zlib.decompress(frame) for frame in frames]
+    return decoder.decode(histograms_meta_data, frames)
+
+
+class HistogramServer(object):
+    '''Interpreting raw data and publishing the histograms.
+
+    Parameters
+    ----------
+    socket_addr : string
+        Address of the raw data publisher.
+    publish_addr : string
+        Address of the histogram publisher (bind).
+    max_rate : float
+        Max. number of histogram snapshots per second.
+    integrate_readouts : int
+        Number of readouts which are integrated into one histogram (0: integrate all readouts).
+    compression_level : int
+        zlib compression level.
+    keyframe_interval : int
+        Number of snapshots between two keyframes (1: no delta encoding).
+    '''
+    def __init__(self, socket_addr, publish_addr, max_rate=10.0, integrate_readouts=1, compression_level=1, keyframe_interval=10):
+        self.socket_addr = socket_addr
+        self.publish_addr = publish_addr
+        self.max_rate = max_rate
+        self.integrate_readouts = integrate_readouts
+        self.compression_level = compression_level
+        self.encoder = HistogramEncoder(keyframe_interval=keyframe_interval)
+        self.sequence_counter = SequenceCounter()  # lost readouts
+        self.max_batch_size = 1000  # max. number of messages processed between two snapshots
+        self.stop_server = Event()
+        self.interpreter, self.histogram, self.has_tdc_distance = create_raw_data_analysis()
+        self.reset()
+
+    def reset(self):
+        self.histogram.reset()
+        self.interpreter.reset()
+        self.encoder.reset()
+        self.sequence_counter.reset()
+        self.n_readout = 0
+        self._interpreted_data = None  # latest histograms, sent with the next snapshot
+        self._meta_data = None  # latest readout meta data, sent with the next snapshot
+        self._n_readouts_update = 0  # readouts since last snapshot
+
+    def handle_readout_data(self, meta_data, data, n_remaining_readouts):
+        data_array = get_data_from_message(meta_data, data)
+        self.sequence_counter.update(meta_data)
+        for key in ('dtype', 'shape', 'compression', 'sequence', 'channel', 'channels'):
+            meta_data.pop(key, None)
+        self.n_readout += 1
+        self._n_readouts_update += 1
+        interpreted_data = integrate_readout(self.interpreter, self.histogram, self.has_tdc_distance, data_array, n_readout=self.n_readout, integrate_readouts=self.integrate_readouts, n_remaining_readouts=n_remaining_readouts)
+        if interpreted_data is not None:  # True: histograms are taken at the next snapshot
+            self._interpreted_data = interpreted_data
+        meta_data.update({'n_hits': self.interpreter.get_n_hits(), 'n_events': self.interpreter.get_n_events(), 'n_lost': self.sequence_counter.n_lost})
+        self._meta_data = meta_data
+
+    def handle_messages(self, messages):
+        n_readouts = sum(1 for meta_data, _ in messages if meta_data['name'] == 'ReadoutData')
+        for meta_data, data in messages:
+            if meta_data['name'] == 'ReadoutData':
+                n_readouts -= 1  # remaining readouts in this batch
+                del meta_data['name']
+                self.handle_readout_data(meta_data, data, n_readouts)
+            else:
+                if meta_data['name'] == 'GlobalRegisterConf':
+                    self.interpreter.set_trig_count(int(meta_data['conf']['Trig_Count']))
+                elif meta_data['name'] == 'Reset':
+                    self.histogram.reset()
+                    self.interpreter.reset()
+                    self.encoder.reset()  # send keyframe
+                    self.sequence_counter.reset()
+                    self._interpreted_data = True
+                try:
+                    self.socket_push.send_json(meta_data, flags=zmq.NOBLOCK)  # forward
+                except zmq.Again:
+                    pass
+
+    def publish(self):
+        '''Publishing latest histograms.
+        '''
+        if self._interpreted_data is None:
+            return
+        interpreted_data = get_interpreted_data(self.interpreter, self.histogram, self.has_tdc_distance) if self._interpreted_data is True else self._interpreted_data
+        meta_data = self._meta_data if self._meta_data is not None else {}
+        meta_data['n_readouts'] = self._n_readouts_update
+        send_histograms(self.socket_push, interpreted_data, meta_data=meta_data, compression_level=self.compression_level, encoder=self.encoder)
+        self._interpreted_data = None
+        self._meta_data = None
+        self._n_readouts_update = 0
+
+    def receive_messages(self, timeout):
+        messages = []
+        if not self.poller.poll(max(0, int(timeout * 1000))):  # blocking until message arrives or timeout
+            return messages
+        while len(messages) < self.max_batch_size:
+            try:
+                meta_data = self.socket_pull.recv_json(flags=zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            if meta_data['name'] == 'ReadoutData':
+                data = self.socket_pull.recv()
+                if not is_message_for_channel(meta_data):  # data of a single channel, complete raw data is also sent
+                    continue
+            else:
+                data = None
+            messages.append((meta_data, data))
+        return messages
+
+    def run(self):
+        '''Serving histograms until stop() is called.
+        '''
+        context = zmq.Context()
+        self.socket_pull = context.socket(zmq.SUB)  # subscriber
+        self.socket_pull.setsockopt(zmq.SUBSCRIBE, '')  # do not filter any data
+        self.socket_pull.connect(self.socket_addr)
+        self.socket_push = context.socket(zmq.PUB)  # publisher
+        self.socket_push.bind(self.publish_addr)
+        self.poller = zmq.Poller()
+        self.poller.register(self.socket_pull, zmq.POLLIN)
+        logging.info('Publishing histograms of %s on %s', self.socket_addr, self.publish_addr)
+        next_update = time.time()
+        try:
+            while not self.stop_server.is_set():
+                messages = self.receive_messages(timeout=min(next_update - time.time(), 0.1))
+                if messages:
+                    self.handle_messages(messages)
+                now = time.time()
+                if now >= next_update:
+                    self.publish()
+                    next_update = max(next_update + 1.0 / self.max_rate, now)  # do not try to catch up
+        finally:
+            self.socket_pull.close()
+            self.socket_push.close(linger=0)
+            context.term()
+
+    def stop(self):
+        self.stop_server.set()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - [%(levelname)-8s] (%(threadName)-10s) %(message)s")
+    usage = "Usage: %prog ADDRESS PUBLISH_ADDRESS"
+    description = "ADDRESS: Remote address of the sender (default: tcp://127.0.0.1:5678). PUBLISH_ADDRESS: Address of the histogram publisher (default: tcp://*:5679)."
+    parser = OptionParser(usage, description=description)
+    parser.add_option("-r", "--max_rate", dest="max_rate", type="float", default=10.0, help="Max. histogram snapshots per second (default: 10)")
+    parser.add_option("-i", "--integrate_readouts", dest="integrate_readouts", type="int", default=1, help="Number of integrated readouts, 0 for infinite integration (default: 1)")
+    parser.add_option("-l", "--compression_level", dest="compression_level", type="int", default=1, help="zlib compression level, 0 for no compression (default: 1)")
+    parser.add_option("-k", "--keyframe_interval", dest="keyframe_interval", type="int", default=10, help="Snapshots between two keyframes, 1 for no delta encoding (default: 10)")
+    options, args = parser.parse_args()
+    if options.max_rate <= 0:
+        parser.error("max. rate must be positive")
+    if options.keyframe_interval < 1:
+        parser.error("keyframe interval must be at least 1")
+    if len(args) > 2:
+        parser.error("incorrect number of arguments")
+    socket_addr = args[0] if len(args) > 0 else 'tcp://127.0.0.1:5678'
+    publish_addr = args[1] if len(args) > 1 else 'tcp://*:5679'
+    server = HistogramServer(socket_addr=socket_addr, publish_addr=publish_addr, max_rate=options.max_rate, integrate_readouts=options.integrate_readouts, compression_level=options.compression_level, keyframe_interval=options.keyframe_interval)
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        server.stop()
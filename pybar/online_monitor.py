@@ -10,9 +10,114 @@ from pyqtgraph.Qt import QtCore, QtGui
 from pyqtgraph.dockarea import DockArea, Dock
 import pyqtgraph.ptime as ptime
 from threading import Event, Lock
+import multiprocessing
 
-from pybar_fei4_interpreter.data_interpreter import PyDataInterpreter
-from pybar_fei4_interpreter.data_histograming import PyDataHistograming
+from pybar.daq.readout_utils import is_data_from_channel, is_fe_word
+from pybar.daq.fei4_raw_data import get_data_from_message, is_message_for_channel, SequenceCounter
+from pybar.histogram_server import histogram_shapes, create_raw_data_analysis, get_interpreted_data, integrate_readout, receive_histograms, HistogramDecoder
+
+
+class SharedHistograms(object):
+    '''Histograms in shared memory, written by an interpretation process and read by the online monitor.
+    '''
+    def __init__(self):
+        self.lock = multiprocessing.Lock()
+        self.histograms = dict((name, multiprocessing.RawArray('I', int(np.prod(shape)))) for name, shape in histogram_shapes)
+        self.counters = multiprocessing.RawArray('L', 2)  # number of hits and events
+
+    def get_array(self, name):
+        return np.frombuffer(self.histograms[name], dtype=np.uint32).reshape(dict(histogram_shapes)[name])
+
+    def set_histograms(self, interpreted_data, n_hits, n_events):
+        with self.lock:
+            for name, shape in histogram_shapes:
+                value = np.asarray(interpreted_data[name]).ravel()[:int(np.prod(shape))]
+                array = self.get_array(name).reshape(-1)
+                array[:value.shape[0]] = value
+                array[value.shape[0]:] = 0
+            self.counters[0] = n_hits
+            self.counters[1] = n_events
+
+    def get_histograms(self):
+        with self.lock:
+            return dict((name, self.get_array(name).copy()) for name, _ in histogram_shapes), self.counters[0], self.counters[1]
+
+    def get_counters(self):
+        '''Returns the number of hits and events without copying the histograms.
+        '''
+        with self.lock:
+            return self.counters[0], self.counters[1]
+
+
+def interpret_data(socket_addr, shared_histograms, channel, frame_rate, integrate_readouts, reset, stop):
+    '''Interpretation process for the online monitor.
+
+    Interprets the raw data of a FE channel (all channels if channel is None) and publishes the histograms at the given frame rate into shared memory.
+    The histograms of the last completed integration are published (see DataWorker.handle_readout_data()).
+    '''
+    interpreter, histogram, has_tdc_distance = create_raw_data_analysis()
+    context = zmq.Context()
+    socket_pull = context.socket(zmq.SUB)  # subscriber
+    socket_pull.setsockopt(zmq.SUBSCRIBE, '')  # do not filter any data
+    socket_pull.connect(socket_addr)
+    poller = zmq.Poller()
+    poller.register(socket_pull, zmq.POLLIN)
+    select_channel = None if channel is None else is_data_from_channel(channel)
+
+    def get_snapshot():
+        return get_interpreted_data(interpreter, histogram, has_tdc_distance, copy=True), interpreter.get_n_hits(), interpreter.get_n_events()
+
+    n_readout = 0
+    snapshot = None  # histograms of the last completed integration, published with the next frame, True: histograms are taken at the next frame
+    next_update = time.time()
+    try:
+        while not stop.is_set():
+            if reset.is_set():
+                reset.clear()
+                histogram.reset()
+                interpreter.reset()
+                n_readout = 0
+                snapshot = get_snapshot()
+            messages = []
+            if poller.poll(max(0, int(min(next_update - time.time(), 0.1) * 1000))):
+                while len(messages) < 1000:  # limit batch size to keep the frame rate
+                    try:
+                        meta_data = socket_pull.recv_json(flags=zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    messages.append((meta_data, socket_pull.recv() if meta_data['name'] == 'ReadoutData' else None))
+            n_readouts = sum(1 for meta_data, _ in messages if meta_data['name'] == 'ReadoutData' and is_message_for_channel(meta_data, channel))
+            for meta_data, data in messages:
+                name = meta_data['name']
+                if name == 'ReadoutData':
+                    if not is_message_for_channel(meta_data, channel):
+                        continue
+                    n_readouts -= 1  # remaining readouts in this batch
+                    data_array = get_data_from_message(meta_data, data)
+                    if 'channel' not in meta_data and select_channel is not None:  # keep trigger and TDC words
+                        data_array = data_array[np.logical_or(select_channel(data_array), np.logical_not(is_fe_word(data_array)))]
+                    n_readout += 1
+                    interpreted_data = integrate_readout(interpreter, histogram, has_tdc_distance, data_array, n_readout=n_readout, integrate_readouts=integrate_readouts.value, n_remaining_readouts=n_readouts)
+                    if interpreted_data is True:
+                        snapshot = True
+                    elif interpreted_data is not None:
+                        snapshot = (interpreted_data, interpreter.get_n_hits(), interpreter.get_n_events())
+                elif name == 'GlobalRegisterConf':
+                    interpreter.set_trig_count(int(meta_data['conf']['Trig_Count']))
+                elif name == 'Reset':
+                    histogram.reset()
+                    interpreter.reset()
+                    snapshot = get_snapshot()
+            now = time.time()
+            if now >= next_update:
+                if snapshot is not None:
+                    interpreted_data, n_hits, n_events = get_snapshot() if snapshot is True else snapshot
+                    shared_histograms.set_histograms(interpreted_data, n_hits=n_hits, n_events=n_events)
+                    snapshot = None
+                next_update = max(next_update + 1.0 / frame_rate.value, now)  # do not try to catch up
+    finally:
+        socket_pull.close()
+        context.term()
 
 
 class DataWorker(QtCore.QObject):
@@ -24,30 +129,23 @@ class DataWorker(QtCore.QObject):
     meta_data = QtCore.pyqtSignal(dict)
     finished = QtCore.pyqtSignal()
 
-    def __init__(self):
+    def __init__(self, frame_rate=10.0):
         QtCore.QObject.__init__(self)
         self.integrate_readouts = 1
+        self.frame_rate = frame_rate  # plot updates per second, independent of the readout rate
+        self.max_batch_size = 1000  # max. number of messages processed between two plot updates
         self.n_readout = 0
         self._stop_readout = Event()
         self.setup_raw_data_analysis()
         self.reset_lock = Lock()
+        self._interpreted_data = None  # latest histograms, emitted with the next plot update
+        self._meta_data = None  # latest meta data, emitted with the next plot update
+        self._n_readouts_update = 0  # readouts since last plot update
+        self.histogram_decoder = HistogramDecoder()  # histograms from histogram server
+        self.sequence_counter = SequenceCounter()  # lost readouts
 
     def setup_raw_data_analysis(self):
-        self.interpreter = PyDataInterpreter()
-        self.histogram = PyDataHistograming()
-        self.interpreter.set_warning_output(False)
-        self.histogram.set_no_scan_parameter()
-        self.histogram.create_occupancy_hist(True)
-        self.histogram.create_rel_bcid_hist(True)
-        self.histogram.create_tot_hist(True)
-        self.histogram.create_tdc_hist(True)
-        try:
-            self.histogram.create_tdc_distance_hist(True)
-            self.interpreter.use_tdc_trigger_time_stamp(True)
-        except AttributeError:
-            self.has_tdc_distance = False
-        else:
-            self.has_tdc_distance = True
+        self.interpreter, self.histogram, self.has_tdc_distance = create_raw_data_analysis()
 
     def connect(self, socket_addr):
         self.socket_addr = socket_addr
@@ -55,82 +153,229 @@ class DataWorker(QtCore.QObject):
         self.socket_pull = self.context.socket(zmq.SUB)  # subscriber
         self.socket_pull.setsockopt(zmq.SUBSCRIBE, '')  # do not filter any data
         self.socket_pull.connect(self.socket_addr)
+        self.poller = zmq.Poller()
+        self.poller.register(self.socket_pull, zmq.POLLIN)
 
     def on_set_integrate_readouts(self, value):
         self.integrate_readouts = value
 
+    def on_set_frame_rate(self, value):
+        self.frame_rate = value
+
     def reset(self):
         with self.reset_lock:
-            self.histogram.reset()
-            self.interpreter.reset()
+            self.reset_raw_data_analysis()
+            self.sequence_counter.reset()
             self.n_readout = 0
+            self._interpreted_data = None
+
+    def reset_raw_data_analysis(self):
+        self.histogram.reset()
+        self.interpreter.reset()
 
     def analyze_raw_data(self, raw_data):
         self.interpreter.interpret_raw_data(raw_data)
         self.histogram.add_hits(self.interpreter.get_hits())
 
+    def get_interpreted_data(self, copy=False):
+        return get_interpreted_data(self.interpreter, self.histogram, self.has_tdc_distance, copy=copy)
+
+    def receive_messages(self, timeout):
+        '''Waiting for messages and receiving all pending messages (up to max_batch_size).
+
+        Parameters
+        ----------
+        timeout : float
+            Timeout in seconds.
+
+        Returns
+        -------
+        List of tuples with meta data and data (None if message has no data).
+        '''
+        messages = []
+        if not self.poller.poll(max(0, int(timeout * 1000))):  # blocking until message arrives or timeout
+            return messages
+        while len(messages) < self.max_batch_size:
+            try:
+                meta_data = self.socket_pull.recv_json(flags=zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            if meta_data['name'] == 'ReadoutData':
+                data = self.socket_pull.recv()
+                if not is_message_for_channel(meta_data):  # data of a single channel, complete raw data is also sent
+                    continue
+            elif meta_data['name'] == 'Histograms':  # histogram server
+                data = self.socket_pull.recv_multipart()
+            else:
+                data = None
+            messages.append((meta_data, data))
+        return messages
+
+    def handle_messages(self, messages):
+        n_readouts = sum(1 for meta_data, _ in messages if meta_data['name'] == 'ReadoutData')
+        for meta_data, data in messages:
+            name = meta_data.pop('name')
+            if name == 'ReadoutData':
+                n_readouts -= 1  # remaining readouts in this batch
+                self.n_readout += 1
+                self._n_readouts_update += 1
+                self.handle_readout_data(meta_data, data, n_readouts)
+            elif name == 'RunConf':
+                self.run_config_data.emit(meta_data)
+            elif name == 'GlobalRegisterConf':
+                trig_count = int(meta_data['conf']['Trig_Count'])
+                self.interpreter.set_trig_count(trig_count)
+                self.global_config_data.emit(meta_data)
+            elif name == 'Reset':
+                self.reset_raw_data_analysis()
+                self.sequence_counter.reset()
+                self.run_start.emit()
+            elif name == 'Filename':
+                self.filename.emit(meta_data)
+            elif name == 'Histograms':
+                self.handle_histograms(meta_data, data)
+
+    def handle_histograms(self, meta_data, frames):
+        '''Taking the histograms from the histogram server (see histogram_server.py) instead of interpreting raw data.
+        '''
+        interpreted_data = receive_histograms(meta_data, frames, decoder=self.histogram_decoder)
+        if interpreted_data is not None:  # waiting for keyframe
+            self._interpreted_data = interpreted_data
+        readout_meta_data = meta_data['meta_data']
+        self._n_readouts_update += readout_meta_data.pop('n_readouts', 0)
+        if readout_meta_data:
+            self._meta_data = readout_meta_data
+
+    def handle_readout_data(self, meta_data, data, n_remaining_readouts):
+        # reconstruct numpy array
+        data_array = get_data_from_message(meta_data, data)
+        self.sequence_counter.update(meta_data)
+        for key in ('dtype', 'shape', 'compression', 'sequence', 'channel', 'channels'):
+            meta_data.pop(key, None)
+        # the interpreter is not reset to keep the error counters
+        interpreted_data = integrate_readout(self.interpreter, self.histogram, self.has_tdc_distance, data_array, n_readout=self.n_readout, integrate_readouts=self.integrate_readouts, n_remaining_readouts=n_remaining_readouts)
+        if interpreted_data is not None:  # True: histograms are taken at the next plot update
+            self._interpreted_data = interpreted_data
+        # meta data
+        meta_data.update({'n_hits': self.interpreter.get_n_hits(), 'n_events': self.interpreter.get_n_events(), 'n_lost': self.sequence_counter.n_lost})
+        self._meta_data = meta_data
+
+    def update(self):
+        '''Emitting latest histograms and meta data.
+        '''
+        if self._interpreted_data is not None:
+            self.interpreted_data.emit(self.get_interpreted_data() if self._interpreted_data is True else self._interpreted_data)
+            self._interpreted_data = None
+        if self._meta_data is not None:
+            self._meta_data['n_readouts'] = self._n_readouts_update
+            self.meta_data.emit(self._meta_data)
+            self._meta_data = None
+            self._n_readouts_update = 0
+
     def process_data(self):  # infinite loop via QObject.moveToThread(), does not block event loop
-        while(not self._stop_readout.wait(0.01)):  # use wait(), do not block here
+        next_update = time.time()
+        while not self._stop_readout.is_set():
+            # wait for data until next plot update, wake up regularly to check for stop
+            messages = self.receive_messages(timeout=min(next_update - time.time(), 0.1))
             with self.reset_lock:
-                try:
-                    meta_data = self.socket_pull.recv_json(flags=zmq.NOBLOCK)
-                except zmq.Again:
-                    pass
-                else:
-                    name = meta_data.pop('name')
-                    if name == 'ReadoutData':
-                        data = self.socket_pull.recv()
-                        # reconstruct numpy array
-                        buf = buffer(data)
-                        dtype = meta_data.pop('dtype')
-                        shape = meta_data.pop('shape')
-                        data_array = np.frombuffer(buf, dtype=dtype).reshape(shape)
-                        # count readouts and reset
-                        self.n_readout += 1
-                        if self.integrate_readouts != 0 and self.n_readout % self.integrate_readouts == 0:
-                            self.histogram.reset()
-                            # we do not want to reset interpreter to keep the error counters
-        #                         self.interpreter.reset()
-                            # interpreted data
-                        self.analyze_raw_data(data_array)
-                        if self.integrate_readouts == 0 or self.n_readout % self.integrate_readouts == self.integrate_readouts - 1:
-                            interpreted_data = {
-                                'occupancy': self.histogram.get_occupancy(),
-                                'tot_hist': self.histogram.get_tot_hist(),
-                                'tdc_counters': self.interpreter.get_tdc_counters(),
-                                'tdc_distance': self.interpreter.get_tdc_distance() if self.has_tdc_distance else np.zeros((256,), dtype=np.uint8),
-                                'error_counters': self.interpreter.get_error_counters(),
-                                'service_records_counters': self.interpreter.get_service_records_counters(),
-                                'trigger_error_counters': self.interpreter.get_trigger_error_counters(),
-                                'rel_bcid_hist': self.histogram.get_rel_bcid_hist()}
-                            self.interpreted_data.emit(interpreted_data)
-                        # meta data
-                        meta_data.update({'n_hits': self.interpreter.get_n_hits(), 'n_events': self.interpreter.get_n_events()})
-                        self.meta_data.emit(meta_data)
-                    elif name == 'RunConf':
-                        self.run_config_data.emit(meta_data)
-                    elif name == 'GlobalRegisterConf':
-                        trig_count = int(meta_data['conf']['Trig_Count'])
-                        self.interpreter.set_trig_count(trig_count)
-                        self.global_config_data.emit(meta_data)
-                    elif name == 'Reset':
-                        self.histogram.reset()
-                        self.interpreter.reset()
-                        self.run_start.emit()
-                    elif name == 'Filename':
-                        self.filename.emit(meta_data)
+                if messages:
+                    self.handle_messages(messages)
+                now = time.time()
+                if now >= next_update:
+                    self.update()
+                    next_update = max(next_update + 1.0 / self.frame_rate, now)  # do not try to catch up
         self.finished.emit()
 
     def stop(self):
         self._stop_readout.set()
 
 
+class MultiProcessDataWorker(DataWorker):
+    '''Data worker with the raw data interpretation running in separate processes.
+
+    Each process interprets the data of a FE channel (or all data if channel is None) and publishes the histograms into shared memory.
+    The histograms of all processes are summed up at the plot update.
+    '''
+    def __init__(self, channels=(None,), frame_rate=10.0):
+        self.channels = channels
+        self._frame_rate = multiprocessing.Value('d', frame_rate)
+        self._integrate_readouts = multiprocessing.Value('l', 1)
+        self._stop_processes = multiprocessing.Event()
+        self.shared_histograms = [SharedHistograms() for _ in channels]
+        self._reset_processes = [multiprocessing.Event() for _ in channels]
+        self.processes = []
+        DataWorker.__init__(self, frame_rate=frame_rate)
+
+    @property
+    def frame_rate(self):
+        return self._frame_rate.value
+
+    @frame_rate.setter
+    def frame_rate(self, value):
+        self._frame_rate.value = value
+
+    @property
+    def integrate_readouts(self):
+        return self._integrate_readouts.value
+
+    @integrate_readouts.setter
+    def integrate_readouts(self, value):
+        self._integrate_readouts.value = value
+
+    def connect(self, socket_addr):
+        DataWorker.connect(self, socket_addr)
+        for channel, shared_histograms, reset in zip(self.channels, self.shared_histograms, self._reset_processes):
+            process = multiprocessing.Process(target=interpret_data, name='Interpretation%s' % ('' if channel is None else ' CH%d' % channel), kwargs={'socket_addr': socket_addr, 'shared_histograms': shared_histograms, 'channel': channel, 'frame_rate': self._frame_rate, 'integrate_readouts': self._integrate_readouts, 'reset': reset, 'stop': self._stop_processes})
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+
+    def reset_raw_data_analysis(self):
+        for reset in self._reset_processes:
+            reset.set()
+
+    def get_interpreted_data(self, copy=False):  # histograms from shared memory are always copies
+        interpreted_data = None
+        for shared_histograms in self.shared_histograms:
+            histograms, _, _ = shared_histograms.get_histograms()
+            if interpreted_data is None:
+                interpreted_data = histograms
+            else:
+                for name, value in histograms.iteritems():
+                    interpreted_data[name] += value
+        return interpreted_data
+
+    def handle_readout_data(self, meta_data, data, n_remaining_readouts):  # raw data is interpreted by the processes
+        self.sequence_counter.update(meta_data)
+        for key in ('dtype', 'shape', 'compression', 'sequence', 'channel', 'channels'):
+            meta_data.pop(key, None)
+        self._interpreted_data = True  # histograms are taken from shared memory at the next plot update
+        n_hits, n_events = 0, 0
+        for shared_histograms in self.shared_histograms:
+            channel_n_hits, channel_n_events = shared_histograms.get_counters()
+            n_hits += channel_n_hits
+            n_events = max(n_events, channel_n_events)  # trigger words are interpreted by all processes
+        meta_data.update({'n_hits': n_hits, 'n_events': n_events, 'n_lost': self.sequence_counter.n_lost})
+        self._meta_data = meta_data
+
+    def process_data(self):
+        try:
+            DataWorker.process_data(self)
+        finally:
+            self._stop_processes.set()
+            for process in self.processes:
+                process.join(1.0)
+                if process.is_alive():
+                    process.terminate()
+
+
 class OnlineMonitorApplication(QtGui.QMainWindow):
 
-    def __init__(self, socket_addr):
+    def __init__(self, socket_addr, frame_rate=10.0, channels=None):
         super(OnlineMonitorApplication, self).__init__()
         self.setup_plots()
         self.add_widgets()
+        self.frame_rate_spin_box.setValue(frame_rate)
         self.fps = 0  # data frames per second
         self.hps = 0  # hits per second
         self.eps = 0  # events per second
@@ -138,7 +383,7 @@ class OnlineMonitorApplication(QtGui.QMainWindow):
         self.updateTime = ptime.time()
         self.total_hits = 0
         self.total_events = 0
-        self.setup_data_worker_and_start(socket_addr)
+        self.setup_data_worker_and_start(socket_addr, frame_rate, channels)
         self.reset_plots()
 
     def closeEvent(self, event):
@@ -147,9 +392,14 @@ class OnlineMonitorApplication(QtGui.QMainWindow):
         self.worker.stop()
         self.thread.wait(2)  # fixes message: QThread: Destroyed while thread is still running
 
-    def setup_data_worker_and_start(self, socket_addr):
+    def setup_data_worker_and_start(self, socket_addr, frame_rate=10.0, channels=None):
+        '''Setting up data worker. If channels is not None, the raw data is interpreted in separate processes (one per channel, None for all channels).
+        '''
         self.thread = QtCore.QThread()  # no parent
-        self.worker = DataWorker()  # no parent
+        if channels is None:
+            self.worker = DataWorker(frame_rate=frame_rate)  # no parent
+        else:
+            self.worker = MultiProcessDataWorker(channels=channels, frame_rate=frame_rate)  # no parent
         self.worker.meta_data.connect(self.on_meta_data)
         self.worker.interpreted_data.connect(self.on_interpreted_data)
         self.worker.run_start.connect(self.on_run_start)
@@ -157,6 +407,7 @@ class OnlineMonitorApplication(QtGui.QMainWindow):
         self.worker.global_config_data.connect(self.on_global_config_data)
         self.worker.filename.connect(self.on_filename)
         self.spin_box.valueChanged.connect(self.worker.on_set_integrate_readouts)
+        self.frame_rate_spin_box.valueChanged.connect(self.worker.on_set_frame_rate)
         self.reset_button.clicked.connect(self.on_reset)
         self.worker.moveToThread(self.thread)
         self.worker.connect(socket_addr)
@@ -214,6 +465,9 @@ class OnlineMonitorApplication(QtGui.QMainWindow):
         self.spin_box = Qt.QSpinBox(value=1)
         self.spin_box.setMaximum(1000000)
         self.spin_box.setSuffix(" Readouts")
+        self.frame_rate_spin_box = Qt.QDoubleSpinBox(value=10.0)
+        self.frame_rate_spin_box.setRange(0.1, 100.0)
+        self.frame_rate_spin_box.setSuffix(" Hz")
         self.reset_button = QtGui.QPushButton('Reset')
         layout.addWidget(self.timestamp_label, 0, 0, 0, 1)
         layout.addWidget(self.plot_delay_label, 0, 1, 0, 1)
@@ -222,7 +476,8 @@ class OnlineMonitorApplication(QtGui.QMainWindow):
         layout.addWidget(self.event_rate_label, 0, 4, 0, 1)
         layout.addWidget(self.scan_parameter_label, 0, 5, 0, 1)
         layout.addWidget(self.spin_box, 0, 6, 0, 1)
-        layout.addWidget(self.reset_button, 0, 7, 0, 1)
+        layout.addWidget(self.frame_rate_spin_box, 0, 7, 0, 1)
+        layout.addWidget(self.reset_button, 0, 8, 0, 1)
         dock_status.addWidget(cw)
 
         # Run config dock
@@ -333,7 +588,7 @@ class OnlineMonitorApplication(QtGui.QMainWindow):
     def on_meta_data(self, meta_data):
         self.update_monitor(**meta_data)
 
-    def update_monitor(self, timestamp_start, timestamp_stop, readout_error, scan_parameters, n_hits, n_events):
+    def update_monitor(self, timestamp_start, timestamp_stop, readout_error, scan_parameters, n_hits, n_events, n_readouts=1, n_lost=0):
         self.timestamp_label.setText("Data Timestamp\n%s" % time.asctime(time.localtime(timestamp_stop)))
         self.scan_parameter_label.setText("Scan Parameters\n%s" % ', '.join('%s: %s' % (str(key), str(val)) for key, val in scan_parameters.iteritems()))
         now = ptime.time()
@@ -341,19 +596,23 @@ class OnlineMonitorApplication(QtGui.QMainWindow):
         recent_total_events = n_events
         self.plot_delay = self.plot_delay * 0.9 + (now - timestamp_stop) * 0.1
         self.plot_delay_label.setText("Plot Delay\n%s" % ((time.strftime('%H:%M:%S', time.gmtime(self.plot_delay))) if abs(self.plot_delay) > 5 else "%1.2f ms" % (self.plot_delay * 1.e3)))
-        recent_fps = 1.0 / (now - self.updateTime)  # calculate FPS
+        recent_fps = n_readouts / (now - self.updateTime)  # calculate FPS, meta data contains the number of readouts since last update
         recent_hps = (recent_total_hits - self.total_hits) / (now - self.updateTime)
         recent_eps = (recent_total_events - self.total_events) / (now - self.updateTime)
         self.updateTime = now
         self.total_hits = recent_total_hits
         self.total_events = recent_total_events
+        # updates are coming with a fixed frame rate
         self.fps = self.fps * 0.7 + recent_fps * 0.3
-        self.hps = self.hps + (recent_hps - self.hps) * 0.3 / self.fps
-        self.eps = self.eps + (recent_eps - self.eps) * 0.3 / self.fps
-        self.update_rate(self.fps, self.hps, recent_total_hits, self.eps, recent_total_events)
+        self.hps = self.hps * 0.7 + recent_hps * 0.3
+        self.eps = self.eps * 0.7 + recent_eps * 0.3
+        self.update_rate(self.fps, self.hps, recent_total_hits, self.eps, recent_total_events, n_lost)
 
-    def update_rate(self, fps, hps, recent_total_hits, eps, recent_total_events):
-        self.rate_label.setText("Readout Rate\n%d Hz" % fps)
+    def update_rate(self, fps, hps, recent_total_hits, eps, recent_total_events, n_lost=0):
+        if n_lost:  # readouts dropped by the publisher or lost
+            self.rate_label.setText("Readout Rate\n%d Hz (%d lost)" % (fps, n_lost))
+        else:
+            self.rate_label.setText("Readout Rate\n%d Hz" % fps)
         if self.spin_box.value() == 0:  # show number of hits, all hits are integrated
             self.hit_rate_label.setText("Total Hits\n%d" % int(recent_total_hits))
         else:
@@ -368,7 +627,21 @@ if __name__ == '__main__':
     usage = "Usage: %prog ADDRESS"
     description = "ADDRESS: Remote address of the sender (default: tcp://127.0.0.1:5678)."
     parser = OptionParser(usage, description=description)
+    parser.add_option("-f", "--frame_rate", dest="frame_rate", type="float", default=10.0, help="Plot updates per second (default: 10)")
+    parser.add_option("-m", "--multiprocessing", dest="multiprocessing", action="store_true", default=False, help="Interpret raw data in a separate process")
+    parser.add_option("-c", "--channels", dest="channels", type="string", default=None, help="Interpret raw data in separate processes, one per channel (comma separated list, e.g. 1,2,3,4)")
     options, args = parser.parse_args()
+    if options.frame_rate <= 0:
+        parser.error("frame rate must be positive")
+    if options.channels:
+        try:
+            channels = [int(channel) for channel in options.channels.split(',')]
+        except ValueError:
+            parser.error("invalid channel list")
+    elif options.multiprocessing:
+        channels = [None]
+    else:
+        channels = None
     if len(args) == 0:
         socket_addr = 'tcp://127.0.0.1:5678'
     elif len(args) == 1:
@@ -378,7 +651,7 @@ if __name__ == '__main__':
 
     app = Qt.QApplication(sys.argv)
 #     app.aboutToQuit.connect(myExitHandler)
-    win = OnlineMonitorApplication(socket_addr=socket_addr)  # enter remote IP to connect to the other side listening
+    win = OnlineMonitorApplication(socket_addr=socket_addr, frame_rate=options.frame_rate, channels=channels)  # enter remote IP to connect to the other side listening
     win.resize(800, 840)
     win.setWindowTitle('Online Monitor')
     win.show()
@@ -0,0 +1,171 @@
+''' Run database.
+
+The run number, run class, run status, timestamps and configuration file of each run are stored in a SQLite database (run.db) inside the working directory.
+Adding a run and updating the run status are single row operations, the run numbers are indexed by run status.
+An existing run list (run.cfg, used by previous versions of pyBAR) is imported when the database is created.
+A connection must not be used in a forked process (e.g. background analysis), a new RunDatabase has to be opened there.
+'''
+import logging
+import os
+import re
+import sqlite3
+from threading import Lock
+
+
+class RunDatabase(object):
+    '''Run database (SQLite).
+
+    Parameters
+    ----------
+    filename : string
+        Filename of the database. The database is created if the file does not exist.
+    timeout : float
+        Timeout in seconds, if the database is locked by another process.
+    '''
+    def __init__(self, filename, timeout=30.0):
+        self.filename = filename
+        self.pid = os.getpid()  # process which opened the connection
+        self.lock = Lock()
+        path = os.path.dirname(filename)
+        if path and not os.path.exists(path):
+            os.makedirs(path)
+        new_database = not os.path.isfile(filename)
+        self.connection = sqlite3.connect(filename, timeout=timeout, check_same_thread=False, isolation_level=None)  # autocommit, transactions are explicit
+        with self.lock:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS runs (run_number INTEGER PRIMARY KEY, run_class TEXT, status TEXT, start_time TEXT, stop_time TEXT, total_time TEXT, configuration_file TEXT)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS runs_status ON runs (status)')
+        if new_database:
+            run_list = os.path.join(path, "run.cfg")
+            if os.path.isfile(run_list):
+                self.import_run_list(run_list)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def import_run_list(self, filename):
+        '''Importing run list (run.cfg) of previous versions of pyBAR.
+        '''
+        runs = []
+        with open(filename, 'r') as f:
+            for line in f.readlines():
+                parts = re.split('\s+', line.strip())
+                try:
+                    run_number = int(parts[0])
+                    run_class, status = parts[1], parts[2]
+                except (IndexError, ValueError):
+                    continue
+                # timestamps: start date and time, stop date and time, total time
+                start_time = ' '.join(parts[3:5]) if len(parts) >= 5 else None
+                stop_time = ' '.join(parts[5:7]) if len(parts) >= 7 else None
+                total_time = parts[7] if len(parts) >= 8 else None
+                runs.append((run_number, run_class, status, start_time, stop_time, total_time))
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                self.connection.executemany('INSERT OR REPLACE INTO runs (run_number, run_class, status, start_time, stop_time, total_time) VALUES (?, ?, ?, ?, ?, ?)', runs)
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+            else:
+                self.connection.execute('COMMIT')
+        logging.info('Imported %d run(s) from %s', len(runs), filename)
+
+    def add_run(self, run_class, status, start_time, run_number=None):
+        '''Adding new run.
+
+        Parameters
+        ----------
+        run_class : string
+            Name of the run class.
+        status : string
+            Run status.
+        start_time : datetime
+            Start time.
+        run_number : int
+            Run number. If None, the next run number will be used. An existing run with the same run number is replaced.
+
+        Returns
+        -------
+        Run number.
+        '''
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')  # lock database, other processes are adding runs as well
+            try:
+                if not run_number:
+                    run_number = self.connection.execute('SELECT COALESCE(MAX(run_number), 0) + 1 FROM runs').fetchone()[0]
+                self.connection.execute('INSERT OR REPLACE INTO runs (run_number, run_class, status, start_time) VALUES (?, ?, ?, ?)', (run_number, run_class, status, str(start_time)))
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+            else:
+                self.connection.execute('COMMIT')
+        return run_number
+
+    def set_run_status(self, run_number, status, stop_time, total_time, run_class=None):
+        '''Updating run status. The run is added if it does not exist.
+        '''
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                if not self.connection.execute('UPDATE runs SET status = ?, stop_time = ?, total_time = ? WHERE run_number = ?', (status, str(stop_time), str(total_time), run_number)).rowcount:
+                    self.connection.execute('INSERT INTO runs (run_number, run_class, status, stop_time, total_time) VALUES (?, ?, ?, ?, ?)', (run_number, run_class, status, str(stop_time), str(total_time)))
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+            else:
+                self.connection.execute('COMMIT')
+
+    def update_run_status(self, run_number, status):
+        '''Updating only the run status of an existing run (e.g. after a failed background analysis).
+        '''
+        with self.lock:
+            self.connection.execute('UPDATE runs SET status = ? WHERE run_number = ?', (status, run_number))
+
+    def set_configuration_file(self, run_number, configuration_file):
+        with self.lock:
+            self.connection.execute('UPDATE runs SET configuration_file = ? WHERE run_number = ?', (configuration_file, run_number))
+
+    def get_configuration_file(self, run_number):
+        with self.lock:
+            row = self.connection.execute('SELECT configuration_file FROM runs WHERE run_number = ?', (run_number,)).fetchone()
+        return row[0] if row else None
+
+    def get_run_numbers(self, status=None):
+        '''Returns the run numbers (descending order).
+
+        Parameters
+        ----------
+        status : string, iterable
+            Run status. If None, all run numbers are returned.
+        '''
+        with self.lock:
+            if status is None:
+                rows = self.connection.execute('SELECT run_number FROM runs ORDER BY run_number DESC').fetchall()
+            else:
+                if isinstance(status, basestring):
+                    status = [status]
+                rows = self.connection.execute('SELECT run_number FROM runs WHERE status IN (%s) ORDER BY run_number DESC' % ', '.join('?' * len(status)), tuple(status)).fetchall()
+        return [row[0] for row in rows]
+
+    def get_runs(self, status=None):
+        '''Returns the runs (descending order).
+
+        Parameters
+        ----------
+        status : string, iterable
+            Run status. If None, all runs are returned.
+
+        Returns
+        -------
+        List of dictionaries with run_number, run_class, status, start_time, stop_time, total_time and configuration_file.
+        '''
+        with self.lock:
+            if status is None:
+                cursor = self.connection.execute('SELECT * FROM runs ORDER BY run_number DESC')
+            else:
+                if isinstance(status, basestring):
+                    status = [status]
+                cursor = self.connection.execute('SELECT * FROM runs WHERE status IN (%s) ORDER BY run_number DESC' % ', '.join('?' * len(status)), tuple(status))
+            names = [description[0] for description in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
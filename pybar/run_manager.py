@@ -4,8 +4,9 @@ import datetime
 import os
 import re
 from collections import namedtuple
-from threading import Lock, Thread, Event
+from threading import Lock, Thread, Event, BoundedSemaphore
 # from multiprocessing import dummy as multiprocessing
+import multiprocessing
 import sys
 import functools
 import traceback
@@ -17,9 +18,13 @@ from inspect import getmembers, isclass
 from functools import partial
 from ast import literal_eval
 from time import time
+from Queue import Empty
 from threading import current_thread
 from functools import wraps
 
+from pybar.run_database import RunDatabase
+from pybar.scans import scans, get_scan
+
 
 punctuation = """!,.:;?"""
 
@@ -60,9 +65,12 @@ class RunBase():
         self._run_number = None
         self._run_status = None
         self.file_lock = Lock()
+        self._run_database = None
         self.stop_run = Event()  # abort condition for loops
         self.abort_run = Event()
         self._last_traceback = None
+        self.analysis_queue = None  # see AnalysisQueue, if set, data analysis can be done in background
+        self._analysis_job = None  # background analysis, started after the run status has been written
 
 #     @abc.abstractproperty
 #     def _run_id(self):
@@ -173,6 +181,7 @@ class RunBase():
                 traceback.print_exc(file=f)
                 f.write('\n')
         logging.log(log_status, '{} run {} ({}) in {} (total time: {})'.format(self.run_status, self.run_number, self.__class__.__name__, self.working_dir, str(self._total_run_time)))
+        self._close_run_database()
         return self.run_status
 
     def _init(self, run_conf, run_number=None):
@@ -228,6 +237,30 @@ class RunBase():
     def _cleanup(self):
         """Cleanup after a new run."""
         self._write_run_status(self.run_status)
+        self._start_analysis_job()
+
+    def _start_analysis_job(self):
+        '''Starting the background analysis (see AnalysisQueue) of a finished run.
+
+        The analysis is started after the run status has been written and after the threads of the run have been stopped (the analysis process is forked).
+        A failed analysis changes the run status to CRASHED (see _write_analysis_status()).
+        '''
+        analysis_job, self._analysis_job = self._analysis_job, None
+        if analysis_job is None or self.run_status != run_status.finished:
+            return
+        logging.info('Analyzing data in background')
+        self.analysis_queue.put(analysis_job, name='%s (run %d)' % (self.__class__.__name__, self.run_number), callback=partial(self._write_analysis_status, self.run_number))
+
+    def _write_analysis_status(self, run_number, success):
+        '''Writing the result of the background analysis to the run database. Executed by the thread waiting for the analysis, a separate connection to the run database is used.
+        '''
+        if success:
+            return
+        run_database = RunDatabase(os.path.join(self.working_dir, "run" + ".db"))
+        try:
+            run_database.update_run_status(run_number=run_number, status=run_status.crashed)
+        finally:
+            run_database.close()
 
     def stop(self, msg=None):
         """Stopping a run. Control for loops.
@@ -250,62 +283,44 @@ class RunBase():
         self.abort_run.set()
         self.stop_run.set()  # set stop_run in case abort_run event is not used
 
+    @property
+    def run_database(self):
+        '''Run database (see RunDatabase) inside working directory.
+
+        The database is opened when needed and closed at the end of the run. In a forked process (e.g. background analysis, see AnalysisQueue),
+        a new connection is opened, the SQLite connection and the locks of the parent process are not used.
+        '''
+        filename = os.path.join(self.working_dir, "run" + ".db")
+        if self._run_database is not None and self._run_database.pid != os.getpid():
+            self._run_database = None
+            self.file_lock = Lock()
+        if self._run_database is None or self._run_database.filename != filename:
+            with self.file_lock:
+                if self._run_database is not None:
+                    self._run_database.close()
+                self._run_database = RunDatabase(filename)
+        return self._run_database
+
+    def _close_run_database(self):
+        if self._run_database is not None and self._run_database.pid == os.getpid():
+            with self.file_lock:
+                self._run_database.close()
+                self._run_database = None
+
     def _get_run_numbers(self, status=None):
         run_numbers = {}
-        with self.file_lock:
-            if not os.path.exists(self.working_dir):
-                os.makedirs(self.working_dir)
-            # In Python 2.x, open on all POSIX systems ultimately just depends on fopen.
-            with open(os.path.join(self.working_dir, "run" + ".cfg"), 'a+') as f:
-                f.seek(0)
-                for line in f.readlines():
-                    try:
-                        number_parts = re.findall('\d+\s+', line)
-                        parts = re.split('\s+', line)
-                        if status:
-                            if parts[2] in status:
-                                run_number = int(number_parts[0])
-                            else:
-                                continue
-                        else:
-                            run_number = int(number_parts[0])
-                    except IndexError:
-                        continue
-                    if line[-1] != '\n':
-                        line = line + '\n'
-                    run_numbers[run_number] = line
+        for run in self.run_database.get_runs(status=status):
+            run_numbers[run['run_number']] = ' '.join([str(run[key]) for key in ('run_number', 'run_class', 'status', 'start_time', 'stop_time', 'total_time') if run[key] is not None]) + '\n'
         return run_numbers
 
     def _write_run_number(self, run_number=None):
         self._run_start_time = datetime.datetime.now()
-        run_numbers = self._get_run_numbers()
-        if run_number:
-            self._run_number = run_number
-        else:
-            if not run_numbers:
-                self._run_number = 1
-            else:
-                self._run_number = max(dict.iterkeys(run_numbers)) + 1
-        run_numbers[self.run_number] = str(self.run_number) + ' ' + self.__class__.__name__ + ' ' + 'RUNNING' + ' ' + str(self._run_start_time) + '\n'
-        with self.file_lock:
-            with open(os.path.join(self.working_dir, "run" + ".cfg"), "w") as f:
-                for value in dict.itervalues(run_numbers):
-                    f.write(value)
+        self._run_number = self.run_database.add_run(run_class=self.__class__.__name__, status='RUNNING', start_time=self._run_start_time, run_number=run_number)
 
     def _write_run_status(self, status_msg):
         self._run_stop_time = datetime.datetime.now()
         self._total_run_time = self._run_stop_time - self._run_start_time
-        run_numbers = self._get_run_numbers()
-        if not run_numbers:
-            run_numbers[self.run_number] = str(self.run_number) + ' ' + self.__class__.__name__ + ' ' + status_msg + ' ' + str(self._run_stop_time) + ' ' + str(self._total_run_time) + '\n'
-        else:
-            parts = re.split('\s+', run_numbers[self.run_number])
-            parts[2] = status_msg
-            run_numbers[self.run_number] = ' '.join(parts[:-1]) + ' ' + str(self._run_stop_time) + ' ' + str(self._total_run_time) + '\n'
-        with self.file_lock:
-            with open(os.path.join(self.working_dir, "run" + ".cfg"), "w") as f:
-                for value in dict.itervalues(run_numbers):
-                    f.write(value)
+        self.run_database.set_run_status(run_number=self.run_number, status=status_msg, stop_time=self._run_stop_time, total_time=self._total_run_time, run_class=self.__class__.__name__)
 
     def _signal_handler(self, signum, frame):
         signal.signal(signal.SIGINT, signal.SIG_DFL)  # setting default handler... pressing Ctrl-C a second time will kill application
@@ -361,6 +376,81 @@ def thunkify(thread_name):
     return actual_decorator
 
 
+class AnalysisQueue(object):
+    '''Data analysis of runs in background processes while the next run is taking data.
+
+    Each analysis job is executed in a separate process. The process is forked when the job is added, so that the job works on a snapshot
+    of the current state (e.g. the FE register, which is shared between runs) and the run object does not need to be pickled.
+    Only the calling thread exists in the forked process, jobs should be added when no other threads hold locks (e.g. after stopping the readout).
+    Needs fork (not available on Windows).
+
+    Parameters
+    ----------
+    n_workers : int
+        Max. number of parallel analysis jobs.
+    '''
+    def __init__(self, n_workers=1):
+        self.n_workers = n_workers
+        self.results = []  # tuples of job name and success
+        self._slots = BoundedSemaphore(n_workers)
+        self._results_lock = Lock()
+        self._threads = []
+
+    def put(self, job, name=None, callback=None):
+        '''Starting analysis job. Blocks only if n_workers jobs are running.
+
+        Parameters
+        ----------
+        job : function
+            Function without arguments executing the analysis.
+        name : string
+            Name of the job for logging.
+        callback : function
+            Function called with the success of the job (bool) when the job has finished. Called by the thread waiting for the job.
+        '''
+        if not name:
+            name = job.__name__
+        self._slots.acquire()
+        logging.info('Starting analysis %s', name)
+        process = multiprocessing.Process(target=job, name=name)
+        process.start()
+        thread = Thread(target=self._wait_for_job, args=(process, name, time(), callback), name='AnalysisThread')
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def _wait_for_job(self, process, name, start_time, callback=None):
+        try:
+            process.join()
+            success = (process.exitcode == 0)
+            if success:
+                logging.info('Finished analysis %s (total time: %s)', name, datetime.timedelta(seconds=time() - start_time))
+            else:
+                logging.error('Failed analysis %s (exit code %s)', name, process.exitcode)
+            if callback is not None:
+                try:
+                    callback(success)
+                except Exception:
+                    logging.error('Failed writing result of analysis %s:\n%s', name, traceback.format_exc())
+            with self._results_lock:
+                self.results.append((name, success))
+        finally:
+            self._slots.release()
+
+    def join(self):
+        '''Waiting for all analysis jobs.
+
+        Returns
+        -------
+        List of tuples with job name and success.
+        '''
+        for thread in self._threads:
+            while thread.is_alive():
+                thread.join(timeout=1.0)  # avoid blocking MainThread
+        with self._results_lock:
+            return list(self.results)
+
+
 class RunManager(object):
     def __init__(self, conf):
         '''Run Manager is taking care of initialization and execution of runs.
@@ -455,8 +545,8 @@ class RunManager(object):
 
         Parameters
         ----------
-        run : class, object
-            Run class or object.
+        run : class, object, string
+            Run class or object, or name of the run class (see pybar.scans).
         run_conf : str, dict, file
             Specific configuration for the run.
         use_thread : bool
@@ -474,6 +564,9 @@ class RunManager(object):
         conf = self.open_conf(conf)
         self._conf.update(conf)
 
+        if isinstance(run, basestring):
+            # run class from scan registry
+            run = get_scan(run)
         if isclass(run):
             # instantiate the class
             run = run(conf=self._conf)
@@ -517,7 +610,7 @@ class RunManager(object):
                 raise RuntimeError('Exception occurred. Please read the log.')
             return status
 
-    def run_primlist(self, primlist, skip_remaining=False):
+    def run_primlist(self, primlist, skip_remaining=False, analysis_workers=0):
         '''Runs runs from a primlist.
 
         Parameters
@@ -526,6 +619,13 @@ class RunManager(object):
             Filename of primlist.
         skip_remaining : bool
             If True, skip remaining runs, if a run does not exit with status FINISHED.
+        analysis_workers : int
+            If larger than 0, the data analysis of the runs is done in background by the given number of workers (see AnalysisQueue),
+            so that the next run can start immediately after the data taking. Runs which need the analysis results (e.g. tunings) are always analyzed immediately.
+
+        Returns
+        -------
+        List of tuples with run number, run class name and run status of the executed runs.
 
         Note
         ----
@@ -533,13 +633,26 @@ class RunManager(object):
         <module name (containing class) or class (in either case use dot notation)>; <scan parameter>=<value>; <another scan parameter>=<another value>
         '''
         runlist = self.open_primlist(primlist)
+        if analysis_workers and os.name == 'nt':
+            logging.warning('Background analysis not supported on Windows')
+            analysis_workers = 0
+        analysis_queue = AnalysisQueue(n_workers=analysis_workers) if analysis_workers else None
+        results = []
         for index, run in enumerate(runlist):
             logging.info('Progressing with run %i out of %i...', index + 1, len(runlist))
+            run.analysis_queue = analysis_queue
             join = self.run_run(run, use_thread=True)
             status = join()
+            results.append((run.run_number, run.__class__.__name__, status))
             if skip_remaining and not status == run_status.finished:
                 logging.error('Exited run %i with status %s: Skipping all remaining runs.', run.run_number, status)
                 break
+        if analysis_queue:
+            logging.info('Waiting for background analysis...')
+            failed = [name for name, success in analysis_queue.join() if not success]
+            if failed:
+                logging.error('Failed analysis: %s', ', '.join(failed))
+        return results
 
     def open_primlist(self, primlist):
         def isrun(item, module):
@@ -554,27 +667,30 @@ class RunManager(object):
                     if not line:
                         continue
                     parts = re.split('\s*[;]\s*', line)
-                    try:
-                        mod = import_module(parts[0])  # points to module
-                    except ImportError:
-                        mod = import_module(parts[0].rsplit('.', 1)[0])  # points to class
-                        islocalrun = partial(isrun, module=parts[0].split('.')[-2])
-                        clsmembers = getmembers(mod, islocalrun)
-                        run_cls = None
-                        for cls in clsmembers:
-                            if cls[0] == parts[0].rsplit('.', 1)[1]:
-                                run_cls = cls[1]
-                                break
-                        if not run_cls:
-                            raise ValueError('Found no matching class: %s' % parts[0].rsplit('.', 1)[1])
+                    if parts[0] in scans:  # name of run class from scan registry
+                        run_cls = get_scan(parts[0])
                     else:
-                        islocalrun = partial(isrun, module=parts[0])
-                        clsmembers = getmembers(mod, islocalrun)
-                        if len(clsmembers) > 1:
-                            raise ValueError('Found more than one matching class.')
-                        elif not len(clsmembers):
-                            raise ValueError('Found no matching class.')
-                        run_cls = clsmembers[0][1]
+                        try:
+                            mod = import_module(parts[0])  # points to module
+                        except ImportError:
+                            mod = import_module(parts[0].rsplit('.', 1)[0])  # points to class
+                            islocalrun = partial(isrun, module=parts[0].split('.')[-2])
+                            clsmembers = getmembers(mod, islocalrun)
+                            run_cls = None
+                            for cls in clsmembers:
+                                if cls[0] == parts[0].rsplit('.', 1)[1]:
+                                    run_cls = cls[1]
+                                    break
+                            if not run_cls:
+                                raise ValueError('Found no matching class: %s' % parts[0].rsplit('.', 1)[1])
+                        else:
+                            islocalrun = partial(isrun, module=parts[0])
+                            clsmembers = getmembers(mod, islocalrun)
+                            if len(clsmembers) > 1:
+                                raise ValueError('Found more than one matching class.')
+                            elif not len(clsmembers):
+                                raise ValueError('Found no matching class.')
+                            run_cls = clsmembers[0][1]
                     if run_cls.__class__.__name__ in self._conf:
                         run_conf = self._conf[run_cls.__class__.__name__]
                     else:
@@ -592,6 +708,131 @@ class RunManager(object):
         self.stop_current_run('Pressed Ctrl-C')
 
 
+def _run_primlist_in_process(index, conf, primlist, skip_remaining, analysis_workers, result_queue):
+    '''Executing primlist with a new run manager. Target of the processes of MultiRunManager.
+    '''
+    working_dir = None
+    runs = []
+    try:
+        runmngr = RunManager(conf)
+        working_dir = runmngr.conf.working_dir
+        runs = runmngr.run_primlist(primlist, skip_remaining=skip_remaining, analysis_workers=analysis_workers)
+    except Exception:
+        error = traceback.format_exc()
+        logging.error('Primlist %s crashed:\n%s', primlist, error)
+        result_queue.put((index, working_dir, runs, error))
+    else:
+        result_queue.put((index, working_dir, runs, None))
+
+
+class MultiRunManager(object):
+    def __init__(self, confs):
+        '''Multi Run Manager is executing the same primlist for several DUTs (e.g. several boards / modules) concurrently.
+
+        Each DUT is represented by a configuration (see RunManager). The primlist is executed by a separate RunManager
+        in a separate process for each configuration, so that the DUTs do not share any state (DUT, FE register, run database).
+        Each configuration needs its own working directory.
+
+        Parameters
+        ----------
+        confs : list of str, dict, file
+            Configuration for each DUT.
+        '''
+        if isinstance(confs, (basestring, dict, file)):
+            confs = [confs]
+        self.confs = [(conf.name if isinstance(conf, file) else conf) for conf in confs]  # file objects cannot be passed to another process
+        self.results = []
+        self._processes = []
+
+    def run_primlist(self, primlist, skip_remaining=False, analysis_workers=0):
+        '''Executing primlist for all DUTs. Blocks until all processes terminate.
+
+        Parameters
+        ----------
+        primlist : string
+            Filename of primlist (see RunManager.run_primlist()).
+        skip_remaining : bool
+            If True, skip remaining runs of a DUT, if a run does not exit with status FINISHED.
+        analysis_workers : int
+            Number of background analysis workers for each DUT (see RunManager.run_primlist()).
+
+        Returns
+        -------
+        List of dictionaries (one for each DUT, same order as the configurations) with keys:
+        conf, working_dir, runs (list of tuples with run number, run class name and run status), error (traceback or None) and exit code of the process.
+        '''
+        # DUTs sharing a working directory would write into the same run database, checked before starting the processes
+        working_dirs = [os.path.normcase(os.path.realpath(RunManager(conf).conf.working_dir)) for conf in self.confs]
+        duplicate_working_dirs = sorted(set(working_dir for working_dir in working_dirs if working_dirs.count(working_dir) > 1))
+        if duplicate_working_dirs:
+            raise ValueError('Same working directory for more than one DUT: %s' % ', '.join(duplicate_working_dirs))
+        result_queue = multiprocessing.Queue()
+        self._processes = []
+        for index, conf in enumerate(self.confs):
+            process = multiprocessing.Process(target=_run_primlist_in_process, args=(index, conf, primlist, skip_remaining, analysis_workers, result_queue), name='DUT%d' % index)
+            process.start()
+            logging.info('Starting primlist %s for DUT %d (%s) in process %d', primlist, index, conf if isinstance(conf, basestring) else 'dict', process.pid)
+            self._processes.append(process)
+
+        # Ctrl-C is received by all processes, the RunManager of each process is stopping its current run
+        signal.signal(signal.SIGINT, self._signal_handler)
+        logging.info('Press Ctrl-C to stop runs')
+        results = [{'conf': conf, 'working_dir': None, 'runs': [], 'error': None, 'exitcode': None} for conf in self.confs]
+        try:
+            pending = len(self.confs)
+            while pending:
+                # reading results before joining the processes, a process putting data into a queue is not terminating until the data is read
+                try:
+                    index, working_dir, runs, error = result_queue.get(timeout=1.0)
+                except Empty:
+                    if not any(process.is_alive() for process in self._processes):
+                        break  # process terminated without result (e.g. killed)
+                else:
+                    results[index].update(working_dir=working_dir, runs=runs, error=error)
+                    pending -= 1
+            for process in self._processes:
+                while process.is_alive():
+                    process.join(timeout=1.0)  # avoid blocking MainThread
+        finally:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+        for index, process in enumerate(self._processes):
+            results[index]['exitcode'] = process.exitcode
+            if process.exitcode != 0 and results[index]['error'] is None:
+                results[index]['error'] = 'Process exited with exit code %s' % process.exitcode
+        self.results = results
+        self._log_summary()
+        return results
+
+    def get_run_numbers(self, status=None):
+        '''Returns the run numbers of the last primlist for each DUT.
+
+        Parameters
+        ----------
+        status : string, iterable
+            Run status. If None, all run numbers are returned.
+
+        Returns
+        -------
+        List of lists of run numbers (same order as the configurations).
+        '''
+        if isinstance(status, basestring):
+            status = [status]
+        return [[run_number for run_number, _, run_status_ in result['runs'] if status is None or run_status_ in status] for result in self.results]
+
+    def _log_summary(self):
+        for index, result in enumerate(self.results):
+            failed = [(run_number, status) for run_number, _, status in result['runs'] if status != run_status.finished]
+            if result['error'] or failed:
+                log_status = logging.ERROR
+            else:
+                log_status = logging.INFO
+            logging.log(log_status, 'DUT %d (%s): %d run(s) %s%s%s', index, result['working_dir'], len(result['runs']), ', '.join(['%s %s' % (run_number, status) for run_number, _, status in result['runs']]), (', failed: ' + ', '.join(['%s' % run_number for run_number, _ in failed])) if failed else '', ('\n' + result['error']) if result['error'] else '')
+
+    def _signal_handler(self, signum, frame):
+        signal.signal(signal.SIGINT, signal.SIG_DFL)  # setting default handler... pressing Ctrl-C a second time will kill application
+        logging.info('Pressed Ctrl-C: Stopping runs...')
+
+
 def set_event_when_keyboard_interrupt(_lambda):
     '''Decorator function that sets Threading.Event() when keyboard interrupt (Ctrl+C) was raised
 
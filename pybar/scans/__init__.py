@@ -1,36 +1,97 @@
-from pybar.scans.calibrate_hit_or import HitOrCalibration, create_hitor_calibration
-from pybar.scans.calibrate_plsr_dac_transient import PlsrDacTransientCalibration
-from pybar.scans.calibrate_plsr_dac import PlsrDacCalibration, plot_pulser_dac
-from pybar.scans.calibrate_pulser_dac_correction import PulserDacCorrectionCalibration
-from pybar.scans.calibrate_plsr_dac_transient import PlsrDacTransientCalibration
-from pybar.scans.calibrate_plsr_dac_transient_advanced import PlsrDacTransientCalibrationAdvanced
-from pybar.scans.calibrate_threshold import ThresholdCalibration, create_threshold_calibration
-from pybar.scans.calibrate_tot import TotCalibration
-from pybar.scans.scan_analog import AnalogScan
-from pybar.scans.scan_crosstalk import CrosstalkScan
-from pybar.scans.scan_digital import DigitalScan
-from pybar.scans.scan_ext_trigger_gdac import ExtTriggerGdacScan
-from pybar.scans.scan_ext_trigger_stop_mode import StopModeExtTriggerScan
-from pybar.scans.scan_ext_trigger import ExtTriggerScan
-from pybar.scans.scan_fei4_self_trigger import FEI4SelfTriggerScan
-from pybar.scans.scan_hit_delay import HitDelayScan
-from pybar.scans.scan_ileak import IleakScan
-from pybar.scans.scan_init import InitScan
-from pybar.scans.scan_iv import IVScan
-from pybar.scans.scan_threshold_fast import FastThresholdScan
-from pybar.scans.scan_threshold import ThresholdScan
-from pybar.scans.test_register import RegisterTest
-from pybar.scans.test_tdc import TdcTest
-from pybar.scans.tune_fdac import FdacTuning
-from pybar.scans.tune_feedback import FeedbackTuning
-from pybar.scans.tune_fei4 import Fei4Tuning
-from pybar.scans.tune_gdac import GdacTuning
-from pybar.scans.tune_hot_pixels import HotPixelTuning
-from pybar.scans.tune_merged_pixels import MergedPixelsTuning
-from pybar.scans.tune_noise_occupancy import NoiseOccupancyScan
-from pybar.scans.tune_stuck_pixel import StuckPixelScan
-from pybar.scans.tune_tdac import TdacTuning
-from pybar.scans.tune_threshold_baseline import ThresholdBaselineTuning
-from pybar.scans.tune_tlu import TluTuning
+''' Scans, tunings and calibrations.
+
+The scan modules (and their dependencies, e.g. PyTables, SciPy, Matplotlib and the interpreter extensions) are imported
+on first access of the scan class, e.g. by "from pybar.scans import AnalogScan" or by get_scan('AnalogScan').
+'''
+import sys
+from importlib import import_module
+from types import ModuleType
+
+
+# scan name -> scan module
+scans = {
+    "HitOrCalibration": "calibrate_hit_or",
+    "create_hitor_calibration": "calibrate_hit_or",
+    "PlsrDacTransientCalibration": "calibrate_plsr_dac_transient",
+    "PlsrDacTransientCalibrationAdvanced": "calibrate_plsr_dac_transient_advanced",
+    "PlsrDacCalibration": "calibrate_plsr_dac",
+    "plot_pulser_dac": "calibrate_plsr_dac",
+    "PulserDacCorrectionCalibration": "calibrate_pulser_dac_correction",
+    "ThresholdCalibration": "calibrate_threshold",
+    "create_threshold_calibration": "calibrate_threshold",
+    "TotCalibration": "calibrate_tot",
+    "AnalogScan": "scan_analog",
+    "CrosstalkScan": "scan_crosstalk",
+    "DigitalScan": "scan_digital",
+    "ExtTriggerGdacScan": "scan_ext_trigger_gdac",
+    "StopModeExtTriggerScan": "scan_ext_trigger_stop_mode",
+    "ExtTriggerScan": "scan_ext_trigger",
+    "FEI4SelfTriggerScan": "scan_fei4_self_trigger",
+    "HitDelayScan": "scan_hit_delay",
+    "IleakScan": "scan_ileak",
+    "InitScan": "scan_init",
+    "IVScan": "scan_iv",
+    "FastThresholdScan": "scan_threshold_fast",
+    "ThresholdScan": "scan_threshold",
+    "RegisterTest": "test_register",
+    "TdcTest": "test_tdc",
+    "FdacTuning": "tune_fdac",
+    "FeedbackTuning": "tune_feedback",
+    "Fei4Tuning": "tune_fei4",
+    "GdacTuning": "tune_gdac",
+    "HotPixelTuning": "tune_hot_pixels",
+    "MergedPixelsTuning": "tune_merged_pixels",
+    "NoiseOccupancyScan": "tune_noise_occupancy",
+    "StuckPixelScan": "tune_stuck_pixel",
+    "TdacTuning": "tune_tdac",
+    "ThresholdBaselineTuning": "tune_threshold_baseline",
+    "TluTuning": "tune_tlu"
+}
 
 __all__ = ["HitOrCalibration", "create_hitor_calibration", "PlsrDacTransientCalibration", "PlsrDacTransientCalibrationAdvanced", "PlsrDacCalibration", "plot_pulser_dac", "PulserDacCorrectionCalibration", "ThresholdCalibration", "create_threshold_calibration", "TotCalibration", "AnalogScan", "CrosstalkScan", "DigitalScan", "ExtTriggerGdacScan", "StopModeExtTriggerScan", "ExtTriggerScan", "FEI4SelfTriggerScan", "HitDelayScan", "IleakScan", "InitScan", "IVScan", "FastThresholdScan", "ThresholdScan", "RegisterTest", "TdcTest", "FdacTuning", "FeedbackTuning", "Fei4Tuning", "GdacTuning", "HotPixelTuning", "MergedPixelsTuning", "NoiseOccupancyScan", "StuckPixelScan", "TdacTuning", "ThresholdBaselineTuning", "TluTuning"]
+
+
+def get_scan(name):
+    '''Returns scan class (or function) from scan registry. The scan module is imported on first use.
+
+    Parameters
+    ----------
+    name : string
+        Name of the scan class (or function), e.g. AnalogScan.
+
+    Returns
+    -------
+    Scan class (or function).
+    '''
+    try:
+        module_name = scans[name]
+    except KeyError:
+        raise ValueError('Unknown scan: %s' % name)
+    return getattr(import_module('pybar.scans.' + module_name), name)
+
+
+class ScanRegistryModule(ModuleType):
+    '''Module resolving the scans of the scan registry on attribute access.
+
+    Parameters
+    ----------
+    module : module
+        Module which is replaced.
+    '''
+    def __init__(self, module):
+        super(ScanRegistryModule, self).__init__(module.__name__, module.__doc__)
+        self.__dict__.update(module.__dict__)
+        self._module = module  # keep reference, the globals of a module are cleared when the module is deleted
+
+    def __getattr__(self, name):
+        if name in scans:
+            scan = get_scan(name)
+            setattr(self, name, scan)
+            return scan
+        raise AttributeError("'module' object has no attribute '%s'" % name)
+
+    def __dir__(self):
+        return sorted(set(self.__dict__.keys() + scans.keys()))
+
+
+sys.modules[__name__] = ScanRegistryModule(sys.modules[__name__])
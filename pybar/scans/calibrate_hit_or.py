@@ -16,15 +16,20 @@ from pybar.analysis.analyze_raw_data import AnalyzeRawData
 from pybar.analysis.plotting.plotting import plot_scurves, plot_tot_tdc_calibration
 
 
-def create_hitor_calibration(output_filename, plot_pixel_calibrations=False):
+def create_hitor_calibration(output_filename, plot_pixel_calibrations=False, chunk_size=10000000):
     '''Generating HitOr calibration file (_calibration.h5) from raw data file and plotting of calibration data.
 
+    The mean and standard deviation of ToT and TDC for all pixels and scan parameter settings are calculated in one pass over the hit table
+    by summing up the values of each scan parameter setting with np.bincount.
+
     Parameters
     ----------
     output_filename : string
         Input raw data file name.
     plot_pixel_calibrations : bool, iterable
         If True, genearating additional pixel calibration plots. If list of column and row tuples (from 1 to 80 / 336), print selected pixels.
+    chunk_size : int
+        Number of hits read at once.
 
     Returns
     -------
@@ -52,58 +57,72 @@ def create_hitor_calibration(output_filename, plot_pixel_calibrations=False):
             meta_data_table_at_scan_parameter = get_unique_scan_parameter_combinations(meta_data, scan_parameters=scan_parameter_names)
             scan_parameter_values = get_scan_parameters_table_from_meta_data(meta_data_table_at_scan_parameter, scan_parameter_names)
             event_number_ranges = get_ranges_from_array(meta_data_table_at_scan_parameter['event_number'])
-            event_ranges_per_parameter = np.column_stack((scan_parameter_values, event_number_ranges))
-            hits = in_file_h5.root.Hits[:]
-            event_numbers = hits['event_number'].copy()  # create contigous array, otherwise np.searchsorted too slow, http://stackoverflow.com/questions/15139299/performance-of-numpy-searchsorted-is-poor-on-structured-arrays
+            for name in scan_parameter_names:
+                if name not in ("column", "row", "PlsrDAC"):
+                    raise ValueError("Unknown scan parameter %s" % name)
+            # the event number ranges of the scan parameter settings are consecutive, the setting of a hit is given by the last start event number before the hit
+            event_number_order = np.argsort(event_number_ranges[:, 0].astype(np.int64), kind='mergesort')
+            event_start = event_number_ranges[event_number_order, 0].astype(np.int64)
+            scan_parameter_values = scan_parameter_values[event_number_order]
+            n_settings = event_start.shape[0]
+            setting_col = scan_parameter_values['column'].astype(np.int64)
+            setting_row = scan_parameter_values['row'].astype(np.int64)
+            setting_inner_loop_scan_parameter_index = np.searchsorted(inner_loop_parameter_values, scan_parameter_values['PlsrDAC'])  # translate the scan parameter value to an index for the result histogram
+            hit_table = in_file_h5.root.Hits
 
             output_filename = os.path.splitext(output_filename)[0]
             with tb.open_file(output_filename + "_calibration.h5", mode="w") as calibration_data_file:
                 logging.info('Create calibration')
                 calibration_data = np.full(shape=(80, 336, len(inner_loop_parameter_values), 4), fill_value=np.nan, dtype='f4')  # result of the calibration is a histogram with col_index, row_index, plsrDAC value, mean discrete tot, rms discrete tot, mean tot from TDC, rms tot from TDC
+                n_wrong_pixel = np.zeros(shape=(n_settings,), dtype=np.int64)
+                n_tot, sum_tot, sum_tot_squares = np.zeros(shape=(n_settings,), dtype=np.int64), np.zeros(shape=(n_settings,), dtype=np.float64), np.zeros(shape=(n_settings,), dtype=np.float64)
+                n_tdc, sum_tdc, sum_tdc_squares = np.zeros(shape=(n_settings,), dtype=np.int64), np.zeros(shape=(n_settings,), dtype=np.float64), np.zeros(shape=(n_settings,), dtype=np.float64)
 
-                progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=len(event_ranges_per_parameter), term_width=80)
+                progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=hit_table.shape[0], term_width=80)
                 progress_bar.start()
 
-                for index, (actual_scan_parameter_values, event_start, event_stop) in enumerate(event_ranges_per_parameter):
-                    if event_stop is None:  # happens for the last chunk
-                        event_stop = hits[-1]['event_number'] + 1
-                    array_index = np.searchsorted(event_numbers, np.array([event_start, event_stop]))
-                    actual_hits = hits[array_index[0]:array_index[1]]
-                    for item_index, item in enumerate(scan_parameter_names):
-                        if item == "column":
-                            actual_col = actual_scan_parameter_values[item_index]
-                        elif item == "row":
-                            actual_row = actual_scan_parameter_values[item_index]
-                        elif item == "PlsrDAC":
-                            plser_dac = actual_scan_parameter_values[item_index]
-                        else:
-                            raise ValueError("Unknown scan parameter %s" % item)
-
+                for index in range(0, hit_table.shape[0], chunk_size):
+                    hits = hit_table.read(index, index + chunk_size)
+                    setting = np.searchsorted(event_start, hits['event_number'], side='right') - 1
+                    hits, setting = hits[setting >= 0], setting[setting >= 0]
                     # Only pixel of actual column/row should be in the actual data chunk but since SRAM is not cleared for each scan step due to speed reasons and there might be noisy pixels this is not always the case
-                    n_wrong_pixel = np.count_nonzero(np.logical_or(actual_hits['column'] != actual_col, actual_hits['row'] != actual_row))
-                    if n_wrong_pixel != 0:
-                        logging.warning('%d hit(s) from other pixels for scan parameters %s', n_wrong_pixel, ', '.join(['%s=%s' % (name, value) for (name, value) in zip(scan_parameter_names, actual_scan_parameter_values)]))
-
-                    actual_hits = actual_hits[np.logical_and(actual_hits['column'] == actual_col, actual_hits['row'] == actual_row)]  # Only take data from selected pixel
-                    actual_tdc_hits = actual_hits[(actual_hits['event_status'] & 0b0000111110011100) == 0b0000000100000000]  # only take hits from good events (one TDC word only, no error)
-                    actual_tot_hits = actual_hits[(actual_hits['event_status'] & 0b0000100010011100) == 0b0000000000000000]  # only take hits from good events for tot
-                    tot, tdc = actual_tot_hits['tot'], actual_tdc_hits['TDC']
-
-                    if tdc.shape[0] < n_injections:
-                        logging.info('%d of %d expected TDC hits for scan parameters %s', tdc.shape[0], n_injections, ', '.join(['%s=%s' % (name, value) for (name, value) in zip(scan_parameter_names, actual_scan_parameter_values)]))
-                    if tot.shape[0] < n_injections:
-                        logging.info('%d of %d expected hits for scan parameters %s', tot.shape[0], n_injections, ', '.join(['%s=%s' % (name, value) for (name, value) in zip(scan_parameter_names, actual_scan_parameter_values)]))
-
-                    inner_loop_scan_parameter_index = np.where(plser_dac == inner_loop_parameter_values)[0][0]  # translate the scan parameter value to an index for the result histogram
-                    # numpy mean and std return nan if array is empty
-                    calibration_data[actual_col - 1, actual_row - 1, inner_loop_scan_parameter_index, 0] = np.mean(tot)
-                    calibration_data[actual_col - 1, actual_row - 1, inner_loop_scan_parameter_index, 1] = np.mean(tdc)
-                    calibration_data[actual_col - 1, actual_row - 1, inner_loop_scan_parameter_index, 2] = np.std(tot)
-                    calibration_data[actual_col - 1, actual_row - 1, inner_loop_scan_parameter_index, 3] = np.std(tdc)
-
-                    progress_bar.update(index)
+                    pixel_selection = np.logical_and(hits['column'] == setting_col[setting], hits['row'] == setting_row[setting])
+                    n_wrong_pixel += np.bincount(setting[~pixel_selection], minlength=n_settings)
+                    hits, setting = hits[pixel_selection], setting[pixel_selection]  # Only take data from selected pixel
+                    tdc_selection = (hits['event_status'] & 0b0000111110011100) == 0b0000000100000000  # only take hits from good events (one TDC word only, no error)
+                    tot_selection = (hits['event_status'] & 0b0000100010011100) == 0b0000000000000000  # only take hits from good events for tot
+                    tot, tot_setting = hits['tot'][tot_selection].astype(np.float64), setting[tot_selection]
+                    tdc, tdc_setting = hits['TDC'][tdc_selection].astype(np.float64), setting[tdc_selection]
+                    n_tot += np.bincount(tot_setting, minlength=n_settings)
+                    sum_tot += np.bincount(tot_setting, weights=tot, minlength=n_settings)
+                    sum_tot_squares += np.bincount(tot_setting, weights=tot ** 2, minlength=n_settings)
+                    n_tdc += np.bincount(tdc_setting, minlength=n_settings)
+                    sum_tdc += np.bincount(tdc_setting, weights=tdc, minlength=n_settings)
+                    sum_tdc_squares += np.bincount(tdc_setting, weights=tdc ** 2, minlength=n_settings)
+                    progress_bar.update(min(index + chunk_size, hit_table.shape[0]))
                 progress_bar.finish()
 
+                def scan_parameter_string(index):
+                    return ', '.join(['%s=%s' % (name, scan_parameter_values[index][name]) for name in scan_parameter_names])
+
+                for index in np.flatnonzero(n_wrong_pixel):
+                    logging.warning('%d hit(s) from other pixels for scan parameters %s', n_wrong_pixel[index], scan_parameter_string(index))
+                for index in np.flatnonzero(n_tdc < n_injections):
+                    logging.info('%d of %d expected TDC hits for scan parameters %s', n_tdc[index], n_injections, scan_parameter_string(index))
+                for index in np.flatnonzero(n_tot < n_injections):
+                    logging.info('%d of %d expected hits for scan parameters %s', n_tot[index], n_injections, scan_parameter_string(index))
+
+                # mean and std are nan if there are no hits
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    mean_tot = sum_tot / n_tot
+                    mean_tdc = sum_tdc / n_tdc
+                    std_tot = np.sqrt(np.maximum(sum_tot_squares / n_tot - mean_tot ** 2, 0.0))
+                    std_tdc = np.sqrt(np.maximum(sum_tdc_squares / n_tdc - mean_tdc ** 2, 0.0))
+                calibration_data[setting_col - 1, setting_row - 1, setting_inner_loop_scan_parameter_index, 0] = mean_tot
+                calibration_data[setting_col - 1, setting_row - 1, setting_inner_loop_scan_parameter_index, 1] = mean_tdc
+                calibration_data[setting_col - 1, setting_row - 1, setting_inner_loop_scan_parameter_index, 2] = std_tot
+                calibration_data[setting_col - 1, setting_row - 1, setting_inner_loop_scan_parameter_index, 3] = std_tdc
+
                 calibration_data_out = calibration_data_file.create_carray(calibration_data_file.root, name='HitOrCalibration', title='Hit OR calibration data', atom=tb.Atom.from_dtype(calibration_data.dtype), shape=calibration_data.shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
                 calibration_data_out[:] = calibration_data
                 calibration_data_out.attrs.dimensions = scan_parameter_names
@@ -23,6 +23,7 @@ from pybar.fei4.register_utils import make_pixel_mask
 
 
 class PlsrDacCalibration(Fei4RunBase):
+    background_analysis = False  # analysis results are written to the FE register
     _default_run_conf = {
         "scan_parameters": [('PlsrDAC', range(0, 1024, 33)), ('Colpr_Addr', range(0, 40))],  # the PlsrDAC and Colpr_Addr range
         "mask_steps": 3,
@@ -47,6 +47,7 @@ interpret_oscilloscope_data = interpret_data_from_tektronix
 class PlsrDacTransientCalibration(AnalogScan):
     ''' Transient PlsrDAC calibration scan
     '''
+    background_analysis = False  # analysis results are written to the FE register
     _default_run_conf = AnalogScan._default_run_conf.copy()
     _default_run_conf.update({
         "scan_parameter_values": range(25, 1024, 25),  # plsr dac settings, be aware: too low plsDAC settings are difficult to trigger
@@ -45,6 +45,7 @@ interpret_oscilloscope_data = interpret_data_from_tektronix
 class PlsrDacTransientCalibrationAdvanced(AnalogScan):
     ''' Transient PlsrDAC calibration scan
     '''
+    background_analysis = False  # analysis results are written to the FE register
     _default_run_conf = AnalogScan._default_run_conf.copy()
     _default_run_conf.update({
         "scan_parameters": [('PlsrDAC', range(25, 1024, 25))],  # plsr dac settings, be aware: too low plsDAC settings are difficult to trigger
@@ -13,6 +13,7 @@ class PulserDacCorrectionCalibration(ThresholdScan):
     Note:
     It is necessary to run threshold baseline tuning before running this calibration.
     '''
+    background_analysis = False  # analysis results are written to the FE register
     def analyze(self):
         with AnalyzeRawData(raw_data_file=self.output_filename, create_pdf=True) as analyze_raw_data:
             analyze_raw_data.create_tot_hist = False
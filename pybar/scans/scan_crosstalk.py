@@ -5,7 +5,7 @@ import tables as tb
 import numpy as np
 
 from pybar.analysis.analyze_raw_data import AnalyzeRawData
-from pybar.fei4.register_utils import invert_pixel_mask, make_xtalk_mask, make_pixel_mask
+from pybar.fei4.register_utils import invert_pixel_mask, make_xtalk_mask, get_pixel_mask
 from pybar.fei4_run_base import Fei4RunBase
 from pybar.fei4.register_utils import scan_loop
 from pybar.run_manager import RunManager
@@ -62,7 +62,7 @@ class CrosstalkScan(Fei4RunBase):
         def set_xtalk_mask():
             frame = inspect.currentframe()
             if frame.f_back.f_locals['index'] == 0:
-                mask = make_pixel_mask(steps=self.mask_steps, shift=frame.f_back.f_locals['mask_step'])
+                mask = get_pixel_mask(steps=self.mask_steps, shift=frame.f_back.f_locals['mask_step'])
                 mask = make_xtalk_mask(mask)
                 map(lambda mask_name: self.register.set_pixel_register_value(mask_name, mask), self.disable_shift_masks)
                 commands = []
@@ -7,16 +7,154 @@ from time import time, strftime, gmtime, sleep
 
 from pybar.run_manager import RunManager, run_status
 from pybar.scans.scan_ext_trigger import ExtTriggerScan
-from pybar.daq.readout_utils import build_events_from_raw_data, is_trigger_word
+from pybar.daq.readout_utils import is_trigger_word, is_fe_word, is_data_header, logical_and, build_event_index_from_raw_data, reduce_events
 
 import sys
 sys.path.append('/home/telescope/eudaq/python/')
-from PyEUDAQWrapper import PyProducer
+try:
+    from PyEUDAQWrapper import PyProducer
+except ImportError:
+    PyProducer = None  # EUDAQ not available
+
+
+class LocalProducer(object):
+    '''Local replacement of the EUDAQ producer (PyProducer) for testing the event building without EUDAQ.
+
+    The events are stored instead of being sent. Has to be set explicitly (see EudaqExtTriggerScan.producer).
+    '''
+    def __init__(self):
+        self.events = []
+
+    def SendEvent(self, data):
+        self.events.append(np.array(data, dtype=np.uint32))
+
+    def SendEvents(self, events):
+        self.events.extend([np.array(event, dtype=np.uint32) for event in events])
+
+
+class EventBuilder(object):
+    '''Building events from the raw data and sending them to the EUDAQ producer.
+
+    Each event starts with a trigger word. The event boundaries (see build_event_index_from_raw_data()) and the trigger number check are calculated with array operations
+    for each readout and the events of a readout are sent as one batch. The data after the last trigger word is kept until the next trigger word arrives.
+    If a data error occurred, the missing trigger numbers are filled with empty events (containing only the trigger number).
+
+    Parameters
+    ----------
+    producer : object
+        EUDAQ producer (PyProducer) or LocalProducer. If the producer has a SendEvents method, each batch is sent with a single call.
+    max_trigger_counter : int
+        Maximum trigger number + 1.
+    n_data_headers : int
+        Expected number of FE data headers of each event (number of consecutive triggers). Events with a different number of data headers are counted (see n_incomplete_events).
+        If None, the data headers are not counted.
+    '''
+    def __init__(self, producer, max_trigger_counter=2 ** 31, n_data_headers=None):
+        self.producer = producer
+        self.max_trigger_counter = max_trigger_counter
+        self.n_data_headers = n_data_headers
+        self.n_incomplete_events = 0
+        self.remaining_data = np.ndarray((0,), dtype=np.uint32)
+        self.last_trigger_number = None
+        self.data_error_occurred = False
+
+    def add_data(self, data):
+        '''Adding raw data and sending the complete events.
+
+        Parameters
+        ----------
+        data : array
+            Raw data words.
+
+        Returns
+        -------
+        Number of sent events.
+        '''
+        events = self.build_events(data)
+        self.send_events(events)
+        return len(events)
+
+    def build_events(self, data):
+        '''Returns the complete events (list of arrays) from the raw data, including empty events for missing trigger numbers.
+        '''
+        data = np.concatenate([self.remaining_data, np.asarray(data, dtype=np.uint32)])
+        offsets = build_event_index_from_raw_data(data)
+        leading_data = data.shape[0] == 0 or not is_trigger_word(data[0])  # the first event contains the data before the first trigger word
+        if offsets.shape[0] - 1 <= int(leading_data):  # no trigger word
+            self.remaining_data = data
+            return []
+        self.remaining_data = data[offsets[-2]:]  # the last event is complete with the next trigger word
+        offsets = offsets[:-1]
+        events = [data[start:stop] for start, stop in zip(offsets[:-1], offsets[1:])]  # views of the raw data
+        trigger_offsets = offsets[1:] if leading_data else offsets
+        if trigger_offsets.shape[0] > 1:
+            if self.n_data_headers:
+                n_data_headers = reduce_events(logical_and(is_fe_word, is_data_header)(data), trigger_offsets, np.add)
+                self.n_incomplete_events += np.count_nonzero(n_data_headers != self.n_data_headers)
+            missing_trigger_numbers = self.check_trigger_numbers(data[trigger_offsets[:-1]] & (self.max_trigger_counter - 1))
+            if missing_trigger_numbers is not None:
+                index, trigger_numbers = missing_trigger_numbers
+                index += int(leading_data)
+                events[index:index] = list(trigger_numbers.astype(np.uint32).reshape(-1, 1))
+        return events
+
+    def check_trigger_numbers(self, trigger_numbers):
+        '''Checking the trigger numbers of consecutive events and updating the last trigger number.
+
+        Parameters
+        ----------
+        trigger_numbers : array
+            Trigger numbers of the events.
+
+        Returns
+        -------
+        Tuple of the event index, before which empty events need to be inserted, and the array of missing trigger numbers.
+        None, if no trigger numbers are missing.
+        '''
+        trigger_numbers = trigger_numbers.astype(np.int64)
+        counter_mask = self.max_trigger_counter - 1
+        if self.last_trigger_number is None:
+            self.last_trigger_number = (trigger_numbers[0] - 1) & counter_mask  # the first trigger number is always expected
+        expected_trigger_numbers = (self.last_trigger_number + 1 + np.arange(trigger_numbers.shape[0], dtype=np.int64)) & counter_mask
+        mismatch_index = np.flatnonzero(trigger_numbers != expected_trigger_numbers)
+        missing_trigger_numbers = None
+        if mismatch_index.shape[0] > 0 and self.data_error_occurred:
+            # re-synchronize at the first mismatch
+            index = mismatch_index[0]
+            last_trigger_number = (expected_trigger_numbers[index] - 1) & counter_mask
+            n_missing_trigger_numbers = (trigger_numbers[index] - last_trigger_number - 1) % self.max_trigger_counter
+            logging.warning('Data errors detected: trigger number read: %d, expected: %d, sending %d empty events', trigger_numbers[index], expected_trigger_numbers[index], n_missing_trigger_numbers)
+            missing_trigger_numbers = (index, (last_trigger_number + 1 + np.arange(n_missing_trigger_numbers, dtype=np.int64)) & counter_mask)
+            self.data_error_occurred = False
+            expected_trigger_numbers[index:] = (trigger_numbers[index] + np.arange(trigger_numbers.shape[0] - index, dtype=np.int64)) & counter_mask
+            mismatch_index = np.flatnonzero(trigger_numbers != expected_trigger_numbers)
+        for index in mismatch_index:
+            logging.warning('Trigger number not increasing: read: %d, expected: %d', trigger_numbers[index], expected_trigger_numbers[index])
+        self.last_trigger_number = expected_trigger_numbers[-1]
+        return missing_trigger_numbers
+
+    def send_events(self, events):
+        '''Sending events to the producer.
+        '''
+        if not events:
+            return
+        if hasattr(self.producer, 'SendEvents'):
+            self.producer.SendEvents(events)
+        else:
+            for event in events:
+                self.producer.SendEvent(event)
+
+    def flush(self):
+        '''Sending the remaining data.
+        '''
+        self.producer.SendEvent(self.remaining_data)
+        self.remaining_data = np.ndarray((0,), dtype=np.uint32)
 
 
 class EudaqExtTriggerScan(ExtTriggerScan):
     '''External trigger scan that connects to EUDAQ producer (EUDAQ 1.4 and higher).
     '''
+    producer = None  # EUDAQ producer (PyProducer), has to be set before the run, LocalProducer for testing without EUDAQ
 #     _default_run_conf = ExtTriggerScan._default_run_conf.copy()
 #     _default_run_conf.update({
 #         "no_data_timeout": 600,
@@ -38,19 +176,18 @@ class EudaqExtTriggerScan(ExtTriggerScan):
     }
 
     def scan(self):
-        self.data_error_occurred = False
-        self.last_trigger_number = None
         clock_cycles = self.dut['TLU']['TRIGGER_CLOCK_CYCLES']
         if clock_cycles:
             self.max_trigger_counter = 2 ** (clock_cycles - 1)
         else:
             self.max_trigger_counter = 2 ** 31
+        if self.producer is None:
+            raise RuntimeError('No EUDAQ producer: set EudaqExtTriggerScan.producer')
+        self.event_builder = EventBuilder(producer=self.producer, max_trigger_counter=self.max_trigger_counter, n_data_headers=(self.trig_count if self.trig_count else 16) * len(self.registers))
         start = time()
         lvl1_command = self.register.get_commands("zeros", length=self.trigger_delay)[0] + self.register.get_commands("LV1")[0] + self.register.get_commands("zeros", length=self.trigger_rate_limit)[0]
         self.register_utils.set_command(lvl1_command)
 
-        self.remaining_data = np.ndarray((0,), dtype=np.uint32)
-
         with self.readout(**self.scan_parameters._asdict()):
             got_data = False
             while not self.stop_run.wait(1.0):
@@ -65,9 +202,11 @@ class EudaqExtTriggerScan(ExtTriggerScan):
                     if self.max_triggers and triggers >= self.max_triggers:
                         self.stop(msg='Trigger limit was reached: %i' % self.max_triggers)
 
-        pp.SendEvent(self.remaining_data)
+        self.event_builder.flush()
 
         logging.info('Total amount of triggers collected: %d', self.dut['TLU']['TRIGGER_COUNTER'])
+        if self.event_builder.n_incomplete_events:
+            logging.warning('Events with unexpected number of data headers: %d', self.event_builder.n_incomplete_events)
 
 #     def analyze(self):
 #         pass
@@ -77,39 +216,10 @@ class EudaqExtTriggerScan(ExtTriggerScan):
 #         self.abort(msg='%s' % exc[1])
 #         pp.logging(...)
         logging.warning(exc[1])
-        self.data_error_occurred = True
+        self.event_builder.data_error_occurred = True
 
     def handle_data(self, data):
-        events = build_events_from_raw_data(data[0])
-        for item in events:
-            if item.shape[0] == 0:
-                continue
-            if is_trigger_word(item[0]):
-                if self.remaining_data.shape[0] > 0:
-                    # check trigger number
-                    if is_trigger_word(self.remaining_data[0]):
-                        trigger_number = self.remaining_data[0] & (self.max_trigger_counter - 1)
-                        if self.last_trigger_number is not None and ((self.last_trigger_number + 1 != trigger_number and self.last_trigger_number + 1 != self.max_trigger_counter) or (self.last_trigger_number + 1 == self.max_trigger_counter and trigger_number != 0)):
-                            if self.data_error_occurred:
-                                if trigger_number > self.last_trigger_number:
-                                    missing_trigger_numbers = trigger_number - self.last_trigger_number - 1
-                                else:
-                                    missing_trigger_numbers = self.max_trigger_counter - (self.last_trigger_number - trigger_number) - 1
-                                logging.warning('Data errors detected: trigger number read: %d, expected: %d, sending %d empty events', trigger_number, 0 if (self.last_trigger_number + 1 == self.max_trigger_counter) else (self.last_trigger_number + 1), missing_trigger_numbers)
-                                for missing_trigger_number in range(self.last_trigger_number + 1, self.last_trigger_number + missing_trigger_numbers + 1):
-                                    pp.SendEvent(np.asarray([missing_trigger_number & (self.max_trigger_counter - 1)], np.uint32))
-                                self.data_error_occurred = False
-                                self.last_trigger_number = trigger_number
-                            else:
-                                logging.warning('Trigger number not increasing: read: %d, expected: %d', trigger_number, 0 if (self.last_trigger_number + 1 == self.max_trigger_counter) else (self.last_trigger_number + 1))
-                                self.last_trigger_number = (self.last_trigger_number + 1) & (self.max_trigger_counter - 1)
-                        else:
-                            self.last_trigger_number = trigger_number
-                    pp.SendEvent(self.remaining_data)
-                self.remaining_data = item
-            else:
-                self.remaining_data = np.concatenate([self.remaining_data, item])
-
+        self.event_builder.add_data(data[0])
         self.raw_data_file.append_item(data, scan_parameters=self.scan_parameters._asdict(), flush=True)
 
 
@@ -125,9 +235,12 @@ if __name__ == "__main__":
 
     else:
         parser.error("incorrect number of arguments")
+    if PyProducer is None:
+        parser.error("EUDAQ Python wrapper (PyEUDAQWrapper) not found")
     run_conf = vars(options)
     # create PyProducer instance
     pp = PyProducer("PyBAR", rcaddr)
+    EudaqExtTriggerScan.producer = pp
     while not pp.Error and not pp.Terminating:
         # wait for configure cmd from RunControl
         while not pp.Configuring and not pp.Terminating:
@@ -24,6 +24,7 @@ class M26TelescopeScan(Fei4RunBase):
 
     Note:
     Set up trigger in DUT configuration file (e.g. dut_configuration_mio.yaml).
+    The FE-I4 hits and the Mimosa26 hits can be merged at the trigger number with pybar.analysis.analysis.merge_m26_telescope_hits().
     '''
     _default_run_conf = {
         "trig_count": 0,  # FE-I4 trigger count, number of consecutive BCs, 0 means 16, from 0 to 15
@@ -1,10 +1,14 @@
 import logging
 
+import numpy as np
+
 from pybar.analysis.analyze_raw_data import AnalyzeRawData
 from pybar.fei4.register_utils import invert_pixel_mask
+from pybar.fei4.mask_utils import AdaptiveInjectionMask, get_scan_loop_selection
 from pybar.fei4_run_base import Fei4RunBase
 from pybar.fei4.register_utils import scan_loop
 from pybar.run_manager import RunManager
+from pybar.daq.fifo_readout import OccupancyHistogram
 
 
 class ThresholdScan(Fei4RunBase):
@@ -20,7 +24,12 @@ class ThresholdScan(Fei4RunBase):
         "use_enable_mask": False,  # if True, use Enable mask during scan, if False, all pixels will be enabled
         "enable_shift_masks": ["Enable", "C_High", "C_Low"],  # enable masks shifted during scan
         "disable_shift_masks": [],  # disable masks shifted during scan
-        "pulser_dac_correction": False  # PlsrDAC correction for each double column
+        "pulser_dac_correction": False,  # PlsrDAC correction for each double column
+        "adaptive_injection_mask": False,  # if True, pixels which see all injections for saturated_steps PlsrDAC steps are not injected anymore
+        "saturated_steps": 3,  # number of consecutive PlsrDAC steps with full occupancy before a pixel is masked
+        "min_masked_pixels": 500,  # minimum number of saturated pixels for changing the injection mask, every mask change costs a pixel by pixel write
+        "max_stalled_pixels": 100,  # the scan stops if not more than max_stalled_pixels pixels are left which do not saturate (e.g. dead or inefficient pixels)
+        "stalled_steps": 10  # number of consecutive PlsrDAC steps without an increasing occupancy before a pixel is considered as not saturating
     }
 
     def configure(self):
@@ -51,6 +60,10 @@ class ThresholdScan(Fei4RunBase):
             scan_parameter_range[1] = self.scan_parameters.PlsrDAC[1]
         scan_parameter_range = range(scan_parameter_range[0], scan_parameter_range[1] + 1, self.step_size)
         logging.info("Scanning %s from %d to %d", 'PlsrDAC', scan_parameter_range[0], scan_parameter_range[-1])
+        self.occupancy_histogram = OccupancyHistogram(callback=self.handle_data)  # online histogramming of the occupancy for each PlsrDAC setting
+        mask = invert_pixel_mask(self.register.get_pixel_register_value('Enable')) if self.use_enable_mask else None
+        self.injection_mask = AdaptiveInjectionMask(n_injections=self.n_injections, saturated_steps=self.saturated_steps, min_masked_pixels=self.min_masked_pixels, max_stalled_pixels=self.max_stalled_pixels, stalled_steps=self.stalled_steps, mask=mask) if self.adaptive_injection_mask else None
+        self.scan_parameter_values = []  # scanned PlsrDAC settings
 
         for scan_parameter_value in scan_parameter_range:
             if self.stop_run.is_set():
@@ -62,16 +75,47 @@ class ThresholdScan(Fei4RunBase):
             commands.extend(self.register.get_commands("WrRegister", name=['PlsrDAC']))
             self.register_utils.send_commands(commands)
 
-            with self.readout(PlsrDAC=scan_parameter_value):
+            if self.injection_mask and np.any(self.injection_mask.adaptive_mask):
+                # only mask steps and double columns with pixels which are not masked are injected
+                scan_loop_mask = self.injection_mask.mask
+                enable_mask_steps, enable_double_columns = get_scan_loop_selection(scan_loop_mask, mask_steps=self.mask_steps)
+            else:
+                scan_loop_mask, enable_mask_steps, enable_double_columns = mask, None, None
+
+            self.occupancy_histogram.set_scan_parameter_value(scan_parameter_value)
+            with self.readout(PlsrDAC=scan_parameter_value, callback=self.occupancy_histogram):
                 cal_lvl1_command = self.register.get_commands("CAL")[0] + self.register.get_commands("zeros", length=40)[0] + self.register.get_commands("LV1")[0]
-                scan_loop(self, cal_lvl1_command, repeat_command=self.n_injections, use_delay=True, mask_steps=self.mask_steps, enable_mask_steps=None, enable_double_columns=None, same_mask_for_all_dc=True, fast_dc_loop=True, bol_function=None, eol_function=None, digital_injection=False, enable_shift_masks=self.enable_shift_masks, disable_shift_masks=self.disable_shift_masks, restore_shift_masks=False, mask=invert_pixel_mask(self.register.get_pixel_register_value('Enable')) if self.use_enable_mask else None, double_column_correction=self.pulser_dac_correction)
+                scan_loop(self, cal_lvl1_command, repeat_command=self.n_injections, use_delay=True, mask_steps=self.mask_steps, enable_mask_steps=enable_mask_steps, enable_double_columns=enable_double_columns, same_mask_for_all_dc=True, fast_dc_loop=True, bol_function=None, eol_function=None, digital_injection=False, enable_shift_masks=self.enable_shift_masks, disable_shift_masks=self.disable_shift_masks, restore_shift_masks=False, mask=scan_loop_mask, double_column_correction=self.pulser_dac_correction)
+            self.scan_parameter_values.append(scan_parameter_value)
+
+            if self.injection_mask:
+                n_masked = self.injection_mask.update(self.occupancy_histogram.get_occupancy(scan_parameter_value), scan_parameter_value)
+                if n_masked:
+                    logging.info('Masking %d pixel(s) with %d hits for %d PlsrDAC step(s)', n_masked, self.n_injections, self.saturated_steps)
+                if self.injection_mask.is_complete():
+                    logging.info('All pixels are masked (%d stalled pixel(s) left)... stopping scan', np.count_nonzero(self.injection_mask.get_stalled_pixels()))
+                    break
+
+    def get_scurves(self):
+        '''Returns the S-curves from the online histogramming.
+
+        Returns
+        -------
+        Tuple of PlsrDAC settings and array with the shape (columns, rows, PlsrDAC settings).
+        '''
+        scan_parameter_values, scurves = self.occupancy_histogram.get_scurves()
+        if self.injection_mask:
+            scurves = self.injection_mask.fill_occupancy(scurves, scan_parameter_values)
+        return scan_parameter_values, scurves
 
     def analyze(self):
         with AnalyzeRawData(raw_data_file=self.output_filename, create_pdf=True) as analyze_raw_data:
             analyze_raw_data.create_tot_hist = False
             analyze_raw_data.create_fitted_threshold_hists = True
             analyze_raw_data.create_threshold_mask = True
-            analyze_raw_data.n_injections = 100
+            analyze_raw_data.n_injections = self.n_injections
+            if self.injection_mask:
+                analyze_raw_data.occupancy_fill_mask = np.swapaxes(self.injection_mask.get_fill_mask(self.scan_parameter_values), 0, 1)  # col, row, parameter --> row, col, parameter
             analyze_raw_data.interpreter.set_warning_output(False)  # so far the data structure in a threshold scan was always bad, too many warnings given
             analyze_raw_data.interpret_word_table()
             analyze_raw_data.interpreter.print_summary()
@@ -1,14 +1,13 @@
 import logging
 import numpy as np
 
-from pybar_fei4_interpreter.analysis_utils import hist_2d_index
-
 from pybar.analysis.analyze_raw_data import AnalyzeRawData
 from pybar.fei4.register_utils import invert_pixel_mask
+from pybar.fei4.mask_utils import AdaptiveInjectionMask, get_scan_loop_selection
 from pybar.fei4_run_base import Fei4RunBase
 from pybar.fei4.register_utils import scan_loop
 from pybar.run_manager import RunManager
-from pybar.daq.readout_utils import get_col_row_array_from_data_record_array, convert_data_array, is_data_record, data_array_from_data_iterable
+from pybar.daq.fifo_readout import OccupancyHistogram
 
 
 class FastThresholdScan(Fei4RunBase):
@@ -28,7 +27,12 @@ class FastThresholdScan(Fei4RunBase):
         "use_enable_mask": False,  # if True, use Enable mask during scan, if False, all pixels will be enabled
         "enable_shift_masks": ["Enable", "C_High", "C_Low"],  # enable masks shifted during scan
         "disable_shift_masks": [],  # disable masks shifted during scan
-        "pulser_dac_correction": False  # PlsrDAC correction for each double column
+        "pulser_dac_correction": False,  # PlsrDAC correction for each double column
+        "adaptive_injection_mask": False,  # if True, pixels which see all injections for saturated_steps PlsrDAC steps are not injected anymore
+        "saturated_steps": 3,  # number of consecutive PlsrDAC steps with full occupancy before a pixel is masked
+        "min_masked_pixels": 500,  # minimum number of saturated pixels for changing the injection mask, every mask change costs a pixel by pixel write
+        "max_stalled_pixels": 100,  # the scan stops if not more than max_stalled_pixels pixels are left which do not saturate (e.g. dead or inefficient pixels)
+        "stalled_steps": 10  # number of consecutive PlsrDAC steps without an increasing occupancy before a pixel is considered as not saturating
     }
     scan_parameter_start = 0  # holding last start value (e.g. used in GDAC threshold scan)
 
@@ -60,6 +64,9 @@ class FastThresholdScan(Fei4RunBase):
         self.stop_at = 0.95  # if more than stop_at*activated_pixel see the maximum numbers of injection, the scan is stopped
 
         self.record_data = False  # set to true to activate data storage, so far not everything is recorded to ease data analysis
+        self.occupancy_histogram = OccupancyHistogram()  # online histogramming of the occupancy for each PlsrDAC setting
+        self.scan_parameter_values = []  # recorded PlsrDAC settings
+        mask = invert_pixel_mask(self.register.get_pixel_register_value('Enable')) if self.use_enable_mask else None
 
         scan_parameter_range = [0, (2 ** self.register.global_registers['PlsrDAC']['bitlength'] - 1)]
         if self.scan_parameters.PlsrDAC[0]:
@@ -86,6 +93,15 @@ class FastThresholdScan(Fei4RunBase):
         for column in self.ignore_columns:
             self.select_arr_columns.remove(column - 1)
 
+        if self.adaptive_injection_mask:  # only used while recording data
+            injection_mask = np.ones(shape=(80, 336), dtype=bool)
+            injection_mask[self.select_arr_columns, :] = False  # ignored columns are masked
+            if mask is not None:
+                injection_mask[mask >= 1] = True
+            self.injection_mask = AdaptiveInjectionMask(n_injections=self.n_injections, saturated_steps=self.saturated_steps, min_masked_pixels=self.min_masked_pixels, max_stalled_pixels=self.max_stalled_pixels, stalled_steps=self.stalled_steps, mask=injection_mask)
+        else:
+            self.injection_mask = None
+
         while self.scan_parameter_value <= scan_parameter_range[1]:  # scan as long as scan parameter is smaller than defined maximum
             if self.stop_run.is_set():
                 break
@@ -96,21 +112,32 @@ class FastThresholdScan(Fei4RunBase):
             commands.extend(self.register.get_commands("WrRegister", name=['PlsrDAC']))
             self.register_utils.send_commands(commands)
 
-            with self.readout(PlsrDAC=self.scan_parameter_value, reset_sram_fifo=True, fill_buffer=True, clear_buffer=True, callback=self.handle_data if self.record_data else None):
+            if self.injection_mask and np.any(self.injection_mask.adaptive_mask):
+                # only mask steps and double columns with pixels which are not masked are injected
+                scan_loop_mask = self.injection_mask.mask
+                scan_loop_enable_mask_steps, scan_loop_enable_double_columns = get_scan_loop_selection(scan_loop_mask, mask_steps=self.mask_steps, enable_mask_steps=self.enable_mask_steps, enable_double_columns=enable_double_columns)
+            else:
+                scan_loop_mask, scan_loop_enable_mask_steps, scan_loop_enable_double_columns = mask, self.enable_mask_steps, enable_double_columns
+
+            self.occupancy_histogram.set_scan_parameter_value(self.scan_parameter_value)
+            self.occupancy_histogram.callback = self.handle_data if self.record_data else None
+            with self.readout(PlsrDAC=self.scan_parameter_value, reset_sram_fifo=True, callback=self.occupancy_histogram):
                 cal_lvl1_command = self.register.get_commands("CAL")[0] + self.register.get_commands("zeros", length=40)[0] + self.register.get_commands("LV1")[0]
-                scan_loop(self, cal_lvl1_command, repeat_command=self.n_injections, use_delay=True, mask_steps=self.mask_steps, enable_mask_steps=self.enable_mask_steps, enable_double_columns=enable_double_columns, same_mask_for_all_dc=True, eol_function=None, digital_injection=False, enable_shift_masks=self.enable_shift_masks, disable_shift_masks=self.disable_shift_masks, restore_shift_masks=False, mask=invert_pixel_mask(self.register.get_pixel_register_value('Enable')) if self.use_enable_mask else None, double_column_correction=self.pulser_dac_correction)
+                scan_loop(self, cal_lvl1_command, repeat_command=self.n_injections, use_delay=True, mask_steps=self.mask_steps, enable_mask_steps=scan_loop_enable_mask_steps, enable_double_columns=scan_loop_enable_double_columns, same_mask_for_all_dc=True, eol_function=None, digital_injection=False, enable_shift_masks=self.enable_shift_masks, disable_shift_masks=self.disable_shift_masks, restore_shift_masks=False, mask=scan_loop_mask, double_column_correction=self.pulser_dac_correction)
 
-            if not self.start_condition_triggered or self.data_points > self.minimum_data_points:  # speed up, only create histograms when needed. Python is much too slow here.
+            occupancy_array = self.occupancy_histogram.get_occupancy(self.scan_parameter_value)
+            if self.injection_mask and self.record_data:
+                n_masked = self.injection_mask.update(occupancy_array, self.scan_parameter_value)
+                if n_masked:
+                    logging.info('Masking %d pixel(s) with %d hits for %d PlsrDAC step(s)', n_masked, self.n_injections, self.saturated_steps)
+                occupancy_array = self.injection_mask.fill_occupancy(occupancy_array, self.scan_parameter_value)
+
+            if not self.start_condition_triggered or self.data_points > self.minimum_data_points:
                 if not self.start_condition_triggered and not self.record_data:
                     logging.info('Testing for start condition: %s %d', 'PlsrDAC', self.scan_parameter_value)
                 if not self.stop_condition_triggered and self.record_data:
                     logging.info('Testing for stop condition: %s %d', 'PlsrDAC', self.scan_parameter_value)
 
-                col, row = convert_data_array(data_array_from_data_iterable(self.fifo_readout.data), filter_func=is_data_record, converter_func=get_col_row_array_from_data_record_array)
-                if np.any(np.logical_and(col < 1, col > 80)) or np.any(np.logical_and(row < 1, row > 336)):  # filter bad data records that can happen 
-                    logging.warning('There are undefined %d data records (e.g. random data)', np.count_nonzero(np.logical_and(col < 1, col > 80)) + np.count_nonzero(np.logical_and(row < 1, row > 336)))
-                    col, row = col[np.logical_and(col > 0, col <= 80)], row[np.logical_and(row > 0, row < 336)]
-                occupancy_array = hist_2d_index(col - 1, row - 1, shape=(80, 336))
                 self.scan_condition(occupancy_array)
 
             # start condition is met for the first time
@@ -126,12 +153,17 @@ class FastThresholdScan(Fei4RunBase):
             # saving data
             if self.record_data:
                 self.data_points = self.data_points + 1
+                self.scan_parameter_values.append(self.scan_parameter_value)
 
             # stop condition is met for the first time
             if self.stop_condition_triggered and self.record_data:
                 logging.info('Stopping threshold scan at %s %d', 'PlsrDAC', self.scan_parameter_value)
                 break
 
+            if self.injection_mask and self.record_data and self.injection_mask.is_complete():
+                logging.info('All pixels are masked (%d stalled pixel(s) left)... stopping threshold scan at %s %d', np.count_nonzero(self.injection_mask.get_stalled_pixels()), 'PlsrDAC', self.scan_parameter_value)
+                break
+
             # increase scan parameter value
             if not self.start_condition_triggered:
                 self.scan_parameter_value = self.scan_parameter_value + self.search_distance
@@ -141,12 +173,26 @@ class FastThresholdScan(Fei4RunBase):
         if self.scan_parameter_value >= scan_parameter_range[1]:
             logging.warning("Reached maximum of PlsrDAC range... stopping scan")
 
+    def get_scurves(self):
+        '''Returns the S-curves of the recorded PlsrDAC settings from the online histogramming.
+
+        Returns
+        -------
+        Tuple of PlsrDAC settings and array with the shape (columns, rows, PlsrDAC settings).
+        '''
+        scan_parameter_values, scurves = self.occupancy_histogram.get_scurves(scan_parameter_values=sorted(set(self.scan_parameter_values)))
+        if self.injection_mask:
+            scurves = self.injection_mask.fill_occupancy(scurves, scan_parameter_values)
+        return scan_parameter_values, scurves
+
     def analyze(self):
         with AnalyzeRawData(raw_data_file=self.output_filename, create_pdf=True) as analyze_raw_data:
             analyze_raw_data.create_tot_hist = False
             analyze_raw_data.create_fitted_threshold_hists = True
             analyze_raw_data.create_threshold_mask = True
             analyze_raw_data.n_injections = self.n_injections
+            if self.injection_mask:
+                analyze_raw_data.occupancy_fill_mask = np.swapaxes(self.injection_mask.get_fill_mask(sorted(set(self.scan_parameter_values))), 0, 1)  # col, row, parameter --> row, col, parameter
             analyze_raw_data.interpreter.set_warning_output(True)
             analyze_raw_data.interpret_word_table()
             analyze_raw_data.interpreter.print_summary()
@@ -3,9 +3,9 @@ import numpy as np
 from matplotlib.backends.backend_pdf import PdfPages
 
 from pybar.fei4_run_base import Fei4RunBase
-from pybar.fei4.register_utils import scan_loop
+from pybar.fei4.sequential_test import sequential_scan_loop, mean_decision, get_tot_sums, normalize
 from pybar.run_manager import RunManager
-from pybar.daq.readout_utils import convert_data_array, is_data_record, is_fe_word, logical_and, data_array_from_data_iterable, get_col_row_tot_array_from_data_record_array
+from pybar.daq.readout_utils import convert_data_array, is_data_record, is_fe_word, logical_and, get_col_row_tot_array_from_data_record_array
 from pybar.analysis.plotting.plotting import plot_three_way
 
 
@@ -20,12 +20,16 @@ class FdacTuning(Fei4RunBase):
     Note:
     Use pybar.scans.tune_fei4 for full FE-I4 tuning.
     '''
+    background_analysis = False  # analysis results are written to the FE register
     _default_run_conf = {
         "scan_parameters": [('FDAC', None)],
         "target_charge": 280,
         "target_tot": 5,
         "fdac_tune_bits": range(3, -1, -1),
         "n_injections_fdac": 30,
+        "sequential_test": False,  # if True, inject in batches and stop injecting pixels with a settled decision (mean ToT above/below target ToT)
+        "sequential_test_batch": 10,  # number of injections per batch
+        "sequential_test_settled_fraction": 0.99,  # fraction of pixels with a settled decision for stopping the injections, some pixels never settle
         "plot_intermediate_steps": False,
         "plots_filename": None,
         "enable_shift_masks": ["Enable", "C_High", "C_Low"],  # enable masks shifted during scan
@@ -85,25 +89,28 @@ class FdacTuning(Fei4RunBase):
 
             self.write_fdac_config()
 
-            with self.readout(FDAC=scan_parameter_value, reset_sram_fifo=True, fill_buffer=True, clear_buffer=True, callback=self.handle_data):
-                scan_loop(self,
-                          command=cal_lvl1_command,
-                          repeat_command=self.n_injections_fdac,
-                          mask_steps=self.mask_steps,
-                          enable_mask_steps=enable_mask_steps,
-                          enable_double_columns=None,
-                          same_mask_for_all_dc=self.same_mask_for_all_dc,
-                          eol_function=None,
-                          digital_injection=False,
-                          enable_shift_masks=self.enable_shift_masks,
-                          disable_shift_masks=self.disable_shift_masks,
-                          restore_shift_masks=True,
-                          mask=None,
-                          double_column_correction=self.pulser_dac_correction)
-
-            col_row_tot = np.column_stack(convert_data_array(data_array_from_data_iterable(self.fifo_readout.data), filter_func=logical_and(is_fe_word, is_data_record), converter_func=get_col_row_tot_array_from_data_record_array))
+            data_array, injections = sequential_scan_loop(self,
+                                                          command=cal_lvl1_command,
+                                                          max_injections=self.n_injections_fdac,
+                                                          batch_injections=self.sequential_test_batch if self.sequential_test else None,
+                                                          decide=self.decide,
+                                                          settled_fraction=self.sequential_test_settled_fraction,
+                                                          readout_kwargs={'FDAC': scan_parameter_value},
+                                                          mask_steps=self.mask_steps,
+                                                          enable_mask_steps=enable_mask_steps,
+                                                          enable_double_columns=None,
+                                                          same_mask_for_all_dc=self.same_mask_for_all_dc,
+                                                          eol_function=None,
+                                                          digital_injection=False,
+                                                          enable_shift_masks=self.enable_shift_masks,
+                                                          disable_shift_masks=self.disable_shift_masks,
+                                                          restore_shift_masks=True,
+                                                          mask=None,
+                                                          double_column_correction=self.pulser_dac_correction)
+
+            col_row_tot = np.column_stack(convert_data_array(data_array, filter_func=logical_and(is_fe_word, is_data_record), converter_func=get_col_row_tot_array_from_data_record_array))
             tot_array = np.histogramdd(col_row_tot, bins=(80, 336, 16), range=[[1, 80], [1, 336], [0, 15]])[0]
-            tot_mean_array = np.average(tot_array, axis=2, weights=range(0, 16)) * sum(range(0, 16)) / self.n_injections_fdac
+            tot_mean_array = normalize(np.average(tot_array, axis=2, weights=range(0, 16)) * sum(range(0, 16)), injections, 1)
             select_better_pixel_mask = abs(tot_mean_array - self.target_tot) <= abs(self.tot_mean_best - self.target_tot)
             pixel_with_too_small_mean_tot_mask = tot_mean_array < self.target_tot
             self.tot_mean_best[select_better_pixel_mask] = tot_mean_array[select_better_pixel_mask]
@@ -140,6 +147,12 @@ class FdacTuning(Fei4RunBase):
         if self.close_plots:
             self.plots_filename.close()
 
+    def decide(self, data_array, injections):
+        '''Pixels with a mean ToT significantly above or below the target ToT and pixels without hits are settled (sequential test).
+        '''
+        n_hits, sum_tot, sum_tot_squares = get_tot_sums(data_array)
+        return np.logical_or(mean_decision(sum_tot, sum_tot_squares, n_hits, target=self.target_tot) != 0, n_hits == 0)
+
     def write_target_charge(self):
         commands = []
         commands.extend(self.register.get_commands("ConfMode"))
@@ -3,9 +3,10 @@ import numpy as np
 from matplotlib.backends.backend_pdf import PdfPages
 
 from pybar.fei4_run_base import Fei4RunBase
-from pybar.fei4.register_utils import scan_loop, make_pixel_mask
+from pybar.fei4.register_utils import make_pixel_mask
+from pybar.fei4.sequential_test import sequential_scan_loop, mean_decision, get_tot_sums, normalize
 from pybar.run_manager import RunManager
-from pybar.daq.readout_utils import convert_data_array, is_data_record, is_fe_word, logical_and, data_array_from_data_iterable, get_col_row_tot_array_from_data_record_array
+from pybar.daq.readout_utils import convert_data_array, is_data_record, is_fe_word, logical_and, get_col_row_tot_array_from_data_record_array
 from pybar.analysis.plotting.plotting import plot_tot
 
 
@@ -18,12 +19,15 @@ class FeedbackTuning(Fei4RunBase):
     Note:
     Use pybar.scans.tune_fei4 for full FE-I4 tuning.
     '''
+    background_analysis = False  # analysis results are written to the FE register
     _default_run_conf = {
         "scan_parameters": [('PrmpVbpf', None)],
         "target_charge": 280,
         "target_tot": 5,
         "feedback_tune_bits": range(7, -1, -1),
         "n_injections_feedback": 50,
+        "sequential_test": False,  # if True, inject in batches and stop injecting when the mean ToT is significantly above/below the target ToT
+        "sequential_test_batch": 10,  # number of injections per batch
         "max_delta_tot": 0.1,
         "enable_mask_steps_feedback": [0],  # mask steps to do per PrmpVbpf setting
         "plot_intermediate_steps": False,
@@ -83,6 +87,7 @@ class FeedbackTuning(Fei4RunBase):
         for column in bits_set(self.register.get_global_register_value("DisableColumnCnfg")):
             logging.info('Deselect double column %d' % column)
             select_mask_array[column, :] = 0
+        self.select_mask_array = select_mask_array
 
         cal_lvl1_command = self.register.get_commands("CAL")[0] + self.register.get_commands("zeros", length=40)[0] + self.register.get_commands("LV1")[0]
 
@@ -105,28 +110,30 @@ class FeedbackTuning(Fei4RunBase):
 
             scan_parameter_value = self.register.get_global_register_value("PrmpVbpf")
 
-            with self.readout(PrmpVbpf=scan_parameter_value, reset_sram_fifo=True, fill_buffer=True, clear_buffer=True, callback=self.handle_data):
-                scan_loop(self,
-                          command=cal_lvl1_command,
-                          repeat_command=self.n_injections_feedback,
-                          mask_steps=self.mask_steps,
-                          enable_mask_steps=self.enable_mask_steps_feedback,
-                          enable_double_columns=None,
-                          same_mask_for_all_dc=self.same_mask_for_all_dc,
-                          eol_function=None,
-                          digital_injection=False,
-                          enable_shift_masks=self.enable_shift_masks,
-                          disable_shift_masks=self.disable_shift_masks,
-                          restore_shift_masks=True,
-                          mask=None,
-                          double_column_correction=self.pulser_dac_correction)
-
-            col_row_tot_array = np.column_stack(convert_data_array(data_array_from_data_iterable(self.fifo_readout.data), filter_func=logical_and(is_fe_word, is_data_record), converter_func=get_col_row_tot_array_from_data_record_array))
+            data_array, injections = sequential_scan_loop(self,
+                                                          command=cal_lvl1_command,
+                                                          max_injections=self.n_injections_feedback,
+                                                          batch_injections=self.sequential_test_batch if self.sequential_test else None,
+                                                          decide=self.decide,
+                                                          readout_kwargs={'PrmpVbpf': scan_parameter_value},
+                                                          mask_steps=self.mask_steps,
+                                                          enable_mask_steps=self.enable_mask_steps_feedback,
+                                                          enable_double_columns=None,
+                                                          same_mask_for_all_dc=self.same_mask_for_all_dc,
+                                                          eol_function=None,
+                                                          digital_injection=False,
+                                                          enable_shift_masks=self.enable_shift_masks,
+                                                          disable_shift_masks=self.disable_shift_masks,
+                                                          restore_shift_masks=True,
+                                                          mask=None,
+                                                          double_column_correction=self.pulser_dac_correction)
+
+            col_row_tot_array = np.column_stack(convert_data_array(data_array, filter_func=logical_and(is_fe_word, is_data_record), converter_func=get_col_row_tot_array_from_data_record_array))
             occupancy_array, _, _ = np.histogram2d(col_row_tot_array[:, 0], col_row_tot_array[:, 1], bins=(80, 336), range=[[1, 80], [1, 336]])
             occupancy_array = np.ma.array(occupancy_array, mask=np.logical_not(np.ma.make_mask(select_mask_array)))  # take only selected pixel into account by creating a mask
-            occupancy_array = np.ma.masked_where(occupancy_array > self.n_injections_feedback, occupancy_array)
+            occupancy_array = np.ma.masked_where(occupancy_array > injections, occupancy_array)
             col_row_tot_hist = np.histogramdd(col_row_tot_array, bins=(80, 336, 16), range=[[1, 80], [1, 336], [0, 15]])[0]
-            tot_mean_array = np.average(col_row_tot_hist, axis=2, weights=range(0, 16)) * sum(range(0, 16)) / self.n_injections_feedback
+            tot_mean_array = normalize(np.average(col_row_tot_hist, axis=2, weights=range(0, 16)) * sum(range(0, 16)), injections, 1)
             tot_mean_array = np.ma.array(tot_mean_array, mask=occupancy_array.mask)
             # keep noisy pixels out
             mean_tot = np.ma.mean(tot_mean_array)
@@ -195,6 +202,13 @@ class FeedbackTuning(Fei4RunBase):
         else:
             logging.info('Tuned PrmpVbpf to %d', self.register.get_global_register_value("PrmpVbpf"))
 
+    def decide(self, data_array, injections):
+        '''The injections stop if the mean ToT of the selected pixels is significantly above or below the target ToT (sequential test).
+        '''
+        n_hits, sum_tot, sum_tot_squares = get_tot_sums(data_array)
+        select = np.ma.make_mask(self.select_mask_array)
+        return mean_decision(np.sum(sum_tot[select]), np.sum(sum_tot_squares[select]), np.sum(n_hits[select]), target=self.target_tot) != 0
+
     def analyze(self):
         # set here because original value is restored after scan()
         self.register.set_global_register_value("PrmpVbpf", self.feedback_best)
@@ -1,7 +1,12 @@
 import logging
+import os
+import hashlib
+import numpy as np
+import tables as tb
 from matplotlib.backends.backend_pdf import PdfPages
 
 from pybar.run_manager import RunManager
+from pybar.fei4.register import save_configuration_to_hdf5, load_configuration_from_hdf5
 from pybar.scans.tune_gdac import GdacTuning
 from pybar.scans.tune_feedback import FeedbackTuning
 from pybar.scans.tune_tdac import TdacTuning
@@ -27,6 +32,11 @@ class Fei4Tuning(GdacTuning, TdacTuning, FeedbackTuning, FdacTuning):
     C_Low + C_High: 53e / 57e
 
     *) measurements from IBL wafer probing
+
+    After each tuning step, a checkpoint (FE configuration and intermediate tuning results) is written to the checkpoint file.
+    If the tuning is aborted, the next tuning with the same tuning parameters and the same initial FE configuration resumes from the last checkpoint and skips the completed tuning steps.
+    The plots of the skipped tuning steps are in the output of the runs which completed these steps.
+    The checkpoint file is deleted after the tuning is completed.
     '''
     _default_run_conf = {
         # tuning parameters
@@ -36,6 +46,9 @@ class Fei4Tuning(GdacTuning, TdacTuning, FeedbackTuning, FdacTuning):
         "global_iterations": 4,  # the number of iterations to do for the global tuning, 0: only global threshold (GDAC) is tuned, -1 or None: no global tuning
         "local_iterations": 3,  # the number of iterations to do for the local tuning, 0: only local threshold (TDAC) is tuned, -1 or None: no local tuning
         "fail_on_warning": True,  # do not continue tuning if a global tuning fails
+        "checkpoint": True,  # write checkpoint after each tuning step
+        "resume": True,  # resume from the last checkpoint, if the tuning parameters and the initial FE configuration (including chip ID) are the same
+        "checkpoint_file": None,  # file name of the checkpoint file, if None use fei4_tuning_checkpoint.h5 inside the working directory
         # GDAC
         "gdac_tune_bits": range(7, -1, -1),  # GDAC bits to change during tuning
         "gdac_lower_limit": 30,  # set GDAC lower limit to prevent FEI4 from becoming noisy, set to 0 or None to disable
@@ -66,6 +79,9 @@ class Fei4Tuning(GdacTuning, TdacTuning, FeedbackTuning, FdacTuning):
         "mask_steps": 3,  # mask steps, be carefull PlsrDAC injects different charge for different mask steps
         "same_mask_for_all_dc": True  # Increases scan speed, should be deactivated for very noisy FE
     }
+    _checkpoint_run_conf = ("target_threshold", "target_charge", "target_tot", "global_iterations", "local_iterations", "gdac_tune_bits", "feedback_tune_bits", "tdac_tune_bits", "fdac_tune_bits")  # checkpoint is only used if these parameters are unchanged
+    _checkpoint_attributes = ("gdac_best", "occ_array_sel_pixels_best", "occ_array_desel_pixels_best", "feedback_best", "tot_hist", "occupancy_best", "tdac_mask_best", "tot_mean_best", "fdac_mask_best")  # intermediate tuning results needed for the analysis
+    _tunings = {"GDAC": GdacTuning, "PrmpVbpf": FeedbackTuning, "TDAC": TdacTuning, "FDAC": FdacTuning}
 
     def configure(self):
         commands = []
@@ -125,33 +141,136 @@ class Fei4Tuning(GdacTuning, TdacTuning, FeedbackTuning, FdacTuning):
         else:
             self.plots_filename = None
 
-        for iteration in range(0, self.global_iterations):  # tune iteratively with decreasing range to save time
-            logging.info("Global tuning step %d / %d", iteration + 1, self.global_iterations)
-            self.set_scan_parameters(global_step=self.scan_parameters.global_step + 1)
-            GdacTuning.scan(self)
-            self.set_scan_parameters(global_step=self.scan_parameters.global_step + 1)
-            FeedbackTuning.scan(self)
+        if not self.checkpoint_file:
+            self.checkpoint_file = os.path.join(self.working_dir, 'fei4_tuning_checkpoint.h5')
+        self.initial_configuration_hash = self.get_configuration_hash()
+        self.step_run_numbers = []  # run number of each completed tuning step
+        completed_steps = self.load_checkpoint() if self.resume else 0
 
-        if self.global_iterations >= 0:
-            self.set_scan_parameters(global_step=self.scan_parameters.global_step + 1)
-            GdacTuning.scan(self)
+        for step, (tuning, step_parameter, iteration, iterations) in enumerate(self.get_tuning_steps()):
+            self.set_scan_parameters(**{step_parameter: getattr(self.scan_parameters, step_parameter) + 1})
+            if step < completed_steps:  # skip completed tuning steps
+                logging.info("Skipping tuning step %d (%s tuning), completed in run %d (see plots of that run)", step + 1, tuning, self.step_run_numbers[step])
+                continue
+            if self.stop_run.is_set():
+                break
+            if iteration < iterations and tuning in ('GDAC', 'TDAC'):
+                logging.info("%s tuning step %d / %d", 'Global' if step_parameter == 'global_step' else 'Local', iteration + 1, iterations)
+            self._tunings[tuning].scan(self)
+            if self.stop_run.is_set():  # do not write incomplete tuning steps
+                break
+            if self.checkpoint:
+                self.save_checkpoint(step + 1)
+        else:
+            if self.global_iterations >= 0:
+                Vthin_AC = self.register.get_global_register_value("Vthin_AltCoarse")
+                Vthin_AF = self.register.get_global_register_value("Vthin_AltFine")
+                PrmpVbpf = self.register.get_global_register_value("PrmpVbpf")
+                logging.info("Results of global threshold tuning: Vthin_AltCoarse / Vthin_AltFine = %d / %d", Vthin_AC, Vthin_AF)
+                logging.info("Results of global feedback tuning: PrmpVbpf = %d", PrmpVbpf)
+            # tuning completed
+            if os.path.isfile(self.checkpoint_file):
+                os.remove(self.checkpoint_file)
 
-            Vthin_AC = self.register.get_global_register_value("Vthin_AltCoarse")
-            Vthin_AF = self.register.get_global_register_value("Vthin_AltFine")
-            PrmpVbpf = self.register.get_global_register_value("PrmpVbpf")
-            logging.info("Results of global threshold tuning: Vthin_AltCoarse / Vthin_AltFine = %d / %d", Vthin_AC, Vthin_AF)
-            logging.info("Results of global feedback tuning: PrmpVbpf = %d", PrmpVbpf)
+    def get_tuning_steps(self):
+        '''Returns the tuning steps.
 
+        Returns
+        -------
+        List of tuples of tuning name, scan parameter counting the steps, iteration and number of iterations.
+        '''
+        steps = []
+        for iteration in range(0, self.global_iterations):  # tune iteratively with decreasing range to save time
+            steps.append(('GDAC', 'global_step', iteration, self.global_iterations))
+            steps.append(('PrmpVbpf', 'global_step', iteration, self.global_iterations))
+        if self.global_iterations >= 0:
+            steps.append(('GDAC', 'global_step', self.global_iterations, self.global_iterations))
         for iteration in range(0, self.local_iterations):
-            logging.info("Local tuning step %d / %d", iteration + 1, self.local_iterations)
-            self.set_scan_parameters(local_step=self.scan_parameters.local_step + 1)
-            TdacTuning.scan(self)
-            self.set_scan_parameters(local_step=self.scan_parameters.local_step + 1)
-            FdacTuning.scan(self)
-
+            steps.append(('TDAC', 'local_step', iteration, self.local_iterations))
+            steps.append(('FDAC', 'local_step', iteration, self.local_iterations))
         if self.local_iterations >= 0:
-            self.set_scan_parameters(local_step=self.scan_parameters.local_step + 1)
-            TdacTuning.scan(self)
+            steps.append(('TDAC', 'local_step', self.local_iterations, self.local_iterations))
+        return steps
+
+    def get_checkpoint_run_conf(self):
+        return str([(key, getattr(self, key)) for key in self._checkpoint_run_conf])
+
+    def get_configuration_hash(self):
+        '''Returns the hash of the FE configuration (FE flavor, chip ID, global and pixel registers).
+        '''
+        sha1 = hashlib.sha1('%s %d' % (self.register.chip_flavor, self.register.chip_id))
+        for name, register in self.register.global_registers.iteritems():
+            sha1.update('%s %s' % (name, register['value']))
+        for name, register in self.register.pixel_registers.iteritems():
+            sha1.update(name)
+            sha1.update(np.ascontiguousarray(register['value']).tostring())
+        return sha1.hexdigest()
+
+    def save_checkpoint(self, completed_steps):
+        '''Writing checkpoint (FE configuration and intermediate tuning results).
+
+        Parameters
+        ----------
+        completed_steps : int
+            Number of completed tuning steps.
+        '''
+        configuration_file = self.register.configuration_file
+        self.step_run_numbers = self.step_run_numbers[:completed_steps - 1] + [self.run_number]
+        temp_file = self.checkpoint_file + '.tmp'
+        with tb.open_file(temp_file, mode='w', title='Fei4Tuning checkpoint') as h5_file:
+            save_configuration_to_hdf5(self.register, h5_file)
+            h5_file.root._v_attrs.completed_steps = completed_steps
+            h5_file.root._v_attrs.run_number = self.run_number
+            h5_file.root._v_attrs.run_conf = self.get_checkpoint_run_conf()
+            h5_file.root._v_attrs.initial_configuration_hash = self.initial_configuration_hash
+            h5_file.create_array(h5_file.root, name='step_run_numbers', obj=np.array(self.step_run_numbers, dtype=np.int64))
+            for name in self._checkpoint_attributes:
+                if not hasattr(self, name):
+                    continue
+                value = getattr(self, name)
+                h5_file.create_array(h5_file.root, name=name, obj=np.ma.getdata(value))
+                if np.ma.isMaskedArray(value):
+                    h5_file.create_array(h5_file.root, name=name + '_mask', obj=np.ma.getmaskarray(value))
+        self.register.configuration_file = configuration_file
+        # replace the last checkpoint only after the new checkpoint is completely written
+        if os.path.isfile(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+        os.rename(temp_file, self.checkpoint_file)
+        logging.info('Writing checkpoint after %d tuning step(s): %s', completed_steps, self.checkpoint_file)
+
+    def load_checkpoint(self):
+        '''Loading checkpoint (FE configuration and intermediate tuning results) and sending the FE configuration.
+
+        Returns
+        -------
+        Number of completed tuning steps.
+        '''
+        if not os.path.isfile(self.checkpoint_file):
+            return 0
+        configuration_file = self.register.configuration_file
+        with tb.open_file(self.checkpoint_file, mode='r') as h5_file:
+            if h5_file.root._v_attrs.run_conf != self.get_checkpoint_run_conf():
+                logging.warning('Tuning parameters changed, ignoring checkpoint from run %d: %s', h5_file.root._v_attrs.run_number, self.checkpoint_file)
+                return 0
+            if 'initial_configuration_hash' not in h5_file.root._v_attrs or h5_file.root._v_attrs.initial_configuration_hash != self.initial_configuration_hash:
+                logging.warning('Initial FE configuration changed, ignoring checkpoint from run %d: %s', h5_file.root._v_attrs.run_number, self.checkpoint_file)
+                return 0
+            completed_steps = int(h5_file.root._v_attrs.completed_steps)
+            self.step_run_numbers = h5_file.root.step_run_numbers.read().tolist()
+            logging.info('Resuming tuning from run %d after %d tuning step(s): %s', h5_file.root._v_attrs.run_number, completed_steps, self.checkpoint_file)
+            load_configuration_from_hdf5(self.register, h5_file)
+            for name in self._checkpoint_attributes:
+                if name not in h5_file.root:
+                    continue
+                value = h5_file.get_node(h5_file.root, name).read()
+                if value.ndim == 0:  # scalar
+                    value = value[()]
+                if name + '_mask' in h5_file.root:
+                    value = np.ma.array(value, mask=h5_file.get_node(h5_file.root, name + '_mask').read())
+                setattr(self, name, value)
+        self.register.configuration_file = configuration_file
+        self.register_utils.configure_all()
+        return completed_steps
 
     def analyze(self):
         if self.global_iterations > 0:
@@ -3,9 +3,9 @@ import numpy as np
 from matplotlib.backends.backend_pdf import PdfPages
 
 from pybar.fei4_run_base import Fei4RunBase
-from pybar.fei4.register_utils import scan_loop, make_pixel_mask
+from pybar.fei4.register_utils import make_pixel_mask
+from pybar.fei4.sequential_test import sequential_scan_loop, binomial_decision, median_decision, get_occupancy, normalize
 from pybar.run_manager import RunManager
-from pybar.daq.readout_utils import convert_data_array, is_data_record, is_fe_word, logical_and, data_array_from_data_iterable, get_col_row_array_from_data_record_array
 from pybar.analysis.plotting.plotting import plot_three_way
 
 
@@ -18,12 +18,15 @@ class GdacTuning(Fei4RunBase):
     Note:
     Use pybar.scans.tune_fei4 for full FE-I4 tuning.
     '''
+    background_analysis = False  # analysis results are written to the FE register
     _default_run_conf = {
         "scan_parameters": [('GDAC', None)],
         "target_threshold": 30,  # target threshold in PlsrDAC to tune to
         "gdac_tune_bits": range(7, -1, -1),  # GDAC bits to change during tuning
         "gdac_lower_limit": 30,  # set GDAC lower limit to prevent FEI4 from becoming noisy, set to 0 or None to disable
         "n_injections_gdac": 50,  # number of injections per GDAC bit setting
+        "sequential_test": False,  # if True, inject in batches and stop injecting when the median occupancy is significantly above/below 50%
+        "sequential_test_batch": 10,  # number of injections per batch
         "max_delta_threshold": 5,  # minimum difference to the target_threshold to abort the tuning
         "enable_mask_steps_gdac": [0],  # mask steps to do per GDAC setting
         "plot_intermediate_steps": False,  # plot intermediate steps (takes time)
@@ -91,6 +94,7 @@ class GdacTuning(Fei4RunBase):
         for column in bits_set(self.register.get_global_register_value("DisableColumnCnfg")):
             logging.info('Deselect double column %d' % column)
             select_mask_array[column, :] = 0
+        self.select_mask_array = select_mask_array
 
         additional_scan = True
         additional_scan_ongoing = False
@@ -111,23 +115,25 @@ class GdacTuning(Fei4RunBase):
                 scan_parameter_value = (self.register.get_global_register_value("Vthin_AltCoarse") << 8) + self.register.get_global_register_value("Vthin_AltFine")
                 logging.info('GDAC setting: %d, set bit %d = 0', scan_parameter_value, gdac_bit)
 
-            with self.readout(GDAC=scan_parameter_value, reset_sram_fifo=True, fill_buffer=True, clear_buffer=True, callback=self.handle_data):
-                scan_loop(self,
-                          command=cal_lvl1_command,
-                          repeat_command=self.n_injections_gdac,
-                          mask_steps=self.mask_steps,
-                          enable_mask_steps=self.enable_mask_steps_gdac,
-                          enable_double_columns=None,
-                          same_mask_for_all_dc=self.same_mask_for_all_dc,
-                          eol_function=None,
-                          digital_injection=False,
-                          enable_shift_masks=self.enable_shift_masks,
-                          disable_shift_masks=self.disable_shift_masks,
-                          restore_shift_masks=True,
-                          mask=None,
-                          double_column_correction=self.pulser_dac_correction)
+            data_array, injections = sequential_scan_loop(self,
+                                                          command=cal_lvl1_command,
+                                                          max_injections=self.n_injections_gdac,
+                                                          batch_injections=self.sequential_test_batch if self.sequential_test else None,
+                                                          decide=self.decide,
+                                                          readout_kwargs={'GDAC': scan_parameter_value},
+                                                          mask_steps=self.mask_steps,
+                                                          enable_mask_steps=self.enable_mask_steps_gdac,
+                                                          enable_double_columns=None,
+                                                          same_mask_for_all_dc=self.same_mask_for_all_dc,
+                                                          eol_function=None,
+                                                          digital_injection=False,
+                                                          enable_shift_masks=self.enable_shift_masks,
+                                                          disable_shift_masks=self.disable_shift_masks,
+                                                          restore_shift_masks=True,
+                                                          mask=None,
+                                                          double_column_correction=self.pulser_dac_correction)
 
-            occupancy_array, _, _ = np.histogram2d(*convert_data_array(data_array_from_data_iterable(self.fifo_readout.data), filter_func=logical_and(is_fe_word, is_data_record), converter_func=get_col_row_array_from_data_record_array), bins=(80, 336), range=[[1, 80], [1, 336]])
+            occupancy_array = normalize(get_occupancy(data_array), injections, self.n_injections_gdac)  # scale to n_injections_gdac for pixels with a settled decision
             occ_array_sel_pixels = np.ma.array(occupancy_array, mask=np.logical_not(np.ma.make_mask(select_mask_array)))  # take only selected pixel into account by using the mask
             occ_array_desel_pixels = np.ma.array(occupancy_array, mask=np.ma.make_mask(select_mask_array))  # take only de-selected pixel into account by using the inverted mask
             median_occupancy = np.ma.median(occ_array_sel_pixels)
@@ -238,6 +244,15 @@ class GdacTuning(Fei4RunBase):
         else:
             logging.info('Tuned GDAC to Vthin_AltCoarse / Vthin_AltFine = %d / %d', self.register.get_global_register_value("Vthin_AltCoarse"), self.register.get_global_register_value("Vthin_AltFine"))
 
+    def decide(self, data_array, injections):
+        '''The injections stop if the median occupancy of the selected pixels is significantly above or below 50%.
+        Pixels with an occupancy significantly above or below 50% are settled (sequential test).
+        '''
+        decision = binomial_decision(get_occupancy(data_array), injections, p=0.5)
+        if median_decision(decision, select=self.select_mask_array):
+            return True
+        return decision != 0
+
     def analyze(self):
         # set here because original value is restored after scan()
         self.register_utils.set_gdac(self.gdac_best, send_command=False)
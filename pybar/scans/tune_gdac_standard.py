@@ -18,6 +18,7 @@ class GdacTuningStandard(Fei4RunBase):
     Note:
     Use pybar.scans.tune_fei4 for full FE-I4 tuning.
     '''
+    background_analysis = False  # analysis results are written to the FE register
     _default_run_conf = {
         "scan_parameters": [('GDAC', [255, 40])],
         "step_size": -1,  # step size of the GDAC during scan
@@ -14,6 +14,7 @@ class HotPixelTuning(FEI4SelfTriggerScan):
 
     Masking hot pixels based on FEI4 self-trigger scan.
     '''
+    background_analysis = False  # analysis results are written to the FE register
     _default_run_conf = {
         "trig_count": 4,  # FE-I4 trigger count, number of consecutive BCs, 0 means 16, from 0 to 15
         "trigger_latency": 239,  # FE-I4 trigger latency, in BCs, external scintillator / TLU / HitOR: 232, USBpix self-trigger: 220, from 0 to 255
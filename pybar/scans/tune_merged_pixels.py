@@ -15,6 +15,7 @@ class MergedPixelsTuning(AnalogScan):
 
     Masking merged pixels. Injecting in every n-th pixel, and reading out everywhere else.
     '''
+    background_analysis = False  # analysis results are written to the FE register
     _default_run_conf = AnalogScan._default_run_conf.copy()
     _default_run_conf.update({
         "mask_steps": 6,  # number of injections per PlsrDAC step
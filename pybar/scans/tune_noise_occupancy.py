@@ -19,6 +19,7 @@ class NoiseOccupancyScan(Fei4RunBase):
     The total number of triggers which will be sent to the FE are <triggers> * <trig_count> (consecutive LVL1).
     To achieve a broader TDAC distribution it is necessary to decrease TdacVbp.
     '''
+    background_analysis = False  # analysis results are written to the FE register
     _default_run_conf = {
         "occupancy_limit": 1 * 10 ** (-5),  # the lower the number the higher the constraints on noise occupancy; 0 will mask any pixel with occupancy greater than zero
         "n_triggers": 10000000,  # total number of triggers which will be sent to the FE. From 1 to 4294967295 (32-bit unsigned int).
@@ -12,6 +12,7 @@ from pybar.analysis.plotting.plotting import plot_occupancy
 class StuckPixelScan(DigitalScan):
     '''Stuck pixel scan to detect and disable stuck pixels (Hitbus/HitOR always high).
     '''
+    background_analysis = False  # analysis results are written to the FE register
     _default_run_conf = {
         "mask_steps": 3,  # mask steps
         "n_injections": 100,  # number of injections
@@ -3,9 +3,8 @@ import numpy as np
 from matplotlib.backends.backend_pdf import PdfPages
 
 from pybar.fei4_run_base import Fei4RunBase
-from pybar.fei4.register_utils import scan_loop
+from pybar.fei4.sequential_test import sequential_scan_loop, binomial_decision, get_occupancy, normalize
 from pybar.run_manager import RunManager
-from pybar.daq.readout_utils import convert_data_array, is_data_record, is_fe_word, logical_and, data_array_from_data_iterable, get_col_row_array_from_data_record_array
 from pybar.analysis.plotting.plotting import plot_three_way
 
 
@@ -18,11 +17,15 @@ class TdacTuning(Fei4RunBase):
     Note:
     Use pybar.scans.tune_fei4 for full FE-I4 tuning.
     '''
+    background_analysis = False  # analysis results are written to the FE register
     _default_run_conf = {
         "scan_parameters": [('TDAC', None)],
         "target_threshold": 30,
         "tdac_tune_bits": range(4, -1, -1),
         "n_injections_tdac": 100,
+        "sequential_test": False,  # if True, inject in batches and stop injecting pixels with a settled decision (occupancy above/below 50%)
+        "sequential_test_batch": 10,  # number of injections per batch
+        "sequential_test_settled_fraction": 0.99,  # fraction of pixels with a settled decision for stopping the injections, some pixels never settle
         "plot_intermediate_steps": False,
         "plots_filename": None,
         "enable_shift_masks": ["Enable", "C_High", "C_Low"],  # enable masks shifted during scan
@@ -81,23 +84,26 @@ class TdacTuning(Fei4RunBase):
 
             self.write_tdac_config()
 
-            with self.readout(TDAC=scan_parameter_value, reset_sram_fifo=True, fill_buffer=True, clear_buffer=True, callback=self.handle_data):
-                scan_loop(self,
-                          command=cal_lvl1_command,
-                          repeat_command=self.n_injections_tdac,
-                          mask_steps=self.mask_steps,
-                          enable_mask_steps=enable_mask_steps,
-                          enable_double_columns=None,
-                          same_mask_for_all_dc=self.same_mask_for_all_dc,
-                          eol_function=None,
-                          digital_injection=False,
-                          enable_shift_masks=self.enable_shift_masks,
-                          disable_shift_masks=self.disable_shift_masks,
-                          restore_shift_masks=True,
-                          mask=None,
-                          double_column_correction=self.pulser_dac_correction)
-
-            occupancy_array, _, _ = np.histogram2d(*convert_data_array(data_array_from_data_iterable(self.fifo_readout.data), filter_func=logical_and(is_fe_word, is_data_record), converter_func=get_col_row_array_from_data_record_array), bins=(80, 336), range=[[1, 80], [1, 336]])
+            data_array, injections = sequential_scan_loop(self,
+                                                          command=cal_lvl1_command,
+                                                          max_injections=self.n_injections_tdac,
+                                                          batch_injections=self.sequential_test_batch if self.sequential_test else None,
+                                                          decide=self.decide,
+                                                          settled_fraction=self.sequential_test_settled_fraction,
+                                                          readout_kwargs={'TDAC': scan_parameter_value},
+                                                          mask_steps=self.mask_steps,
+                                                          enable_mask_steps=enable_mask_steps,
+                                                          enable_double_columns=None,
+                                                          same_mask_for_all_dc=self.same_mask_for_all_dc,
+                                                          eol_function=None,
+                                                          digital_injection=False,
+                                                          enable_shift_masks=self.enable_shift_masks,
+                                                          disable_shift_masks=self.disable_shift_masks,
+                                                          restore_shift_masks=True,
+                                                          mask=None,
+                                                          double_column_correction=self.pulser_dac_correction)
+
+            occupancy_array = normalize(get_occupancy(data_array), injections, self.n_injections_tdac)  # scale to n_injections_tdac for pixels with a settled decision
             select_better_pixel_mask = abs(occupancy_array - self.n_injections_tdac / 2) <= abs(self.occupancy_best - self.n_injections_tdac / 2)
             pixel_with_too_high_occupancy_mask = occupancy_array > self.n_injections_tdac / 2
             self.occupancy_best[select_better_pixel_mask] = occupancy_array[select_better_pixel_mask]
@@ -146,6 +152,11 @@ class TdacTuning(Fei4RunBase):
         if self.close_plots:
             self.plots_filename.close()
 
+    def decide(self, data_array, injections):
+        '''Pixels with an occupancy significantly above or below 50% are settled (sequential test).
+        '''
+        return binomial_decision(get_occupancy(data_array), injections, p=0.5) != 0
+
     def write_target_threshold(self):
         commands = []
         commands.extend(self.register.get_commands("ConfMode"))
@@ -21,6 +21,7 @@ class ThresholdBaselineTuning(Fei4RunBase):
     NOTE: In case of RX errors decrease the trigger frequency (= increase trigger_rate_limit)
     NOTE: To increase the TDAC range, decrease TdacVbp.
     '''
+    background_analysis = False  # analysis results are written to the FE register
     _default_run_conf = {
         "occupancy_limit": 0,  # occupancy limit, when reached the TDAC will be decreased (increasing threshold). 0 will mask any pixel with occupancy greater than zero
         "scan_parameters": [('Vthin_AltFine', (120, None)), ('Step', 60)],  # the Vthin_AltFine range, number of steps (repetition at constant Vthin_AltFine)
@@ -0,0 +1,75 @@
+''' Script to check the recording of the command stream and the estimation of the scan duration in a dry run without FE-I4 or readout hardware.
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+import tables as tb
+from numpy.testing import assert_array_equal
+
+from pybar.fei4.register import FEI4Register
+from pybar.fei4.register_utils import scan_loop
+from pybar.fei4.command_recorder import DryRun, clock_period, get_wait_cycles, load_summary
+
+
+class TestCommandRecorder(unittest.TestCase):
+
+    def setUp(self):
+        self.dry_run = DryRun(register=FEI4Register(fe_type='fei4b'))
+        self.command = self.dry_run.register.get_commands("CAL")[0] + self.dry_run.register.get_commands("zeros", length=40)[0] + self.dry_run.register.get_commands("LV1")[0]
+        self.output_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_folder)
+
+    def record_scan_loop(self, **kwargs):
+        scan_loop(self.dry_run, self.command, repeat_command=100, use_delay=True, mask_steps=3, same_mask_for_all_dc=True, fast_dc_loop=True, digital_injection=False, enable_shift_masks=["Enable", "C_High", "C_Low"], disable_shift_masks=[], restore_shift_masks=False, **kwargs)
+        return self.dry_run.recorder.get_records()
+
+    def test_get_wait_cycles(self):
+        self.assertEqual(get_wait_cycles(cmd_size=54, cmd_repeat=1), 54)
+        self.assertEqual(get_wait_cycles(cmd_size=54, cmd_repeat=0), 54)
+        self.assertEqual(get_wait_cycles(cmd_size=54, cmd_repeat=100), 5400)
+        # start and stop sequence are sent only once
+        self.assertEqual(get_wait_cycles(cmd_size=104 + 54 + 10, cmd_repeat=100, start_sequence_length=104, stop_sequence_length=10), 104 + 5400 + 10)
+
+    def test_scan_loop(self):
+        records = self.record_scan_loop()
+        summary = self.dry_run.recorder.get_summary()
+        self.assertEqual(summary.keys(), ['', 'mask step 0', 'mask step 1', 'mask step 2'])
+        for mask_step in range(3):
+            section_records = records[records['section'] == 'mask step %d' % mask_step]
+            # one command writing the mask and one command for each double column
+            self.assertEqual(summary['mask step %d' % mask_step]['n_commands'], 41)
+            self.assertEqual(section_records.shape[0], 41)
+            self.assertEqual(sum(section_records['cmd_repeat'] == 100), 40)
+            self.assertEqual(summary['mask step %d' % mask_step]['data_bytes'], sum(section_records['data_bytes']))
+        # duration estimate from the command length and repetitions
+        assert_array_equal(records['wait_cycles'], [get_wait_cycles(record['cmd_size'], record['cmd_repeat'], record['start_sequence_length'], record['stop_sequence_length']) for record in records])
+        self.assertAlmostEqual(sum(section_summary['hardware_time'] for section_summary in summary.values()), sum(records['wait_cycles']) * clock_period)
+        self.assertGreater(summary['mask step 0']['hardware_time'], 40 * 100 * self.command.length() * clock_period)
+        self.assertTrue(all(records['host_time'] >= 0.0))
+
+    def test_enable_double_columns(self):
+        hardware_time = sum(self.record_scan_loop()['hardware_time'])
+        self.dry_run.recorder.reset()
+        records = self.record_scan_loop(enable_double_columns=[0, 1])
+        self.assertEqual(sum(records['cmd_repeat'] == 100), 3 * 2)
+        self.assertLess(sum(records['hardware_time']), hardware_time / 10)
+
+    def test_save(self):
+        records = self.record_scan_loop(enable_mask_steps=[0])
+        filename = os.path.join(self.output_folder, 'commands.h5')
+        self.dry_run.recorder.save(filename)
+        with tb.open_file(filename, mode='r') as h5_file:
+            assert_array_equal(h5_file.root.commands[:], records)
+            self.assertEqual(h5_file.root.command_data.nrows, records.shape[0])
+            for record, command_data in zip(records, h5_file.root.command_data):
+                self.assertEqual(command_data.shape[0], (record['cmd_size'] + 7) // 8)
+        self.assertEqual(load_summary(filename), self.dry_run.recorder.get_summary())
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestCommandRecorder)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,141 @@
+''' Script to check the event building of the EUDAQ external trigger scan. The events are stored by the LocalProducer instead of being sent to EUDAQ.
+'''
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from pybar.scans.scan_eudaq_ext_trigger import EventBuilder, LocalProducer
+
+
+class SingleEventProducer(object):
+    ''' Producer without SendEvents method.
+    '''
+    def __init__(self):
+        self.events = []
+
+    def SendEvent(self, data):
+        self.events.append(np.array(data, dtype=np.uint32))
+
+
+def trigger_word(trigger_number):
+    return 0x80000000 | trigger_number
+
+
+def get_raw_data(trigger_numbers, n_words=3, leading_words=0):
+    # each event: trigger word and n_words FE words containing the trigger number
+    raw_data = [0x00E90000 + index for index in range(leading_words)]
+    for trigger_number in trigger_numbers:
+        raw_data.append(trigger_word(trigger_number))
+        raw_data.extend([0x00E90000 + (trigger_number & 0xFFFF)] * n_words)
+    return np.array(raw_data, dtype=np.uint32)
+
+
+class TestEventBuilder(unittest.TestCase):
+
+    def setUp(self):
+        self.producer = LocalProducer()
+
+    def assert_events_equal(self, events, expected_events):
+        self.assertEqual(len(events), len(expected_events))
+        for event, expected_event in zip(events, expected_events):
+            assert_array_equal(event, expected_event)
+
+    def get_events(self, trigger_numbers, n_words=3):
+        return [get_raw_data([trigger_number], n_words=n_words) for trigger_number in trigger_numbers]
+
+    def test_build_events(self):
+        event_builder = EventBuilder(producer=self.producer)
+        self.assertEqual(event_builder.add_data(get_raw_data(range(10, 15))), 4)  # last event is kept until the next trigger word
+        self.assert_events_equal(self.producer.events, self.get_events(range(10, 14)))
+        self.assertEqual(event_builder.add_data(get_raw_data([15])), 1)
+        event_builder.flush()
+        self.assert_events_equal(self.producer.events, self.get_events(range(10, 16)))
+        self.assertEqual(event_builder.remaining_data.shape[0], 0)
+
+    def test_leading_data(self):
+        # data before the first trigger word is sent as the first event
+        event_builder = EventBuilder(producer=self.producer)
+        raw_data = get_raw_data(range(3), leading_words=2)
+        self.assertEqual(event_builder.add_data(raw_data), 3)
+        self.assert_events_equal(self.producer.events, [raw_data[:2]] + self.get_events(range(2)))
+        # data without trigger word
+        event_builder = EventBuilder(producer=LocalProducer())
+        self.assertEqual(event_builder.add_data(raw_data[:2]), 0)
+        self.assertEqual(event_builder.add_data(raw_data[2:]), 3)
+        self.assert_events_equal(event_builder.producer.events, [raw_data[:2]] + self.get_events(range(2)))
+
+    def test_chunks(self):
+        # events split at arbitrary positions between readouts
+        raw_data = get_raw_data(range(100), n_words=5, leading_words=1)
+        np.random.seed(0)
+        for n_chunks in [1, 7, 50, raw_data.shape[0]]:
+            producer = LocalProducer()
+            event_builder = EventBuilder(producer=producer)
+            split_index = np.sort(np.random.choice(np.arange(1, raw_data.shape[0]), size=n_chunks - 1, replace=False))
+            for data in np.split(raw_data, split_index):
+                event_builder.add_data(data)
+            event_builder.flush()
+            self.assert_events_equal(producer.events, [raw_data[:1]] + self.get_events(range(100), n_words=5))
+
+    def test_missing_trigger_numbers(self):
+        # after a data error, empty events (trigger number only) are sent for the missing trigger numbers
+        event_builder = EventBuilder(producer=self.producer)
+        event_builder.add_data(get_raw_data(range(0, 3)))
+        event_builder.data_error_occurred = True
+        self.assertEqual(event_builder.add_data(get_raw_data([6, 7])), 5)
+        self.assert_events_equal(self.producer.events, self.get_events(range(0, 3)) + [[3], [4], [5]] + self.get_events([6]))
+        self.assertFalse(event_builder.data_error_occurred)
+        self.assertEqual(event_builder.last_trigger_number, 6)
+        # missing trigger numbers within one readout
+        event_builder.data_error_occurred = True
+        event_builder.add_data(get_raw_data([8, 9, 11, 12]))
+        event_builder.flush()
+        self.assert_events_equal(self.producer.events[-6:-1], self.get_events([7, 8, 9]) + [[10], get_raw_data([11])])
+        self.assert_events_equal(self.producer.events[-1:], [get_raw_data([12])])
+
+    def test_missing_trigger_numbers_without_data_error(self):
+        # without data error, the events are sent unchanged
+        event_builder = EventBuilder(producer=self.producer)
+        event_builder.add_data(get_raw_data([0, 1, 5, 6, 7]))
+        self.assert_events_equal(self.producer.events, self.get_events([0, 1, 5, 6]))
+        self.assertEqual(event_builder.last_trigger_number, 3)  # expected trigger number is counted further
+
+    def test_wrap_around(self):
+        event_builder = EventBuilder(producer=self.producer, max_trigger_counter=8)
+        event_builder.add_data(get_raw_data([5, 6, 7, 0, 1, 2]))
+        self.assert_events_equal(self.producer.events, self.get_events([5, 6, 7, 0, 1]))
+        self.assertEqual(event_builder.last_trigger_number, 1)
+        # missing trigger numbers across the wrap-around
+        event_builder.data_error_occurred = True
+        event_builder.add_data(get_raw_data([3, 4, 5, 6, 7, 1, 2]))
+        self.assert_events_equal(self.producer.events[5:], self.get_events([2, 3, 4, 5, 6, 7]) + [[0]] + self.get_events([1]))
+        # trigger numbers above the counter are truncated
+        event_builder = EventBuilder(producer=LocalProducer(), max_trigger_counter=8)
+        event_builder.add_data(get_raw_data([6, 7, 8, 9]))
+        self.assertEqual(event_builder.last_trigger_number, 0)
+        self.assertEqual(len(event_builder.producer.events), 3)
+
+    def test_data_headers(self):
+        # each event has 3 data headers, the leading data and the empty events are not counted
+        event_builder = EventBuilder(producer=self.producer, n_data_headers=3)
+        event_builder.add_data(get_raw_data(range(5), leading_words=1))
+        self.assertEqual(event_builder.n_incomplete_events, 0)
+        event_builder.add_data(np.concatenate([get_raw_data([5], n_words=2), get_raw_data([6])]))
+        self.assertEqual(event_builder.n_incomplete_events, 1)  # trigger number 5
+        event_builder.data_error_occurred = True
+        event_builder.add_data(np.concatenate([get_raw_data([9], n_words=4), get_raw_data([10])]))
+        self.assertEqual(event_builder.n_incomplete_events, 2)  # trigger number 9
+        self.assert_events_equal(self.producer.events[-5:], self.get_events([5], n_words=2) + self.get_events([6]) + [[7], [8]] + self.get_events([9], n_words=4))
+
+    def test_send_single_events(self):
+        producer = SingleEventProducer()
+        event_builder = EventBuilder(producer=producer)
+        event_builder.add_data(get_raw_data(range(4), leading_words=1))
+        event_builder.flush()
+        self.assert_events_equal(producer.events, [get_raw_data([], leading_words=1)] + self.get_events(range(4)))
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestEventBuilder)
+    unittest.TextTestRunner(verbosity=2).run(suite)
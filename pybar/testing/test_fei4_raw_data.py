@@ -0,0 +1,164 @@
+''' Script to check the raw data publisher. The raw data messages are received and interpreted like in the online monitor,
+the number of events has to be the same as for the interpretation of the raw data without the publisher.
+'''
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import tables as tb
+import zmq
+
+from pybar.daq.fei4_raw_data import DataPublisher, get_data_from_message, is_message_for_channel, SequenceCounter, open_raw_data_file, demultiplex_raw_data_file
+from pybar.daq.readout_utils import is_data_from_channel, is_fe_word, is_trigger_word
+from pybar.fei4.register import FEI4Register
+from pybar.histogram_server import create_raw_data_analysis
+
+tests_data_folder = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_analysis_data')
+
+
+def get_n_events(raw_data_arrays):
+    interpreter, histogram, _ = create_raw_data_analysis()
+    for raw_data in raw_data_arrays:
+        interpreter.interpret_raw_data(raw_data)
+        histogram.add_hits(interpreter.get_hits())
+    return interpreter.get_n_events()
+
+
+def get_two_fe_raw_data():
+    # second FE on channel 3 with the same hits as the FE on channel 4
+    with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_5.h5'), mode="r") as in_file_h5:
+        raw_data = in_file_h5.root.raw_data[:]
+    fe_words = is_fe_word(raw_data)
+    two_fe_raw_data = np.repeat(raw_data, np.where(fe_words, 2, 1))
+    channel_3_words = np.zeros_like(two_fe_raw_data, dtype=np.bool)
+    channel_3_words[np.cumsum(np.where(fe_words, 2, 1))[fe_words] - 1] = True
+    two_fe_raw_data[channel_3_words] = np.bitwise_or(np.bitwise_and(two_fe_raw_data[channel_3_words], 0x00FFFFFF), 0x03000000)
+    return raw_data, two_fe_raw_data
+
+
+class TestRawDataPublisher(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        raw_data, cls.raw_data = get_two_fe_raw_data()
+        cls.readouts = np.array_split(cls.raw_data, 10)
+        cls.n_events = get_n_events([raw_data])
+        cls.n_events_all_channels = get_n_events(cls.readouts)
+        cls.n_trigger_words = np.count_nonzero(is_trigger_word(raw_data))
+
+    def setUp(self):
+        self.context = zmq.Context()
+
+    def tearDown(self):
+        self.context.term()
+
+    def get_messages(self, channels):
+        # publishing and receiving the readouts
+        publisher = DataPublisher(socket_address='inproc://raw_data', context=self.context, channels=channels)
+        socket_sub = self.context.socket(zmq.SUB)
+        socket_sub.setsockopt(zmq.SUBSCRIBE, '')
+        socket_sub.connect('inproc://raw_data')
+        try:
+            time.sleep(0.1)  # subscription has to arrive at the publisher
+            for raw_data in self.readouts:
+                publisher.send_data((raw_data, 0.0, 0.0, 0))
+            messages = []
+            while socket_sub.poll(100):
+                meta_data = socket_sub.recv_json()
+                messages.append((meta_data, socket_sub.recv()))
+        finally:
+            socket_sub.close()
+            publisher.close()
+        return messages
+
+    def get_channel_data(self, messages, channel):
+        # selecting the raw data like the online monitor (see online_monitor.interpret_data())
+        raw_data_arrays = []
+        sequence_counter = SequenceCounter()
+        for meta_data, data in messages:
+            if not is_message_for_channel(meta_data, channel):
+                continue
+            sequence_counter.update(meta_data)
+            raw_data = get_data_from_message(meta_data, data)
+            if 'channel' not in meta_data and channel is not None:
+                raw_data = raw_data[np.logical_or(is_data_from_channel(channel)(raw_data), np.logical_not(is_fe_word(raw_data)))]
+            raw_data_arrays.append(raw_data)
+        self.assertEqual(sequence_counter.n_lost, 0)
+        return raw_data_arrays
+
+    def test_complete_raw_data(self):
+        messages = self.get_messages(channels=None)
+        self.assertEqual(len(messages), len(self.readouts))
+        self.assertEqual(get_n_events(self.get_channel_data(messages, None)), self.n_events_all_channels)
+        for channel in [3, 4]:
+            self.assertEqual(get_n_events(self.get_channel_data(messages, channel)), self.n_events)
+
+    def test_demultiplexed_raw_data(self):
+        messages = self.get_messages(channels=[3, 4])
+        self.assertEqual(len(messages), 3 * len(self.readouts))  # complete raw data and data of each channel
+        # subscribers of all channels take only the complete raw data, trigger words are not counted multiple times
+        raw_data_arrays = self.get_channel_data(messages, None)
+        self.assertEqual(len(raw_data_arrays), len(self.readouts))
+        self.assertEqual(sum(np.count_nonzero(is_trigger_word(raw_data)) for raw_data in raw_data_arrays), self.n_trigger_words)
+        self.assertEqual(get_n_events(raw_data_arrays), self.n_events_all_channels)
+        # subscribers of a channel take only the data of their channel
+        for channel in [3, 4]:
+            raw_data_arrays = self.get_channel_data(messages, channel)
+            self.assertEqual(len(raw_data_arrays), len(self.readouts))
+            self.assertEqual(sum(np.count_nonzero(is_trigger_word(raw_data)) for raw_data in raw_data_arrays), self.n_trigger_words)
+            self.assertEqual(get_n_events(raw_data_arrays), self.n_events)
+        # channel not demultiplexed by the publisher, complete raw data is filtered
+        self.assertEqual(get_n_events(self.get_channel_data(messages, 1)), get_n_events([self.raw_data[np.logical_not(is_fe_word(self.raw_data))]]))
+
+
+class TestDemultiplexRawDataFile(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.raw_data, cls.two_fe_raw_data = get_two_fe_raw_data()
+        cls.readouts = np.array_split(cls.two_fe_raw_data, 10)
+
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.working_dir, '1_module_test_analog_scan')
+        with open_raw_data_file(filename=self.filename, mode='w', scan_parameters=['PlsrDAC']) as raw_data_file:
+            for index, raw_data in enumerate(self.readouts):
+                raw_data_file.append_item((raw_data, float(index), float(index) + 0.5, index % 2), scan_parameters={'PlsrDAC': index // 3})
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+
+    def test_demultiplex_raw_data_file(self):
+        registers = [FEI4Register(fe_type='fei4b', chip_address=chip_address, broadcast=False) for chip_address in [1, 2]]
+        filenames = demultiplex_raw_data_file(self.filename + '.h5', channels=[3, 4], registers=registers, conf={'module_id': 'module_test'}, run_conf={'n_injections': 100}, chunk_size=3)
+        self.assertEqual(filenames, {3: self.filename + '_ch3', 4: self.filename + '_ch4'})
+        for channel, chip_address in [(3, 1), (4, 2)]:
+            with tb.open_file(filenames[channel] + '.h5', mode="r") as in_file_h5:
+                raw_data = in_file_h5.root.raw_data[:]
+                meta_data = in_file_h5.root.meta_data[:]
+                scan_parameters = in_file_h5.root.scan_parameters[:]
+                self.assertEqual(in_file_h5.root.configuration.conf[:]['value'][0], 'module_test')
+                self.assertEqual(in_file_h5.root.configuration.run_conf[:]['value'][0], '100')
+            # FE words of the channel, all other words (e.g. trigger words) are kept, each channel has the hits of the original data
+            np.testing.assert_array_equal(raw_data[is_fe_word(raw_data)], np.bitwise_or(np.bitwise_and(self.raw_data[is_fe_word(self.raw_data)], 0x00FFFFFF), channel << 24))
+            self.assertEqual(np.count_nonzero(is_trigger_word(raw_data)), np.count_nonzero(is_trigger_word(self.raw_data)))
+            self.assertEqual(get_n_events([raw_data]), get_n_events([self.raw_data]))
+            # meta data and scan parameters of each readout
+            self.assertEqual(meta_data.shape[0], len(self.readouts))
+            np.testing.assert_array_equal(meta_data['timestamp_start'], np.arange(len(self.readouts)))
+            np.testing.assert_array_equal(meta_data['error'], np.arange(len(self.readouts)) % 2)
+            np.testing.assert_array_equal(meta_data['index_stop'] - meta_data['index_start'], [np.count_nonzero(np.logical_or(is_data_from_channel(channel)(readout), np.logical_not(is_fe_word(readout)))) for readout in self.readouts])
+            np.testing.assert_array_equal(scan_parameters['PlsrDAC'], np.arange(len(self.readouts)) // 3)
+            self.assertEqual(FEI4Register(configuration_file=filenames[channel] + '.h5').chip_address, chip_address)
+        # original raw data file is kept
+        with tb.open_file(self.filename + '.h5', mode="r") as in_file_h5:
+            np.testing.assert_array_equal(in_file_h5.root.raw_data[:], self.two_fe_raw_data)
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestRawDataPublisher)
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestDemultiplexRawDataFile))
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,135 @@
+''' Script to check the multi-FE support of the FE-I4 run base (FE selection, configuration file of each FE) without a FE-I4 or readout hardware.
+'''
+import os
+import shutil
+import tempfile
+import datetime
+import unittest
+
+from pybar.fei4.register import FEI4Register
+from pybar.fei4_run_base import Fei4RunBase
+
+
+class Fei4RunDummy(Fei4RunBase):
+    _default_run_conf = {}
+
+    def configure(self):
+        pass
+
+    def scan(self):
+        pass
+
+    def analyze(self):
+        pass
+
+
+class Fei4TuningDummy(Fei4RunDummy):
+    background_analysis = False  # analysis results are written to the FE register
+
+
+class TestFei4RunBase(unittest.TestCase):
+
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+
+    def get_run(self, run_class=Fei4RunDummy, rx_channels=(3, 4)):
+        # multi-FE run without hardware, see Fei4RunBase.init_fe()
+        registers = [FEI4Register(fe_type='fei4b', chip_address=chip_address, broadcast=False) for chip_address in range(len(rx_channels))]
+        run = run_class(conf={'working_dir': self.working_dir, 'module_id': 'Test Module', 'rx_channels': list(rx_channels), 'fe_configuration': registers, 'dut': 'not_existing_dut.yaml'})
+        run._broadcast_register = FEI4Register(fe_type='fei4b', chip_address=0, broadcast=True)
+        run._register_utils = 'broadcast register utils'
+        run._fe_register_utils = dict((channel, 'register utils ch%d' % channel) for channel in rx_channels)
+        run._run_number = 5
+        return run
+
+    def add_run(self, run, run_number, status='FINISHED', configuration_file=None):
+        run.run_database.add_run(run_class=run.__class__.__name__, status=status, start_time=datetime.datetime.now(), run_number=run_number)
+        if configuration_file:
+            run.run_database.set_configuration_file(run_number, configuration_file)
+
+    def write_configuration_file(self, run, run_number, channel):
+        filename = os.path.join(run.working_dir, '%d_%s_fei4_run_dummy_ch%d.cfg' % (run_number, run.module_id, channel))
+        if not os.path.isdir(run.working_dir):
+            os.makedirs(run.working_dir)
+        with open(filename, 'w'):
+            pass
+        return filename
+
+    def test_select_fe(self):
+        run = self.get_run()
+        self.assertTrue(run.multi_fe)
+        self.assertEqual(run.registers.keys(), [3, 4])
+        self.assertIsNone(run.selected_channel)
+        self.assertIs(run.register, run._broadcast_register)
+        self.assertEqual(run.register_utils, 'broadcast register utils')
+        output_filename = run.output_filename
+        self.assertEqual(os.path.basename(output_filename), '5_test_module_fei4_run_dummy')
+        with run.select_fe(4) as register:
+            self.assertIs(register, run.registers[4])
+            self.assertIs(run.register, run.registers[4])
+            self.assertEqual(register.chip_address, 1)
+            self.assertEqual(run.selected_channel, 4)
+            self.assertEqual(run.register_utils, 'register utils ch4')
+            self.assertEqual(run.output_filename, output_filename + '_ch4')
+            # broadcast register inside the context
+            with run.select_fe(None) as broadcast_register:
+                self.assertIs(broadcast_register, run._broadcast_register)
+                self.assertEqual(run.output_filename, output_filename)
+            self.assertEqual(run.selected_channel, 4)
+        self.assertIsNone(run.selected_channel)
+        # selection is restored after an exception
+        with self.assertRaises(RuntimeError):
+            with run.select_fe(3):
+                raise RuntimeError()
+        self.assertIsNone(run.selected_channel)
+        with self.assertRaises(ValueError):
+            with run.select_fe(5):
+                pass
+        # single FE
+        run = self.get_run(rx_channels=(4,))
+        self.assertFalse(run.multi_fe)
+        self.assertEqual(run.registers.keys(), [4])
+        with run.select_fe(4) as register:
+            self.assertIs(register, run._conf['fe_configuration'])
+
+    def test_get_configuration(self):
+        run = self.get_run()
+        # configuration file of the first FE is stored in the run database (see save_configuration())
+        cfg_files = dict((channel, self.write_configuration_file(run, 5, channel)) for channel in [3, 4])
+        self.add_run(run, 5, configuration_file=cfg_files[3])
+        for channel in [3, 4]:
+            self.assertEqual(run._get_configuration(5, channel=channel), cfg_files[channel])
+            self.assertEqual(run._get_configuration(channel=channel), cfg_files[channel])
+        self.assertEqual(run._get_configuration(5), cfg_files[3])
+        # configuration file not in the run database
+        cfg_files = dict((channel, self.write_configuration_file(run, 7, channel)) for channel in [3, 4])
+        self.add_run(run, 7)
+        self.assertEqual(run._get_configuration(7, channel=4), cfg_files[4])
+        self.assertEqual(run.run_database.get_configuration_file(7), cfg_files[4])
+        self.assertEqual(run._get_configuration(7, channel=3), cfg_files[3])
+        # last finished run with a configuration file
+        self.add_run(run, 8)
+        self.add_run(run, 9, status='CRASHED')
+        self.write_configuration_file(run, 9, 4)
+        self.assertEqual(run._get_configuration(channel=4), cfg_files[4])
+        self.assertIsNone(run._get_configuration(channel=5))
+        with self.assertRaises(ValueError):
+            run._get_configuration(8, channel=3)
+        run._close_run_database()
+
+    def test_multi_fe_tuning(self):
+        # broadcast register is a copy of the register of the first FE
+        with self.assertRaises(NotImplementedError):
+            self.get_run(run_class=Fei4TuningDummy).pre_run()
+        # DUT is initialized
+        for run_class, rx_channels in [(Fei4TuningDummy, (3,)), (Fei4RunDummy, (3, 4))]:
+            with self.assertRaises(ValueError):
+                self.get_run(run_class=run_class, rx_channels=rx_channels).pre_run()
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestFei4RunBase)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,155 @@
+''' Script to check the delta encoding of the histogram snapshots of the histogram server.
+The encoded snapshots are decoded and compared to the original histograms.
+'''
+import os
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+import tables as tb
+import zmq
+
+from pybar.histogram_server import HistogramEncoder, HistogramDecoder, send_histograms, receive_histograms, histogram_shapes, create_raw_data_analysis, get_interpreted_data, integrate_readout
+
+tests_data_folder = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_analysis_data')
+
+
+def get_encodings(snapshot_meta_data):
+    return dict((histogram_meta_data['name'], histogram_meta_data['encoding']) for histogram_meta_data in snapshot_meta_data['histograms'])
+
+
+class TestHistogramServer(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.histograms = dict((name, np.random.randint(0, 100, size=shape).astype(np.uint32)) for name, shape in histogram_shapes)
+
+    def assert_histograms_equal(self, histograms, expected_histograms):
+        self.assertEqual(sorted(histograms.keys()), sorted(expected_histograms.keys()))
+        for name in expected_histograms:
+            assert_array_equal(histograms[name], expected_histograms[name], err_msg=name)
+
+    def get_snapshots(self, n_snapshots):
+        # first snapshot random, afterwards sparse changes, full changes and unchanged histograms
+        snapshots = []
+        histograms = dict((name, value.copy()) for name, value in self.histograms.iteritems())
+        for index in range(n_snapshots):
+            if index > 0:
+                histograms = dict((name, value.copy()) for name, value in histograms.iteritems())
+                histograms['occupancy'][index % 80, index % 336, 0] += 1  # sparse
+                histograms['tot_hist'][:] = np.random.randint(100, 200, size=histograms['tot_hist'].shape)  # full
+            snapshots.append(histograms)
+        return snapshots
+
+    def test_encodings(self):
+        encoder = HistogramEncoder(keyframe_interval=10)
+        decoder = HistogramDecoder()
+        snapshots = self.get_snapshots(3)
+        # keyframe
+        snapshot_meta_data, frames = encoder.encode(snapshots[0])
+        self.assertTrue(snapshot_meta_data['keyframe'])
+        self.assertEqual(set(get_encodings(snapshot_meta_data).values()), set(['full']))
+        self.assert_histograms_equal(decoder.decode(snapshot_meta_data, frames), snapshots[0])
+        # delta frames
+        for histograms in snapshots[1:]:
+            snapshot_meta_data, frames = encoder.encode(histograms)
+            self.assertFalse(snapshot_meta_data['keyframe'])
+            encodings = get_encodings(snapshot_meta_data)
+            self.assertEqual(encodings['occupancy'], 'sparse')
+            self.assertEqual(encodings['tot_hist'], 'full')
+            self.assertEqual(encodings['tdc_counters'], 'unchanged')
+            self.assertEqual(len(frames[sorted(histograms.keys()).index('tdc_counters')]), 0)
+            self.assertLess(len(frames[sorted(histograms.keys()).index('occupancy')]), histograms['occupancy'].nbytes)
+            self.assert_histograms_equal(decoder.decode(snapshot_meta_data, frames), histograms)
+
+    def test_decoded_histograms_not_modified(self):
+        encoder = HistogramEncoder(keyframe_interval=10)
+        decoder = HistogramDecoder()
+        snapshots = self.get_snapshots(2)
+        decoded_histograms = decoder.decode(*encoder.encode(snapshots[0]))
+        decoder.decode(*encoder.encode(snapshots[1]))
+        self.assert_histograms_equal(decoded_histograms, snapshots[0])
+
+    def test_keyframe_interval(self):
+        encoder = HistogramEncoder(keyframe_interval=3)
+        keyframes = [encoder.encode(histograms)[0]['keyframe'] for histograms in self.get_snapshots(7)]
+        self.assertEqual(keyframes, [True, False, False, True, False, False, True])
+        encoder.reset()
+        self.assertTrue(encoder.encode(self.histograms)[0]['keyframe'])
+
+    def test_lost_snapshot(self):
+        encoder = HistogramEncoder(keyframe_interval=4)
+        decoder = HistogramDecoder()
+        snapshots = self.get_snapshots(9)
+        encoded_snapshots = [encoder.encode(histograms) for histograms in snapshots]
+        # decoder starts with a delta frame: waiting for keyframe
+        self.assertIsNone(decoder.decode(*encoded_snapshots[1]))
+        self.assertIsNone(decoder.decode(*encoded_snapshots[2]))
+        self.assertIsNone(decoder.decode(*encoded_snapshots[3]))
+        self.assert_histograms_equal(decoder.decode(*encoded_snapshots[4]), snapshots[4])
+        # snapshot 5 lost, all following delta frames are dropped
+        self.assertIsNone(decoder.decode(*encoded_snapshots[6]))
+        self.assertIsNone(decoder.decode(*encoded_snapshots[7]))
+        # resync with next keyframe
+        self.assertTrue(encoded_snapshots[8][0]['keyframe'])
+        self.assert_histograms_equal(decoder.decode(*encoded_snapshots[8]), snapshots[8])
+
+    def test_send_receive_histograms(self):
+        context = zmq.Context()
+        socket_push = context.socket(zmq.PAIR)
+        socket_push.bind('inproc://test_histograms')
+        socket_pull = context.socket(zmq.PAIR)
+        socket_pull.connect('inproc://test_histograms')
+        try:
+            encoder = HistogramEncoder(keyframe_interval=10)
+            decoder = HistogramDecoder()
+            for compression_level in [0, 1, 9]:
+                for histograms in self.get_snapshots(3):
+                    send_histograms(socket_push, histograms, meta_data={'n_hits': 1}, compression_level=compression_level, encoder=encoder)
+                    histograms_meta_data = socket_pull.recv_json()
+                    self.assertEqual(histograms_meta_data['meta_data'], {'n_hits': 1})
+                    self.assert_histograms_equal(receive_histograms(histograms_meta_data, socket_pull.recv_multipart(), decoder=decoder), histograms)
+            # without encoder every snapshot is a keyframe
+            send_histograms(socket_push, self.histograms)
+            self.assert_histograms_equal(receive_histograms(socket_pull.recv_json(), socket_pull.recv_multipart()), self.histograms)
+        finally:
+            socket_push.close()
+            socket_pull.close()
+            context.term()
+
+    def test_integrate_readout(self):
+        with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_5.h5'), mode='r') as in_file_h5:
+            raw_data = in_file_h5.root.raw_data[:]
+            meta_data = in_file_h5.root.meta_data[:]
+        readouts = [raw_data[index_start:index_stop] for index_start, index_stop in meta_data[['index_start', 'index_stop']][:8]]
+        # reference: all readouts without reset
+        interpreter, histogram, has_tdc_distance = create_raw_data_analysis()
+        for readout in readouts[:-1]:
+            interpreter.interpret_raw_data(readout)
+            histogram.add_hits(interpreter.get_hits())
+        n_hits_without_last = get_interpreted_data(interpreter, histogram, has_tdc_distance)['occupancy'].sum()
+        interpreter.interpret_raw_data(readouts[-1])
+        histogram.add_hits(interpreter.get_hits())
+        n_hits_total = get_interpreted_data(interpreter, histogram, has_tdc_distance)['occupancy'].sum()
+        self.assertGreater(n_hits_total, n_hits_without_last)
+        # integration of all readouts
+        interpreter, histogram, has_tdc_distance = create_raw_data_analysis()
+        for n_readout, readout in enumerate(readouts, start=1):
+            self.assertIs(integrate_readout(interpreter, histogram, has_tdc_distance, readout, n_readout=n_readout, integrate_readouts=0, n_remaining_readouts=0), True)
+        self.assertEqual(get_interpreted_data(interpreter, histogram, has_tdc_distance)['occupancy'].sum(), n_hits_total)
+        # integration of two readouts, one readout per batch
+        interpreter, histogram, has_tdc_distance = create_raw_data_analysis()
+        snapshots = [integrate_readout(interpreter, histogram, has_tdc_distance, readout, n_readout=n_readout, integrate_readouts=2, n_remaining_readouts=0) for n_readout, readout in enumerate(readouts, start=1)]
+        self.assertEqual([snapshot is None for snapshot in snapshots], [False, True] * 4)
+        self.assertTrue(all(isinstance(snapshot, dict) for snapshot in snapshots[::2]))
+        # integrations: 1, 2 - 3, 4 - 5, 6 - 7, last readout not completed
+        self.assertEqual(sum(snapshot['occupancy'].sum() for snapshot in snapshots[::2]), n_hits_without_last)  # histograms are reset between integrations and are copies
+        # integration of two readouts, all readouts in one batch: only the last completed integration is taken
+        interpreter, histogram, has_tdc_distance = create_raw_data_analysis()
+        snapshots = [integrate_readout(interpreter, histogram, has_tdc_distance, readout, n_readout=n_readout, integrate_readouts=2, n_remaining_readouts=len(readouts) - n_readout) for n_readout, readout in enumerate(readouts, start=1)]
+        self.assertEqual([snapshot is None for snapshot in snapshots], [True] * 6 + [False, True])
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestHistogramServer)
+    unittest.TextTestRunner(verbosity=2).run(suite)
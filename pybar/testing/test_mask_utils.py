@@ -0,0 +1,211 @@
+''' Script to check the pixel mask generation. The vectorized masks are compared to a pixel by pixel implementation.
+'''
+import unittest
+import itertools
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from pybar.fei4.mask_utils import make_pixel_mask, get_pixel_mask, clear_mask_cache, make_xtalk_mask, make_pixel_mask_from_col_row, get_mask_steps, get_scan_loop_selection, get_newly_masked_pixels, AdaptiveInjectionMask
+
+
+def make_pixel_mask_reference(steps, shift, default=0, value=1, enable_columns=None, mask=None):
+    # pixel by pixel implementation of make_pixel_mask()
+    mask_array = np.full((80, 336), default, dtype=np.uint8)
+    if enable_columns:
+        odd_columns = [odd - 1 for odd in enable_columns if odd % 2 != 0]
+        even_columns = [even - 1 for even in enable_columns if even % 2 == 0]
+    else:
+        odd_columns = range(0, 80, 2)
+        even_columns = range(1, 80, 2)
+    odd_rows = np.arange(shift % steps, 336, steps)
+    even_rows = np.arange(((steps // 2) + shift) % steps, 336, steps)
+    for column, row in itertools.product(odd_columns, odd_rows):
+        mask_array[column, row] = value
+    for column, row in itertools.product(even_columns, even_rows):
+        mask_array[column, row] = value
+    if mask is not None:
+        mask_array = np.ma.array(mask_array, mask=mask, fill_value=default).filled()
+    return mask_array
+
+
+def make_xtalk_mask_reference(mask):
+    # pixel by pixel implementation of make_xtalk_mask(), row - 1 of the first row is the last row
+    xtalk_mask = np.zeros((80, 336), dtype=np.uint8)
+    for column, row in zip(*np.nonzero(mask)):
+        if row + 1 < 336:
+            xtalk_mask[column, row + 1] = 1
+        xtalk_mask[column, (row - 1) % 336] = 1
+    return xtalk_mask
+
+
+class TestMaskUtils(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        np.random.seed(0)
+        cls.random_mask = np.random.randint(0, 2, size=(80, 336)).astype(bool)
+        cls.parameters = []  # steps, shift, default, value, enable_columns, mask
+        for steps, shift in [(3, 0), (3, 2), (3, 5), (6, 1), (336, 0), (336, 335), (672, 1), (672, 400)]:
+            for default, value in [(0, 1), (1, 0), (3, 7)]:
+                cls.parameters.append((steps, shift, default, value, None, None))
+        cls.parameters.append((3, 1, 0, 1, [1, 2, 3, 80], None))
+        cls.parameters.append((6, 4, 1, 0, [5, 6, 7], cls.random_mask))
+        cls.parameters.append((672, 10, 0, 1, None, cls.random_mask))
+
+    def setUp(self):
+        clear_mask_cache()
+
+    def test_make_pixel_mask(self):
+        for steps, shift, default, value, enable_columns, mask in self.parameters:
+            assert_array_equal(make_pixel_mask(steps, shift, default=default, value=value, enable_columns=enable_columns, mask=mask), make_pixel_mask_reference(steps, shift, default=default, value=value, enable_columns=enable_columns, mask=mask), err_msg='steps=%d, shift=%d, default=%d, value=%d' % (steps, shift, default, value))
+
+    def test_get_pixel_mask(self):
+        for steps, shift, default, value, enable_columns, mask in self.parameters:
+            mask_array = get_pixel_mask(steps, shift, default=default, value=value, enable_columns=enable_columns, mask=mask)
+            assert_array_equal(mask_array, make_pixel_mask_reference(steps, shift, default=default, value=value, enable_columns=enable_columns, mask=mask))
+            self.assertFalse(mask_array.flags.writeable)
+            self.assertIs(mask_array, get_pixel_mask(steps, shift, default=default, value=value, enable_columns=enable_columns, mask=mask))  # from cache
+        # different additional mask
+        self.assertFalse(np.array_equal(get_pixel_mask(3, 0, mask=self.random_mask), get_pixel_mask(3, 0, mask=~self.random_mask)))
+
+    def test_make_xtalk_mask(self):
+        for steps, shift in [(3, 0), (6, 1), (336, 0), (336, 335)]:
+            mask = make_pixel_mask_reference(steps, shift)
+            assert_array_equal(make_xtalk_mask(mask), make_xtalk_mask_reference(mask))
+        assert_array_equal(make_xtalk_mask(self.random_mask), make_xtalk_mask_reference(self.random_mask))
+        mask = make_pixel_mask_from_col_row([1, 80], [1, 336])
+        assert_array_equal(make_xtalk_mask(mask), make_xtalk_mask_reference(mask))
+
+    def test_get_mask_steps(self):
+        for steps in [1, 3, 6, 336, 672]:
+            mask_steps = get_mask_steps(steps)
+            for shift in range(steps):
+                assert_array_equal(mask_steps == shift, make_pixel_mask_reference(steps, shift).astype(bool), err_msg='steps=%d, shift=%d' % (steps, shift))
+
+    def test_get_scan_loop_selection(self):
+        self.assertEqual(get_scan_loop_selection(None, mask_steps=3), ([0, 1, 2], range(40)))
+        self.assertEqual(get_scan_loop_selection(np.ones((80, 336), dtype=bool), mask_steps=3), ([], []))
+        # analog injection: DC 0 injects column 1, DC 39 injects columns 78 to 80
+        mask = ~make_pixel_mask_from_col_row([1, 3, 79], [1, 1, 2]).astype(bool)
+        self.assertEqual(get_scan_loop_selection(mask, mask_steps=3), ([0, 1], [0, 1, 39]))
+        self.assertEqual(get_scan_loop_selection(mask, mask_steps=3, digital_injection=True), ([0, 1], [0, 1, 39]))
+        mask = ~make_pixel_mask_from_col_row([4, 5], [2, 2]).astype(bool)
+        self.assertEqual(get_scan_loop_selection(mask, mask_steps=3), ([0, 1], [2]))
+        self.assertEqual(get_scan_loop_selection(mask, mask_steps=3, digital_injection=True), ([0, 1], [1, 2]))
+        # selecting from given mask steps and DCs
+        self.assertEqual(get_scan_loop_selection(mask, mask_steps=3, enable_mask_steps=[2, 1], enable_double_columns=[2, 1, 0]), ([1], [2]))
+        self.assertEqual(get_scan_loop_selection(mask, mask_steps=3, enable_double_columns=[1]), ([], []))
+        # the selected mask steps and DCs inject all unmasked pixels
+        for steps in [3, 6, 336]:
+            selected_mask_steps, selected_double_columns = get_scan_loop_selection(self.random_mask, mask_steps=steps)
+            for mask_step in set(range(steps)) - set(selected_mask_steps):
+                self.assertFalse(np.any(make_pixel_mask(steps, mask_step, mask=self.random_mask)))
+            self.assertEqual(selected_double_columns, range(40))
+
+    def test_get_newly_masked_pixels(self):
+        mask = np.zeros((80, 336), dtype=bool)
+        mask[:, 1:] = True
+        selected = np.zeros((80, 336), dtype=bool)
+        selected[:10, :2] = True
+        assert_array_equal(get_newly_masked_pixels(mask, selected, min_pixels=10), np.logical_and(selected, ~mask))
+        self.assertFalse(np.any(get_newly_masked_pixels(mask, selected, min_pixels=11)))
+        # the remaining pixels are always masked
+        selected[:, 0] = True
+        assert_array_equal(get_newly_masked_pixels(mask, selected, min_pixels=100), ~mask)
+
+
+class TestAdaptiveInjectionMask(unittest.TestCase):
+
+    def setUp(self):
+        # S-curves with the transition at the threshold
+        np.random.seed(0)
+        self.initial_mask = np.zeros((80, 336), dtype=bool)
+        self.initial_mask[0, :] = True
+        self.thresholds = np.random.randint(10, 20, size=(80, 336))
+        self.scan_parameter_values = range(0, 30)
+
+    def get_occupancy(self, scan_parameter_value):
+        return np.where(scan_parameter_value >= self.thresholds, 100, 50)
+
+    def test_update(self):
+        injection_mask = AdaptiveInjectionMask(n_injections=100, saturated_steps=3, mask=self.initial_mask)
+        assert_array_equal(injection_mask.mask, self.initial_mask)
+        for scan_parameter_value in self.scan_parameter_values:
+            n_masked = injection_mask.update(self.get_occupancy(scan_parameter_value), scan_parameter_value)
+            masked = np.logical_and(np.logical_not(self.initial_mask), self.thresholds + 2 == scan_parameter_value)
+            self.assertEqual(n_masked, np.count_nonzero(masked))
+            assert_array_equal(injection_mask.mask, np.logical_or(self.initial_mask, self.thresholds + 2 <= scan_parameter_value))
+        self.assertTrue(injection_mask.is_complete())
+        assert_array_equal(injection_mask.masked_after[~self.initial_mask], (self.thresholds + 2)[~self.initial_mask])
+        self.assertTrue(np.all(np.isinf(injection_mask.masked_after[self.initial_mask])))
+        # saturated steps have to be consecutive
+        injection_mask.reset()
+        for scan_parameter_value, occupancy in enumerate([100, 100, 99, 100, 100]):
+            self.assertEqual(injection_mask.update(np.full((80, 336), occupancy), scan_parameter_value), 0)
+        self.assertFalse(np.any(injection_mask.adaptive_mask))
+        self.assertEqual(injection_mask.update(np.full((80, 336), 100), 5), 80 * 336 - 336)
+        self.assertTrue(injection_mask.is_complete())
+
+    def test_min_masked_pixels(self):
+        injection_mask = AdaptiveInjectionMask(n_injections=100, saturated_steps=1, min_masked_pixels=10)
+        occupancy = np.zeros((80, 336))
+        occupancy[0, :9] = 100
+        self.assertEqual(injection_mask.update(occupancy, 0), 0)  # collecting saturated pixels
+        occupancy[0, :20] = 100
+        self.assertEqual(injection_mask.update(occupancy, 1), 20)
+        self.assertTrue(np.all(injection_mask.masked_after[0, :20] == 1))
+        # remaining pixels are masked
+        occupancy[:] = 100
+        occupancy[:, 0] = 0
+        self.assertEqual(injection_mask.update(occupancy, 2), 80 * 336 - 20 - 79)
+        occupancy[:, 0] = 100
+        self.assertEqual(injection_mask.update(occupancy, 3), 79)
+        self.assertTrue(injection_mask.is_complete())
+
+    def test_stalled_pixels(self):
+        injection_mask = AdaptiveInjectionMask(n_injections=100, saturated_steps=1, max_stalled_pixels=2, stalled_steps=3)
+        occupancy = np.full((80, 336), 100)
+        occupancy[0, 0] = 0  # dead pixel
+        occupancy[0, 1] = 20  # inefficient pixel
+        self.assertEqual(injection_mask.update(occupancy, 0), 80 * 336 - 2)
+        self.assertFalse(injection_mask.is_complete())
+        for scan_parameter_value in range(1, 3):
+            occupancy[0, 1] = 20 - scan_parameter_value  # not exceeding the maximum occupancy
+            injection_mask.update(occupancy, scan_parameter_value)
+        assert_array_equal(np.nonzero(injection_mask.get_stalled_pixels()), [[0], [0]])
+        self.assertFalse(injection_mask.is_complete())
+        injection_mask.update(occupancy, 3)
+        assert_array_equal(np.nonzero(injection_mask.get_stalled_pixels()), [[0, 0], [0, 1]])
+        self.assertTrue(injection_mask.is_complete())
+        occupancy[0, 1] = 21  # new maximum occupancy
+        injection_mask.update(occupancy, 4)
+        assert_array_equal(np.nonzero(injection_mask.get_stalled_pixels()), [[0], [0]])
+        self.assertFalse(injection_mask.is_complete())
+        for scan_parameter_value in range(5, 8):
+            injection_mask.update(occupancy, scan_parameter_value)
+        self.assertTrue(injection_mask.is_complete())
+        # too many stalled pixels
+        injection_mask.max_stalled_pixels = 1
+        self.assertFalse(injection_mask.is_complete())
+
+    def test_fill_occupancy(self):
+        injection_mask = AdaptiveInjectionMask(n_injections=100, saturated_steps=3)
+        occupancy = np.zeros((80, 336, len(self.scan_parameter_values)), dtype=np.uint32)
+        for index, scan_parameter_value in enumerate(self.scan_parameter_values):
+            occupancy[:, :, index] = np.where(injection_mask.mask, 0, self.get_occupancy(scan_parameter_value))  # masked pixels are not injected
+            injection_mask.update(occupancy[:, :, index], scan_parameter_value)
+        fill_mask = injection_mask.get_fill_mask(self.scan_parameter_values)
+        self.assertEqual(fill_mask.shape, (80, 336, len(self.scan_parameter_values)))
+        assert_array_equal(fill_mask, np.less.outer(self.thresholds + 2, self.scan_parameter_values))
+        expected_occupancy = np.dstack([self.get_occupancy(scan_parameter_value) for scan_parameter_value in self.scan_parameter_values])
+        assert_array_equal(injection_mask.fill_occupancy(occupancy, self.scan_parameter_values), expected_occupancy)
+        self.assertFalse(np.array_equal(occupancy, expected_occupancy))  # not modified
+        # single scan parameter value
+        assert_array_equal(injection_mask.fill_occupancy(occupancy[:, :, 25], 25), expected_occupancy[:, :, 25])
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestMaskUtils)
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestAdaptiveInjectionMask))
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,98 @@
+''' Script to check the online histogramming of the pixel occupancy (see fifo_readout.OccupancyHistogram) with generated raw data.
+'''
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from pybar.daq.fifo_readout import OccupancyHistogram
+
+
+def data_record(col, row, tot1=0, tot2=0xF):
+    ''' FE data record, the second hit (row + 1) is added if tot2 is not 15.
+    '''
+    return (col << 17) | (row << 8) | (tot1 << 4) | tot2
+
+
+class TestOccupancyHistogram(unittest.TestCase):
+
+    def setUp(self):
+        self.histogram = OccupancyHistogram()
+
+    def test_fill(self):
+        data = np.array([data_record(1, 1), data_record(80, 336), data_record(5, 10, tot2=3), data_record(5, 10)], dtype=np.uint32)
+        self.histogram.fill(data, scan_parameter_value=1)
+        expected = np.zeros((80, 336), dtype=np.uint32)
+        expected[0, 0] = 1
+        expected[79, 335] = 1
+        expected[4, 9] = 2
+        expected[4, 10] = 1
+        assert_array_equal(self.histogram.get_occupancy(1), expected)
+        self.assertEqual(self.histogram.get_occupancy(1).dtype, np.uint32)
+        self.histogram.fill(data, scan_parameter_value=1)
+        assert_array_equal(self.histogram.get_occupancy(1), 2 * expected)
+        assert_array_equal(self.histogram.get_occupancy(2), np.zeros((80, 336), dtype=np.uint32))  # no data
+        self.assertEqual(self.histogram.get_scan_parameter_values(), [1])
+
+    def test_fill_out_of_range(self):
+        data = np.array([
+            data_record(10, 336, tot2=2),  # second hit in row 337
+            data_record(81, 1),  # column out of range
+            data_record(1, 337),  # row out of range
+            data_record(0, 1),
+            0x40000000 | data_record(2, 2),  # TDC word
+            0x80000000 | data_record(3, 3),  # trigger word
+            0x00E90000,  # data header
+            0x00EF0000],  # service record
+            dtype=np.uint32)
+        self.histogram.fill(data)
+        occupancy = self.histogram.get_occupancy()
+        self.assertEqual(occupancy.sum(), 1)
+        self.assertEqual(occupancy[9, 335], 1)
+        self.histogram.fill(np.array([], dtype=np.uint32))
+        self.assertEqual(self.histogram.get_occupancy().sum(), 1)
+
+    def test_set_scan_parameter_value(self):
+        handled = []
+        histogram = OccupancyHistogram(callback=handled.append)
+        data_tuple = (np.array([data_record(1, 1)], dtype=np.uint32), 0.0, 0.0, 0)
+        histogram.set_scan_parameter_value(10)
+        histogram(data_tuple)
+        histogram(data_tuple)
+        self.assertEqual(handled, [data_tuple] * 2)
+        self.assertEqual(histogram.get_occupancy(10)[0, 0], 2)
+        # scan parameter value is scanned again
+        histogram.set_scan_parameter_value(10, clear=True)
+        self.assertEqual(histogram.get_occupancy(10)[0, 0], 0)
+        self.assertEqual(histogram.get_scan_parameter_values(), [])
+        histogram(data_tuple)
+        histogram.set_scan_parameter_value(20)
+        histogram(data_tuple)
+        histogram.set_scan_parameter_value(10, clear=False)
+        histogram(data_tuple)
+        self.assertEqual(histogram.get_occupancy(10)[0, 0], 2)
+        self.assertEqual(histogram.get_occupancy(20)[0, 0], 1)
+        histogram.reset()
+        self.assertIsNone(histogram.scan_parameter_value)
+        self.assertEqual(histogram.get_scan_parameter_values(), [])
+
+    def test_get_scurves(self):
+        for scan_parameter_value in [30, 10, 20]:
+            self.histogram.fill(np.array([data_record(2, 3)] * scan_parameter_value, dtype=np.uint32), scan_parameter_value=scan_parameter_value)
+        scan_parameter_values, scurves = self.histogram.get_scurves()
+        self.assertEqual(scan_parameter_values, [10, 20, 30])  # ascending order
+        self.assertEqual(scurves.shape, (80, 336, 3))
+        assert_array_equal(scurves[1, 2], [10, 20, 30])
+        self.assertEqual(scurves.sum(), 60)
+        # given order, missing scan parameter values have zero occupancy
+        scan_parameter_values, scurves = self.histogram.get_scurves([30, 10, 40])
+        self.assertEqual(scan_parameter_values, [30, 10, 40])
+        assert_array_equal(scurves[1, 2], [30, 10, 0])
+        scan_parameter_values, scurves = OccupancyHistogram().get_scurves()
+        self.assertEqual(scan_parameter_values, [])
+        self.assertEqual(scurves.shape, (80, 336, 0))
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestOccupancyHistogram)
+    unittest.TextTestRunner(verbosity=2).run(suite)
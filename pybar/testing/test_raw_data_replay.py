@@ -0,0 +1,85 @@
+''' Script to check the replay of raw data files. The replayed readouts are compared to the raw data and meta data of the file.
+'''
+import os
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+import tables as tb
+
+from pybar.daq.raw_data_replay import read_raw_data_file, replay_raw_data_file
+
+tests_data_folder = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_analysis_data')
+
+
+class PublisherDummy(object):
+    ''' Replacement of the DataPublisher, recording the sent readouts.
+    '''
+    def __init__(self):
+        self.sent = []
+
+    def send_data(self, data, scan_parameters=None):
+        self.sent.append((data, scan_parameters))
+
+
+def read_file(filename):
+    with tb.open_file(filename, mode='r') as in_file_h5:
+        raw_data = in_file_h5.root.raw_data[:]
+        meta_data = in_file_h5.root.meta_data[:]
+        try:
+            scan_parameters = in_file_h5.root.scan_parameters[:]
+        except tb.NoSuchNodeError:
+            scan_parameters = None
+    return raw_data, meta_data, scan_parameters
+
+
+class TestRawDataReplay(unittest.TestCase):
+
+    def assert_readouts_equal(self, readouts, filename):
+        raw_data, meta_data, scan_parameters = read_file(filename)
+        self.assertEqual(len(readouts), meta_data.shape[0])
+        for index, ((data, timestamp_start, timestamp_stop, error), readout_scan_parameters) in enumerate(readouts):
+            assert_array_equal(data, raw_data[meta_data['index_start'][index]:meta_data['index_stop'][index]])
+            self.assertEqual(timestamp_start, meta_data['timestamp_start'][index])
+            self.assertEqual(timestamp_stop, meta_data['timestamp_stop'][index])
+            self.assertEqual(error, meta_data['error'][index])
+            if scan_parameters is None:
+                self.assertIsNone(readout_scan_parameters)
+            else:
+                self.assertEqual(readout_scan_parameters, dict((name, scan_parameters[index][name]) for name in scan_parameters.dtype.names))
+
+    def test_read_raw_data_file(self):
+        for filename in ['unit_test_data_5.h5', 'unit_test_data_4.h5']:
+            filename = os.path.join(tests_data_folder, filename)
+            n_readouts = read_file(filename)[1].shape[0]
+            # chunk boundaries inside, at the end and beyond the end of the meta data
+            for chunk_size in [1, 2, 4, n_readouts - 1, n_readouts, 10000]:
+                self.assert_readouts_equal(list(read_raw_data_file(filename, chunk_size=chunk_size)), filename)
+
+    def test_replay_raw_data_file(self):
+        filename = os.path.join(tests_data_folder, 'unit_test_data_4.h5')
+        raw_data, meta_data, _ = read_file(filename)
+        publisher = PublisherDummy()
+        throughput = replay_raw_data_file(filename, publisher, speed=0, chunk_size=2, progress_bar=False)
+        self.assert_readouts_equal(publisher.sent, filename)
+        self.assertEqual(throughput['n_readouts'], meta_data.shape[0])
+        self.assertEqual(throughput['n_words'], np.sum(meta_data['index_stop'] - meta_data['index_start']))
+        self.assertLess(throughput['duration'], meta_data['timestamp_stop'][-1] - meta_data['timestamp_stop'][0])  # as fast as possible
+        self.assertAlmostEqual(throughput['word_rate'], throughput['n_words'] / throughput['duration'])
+        self.assertAlmostEqual(throughput['readout_rate'], throughput['n_readouts'] / throughput['duration'])
+        self.assertAlmostEqual(throughput['byte_rate'], 4 * throughput['word_rate'])
+
+    def test_replay_speed(self):
+        filename = os.path.join(tests_data_folder, 'unit_test_data_5.h5')
+        meta_data = read_file(filename)[1]
+        data_taking_duration = meta_data['timestamp_stop'][-1] - meta_data['timestamp_stop'][0]
+        publisher = PublisherDummy()
+        throughput = replay_raw_data_file(filename, publisher, speed=10.0, progress_bar=False)
+        self.assert_readouts_equal(publisher.sent, filename)
+        self.assertGreaterEqual(throughput['duration'], data_taking_duration / 10.0)  # scaled timing
+        self.assertLess(throughput['duration'], data_taking_duration)
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestRawDataReplay)
+    unittest.TextTestRunner(verbosity=2).run(suite)
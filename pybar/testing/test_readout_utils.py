@@ -0,0 +1,94 @@
+''' Script to check the event index (CSR-style offsets) of the raw data. The events are compared to the events from splitting the raw data.
+'''
+import os
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+import tables as tb
+
+from pybar.daq.readout_utils import build_events_from_raw_data, build_event_index_from_raw_data, get_event_sizes, get_event_numbers, reduce_events, is_trigger_word, is_data_record, is_fe_word, logical_and
+
+tests_data_folder = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_analysis_data')
+
+
+def trigger_word(trigger_number):
+    return 0x80000000 | trigger_number
+
+
+class TestEventIndex(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_5.h5'), mode="r") as in_file_h5:
+            cls.raw_data = in_file_h5.root.raw_data[:]
+
+    def assert_events_equal(self, array, offsets, events):
+        self.assertEqual(offsets.shape[0], len(events) + 1)
+        self.assertEqual(offsets[0], 0)
+        self.assertEqual(offsets[-1], array.shape[0])
+        for index, event in enumerate(events):
+            assert_array_equal(array[offsets[index]:offsets[index + 1]], event)
+
+    def test_empty_data(self):
+        array = np.array([], dtype=np.uint32)
+        offsets = build_event_index_from_raw_data(array)
+        assert_array_equal(offsets, [0])
+        self.assertEqual(get_event_sizes(offsets).shape[0], 0)
+        self.assertEqual(get_event_numbers(offsets).shape[0], 0)
+        self.assertEqual(reduce_events(array, offsets).shape[0], 0)
+        self.assertEqual(len(build_events_from_raw_data(array)), 1)  # unchanged, single empty event
+
+    def test_no_trigger_words(self):
+        array = np.array([1, 2, 3], dtype=np.uint32)
+        offsets = build_event_index_from_raw_data(array)
+        assert_array_equal(offsets, [0, 3])
+        assert_array_equal(get_event_sizes(offsets), [3])
+        assert_array_equal(get_event_numbers(offsets), [0, 0, 0])
+        assert_array_equal(reduce_events(array, offsets), [6])
+        self.assert_events_equal(array, offsets, build_events_from_raw_data(array))
+
+    def test_data_before_first_trigger(self):
+        array = np.array([1, 2, trigger_word(0), 3, trigger_word(1), trigger_word(2), 4, 5], dtype=np.uint32)
+        offsets = build_event_index_from_raw_data(array)
+        assert_array_equal(offsets, [0, 2, 4, 5, 8])
+        assert_array_equal(get_event_sizes(offsets), [2, 2, 1, 3])
+        assert_array_equal(get_event_numbers(offsets), [0, 0, 1, 1, 2, 3, 3, 3])
+        assert_array_equal(reduce_events(is_trigger_word(array), offsets, np.logical_or), [False, True, True, True])
+        self.assert_events_equal(array, offsets, build_events_from_raw_data(array))
+
+    def test_trigger_at_start(self):
+        array = np.array([trigger_word(0), 3, trigger_word(1), 4, 5], dtype=np.uint32)
+        offsets = build_event_index_from_raw_data(array)
+        assert_array_equal(offsets, [0, 2, 5])
+        self.assert_events_equal(array, offsets, [[trigger_word(0), 3], [trigger_word(1), 4, 5]])
+        # events from splitting the raw data start with an empty event
+        events = build_events_from_raw_data(array)
+        self.assertEqual(events[0].shape[0], 0)
+        self.assert_events_equal(array, offsets, events[1:])
+
+    def test_reduce_events(self):
+        values = np.array([1, 2, 3, 4, 5, 6])
+        offsets = np.array([0, 2, 2, 5, 5, 6])  # empty events
+        assert_array_equal(reduce_events(values, offsets, np.add), [3, 0, 12, 0, 6])
+        assert_array_equal(reduce_events(values, offsets, np.maximum, empty_value=-1), [2, -1, 5, -1, 6])
+        # offsets of a part of the values
+        assert_array_equal(reduce_events(values, np.array([1, 3, 3, 4]), np.add), [5, 0, 4])
+        assert_array_equal(reduce_events(values, np.array([2, 2, 2]), np.add, empty_value=7), [7, 7])
+
+    def test_raw_data(self):
+        offsets = build_event_index_from_raw_data(self.raw_data)
+        events = build_events_from_raw_data(self.raw_data)
+        self.assertGreater(offsets.shape[0], 2)
+        if events[0].shape[0] == 0:
+            events = events[1:]
+        self.assert_events_equal(self.raw_data, offsets, events)
+        # number of data records of each event
+        n_data_records = reduce_events(logical_and(is_fe_word, is_data_record)(self.raw_data), offsets, np.add)
+        assert_array_equal(n_data_records, [np.count_nonzero(logical_and(is_fe_word, is_data_record)(event)) for event in events])
+        assert_array_equal(np.bincount(get_event_numbers(offsets), minlength=len(events)), [event.shape[0] for event in events])
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestEventIndex)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,132 @@
+''' Script to check the configuration cache for text configurations (compiled configurations in memory and on disk).
+'''
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+import pybar
+from pybar.fei4 import register
+from pybar.fei4.register import FEI4Register, write_pixel_dac_config, write_pixel_mask_config
+
+std_cfg = os.path.join(os.path.dirname(pybar.__file__), 'config', 'fei4', 'configs', 'std_cfg_fei4b.cfg')
+
+
+class TestConfigurationCache(unittest.TestCase):
+
+    def setUp(self):
+        self.configuration_folder = tempfile.mkdtemp()
+        self.cache_folder = os.path.join(self.configuration_folder, 'cache')
+        os.makedirs(os.path.join(self.configuration_folder, 'tdacs'))
+        os.makedirs(os.path.join(self.configuration_folder, 'masks'))
+        self.tdac = np.random.RandomState(0).randint(0, 32, size=(80, 336)).astype(np.uint8)
+        self.enable = np.random.RandomState(1).randint(0, 2, size=(80, 336)).astype(np.uint8)
+        write_pixel_dac_config(os.path.join(self.configuration_folder, 'tdacs', 'tdac.dat'), self.tdac)
+        write_pixel_mask_config(os.path.join(self.configuration_folder, 'masks', 'enable.dat'), self.enable)
+        self.configuration_file = self.write_configuration(os.path.join(self.configuration_folder, 'fei4b.cfg'))
+        # counting the hashed files
+        self.hashed_files = []
+        self.get_file_hash = register.get_file_hash
+
+        def get_file_hash(filename):
+            self.hashed_files.append(filename)
+            return self.get_file_hash(filename)
+        register.get_file_hash = get_file_hash
+        register._configuration_cache.clear()
+
+    def tearDown(self):
+        register.get_file_hash = self.get_file_hash
+        register._configuration_cache.clear()
+        register.set_configuration_cache_dir(None)
+        shutil.rmtree(self.configuration_folder)
+
+    def write_configuration(self, filename, trig_count=0):
+        with open(std_cfg, 'r') as f:
+            configuration = f.read()
+        configuration = re.sub(r'^TDAC .*$', 'TDAC tdacs/tdac.dat', configuration, flags=re.M)
+        configuration = re.sub(r'^Enable .*$', 'Enable masks/enable.dat', configuration, flags=re.M)
+        configuration = re.sub(r'^Trig_Count .*$', 'Trig_Count %d' % trig_count, configuration, flags=re.M)
+        with open(filename, 'w') as f:
+            f.write(configuration)
+        return filename
+
+    def touch(self, filename, offset=10.0):
+        stat = os.stat(filename)
+        os.utime(filename, (stat.st_atime, stat.st_mtime + offset))
+
+    def test_cache_hit(self):
+        self.assertIsNone(register.get_compiled_configuration(self.configuration_file))
+        fe_register = FEI4Register(configuration_file=self.configuration_file)
+        self.assertEqual(len(self.hashed_files), 2)  # dependencies of the compiled configuration
+        del self.hashed_files[:]
+        config_dict, pixel_registers = register.get_compiled_configuration(self.configuration_file)
+        self.assertEqual(sorted(pixel_registers.keys()), ['Enable', 'TDAC'])
+        assert_array_equal(pixel_registers['TDAC'], self.tdac)
+        assert_array_equal(pixel_registers['Enable'], self.enable)
+        self.assertEqual(config_dict['Trig_Count'], 0)
+        cached_fe_register = FEI4Register(configuration_file=self.configuration_file)
+        self.assertEqual(self.hashed_files, [])  # pixel configuration files are not hashed if unchanged
+        for name in ['TDAC', 'Enable', 'FDAC', 'C_High']:
+            assert_array_equal(cached_fe_register.get_pixel_register_value(name), fe_register.get_pixel_register_value(name))
+        self.assertEqual(cached_fe_register.get_global_register_value('Trig_Lat'), fe_register.get_global_register_value('Trig_Lat'))
+        # modified time stamp, unchanged content
+        self.touch(os.path.join(self.configuration_folder, 'tdacs', 'tdac.dat'))
+        self.assertIsNotNone(register.get_compiled_configuration(self.configuration_file))
+        self.assertEqual(self.hashed_files, [os.path.join(self.configuration_folder, 'tdacs', 'tdac.dat')])
+
+    def test_invalidation(self):
+        FEI4Register(configuration_file=self.configuration_file)
+        self.tdac[0, 0] = 31 - self.tdac[0, 0]
+        tdac_file = os.path.join(self.configuration_folder, 'tdacs', 'tdac.dat')
+        write_pixel_dac_config(tdac_file, self.tdac)
+        self.touch(tdac_file)  # same size, ensure different time stamp
+        self.assertIsNone(register.get_compiled_configuration(self.configuration_file))
+        fe_register = FEI4Register(configuration_file=self.configuration_file)
+        assert_array_equal(fe_register.get_pixel_register_value('TDAC'), self.tdac)
+        assert_array_equal(register.get_compiled_configuration(self.configuration_file)[1]['TDAC'], self.tdac)
+        # modified configuration file
+        self.write_configuration(self.configuration_file, trig_count=5)
+        self.assertIsNone(register.get_compiled_configuration(self.configuration_file))
+        self.assertEqual(FEI4Register(configuration_file=self.configuration_file).get_global_register_value('Trig_Count'), 5)
+
+    def test_missing_dependency(self):
+        FEI4Register(configuration_file=self.configuration_file)
+        os.remove(os.path.join(self.configuration_folder, 'masks', 'enable.dat'))
+        self.assertIsNone(register.get_compiled_configuration(self.configuration_file))
+        with self.assertRaises(IOError):
+            FEI4Register(configuration_file=self.configuration_file)
+
+    def test_disk_cache(self):
+        register.set_configuration_cache_dir(self.cache_folder, size=2)
+        FEI4Register(configuration_file=self.configuration_file)
+        self.assertEqual(len(os.listdir(self.cache_folder)), 1)
+        register._configuration_cache.clear()
+        del self.hashed_files[:]
+        config_dict, pixel_registers = register.get_compiled_configuration(self.configuration_file)
+        self.assertEqual(self.hashed_files, [])
+        assert_array_equal(pixel_registers['TDAC'], self.tdac)
+        self.assertEqual(config_dict['Trig_Count'], 0)
+
+    def test_disk_cache_pruning(self):
+        register.set_configuration_cache_dir(self.cache_folder, size=2)
+        configuration_files = [self.write_configuration(os.path.join(self.configuration_folder, 'fei4b_%d.cfg' % index), trig_count=index) for index in range(3)]
+        cache_files = []
+        for index, configuration_file in enumerate(configuration_files):
+            FEI4Register(configuration_file=configuration_file)
+            cache_files.append(os.path.join(self.cache_folder, register.get_configuration_cache_key(configuration_file) + '.npz'))
+            self.touch(cache_files[-1], offset=index - 10.0)  # distinct age
+        self.assertEqual(sorted(os.listdir(self.cache_folder)), sorted(os.path.basename(cache_file) for cache_file in cache_files[1:]))  # least recently used removed
+        register._configuration_cache.clear()
+        self.assertIsNone(register.get_compiled_configuration(configuration_files[0]))
+        self.assertIsNotNone(register.get_compiled_configuration(configuration_files[1]))
+        with self.assertRaises(ValueError):
+            register.set_configuration_cache_dir(self.cache_folder, size=0)
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestConfigurationCache)
+    unittest.TextTestRunner(verbosity=2).run(suite)
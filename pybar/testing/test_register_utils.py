@@ -0,0 +1,205 @@
+''' Script to check the compiled scan loop commands and the asynchronous command queue. The commands are checked against freshly generated commands without a FE-I4 or readout hardware.
+'''
+import unittest
+from threading import Event
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from pybar.fei4.register import FEI4Register
+from pybar.fei4.register_utils import FEI4RegisterUtils, ScanLoopProgram, CmdTimeoutError
+from pybar.utils.utils import bitarray_to_array
+
+
+class CmdDummy(object):
+    ''' Replacement of the CMD interface, recording the command memory data.
+    '''
+    name = 'CMD'
+
+    def __init__(self):
+        self.registers = {'CMD_SIZE': 0, 'CMD_REPEAT': 1, 'START_SEQUENCE_LENGTH': 0, 'STOP_SEQUENCE_LENGTH': 0, 'READY': 1}
+        self.data = []
+        self.started = []
+
+    def __getitem__(self, name):
+        if name == 'START':
+            self.started.append((self.registers['CMD_SIZE'], self.registers['CMD_REPEAT'], self.registers['START_SEQUENCE_LENGTH']))
+            return
+        return self.registers[name]
+
+    def __setitem__(self, name, value):
+        self.registers[name] = value
+
+    def set_data(self, data, addr=0):
+        self.data.append((np.array(data), addr))
+
+    def wait_for_ready(self, timeout=None, times=None, delay=None, abort=None):
+        return self.registers['READY'] == 1
+
+
+class TestScanLoopProgram(unittest.TestCase):
+
+    def setUp(self):
+        self.register = FEI4Register(fe_type='fei4b', chip_address=0)
+        self.dut = {'CMD': CmdDummy()}
+        self.register_utils = FEI4RegisterUtils(self.dut, self.register)
+
+    def generate_commands(self):
+        # similar to the commands of a digital injection mask step
+        commands = []
+        commands.extend(self.register.get_commands("ConfMode"))
+        self.register.set_global_register_value("DIGHITIN_SEL", 1)
+        commands.extend(self.register.get_commands("WrRegister", name=["DIGHITIN_SEL"]))
+        commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, name=["Enable", "EnableDigInj"]))
+        self.register.set_global_register_value("DIGHITIN_SEL", 0)
+        commands.extend(self.register.get_commands("WrRegister", name=["DIGHITIN_SEL", "Vthin_AltFine"]))
+        commands.extend(self.register.get_commands("RunMode"))
+        return commands
+
+    def test_compile_commands(self):
+        # compiled commands are split in the same way as FEI4RegisterUtils.send_commands()
+        for byte_padding in [False, True]:
+            self.dut['CMD'].data = []
+            commands = self.generate_commands()
+            self.register_utils.send_commands(commands, byte_padding=byte_padding)
+            compiled_commands, _ = ScanLoopProgram(self.register, self.register_utils).compile_commands(commands, byte_padding=byte_padding)
+            self.assertGreater(len(compiled_commands), 1)
+            self.assertEqual(len(compiled_commands), len(self.dut['CMD'].data))
+            for compiled_command, (data, _) in zip(compiled_commands, self.dut['CMD'].data):
+                assert_array_equal(bitarray_to_array(compiled_command), data)
+
+    def test_patch_commands(self):
+        def generate_not_allowed():
+            raise AssertionError('Commands must not be generated again')
+
+        program = ScanLoopProgram(self.register, self.register_utils)
+        self.register.set_global_register_value("PlsrDAC", 100)
+        self.register.set_global_register_value("Vthin_AltFine", 10)
+        commands = [command.copy() for command in program.get_commands(key='mask', generate=self.generate_commands)]
+        self.assertEqual(commands, ScanLoopProgram(self.register, self.register_utils).compile_commands(self.generate_commands())[0])
+        # PlsrDAC shares the address with DIGHITIN_SEL, Vthin_AltFine is written directly
+        for plsr_dac, vthin_alt_fine in [(200, 10), (1023, 255), (0, 0), (100, 10)]:
+            self.register.set_global_register_value("PlsrDAC", plsr_dac)
+            self.register.set_global_register_value("Vthin_AltFine", vthin_alt_fine)
+            patched_commands = [command.copy() for command in program.get_commands(key='mask', generate=generate_not_allowed)]
+            self.assertEqual(patched_commands, ScanLoopProgram(self.register, self.register_utils).compile_commands(self.generate_commands())[0])
+            if plsr_dac != 100:
+                self.assertNotEqual(patched_commands, commands)
+        self.assertEqual(patched_commands, commands)
+
+    def test_get_key(self):
+        key = ScanLoopProgram.get_key(self.register, mask_steps=3, enable_mask_steps=[0, 1], mask=np.ones((80, 336), dtype=bool))
+        self.assertEqual(key, ScanLoopProgram.get_key(self.register, enable_mask_steps=[0, 1], mask_steps=3, mask=np.ones((80, 336), dtype=bool)))
+        self.assertNotEqual(key, ScanLoopProgram.get_key(self.register, mask_steps=3, enable_mask_steps=[0, 1], mask=np.zeros((80, 336), dtype=bool)))
+        self.register.set_global_register_value("PlsrDAC", 500)  # patched, not part of the key
+        self.assertEqual(key, ScanLoopProgram.get_key(self.register, mask_steps=3, enable_mask_steps=[0, 1], mask=np.ones((80, 336), dtype=bool)))
+        self.register.set_global_register_value("DIGHITIN_SEL", 1)  # modified by the scan loop
+        self.assertNotEqual(key, ScanLoopProgram.get_key(self.register, mask_steps=3, enable_mask_steps=[0, 1], mask=np.ones((80, 336), dtype=bool)))
+
+    def test_get_scan_loop_program(self):
+        programs = [self.register_utils.get_scan_loop_program(key) for key in range(self.register_utils.max_scan_loop_programs)]
+        self.assertIs(programs[0], self.register_utils.get_scan_loop_program(0))  # 0 is now the most recently used program
+        self.register_utils.get_scan_loop_program('new')
+        self.assertEqual(len(self.register_utils.scan_loop_programs), self.register_utils.max_scan_loop_programs)
+        self.assertNotIn(1, self.register_utils.scan_loop_programs)  # least recently used program removed
+        self.assertIs(programs[0], self.register_utils.get_scan_loop_program(0))
+
+
+class TestCommandQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.register = FEI4Register(fe_type='fei4b', chip_address=0)
+        self.dut = {'CMD': CmdDummy()}
+        self.register_utils = FEI4RegisterUtils(self.dut, self.register, abort=Event())
+
+    def test_put(self):
+        commands = self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, name=["Enable"])[:10]
+        with self.register_utils.command_queue() as command_queue:
+            finished = [command_queue.put(command=command, repeat=index + 1) for index, command in enumerate(commands)]
+            command_queue.join()
+            self.assertTrue(all(event.is_set() for event in finished))
+        self.assertFalse(command_queue.is_running)
+        # same order and content as sending the commands one by one
+        self.assertEqual(len(self.dut['CMD'].data), len(commands))
+        for index, (command, (data, addr)) in enumerate(zip(commands, self.dut['CMD'].data)):
+            assert_array_equal(bitarray_to_array(command), data)
+            self.assertEqual(addr, 0)
+            self.assertEqual(self.dut['CMD'].started[index][:2], (command.length(), index + 1))
+
+    def test_put_partial(self):
+        dc_address_command = self.register.get_commands("WrRegister", name=["Colpr_Addr"])[0]
+        scan_loop_command = self.register.get_commands("CAL")[0]
+        with self.register_utils.command_queue() as command_queue:
+            command_queue.put(command=self.register_utils.concatenate_commands((dc_address_command, scan_loop_command)), repeat=100, start_sequence_length=dc_address_command.length())
+            command_queue.put(command=dc_address_command, repeat=None, set_length=False)
+            command_queue.join()
+        self.assertEqual(self.dut['CMD'].started, [(dc_address_command.length() + 1 + scan_loop_command.length(), 100, dc_address_command.length())] * 2)
+
+    def test_exception(self):
+        commands = self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, name=["Enable"])[:5]
+        self.dut['CMD']['READY'] = 0  # timeout
+        with self.assertRaises(CmdTimeoutError):
+            with self.register_utils.command_queue() as command_queue:
+                for command in commands:
+                    command_queue.put(command=command)
+                command_queue.join()
+        self.assertFalse(command_queue.is_running)
+        self.assertLess(len(self.dut['CMD'].data), len(commands))  # remaining commands skipped
+        # queue can be restarted after an error
+        self.dut['CMD']['READY'] = 1
+        self.dut['CMD'].data = []
+        with self.register_utils.command_queue() as command_queue:
+            command_queue.put(command=commands[0])
+            command_queue.join()
+        self.assertEqual(len(self.dut['CMD'].data), 1)
+
+    def test_exception_queued_command(self):
+        commands = self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, name=["Enable"])[:3]
+        uploading = Event()
+        release = Event()
+
+        def set_data(data, addr=0):
+            uploading.set()
+            release.wait()
+            raise ValueError('upload failed')
+        self.dut['CMD'].set_data = set_data
+        command_queue = self.register_utils.command_queue()
+        command_queue.start()
+        command_queue.put(command=commands[0])
+        self.assertTrue(uploading.wait(5.0))
+        # worker thread is busy with the first command, the following commands are still queued
+        finished = [command_queue.put(command=command) for command in commands[1:]]
+        release.set()
+        with self.assertRaises(ValueError):
+            command_queue.join()
+        # the error is kept until start(), no further command is accepted
+        with self.assertRaises(ValueError):
+            command_queue.put(command=commands[0])
+        command_queue.stop(raise_exception=False)
+        self.assertFalse(command_queue.is_running)
+        self.assertTrue(all(event.is_set() for event in finished))
+        self.assertEqual(self.dut['CMD'].started, [])  # queued commands skipped
+        del self.dut['CMD'].set_data
+        command_queue.start()
+        command_queue.put(command=commands[0])
+        command_queue.join()
+        command_queue.stop()
+        self.assertEqual(len(self.dut['CMD'].started), 1)
+
+    def test_start_stop(self):
+        command_queue = self.register_utils.command_queue()
+        with self.assertRaises(RuntimeError):
+            command_queue.put(command=self.register.get_commands("CAL")[0])
+        command_queue.start()
+        with self.assertRaises(RuntimeError):
+            command_queue.start()
+        command_queue.join()  # nothing to wait for
+        command_queue.stop()
+        command_queue.stop()
+        self.assertFalse(command_queue.is_running)
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestScanLoopProgram)
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestCommandQueue))
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,141 @@
+''' Script to check the run database (SQLite) and its use in forked processes (background analysis).
+'''
+import os
+import shutil
+import tempfile
+import datetime
+import multiprocessing
+import unittest
+
+from pybar.run_database import RunDatabase
+from pybar.run_manager import RunBase
+
+
+class DummyRun(RunBase):
+    _default_run_conf = {}
+
+    def pre_run(self):
+        pass
+
+    def do_run(self):
+        pass
+
+    def post_run(self):
+        pass
+
+    def cleanup_run(self):
+        pass
+
+
+def set_configuration_file_in_forked_process(run, run_number, configuration_file):
+    run.run_database.set_configuration_file(run_number, configuration_file)
+    run._close_run_database()
+
+
+class TestRunDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.working_dir, 'run.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+
+    def test_add_run(self):
+        run_database = RunDatabase(self.filename)
+        start_time = datetime.datetime(2017, 1, 1, 12, 0, 0)
+        self.assertEqual(run_database.add_run(run_class='AnalogScan', status='RUNNING', start_time=start_time), 1)
+        self.assertEqual(run_database.add_run(run_class='DigitalScan', status='RUNNING', start_time=start_time), 2)
+        self.assertEqual(run_database.add_run(run_class='ThresholdScan', status='RUNNING', start_time=start_time, run_number=10), 10)
+        self.assertEqual(run_database.add_run(run_class='ThresholdScan', status='RUNNING', start_time=start_time), 11)
+        self.assertEqual(run_database.add_run(run_class='FdacTuning', status='RUNNING', start_time=start_time, run_number=2), 2)  # replacing existing run
+        runs = run_database.get_runs()
+        self.assertEqual([run['run_number'] for run in runs], [11, 10, 2, 1])
+        self.assertEqual(runs[2]['run_class'], 'FdacTuning')
+        self.assertEqual(runs[2]['start_time'], str(start_time))
+        self.assertIsNone(runs[2]['stop_time'])
+        run_database.close()
+        # runs are stored
+        run_database = RunDatabase(self.filename)
+        self.assertEqual(run_database.get_run_numbers(), [11, 10, 2, 1])
+        run_database.close()
+
+    def test_set_run_status(self):
+        run_database = RunDatabase(self.filename)
+        start_time = datetime.datetime(2017, 1, 1, 12, 0, 0)
+        stop_time = datetime.datetime(2017, 1, 1, 12, 1, 0)
+        run_number = run_database.add_run(run_class='AnalogScan', status='RUNNING', start_time=start_time)
+        run_database.set_run_status(run_number, status='FINISHED', stop_time=stop_time, total_time=stop_time - start_time)
+        run = run_database.get_runs()[0]
+        self.assertEqual((run['run_number'], run['run_class'], run['status'], run['start_time'], run['stop_time'], run['total_time']), (1, 'AnalogScan', 'FINISHED', str(start_time), str(stop_time), '0:01:00'))
+        # run is added if not existing
+        run_database.set_run_status(5, status='CRASHED', stop_time=stop_time, total_time=stop_time - start_time, run_class='DigitalScan')
+        run = run_database.get_runs(status='CRASHED')[0]
+        self.assertEqual((run['run_number'], run['run_class'], run['status'], run['start_time']), (5, 'DigitalScan', 'CRASHED', None))
+        run_database.close()
+
+    def test_update_run_status(self):
+        run_database = RunDatabase(self.filename)
+        start_time = datetime.datetime(2017, 1, 1, 12, 0, 0)
+        stop_time = datetime.datetime(2017, 1, 1, 12, 1, 0)
+        run_number = run_database.add_run(run_class='AnalogScan', status='RUNNING', start_time=start_time)
+        run_database.set_run_status(run_number, status='FINISHED', stop_time=stop_time, total_time=stop_time - start_time)
+        run_database.update_run_status(run_number, status='CRASHED')
+        run = run_database.get_runs()[0]
+        self.assertEqual((run['status'], run['stop_time'], run['total_time']), ('CRASHED', str(stop_time), '0:01:00'))  # timestamps unchanged
+        run_database.update_run_status(100, status='CRASHED')  # not existing run, ignored
+        self.assertEqual(run_database.get_run_numbers(), [run_number])
+        run_database.close()
+
+    def test_get_run_numbers(self):
+        run_database = RunDatabase(self.filename)
+        start_time = datetime.datetime(2017, 1, 1, 12, 0, 0)
+        for status in ['FINISHED', 'ABORTED', 'FINISHED', 'CRASHED', 'RUNNING']:
+            run_number = run_database.add_run(run_class='AnalogScan', status='RUNNING', start_time=start_time)
+            run_database.set_run_status(run_number, status=status, stop_time=start_time, total_time=datetime.timedelta(0))
+        self.assertEqual(run_database.get_run_numbers(), [5, 4, 3, 2, 1])
+        self.assertEqual(run_database.get_run_numbers(status='FINISHED'), [3, 1])
+        self.assertEqual(run_database.get_run_numbers(status=['ABORTED', 'CRASHED']), [4, 2])
+        self.assertEqual(run_database.get_run_numbers(status='STOPPED'), [])
+        run_database.close()
+
+    def test_configuration_file(self):
+        run_database = RunDatabase(self.filename)
+        run_number = run_database.add_run(run_class='AnalogScan', status='RUNNING', start_time=datetime.datetime.now())
+        self.assertIsNone(run_database.get_configuration_file(run_number))
+        self.assertIsNone(run_database.get_configuration_file(100))  # not existing run
+        run_database.set_configuration_file(run_number, '/module_test/configs/1_module_test_analog_scan.cfg')
+        self.assertEqual(run_database.get_configuration_file(run_number), '/module_test/configs/1_module_test_analog_scan.cfg')
+        run_database.set_configuration_file(100, 'not_existing_run.cfg')  # ignored
+        self.assertIsNone(run_database.get_configuration_file(100))
+        run_database.close()
+
+    def test_import_run_list(self):
+        with open(os.path.join(self.working_dir, 'run.cfg'), 'w') as f:
+            f.write('1 AnalogScan FINISHED 2017-01-01 12:00:00 2017-01-01 12:01:00 0:01:00\n')
+            f.write('2 DigitalScan CRASHED 2017-01-01 12:02:00\n')
+            f.write('invalid line\n')
+        run_database = RunDatabase(self.filename)
+        runs = run_database.get_runs()
+        self.assertEqual([(run['run_number'], run['run_class'], run['status']) for run in runs], [(2, 'DigitalScan', 'CRASHED'), (1, 'AnalogScan', 'FINISHED')])
+        self.assertEqual((runs[1]['start_time'], runs[1]['stop_time'], runs[1]['total_time']), ('2017-01-01 12:00:00', '2017-01-01 12:01:00', '0:01:00'))
+        self.assertEqual(run_database.add_run(run_class='AnalogScan', status='RUNNING', start_time=datetime.datetime.now()), 3)
+        run_database.close()
+
+    def test_forked_process(self):
+        run = DummyRun(conf={'working_dir': self.working_dir})
+        run_number = run.run_database.add_run(run_class='AnalogScan', status='RUNNING', start_time=datetime.datetime.now())
+        run_database = run.run_database
+        process = multiprocessing.Process(target=set_configuration_file_in_forked_process, args=(run, run_number, 'analog_scan.cfg'))
+        process.start()
+        process.join()
+        self.assertEqual(process.exitcode, 0)
+        self.assertIs(run.run_database, run_database)  # connection of this process is kept
+        self.assertEqual(run.run_database.get_configuration_file(run_number), 'analog_scan.cfg')
+        run._close_run_database()
+        self.assertIsNone(run._run_database)
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestRunDatabase)
+    unittest.TextTestRunner(verbosity=2).run(suite)
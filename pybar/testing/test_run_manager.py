@@ -0,0 +1,200 @@
+''' Script to check the background analysis of runs (analysis queue) without readout hardware.
+'''
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from pybar.run_database import RunDatabase
+from pybar.run_manager import RunBase, RunAborted, AnalysisQueue, MultiRunManager, run_status
+
+
+def analysis_success():
+    pass
+
+
+def analysis_failure():
+    raise ValueError('Analysis failed')
+
+
+class AnalysisWriting(object):
+    ''' Analysis job writing its start and stop time into a file.
+    '''
+    def __init__(self, filename, duration=0.2):
+        self.filename = filename
+        self.duration = duration
+
+    def __call__(self):
+        start_time = time.time()
+        time.sleep(self.duration)
+        with open(self.filename, 'w') as f:
+            f.write('%r %r' % (start_time, time.time()))
+
+
+class DummyRun(RunBase):
+    ''' Run of the primlist of the tests (only run class of this module). The failure of each DUT is given by dummy_run_failure in the configuration.
+    '''
+    _default_run_conf = {'analysis': None, 'abort': False}
+
+    def __init__(self, conf, run_conf=None):
+        if conf.get('dummy_run_failure') == 'init':
+            raise ValueError('Run initialization failed')
+        super(DummyRun, self).__init__(conf=conf, run_conf=run_conf)
+
+    def pre_run(self):
+        pass
+
+    def do_run(self):
+        if self._conf.get('dummy_run_failure') == 'exit':
+            os._exit(3)  # process terminates without result
+        if self._conf.get('dummy_run_failure') == 'run':
+            raise RuntimeError('Run crashed')
+        if self.analysis_queue is not None and self.analysis is not None:
+            self._analysis_job = self.analysis
+        if self.abort:
+            raise RunAborted('Aborted run')
+
+    def post_run(self):
+        pass
+
+    def cleanup_run(self):
+        pass
+
+
+@unittest.skipIf(os.name == 'nt', 'AnalysisQueue needs fork')
+class TestAnalysisQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+
+    def get_status(self, run_number):
+        run_database = RunDatabase(os.path.join(self.working_dir, 'run.db'))
+        try:
+            return [run['status'] for run in run_database.get_runs() if run['run_number'] == run_number][0]
+        finally:
+            run_database.close()
+
+    def test_success(self):
+        analysis_queue = AnalysisQueue(n_workers=2)
+        results = []
+        analysis_queue.put(analysis_success, callback=results.append)
+        analysis_queue.put(analysis_success, name='Analysis 2')
+        self.assertEqual(sorted(analysis_queue.join()), [('Analysis 2', True), ('analysis_success', True)])
+        self.assertEqual(results, [True])
+
+    def test_failure(self):
+        analysis_queue = AnalysisQueue(n_workers=1)
+        results = []
+        analysis_queue.put(analysis_failure, name='Analysis 1', callback=results.append)
+
+        def failing_callback(success):
+            raise RuntimeError('Callback failed')
+        analysis_queue.put(analysis_success, name='Analysis 2', callback=failing_callback)  # failing callback does not affect the result
+        self.assertEqual(analysis_queue.join(), [('Analysis 1', False), ('Analysis 2', True)])
+        self.assertEqual(results, [False])
+
+    def test_join(self):
+        filenames = [os.path.join(self.working_dir, 'analysis_%d.txt' % index) for index in range(3)]
+        analysis_queue = AnalysisQueue(n_workers=1)
+        for index, filename in enumerate(filenames):
+            analysis_queue.put(AnalysisWriting(filename), name='Analysis %d' % index)
+        self.assertEqual(analysis_queue.join(), [('Analysis %d' % index, True) for index in range(3)])
+        times = []
+        for filename in filenames:
+            with open(filename, 'r') as f:
+                times.append([float(value) for value in f.read().split()])
+        for (_, stop_time), (start_time, _) in zip(times[:-1], times[1:]):  # one worker: jobs are executed one after another
+            self.assertLessEqual(stop_time, start_time)
+        self.assertEqual(analysis_queue.join(), [('Analysis %d' % index, True) for index in range(3)])  # nothing to wait for
+
+    def test_run_status(self):
+        analysis_queue = AnalysisQueue(n_workers=2)
+        run_numbers = []
+        for run_conf in [{'analysis': analysis_success}, {'analysis': analysis_failure}, {'analysis': analysis_failure, 'abort': True}]:
+            run = DummyRun(conf={'working_dir': self.working_dir})
+            run.analysis_queue = analysis_queue
+            run.run(run_conf=run_conf)
+            self.assertIsNone(run._analysis_job)
+            run_numbers.append(run.run_number)
+        self.assertEqual(self.get_status(run_numbers[0]), run_status.finished)
+        self.assertEqual(self.get_status(run_numbers[2]), run_status.aborted)
+        self.assertEqual(analysis_queue.join(), [('DummyRun (run 1)', True), ('DummyRun (run 2)', False)])  # no analysis of unfinished run
+        # failed analysis is written to the run database
+        self.assertEqual([self.get_status(run_number) for run_number in run_numbers], [run_status.finished, run_status.crashed, run_status.aborted])
+
+
+@unittest.skipIf(os.name == 'nt', 'MultiRunManager test needs fork')
+class TestMultiRunManager(unittest.TestCase):
+
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.primlist = os.path.join(self.working_dir, 'primlist.txt')
+        with open(self.primlist, 'w') as f:
+            f.write('# two runs for each DUT\npybar.testing.test_run_manager\npybar.testing.test_run_manager; abort=False\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+
+    def get_conf(self, name, failure=None):
+        return {'working_dir': os.path.join(self.working_dir, name), 'dummy_run_failure': failure}
+
+    def test_results(self):
+        confs = [self.get_conf('dut_0'), self.get_conf('dut_1')]
+        multi_run_manager = MultiRunManager(confs)
+        results = multi_run_manager.run_primlist(self.primlist)
+        self.assertEqual(len(results), 2)
+        for conf, result in zip(confs, results):
+            self.assertEqual(result['conf'], conf)
+            self.assertEqual(result['working_dir'], conf['working_dir'])
+            self.assertEqual(result['runs'], [(1, 'DummyRun', run_status.finished), (2, 'DummyRun', run_status.finished)])
+            self.assertIsNone(result['error'])
+            self.assertEqual(result['exitcode'], 0)
+            self.assertTrue(os.path.isfile(os.path.join(conf['working_dir'], 'run.db')))
+        self.assertEqual(multi_run_manager.get_run_numbers(), [[1, 2], [1, 2]])
+
+    def test_crashed_run(self):
+        multi_run_manager = MultiRunManager([self.get_conf('dut_0', failure='run'), self.get_conf('dut_1')])
+        results = multi_run_manager.run_primlist(self.primlist, skip_remaining=True)
+        self.assertEqual(results[0]['runs'], [(1, 'DummyRun', run_status.crashed)])  # remaining run skipped
+        self.assertIsNone(results[0]['error'])
+        self.assertEqual(results[0]['exitcode'], 0)
+        self.assertEqual(len(results[1]['runs']), 2)
+        self.assertEqual(multi_run_manager.get_run_numbers(status=run_status.finished), [[], [1, 2]])
+        self.assertEqual(multi_run_manager.get_run_numbers(status=[run_status.finished, run_status.crashed]), [[1], [1, 2]])
+
+    def test_crashed_process(self):
+        # exception in the process, e.g. while opening the primlist
+        multi_run_manager = MultiRunManager([self.get_conf('dut_0'), self.get_conf('dut_1', failure='init')])
+        results = multi_run_manager.run_primlist(self.primlist)
+        self.assertEqual(len(results[0]['runs']), 2)
+        self.assertEqual(results[1]['working_dir'], os.path.join(self.working_dir, 'dut_1'))
+        self.assertEqual(results[1]['runs'], [])
+        self.assertIn('ValueError: Run initialization failed', results[1]['error'])
+        self.assertEqual(results[1]['exitcode'], 0)
+        # process terminated without result
+        multi_run_manager = MultiRunManager([self.get_conf('dut_1', failure='exit'), self.get_conf('dut_0')])
+        results = multi_run_manager.run_primlist(self.primlist)
+        self.assertIsNone(results[0]['working_dir'])
+        self.assertEqual(results[0]['runs'], [])
+        self.assertEqual(results[0]['exitcode'], 3)
+        self.assertEqual(results[0]['error'], 'Process exited with exit code 3')
+        self.assertEqual(results[1]['exitcode'], 0)
+        self.assertEqual([run_number for run_number, _, _ in results[1]['runs']], [3, 4])  # run numbers are continued in the working directory
+
+    def test_same_working_dir(self):
+        conf = self.get_conf('dut_0')
+        multi_run_manager = MultiRunManager([conf, dict(conf, working_dir=os.path.join(conf['working_dir'], '.', ''))])
+        with self.assertRaises(ValueError):
+            multi_run_manager.run_primlist(self.primlist)
+        self.assertEqual(multi_run_manager._processes, [])  # no process started
+        self.assertFalse(os.path.exists(conf['working_dir']))
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestAnalysisQueue)
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestMultiRunManager))
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,89 @@
+''' Script to check the deferred imports of the scan registry (pybar.scans) and of lazy modules.
+'''
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import pybar
+from pybar.utils.utils import LazyModule
+
+
+def run_python(code):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.dirname(pybar.__file__))] + sys.path)
+    return subprocess.check_output([sys.executable, '-c', code], env=env).strip().splitlines()[-1]
+
+
+class TestLazyModule(unittest.TestCase):
+
+    def setUp(self):
+        self.module_folder = tempfile.mkdtemp()
+        with open(os.path.join(self.module_folder, 'lazy_test_module.py'), 'w') as f:
+            f.write('value = 42\n')
+        sys.path.insert(0, self.module_folder)
+
+    def tearDown(self):
+        sys.path.remove(self.module_folder)
+        sys.modules.pop('lazy_test_module', None)
+        shutil.rmtree(self.module_folder)
+
+    def test_lazy_import(self):
+        lazy_module = LazyModule('lazy_test_module')
+        self.assertNotIn('lazy_test_module', sys.modules)
+        self.assertEqual(lazy_module.value, 42)
+        self.assertIn('lazy_test_module', sys.modules)
+        self.assertIs(lazy_module._module, sys.modules['lazy_test_module'])
+        with self.assertRaises(AttributeError):
+            lazy_module.not_existing
+
+    def test_dir(self):
+        lazy_module = LazyModule('lazy_test_module')
+        self.assertIn('value', dir(lazy_module))
+
+    def test_not_existing_module(self):
+        lazy_module = LazyModule('not_existing_lazy_test_module')  # no error until first use
+        with self.assertRaises(ImportError):
+            lazy_module.value
+
+    def test_scipy_import(self):
+        # SciPy is imported on first use by the raw data analysis
+        self.assertEqual(run_python('import sys; import pybar.analysis.analyze_raw_data; print "scipy.optimize" in sys.modules or "scipy.special" in sys.modules'), 'False')
+        self.assertEqual(run_python('import sys; from pybar.analysis.analyze_raw_data import scurve; print scurve(0.0, 100.0, 0.0, 1.0)'), '50.0')
+
+
+class TestScanRegistry(unittest.TestCase):
+
+    def test_registry(self):
+        from pybar.scans import scans, __all__
+        self.assertEqual(sorted(__all__), sorted(scans.keys()))
+        scan_folder = os.path.join(os.path.dirname(pybar.__file__), 'scans')
+        for module_name in set(scans.values()):
+            self.assertTrue(os.path.isfile(os.path.join(scan_folder, module_name + '.py')), module_name)
+
+    def test_lazy_import(self):
+        self.assertEqual(run_python('import sys; import pybar.scans; print sorted(name for name in sys.modules if name.startswith("pybar.scans.") and sys.modules[name] is not None)'), '[]')
+        self.assertEqual(run_python('import sys; from pybar.scans import DigitalScan; print sorted(name for name in sys.modules if name.startswith("pybar.scans.") and sys.modules[name] is not None)'), "['pybar.scans.scan_digital']")
+
+    def test_get_scan(self):
+        import pybar.scans
+        from pybar.scans import get_scan, ScanRegistryModule
+        self.assertIsInstance(sys.modules['pybar.scans'], ScanRegistryModule)
+        from pybar.scans import DigitalScan
+        from pybar.scans.scan_digital import DigitalScan as ModuleDigitalScan  # importing the scan module directly
+        self.assertIs(DigitalScan, ModuleDigitalScan)
+        self.assertIs(get_scan('DigitalScan'), ModuleDigitalScan)
+        self.assertIs(pybar.scans.DigitalScan, ModuleDigitalScan)
+        self.assertIn('AnalogScan', dir(pybar.scans))
+        with self.assertRaises(ValueError):
+            get_scan('NotExistingScan')
+        with self.assertRaises(AttributeError):
+            pybar.scans.NotExistingScan
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestLazyModule)
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestScanRegistry))
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,172 @@
+''' Script to check the decisions of the sequential testing of the tunings.
+'''
+import os
+import unittest
+from threading import Event
+from contextlib import contextmanager
+
+import numpy as np
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+import tables as tb
+
+from pybar.fei4 import sequential_test
+from pybar.fei4.sequential_test import binomial_decision, mean_decision, median_decision, get_occupancy, get_tot_sums, normalize, sequential_scan_loop
+from pybar.fei4.mask_utils import make_pixel_mask, get_injected_columns
+from pybar.daq.readout_utils import convert_data_array, is_data_record, is_fe_word, logical_and, get_col_row_tot_array_from_data_record_array
+
+tests_data_folder = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_analysis_data')
+
+
+class FifoReadoutDummy(object):
+    def __init__(self):
+        self.data = []
+
+
+class RunDummy(object):
+    def __init__(self, hit_probability=None):
+        self.stop_run = Event()
+        self.fifo_readout = FifoReadoutDummy()
+        self.hit_probability = np.ones((80, 336)) if hit_probability is None else hit_probability  # 1, 0.5 or 0
+        self.scan_loop_calls = []
+
+    @contextmanager
+    def readout(self, **kwargs):
+        self.fifo_readout.data = []
+        yield
+
+    def handle_data(self, data):
+        pass
+
+
+def scan_loop_dummy(self, command, repeat_command, mask_steps=3, enable_mask_steps=None, enable_double_columns=None, mask=None, **kwargs):
+    # every injected pixel sees repeat_command * hit_probability hits
+    self.scan_loop_calls.append((repeat_command, list(enable_mask_steps), list(enable_double_columns)))
+    injected = np.zeros((80, 336), dtype=bool)
+    for mask_step in enable_mask_steps:
+        for double_column in enable_double_columns:
+            injected |= make_pixel_mask(mask_steps, mask_step, enable_columns=get_injected_columns(double_column), mask=mask).astype(bool)
+    col, row = np.nonzero(injected)
+    n_hits = (repeat_command * self.hit_probability[col, row]).astype(np.int64)
+    data_records = ((col + 1) << 17) | ((row + 1) << 8) | 0xF  # FE data records
+    self.fifo_readout.data.append((np.repeat(data_records, n_hits).astype(np.uint32), 0, 0, 0))
+
+
+class TestSequentialTest(unittest.TestCase):
+
+    def test_binomial_decision(self):
+        hits = np.array([100, 0, 50, 60, 40, 3, 0, 0, 120])
+        injections = np.array([100, 100, 100, 100, 100, 3, 3, 0, 100])
+        assert_array_equal(binomial_decision(hits, injections, p=0.5, z=3.0), [1, -1, 0, 0, 0, 0, 0, 0, 1])  # noise hits above the number of injections are above
+        assert_array_equal(binomial_decision(hits, injections, p=0.5, z=1.0), [1, -1, 0, 1, -1, 1, -1, 0, 1])
+        self.assertEqual(binomial_decision(np.zeros((80, 336)), np.full((80, 336), 100)).shape, (80, 336))
+        # more injections are needed for a settled decision close to p
+        self.assertEqual(binomial_decision(55, 100), 0)
+        self.assertEqual(binomial_decision(5500, 10000), 1)
+        self.assertEqual(binomial_decision(45, 100, p=0.9), -1)
+
+    def test_mean_decision(self):
+        # mean ToT compared to the target ToT
+        n = np.array([100, 100, 100, 100, 1, 0])
+        sum_values = np.array([600, 800, 50 * 6 + 50 * 8, 50 * 5 + 50 * 10, 7.5, 0])
+        sum_squares = np.array([3600, 6400, 50 * 36 + 50 * 64, 50 * 25 + 50 * 100, 7.5 ** 2, 0])
+        assert_array_equal(mean_decision(sum_values, sum_squares, n, target=7.0), [-1, 1, 0, 0, 0, 0])
+        # sample variance
+        self.assertEqual(mean_decision(50 * 5 + 50 * 10, 50 * 25 + 50 * 100, 100, target=7.0), 0)
+        self.assertEqual(mean_decision(500 * 5 + 500 * 10, 500 * 25 + 500 * 100, 1000, target=7.0), 1)
+        # quantization
+        self.assertEqual(mean_decision(7.2 * 100, 7.2 ** 2 * 100, 100, target=7.0), 1)
+        self.assertEqual(mean_decision(7.2 * 100, 7.2 ** 2 * 100, 100, target=7.0, quantization=4.0), 0)
+
+    def test_median_decision(self):
+        self.assertEqual(median_decision([1, 1, -1]), 1)
+        self.assertEqual(median_decision([-1, -1, 1, 0]), 0)
+        self.assertEqual(median_decision([-1, -1, -1, 0]), -1)
+        self.assertEqual(median_decision([1, 1, 0, 0]), 0)  # not more than half
+        self.assertEqual(median_decision([1, 1, -1, -1, -1], select=[True, True, False, False, True]), 1)
+        decision = np.zeros((80, 336), dtype=np.int8)
+        decision[:41, :] = -1
+        self.assertEqual(median_decision(decision), -1)
+        self.assertEqual(median_decision(decision, select=np.arange(80 * 336).reshape(80, 336) >= 40 * 336), 0)
+
+    def test_get_tot_sums(self):
+        with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_5.h5'), mode="r") as in_file_h5:
+            raw_data = in_file_h5.root.raw_data[:]
+        n_hits, sum_tot, sum_tot_squares = get_tot_sums(raw_data)
+        # reference from the hit list
+        n_hits_reference = np.zeros((80, 336))
+        sum_tot_reference = np.zeros((80, 336))
+        sum_tot_squares_reference = np.zeros((80, 336))
+        for col, row, tot in zip(*convert_data_array(raw_data, filter_func=logical_and(is_fe_word, is_data_record), converter_func=get_col_row_tot_array_from_data_record_array)):
+            n_hits_reference[col - 1, row - 1] += 1
+            sum_tot_reference[col - 1, row - 1] += tot
+            sum_tot_squares_reference[col - 1, row - 1] += tot ** 2
+        self.assertGreater(np.sum(n_hits_reference), 0)
+        assert_array_equal(n_hits, n_hits_reference)
+        assert_array_equal(sum_tot, sum_tot_reference)
+        assert_array_equal(sum_tot_squares, sum_tot_squares_reference)
+        # no data
+        for sums in get_tot_sums(np.array([], dtype=np.uint32)):
+            assert_array_equal(sums, np.zeros((80, 336)))
+
+    def test_normalize(self):
+        values = np.array([[5, 10, 0], [2, 0, 0]])
+        injections = np.array([[10, 100, 0], [1, 0, 100]])
+        with np.errstate(all='raise'):
+            assert_array_almost_equal(normalize(values, injections, 100), [[50, 10, 0], [200, 0, 0]])
+            assert_array_equal(normalize(values, np.zeros_like(injections), 100), np.zeros_like(values))
+
+    def test_sequential_scan_loop(self):
+        # all pixels see all injections, except the pixels of mask step 1 of DC 5 (occupancy 50%)
+        unsettled = make_pixel_mask(3, 1, enable_columns=[10, 11]).astype(bool)
+        hit_probability = np.where(unsettled, 0.5, 1.0)
+
+        def decide(data_array, injections):
+            return binomial_decision(get_occupancy(data_array), injections, p=0.5) != 0
+
+        original_scan_loop = sequential_test.scan_loop
+        sequential_test.scan_loop = scan_loop_dummy
+        try:
+            # settled pixels are masked, only the mask steps and DCs of the unsettled pixels are injected
+            run = RunDummy(hit_probability)
+            data_array, injections = sequential_scan_loop(run, command=None, max_injections=100, batch_injections=10, decide=decide, min_settled_pixels=500, mask_steps=3)
+            self.assertEqual(run.scan_loop_calls, [(10, [0, 1, 2], range(40))] + [(10, [1], [5])] * 9)
+            assert_array_equal(injections, np.where(unsettled, 100, 10))
+            assert_array_equal(get_occupancy(data_array), np.where(unsettled, 50, 10))
+            # less than min_settled_pixels settled pixels
+            run = RunDummy(hit_probability)
+            data_array, injections = sequential_scan_loop(run, command=None, max_injections=100, batch_injections=30, decide=decide, min_settled_pixels=80 * 336, mask_steps=3)
+            self.assertEqual(run.scan_loop_calls, [(30, [0, 1, 2], range(40))] * 3 + [(10, [0, 1, 2], range(40))])
+            assert_array_equal(injections, np.full((80, 336), 100))
+            # stop condition: fraction of pixels with a settled decision
+            run = RunDummy(hit_probability)
+            data_array, injections = sequential_scan_loop(run, command=None, max_injections=100, batch_injections=10, decide=decide, settled_fraction=0.97, mask_steps=3)
+            self.assertEqual(run.scan_loop_calls, [(10, [0, 1, 2], range(40))])
+            assert_array_equal(injections, np.full((80, 336), 10))
+            # only the selected mask steps and DCs are injected and count for the settled fraction
+            run = RunDummy(hit_probability)
+            data_array, injections = sequential_scan_loop(run, command=None, max_injections=100, batch_injections=10, decide=decide, mask_steps=3, enable_mask_steps=[0, 2], enable_double_columns=[4, 5, 6])
+            self.assertEqual(run.scan_loop_calls, [(10, [0, 2], [4, 5, 6])])
+            assert_array_equal(np.nonzero(injections)[0], np.nonzero(get_occupancy(data_array))[0])
+            self.assertEqual(np.count_nonzero(injections), 6 * 336 * 2 / 3)  # columns 8 to 13
+            # decision of all pixels
+            run = RunDummy(hit_probability)
+            data_array, injections = sequential_scan_loop(run, command=None, max_injections=100, batch_injections=10, decide=lambda data_array, injections: np.all(injections >= 20), mask_steps=3)
+            self.assertEqual(len(run.scan_loop_calls), 2)
+            # without sequential test
+            run = RunDummy(hit_probability)
+            data_array, injections = sequential_scan_loop(run, command=None, max_injections=100, decide=decide, mask_steps=3)
+            self.assertEqual(run.scan_loop_calls, [(100, [0, 1, 2], range(40))])
+        finally:
+            sequential_test.scan_loop = original_scan_loop
+
+    def test_stopped_before_first_batch(self):
+        run = RunDummy()
+        run.stop_run.set()
+        data_array, injections = sequential_scan_loop(run, command=None, max_injections=100, batch_injections=10)
+        self.assertEqual(data_array.shape, (0,))
+        assert_array_equal(injections, np.zeros((80, 336)))
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestSequentialTest)
+    unittest.TextTestRunner(verbosity=2).run(suite)
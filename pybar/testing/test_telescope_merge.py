@@ -0,0 +1,130 @@
+''' Script to check the merging of FE-I4 hits and Mimosa26 hits at the trigger number. The merged hits are compared to a trigger by trigger implementation.
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+import tables as tb
+
+from pybar.analysis.analysis import merge_m26_telescope_hits
+from pybar.analysis.analysis_utils import unwrap_trigger_number, merge_hits_at_trigger_number, telescope_hit_dtype, InvalidInputError
+
+fe_hit_dtype = np.dtype([('event_number', '<i8'), ('trigger_number', '<u4'), ('column', 'u1'), ('row', '<u2'), ('tot', 'u1')])
+m26_hit_dtype = np.dtype([('trigger_number', '<u4'), ('plane', 'u1'), ('column', '<u2'), ('row', '<u2')])
+
+
+def get_hits(trigger_numbers, dtype, max_hits=4):
+    # random number of hits (0 to max_hits) for each trigger number
+    n_hits = np.random.randint(0, max_hits + 1, size=len(trigger_numbers))
+    hits = np.zeros(shape=(np.sum(n_hits),), dtype=dtype)
+    hits['trigger_number'] = np.repeat(trigger_numbers, n_hits)
+    hits['column'] = np.random.randint(1, 80, size=hits.shape[0])
+    hits['row'] = np.random.randint(1, 336, size=hits.shape[0])
+    if 'tot' in dtype.names:
+        hits['tot'] = np.random.randint(0, 14, size=hits.shape[0])
+    if 'plane' in dtype.names:
+        hits['plane'] = np.random.randint(1, 7, size=hits.shape[0])
+    return hits
+
+
+def merge_hits_reference(fe_hits, m26_hits, fe_trigger_number, m26_trigger_number):
+    # trigger by trigger implementation of merge_hits_at_trigger_number()
+    merged_hits = []
+    for event_number, trigger_number in enumerate(sorted(set(fe_trigger_number) & set(m26_trigger_number))):
+        for hit in fe_hits[fe_trigger_number == trigger_number]:
+            merged_hits.append((event_number, trigger_number, 0, hit['column'], hit['row'], hit['tot']))
+        for hit in m26_hits[m26_trigger_number == trigger_number]:
+            merged_hits.append((event_number, trigger_number, hit['plane'], hit['column'], hit['row'], 0))
+    return np.array(merged_hits, dtype=telescope_hit_dtype)
+
+
+class TestTelescopeMerge(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.working_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+
+    def write_hits(self, filename, hits):
+        with tb.open_file(os.path.join(self.working_dir, filename), mode='w') as out_file_h5:
+            hit_table = out_file_h5.create_table(out_file_h5.root, name='Hits', description=hits.dtype)
+            hit_table.append(hits)
+        return os.path.join(self.working_dir, filename)
+
+    def read_hits(self, filename):
+        with tb.open_file(os.path.join(self.working_dir, filename), mode='r') as in_file_h5:
+            return in_file_h5.root.Hits[:]
+
+    def test_unwrap_trigger_number(self):
+        trigger_number = np.array([32765, 32766, 32767, 0, 1, 0, 2, 32767, 3])  # small decreases are no overflow, 32767 is from before the overflow
+        unwrapped_trigger_number, offset, last_trigger_number = unwrap_trigger_number(trigger_number, 2 ** 15)
+        assert_array_equal(unwrapped_trigger_number, [32765, 32766, 32767, 32768, 32769, 32768, 32770, 32767, 32771])
+        self.assertEqual((offset, last_trigger_number), (2 ** 15, 3))
+        # several overflows
+        trigger_number = np.arange(0, 100) % 8
+        assert_array_equal(unwrap_trigger_number(trigger_number, 8)[0], np.arange(0, 100))
+        # chunks, with wrap-around at the chunk boundary
+        for split_index in [[1], [3], [3, 4], [2, 5, 8]]:
+            trigger_number = np.array([5, 6, 7, 0, 1, 2, 5, 7, 0, 1])
+            offset, last_trigger_number = 0, None
+            unwrapped_trigger_number = []
+            for chunk in np.split(trigger_number, split_index):
+                chunk_trigger_number, offset, last_trigger_number = unwrap_trigger_number(chunk, 8, offset, last_trigger_number)
+                unwrapped_trigger_number.extend(chunk_trigger_number)
+            assert_array_equal(unwrapped_trigger_number, [5, 6, 7, 8, 9, 10, 13, 15, 16, 17])
+        # empty chunk
+        unwrapped_trigger_number, offset, last_trigger_number = unwrap_trigger_number([], 8, 16, 7)
+        self.assertEqual((unwrapped_trigger_number.shape[0], offset, last_trigger_number), (0, 16, 7))
+
+    def test_merge_hits_at_trigger_number(self):
+        fe_hits = get_hits(range(0, 100), fe_hit_dtype)
+        m26_hits = get_hits(range(50, 150), m26_hit_dtype)  # triggers 0 to 49 only in FE-I4 hits, 100 to 149 only in Mimosa26 hits
+        merged_hits, n_events = merge_hits_at_trigger_number(fe_hits, m26_hits, event_number_offset=10)
+        reference_hits = merge_hits_reference(fe_hits, m26_hits, fe_hits['trigger_number'], m26_hits['trigger_number'])
+        reference_hits['event_number'] += 10
+        assert_array_equal(merged_hits, reference_hits)
+        self.assertEqual(n_events, np.unique(reference_hits['trigger_number']).shape[0])
+        self.assertTrue(np.all(merged_hits['trigger_number'] >= 50) and np.all(merged_hits['trigger_number'] < 100))
+        # no common triggers
+        merged_hits, n_events = merge_hits_at_trigger_number(fe_hits[fe_hits['trigger_number'] < 50], m26_hits)
+        self.assertEqual((merged_hits.shape[0], n_events), (0, 0))
+        self.assertEqual(merged_hits.dtype, telescope_hit_dtype)
+
+    def test_merge_m26_telescope_hits(self):
+        # trigger numbers with wrap-around, triggers in only one stream and chunk boundaries within the hits of a trigger
+        trigger_numbers = np.arange(-200, 1000) % 512
+        fe_trigger_numbers = trigger_numbers[np.random.random(size=trigger_numbers.shape[0]) > 0.1]
+        m26_trigger_numbers = trigger_numbers[np.random.random(size=trigger_numbers.shape[0]) > 0.1]
+        fe_hits = get_hits(fe_trigger_numbers, fe_hit_dtype, max_hits=6)
+        m26_hits = get_hits(m26_trigger_numbers, m26_hit_dtype, max_hits=6)
+        input_file_hits = self.write_hits('fe_hits.h5', fe_hits)
+        input_file_m26_hits = self.write_hits('m26_hits.h5', m26_hits)
+        unwrapped_trigger_numbers = np.arange(-200, 1000) + 200 + 312  # first trigger number 312
+        reference_hits = merge_hits_reference(fe_hits, m26_hits, unwrap_trigger_number(fe_hits['trigger_number'], 512)[0], unwrap_trigger_number(m26_hits['trigger_number'], 512)[0])
+        self.assertTrue(np.all(np.in1d(reference_hits['trigger_number'], unwrapped_trigger_numbers)))
+        for chunk_size in [1, 7, 100, 1000000]:
+            output_file_hits = os.path.join(self.working_dir, 'merged_hits_%d.h5' % chunk_size)
+            n_events = merge_m26_telescope_hits(input_file_hits, input_file_m26_hits, output_file_hits, trigger_number_range=512, chunk_size=chunk_size)
+            merged_hits = self.read_hits(output_file_hits)
+            assert_array_equal(merged_hits, reference_hits, err_msg='chunk_size=%d' % chunk_size)
+            self.assertEqual(n_events, np.unique(reference_hits['trigger_number']).shape[0])
+        # trigger numbers not increasing
+        with self.assertRaises(InvalidInputError):
+            merge_m26_telescope_hits(input_file_hits, input_file_m26_hits, os.path.join(self.working_dir, 'merged_hits.h5'), trigger_number_range=None)
+
+    def test_merge_m26_telescope_hits_one_stream_empty(self):
+        input_file_hits = self.write_hits('fe_hits.h5', get_hits(range(0, 100), fe_hit_dtype))
+        input_file_m26_hits = self.write_hits('m26_hits.h5', np.zeros(shape=(0,), dtype=m26_hit_dtype))
+        output_file_hits = os.path.join(self.working_dir, 'merged_hits.h5')
+        self.assertEqual(merge_m26_telescope_hits(input_file_hits, input_file_m26_hits, output_file_hits, chunk_size=10), 0)
+        self.assertEqual(self.read_hits(output_file_hits).shape[0], 0)
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestTelescopeMerge)
+    unittest.TextTestRunner(verbosity=2).run(suite)
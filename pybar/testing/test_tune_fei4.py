@@ -0,0 +1,107 @@
+''' Script to check the checkpoints of the FE-I4 tuning. The checkpoint is written and loaded without a FE-I4 or readout hardware.
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from pybar.fei4.register import FEI4Register
+from pybar.scans.tune_fei4 import Fei4Tuning
+
+
+class RegisterUtilsDummy(object):
+    def __init__(self):
+        self.configured = 0
+
+    def configure_all(self):
+        self.configured += 1
+
+
+class TestTuningCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+
+    def get_tuning(self, run_number, chip_address=0):
+        # tuning without running it, see Fei4Tuning.scan()
+        tuning = Fei4Tuning.__new__(Fei4Tuning)
+        for key, value in Fei4Tuning._default_run_conf.iteritems():
+            setattr(tuning, key, value)
+        tuning._conf = {'fe_configuration': FEI4Register(fe_type='fei4b', chip_address=chip_address), 'rx_channels': None}
+        tuning._selected_channel = None
+        tuning._register_utils = RegisterUtilsDummy()
+        tuning._run_number = run_number
+        tuning.checkpoint_file = os.path.join(self.working_dir, 'fei4_tuning_checkpoint.h5')
+        tuning.initial_configuration_hash = tuning.get_configuration_hash()
+        tuning.step_run_numbers = []
+        return tuning
+
+    def save_tuning_results(self, tuning):
+        np.random.seed(0)
+        tuning.gdac_best = 150
+        tuning.feedback_best = 80
+        tuning.occ_array_sel_pixels_best = np.ma.array(np.random.randint(0, 50, size=(80, 336)), mask=np.random.randint(0, 2, size=(80, 336)))
+        tuning.occupancy_best = np.random.randint(0, 100, size=(80, 336))
+        tuning.tdac_mask_best = np.random.randint(0, 32, size=(80, 336))
+        tuning.register.set_global_register_value('Vthin_AltFine', 150)
+        tuning.register.set_pixel_register_value('TDAC', tuning.tdac_mask_best)
+        tuning.save_checkpoint(1)
+        tuning._run_number += 1
+        tuning.save_checkpoint(2)
+
+    def test_save_load_checkpoint(self):
+        tuning = self.get_tuning(run_number=10)
+        self.save_tuning_results(tuning)
+        self.assertFalse(os.path.isfile(tuning.checkpoint_file + '.tmp'))
+        # resuming tuning
+        resumed_tuning = self.get_tuning(run_number=12)
+        self.assertEqual(resumed_tuning.load_checkpoint(), 2)
+        self.assertEqual(resumed_tuning.register_utils.configured, 1)
+        self.assertEqual(resumed_tuning.step_run_numbers, [10, 11])
+        self.assertEqual(resumed_tuning.gdac_best, 150)
+        self.assertEqual(resumed_tuning.feedback_best, 80)
+        self.assertFalse(hasattr(resumed_tuning, 'tot_mean_best'))  # not existing in checkpoint
+        self.assertTrue(np.ma.isMaskedArray(resumed_tuning.occ_array_sel_pixels_best))
+        assert_array_equal(resumed_tuning.occ_array_sel_pixels_best.data, tuning.occ_array_sel_pixels_best.data)
+        assert_array_equal(resumed_tuning.occ_array_sel_pixels_best.mask, tuning.occ_array_sel_pixels_best.mask)
+        self.assertEqual(np.ma.median(resumed_tuning.occ_array_sel_pixels_best), np.ma.median(tuning.occ_array_sel_pixels_best))
+        self.assertFalse(np.ma.isMaskedArray(resumed_tuning.occupancy_best))
+        assert_array_equal(resumed_tuning.occupancy_best, tuning.occupancy_best)
+        # FE configuration
+        self.assertEqual(resumed_tuning.register.get_global_register_value('Vthin_AltFine'), 150)
+        assert_array_equal(resumed_tuning.register.get_pixel_register_value('TDAC'), tuning.tdac_mask_best)
+        self.assertEqual(resumed_tuning.register.configuration_file, 'fei4b')  # configuration file name is kept
+        # next checkpoint keeps the run numbers of the completed steps
+        resumed_tuning.save_checkpoint(3)
+        self.assertEqual(resumed_tuning.step_run_numbers, [10, 11, 12])
+
+    def test_changed_configuration(self):
+        self.save_tuning_results(self.get_tuning(run_number=10))
+        # tuning parameters
+        tuning = self.get_tuning(run_number=12)
+        tuning.target_threshold += 1
+        self.assertEqual(tuning.load_checkpoint(), 0)
+        # initial FE configuration
+        tuning = self.get_tuning(run_number=12)
+        tuning.register.set_pixel_register_value('FDAC', 0)
+        tuning.initial_configuration_hash = tuning.get_configuration_hash()
+        self.assertEqual(tuning.load_checkpoint(), 0)
+        self.assertEqual(tuning.register_utils.configured, 0)
+        self.assertEqual(tuning.register.get_global_register_value('Vthin_AltFine'), self.get_tuning(run_number=12).register.get_global_register_value('Vthin_AltFine'))  # not loaded
+        # chip ID
+        self.assertEqual(self.get_tuning(run_number=12, chip_address=1).load_checkpoint(), 0)
+        self.assertEqual(self.get_tuning(run_number=12).load_checkpoint(), 2)
+
+    def test_no_checkpoint(self):
+        self.assertEqual(self.get_tuning(run_number=1).load_checkpoint(), 0)
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestTuningCheckpoint)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -4,6 +4,8 @@ import datetime
 import Queue
 import collections
 import itertools
+from types import ModuleType
+from importlib import import_module
 # import array
 import numpy as np
 # from bitarray import bitarray
@@ -309,6 +311,30 @@ def str2bool(value):
         return bool(value)
 
 
+class LazyModule(ModuleType):
+    '''Module which is imported on first attribute access.
+
+    Deferring the import of heavy modules (e.g. plotting) until they are used.
+
+    Usage
+    -----
+    plotting = LazyModule('pybar.analysis.plotting.plotting')
+    '''
+    def __init__(self, name):
+        super(LazyModule, self).__init__(name)
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, name):
+        if self._module is None:
+            self.__dict__['_module'] = import_module(self.__name__)
+        return getattr(self._module, name)
+
+    def __dir__(self):
+        if self._module is None:
+            self.__dict__['_module'] = import_module(self.__name__)
+        return dir(self._module)
+
+
 #-----------------------------------------------------------------
 if __name__ == "__main__":
     # ~ print list(flatten([[1, 2], (4, 5), [5], [6, 6, 8]]))